@@ -216,19 +216,23 @@ class AgencyAgent(log.LogProxy, log.Logger, manhole.Manhole,
             factory, self.snapshot())
 
     def check_if_should_snapshot(self, force=False):
-        if force or self._entries_since_snapshot > MIN_ENTRIES_PER_SNAPSHOT:
+        # Forced snapshots are the ones done when the journal is rotated
+        # or the agent terminates, they must not depend on a previous one.
+        if force:
+            self.journal_snapshot(full=True)
+        elif self._entries_since_snapshot > MIN_ENTRIES_PER_SNAPSHOT:
             self.journal_snapshot()
         else:
             self.log('Skipping snapshot, number of entries %d < %d',
                      self._entries_since_snapshot, MIN_ENTRIES_PER_SNAPSHOT)
 
-    def journal_snapshot(self):
+    def journal_snapshot(self, full=False):
         # Remove all the entries for the agent from  the registry,
         # so that snapshot contains full objects not just the references
         agent_id = self._descriptor.doc_id
         self._entries_since_snapshot = 0
         self.agency.journal_agent_snapshot(
-            agent_id, self._instance_id, self.snapshot_agent())
+            agent_id, self._instance_id, self.snapshot_agent(), full=full)
 
     def journal_protocol_created(self, *args, **kwargs):
         self.agency.journal_protocol_created(self._descriptor.doc_id,
@@ -712,6 +716,7 @@ class AgencyAgent(log.LogProxy, log.Logger, manhole.Manhole,
         self.debug("Revision received: %s, deleted flag: %s, "
                    "current revision: %s", rev, deleted,
                    self._descriptor.rev)
+        self.agency.descriptor_changed(self)
         return self.terminate_hard()
 
     def _configuration_changed(self, doc_id, rev, deleted, own_change):
@@ -768,6 +773,7 @@ class AgencyAgent(log.LogProxy, log.Logger, manhole.Manhole,
         def saved(desc, result, d):
             self.log("Updating descriptor: %r", desc)
             self._descriptor = desc
+            self.agency.descriptor_changed(self)
             d.callback(result)
 
         def error_handler(failure, d):
@@ -1065,6 +1071,8 @@ class Agency(log.LogProxy, log.Logger, manhole.Manhole,
         common.ConnectionManager.__init__(self)
 
         self._agents = []
+        # incremented every time an agent is registered or unregistered
+        self._agents_generation = 0
 
         self.registry = weakref.WeakValueDictionary()
         # IJournaler
@@ -1129,6 +1137,11 @@ class Agency(log.LogProxy, log.Logger, manhole.Manhole,
     def iter_agents(self):
         return iter(self._agents)
 
+    def get_agents_generation(self):
+        '''Returns a number changing every time an agent is registered
+        or unregistered, even when an agent is restarted.'''
+        return self._agents_generation
+
     def get_agency(self, agency_id):
         if agency_id == self.agency_id:
             return self
@@ -1208,11 +1221,16 @@ class Agency(log.LogProxy, log.Logger, manhole.Manhole,
 
     def register_agent(self, medium):
         self._agents.append(medium)
+        self._agents_generation += 1
+
+    def descriptor_changed(self, medium):
+        '''Called when the descriptor of a registered agent changed.'''
 
     def unregister_agent(self, medium):
         agent_id = medium.get_descriptor().doc_id
         self.debug('Unregistering agent id: %r', agent_id)
         self._agents.remove(medium)
+        self._agents_generation += 1
 
         # FIXME: This shouldn't be necessary! Here we are manually getting
         # rid of things which should just be garbage collected (self.registry
@@ -1298,11 +1316,19 @@ class Agency(log.LogProxy, log.Logger, manhole.Manhole,
 
     def journal_agent_deleted(self, agent_id, instance_id):
         self.journal_agency_entry(agent_id, instance_id, 'agent_deleted')
+        self._jourconn.forget_snapshot(agent_id, instance_id)
 
-    def journal_agent_snapshot(self, agent_id, instance_id, snapshot):
+    def journal_agent_snapshot(self, agent_id, instance_id, snapshot,
+                               full=True):
         self.log("Storing agents snapshot. Agent_id: %r, Instance_id: %r.",
                  agent_id, instance_id)
-        self._jourconn.snapshot(agent_id, instance_id, snapshot)
+        self._jourconn.snapshot(agent_id, instance_id, snapshot, full=full)
+
+    @manhole.expose()
+    def get_snapshot_stats(self):
+        '''Gives the counters of the full and delta snapshots journaled
+        and the estimated bytes the deltas saved.'''
+        return self._jourconn.get_snapshot_stats()
 
     ### IExternalizer Methods ###
 
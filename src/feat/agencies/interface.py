@@ -234,6 +234,9 @@ class IRecord(Interface):
          - result             - serialized result of the call
          - side_effects       - serialized list of side effects produced
                                 by the call
+        The serialized values may also be given before the banana encoding,
+        wrapped in L{feat.agencies.journaler.Unencoded}, the journaler
+        encodes them before the entry is written.
         '''
 
 
@@ -250,9 +253,11 @@ class IJournalerConnection(Interface):
         @rtype: IAgencyJournalEntry
         """
 
-    def snapshot(agent_id, instance_id, snapshot):
+    def snapshot(agent_id, instance_id, snapshot, full=True):
         """
         Create special IAgencyJournalEntry representing agent snapshot.
+        Unless full is True, the entry may only hold the differences
+        from the last full snapshot of the agent.
         """
 
 
@@ -287,7 +292,7 @@ class IJournalReader(Interface):
         @rtype: Deferred([L{feat.agencies.journal.History}])
         '''
 
-    def get_entries(history):
+    def get_entries(history, start_date, limit, cursor):
         '''
         Fetches the journal entries for given history. History object contains
         the information about the agent_id and instance_id.
@@ -309,7 +314,10 @@ class IJournalReader(Interface):
 
         @param history: History object interesting us.
         @type history: L{feat.agencies.journal.History}
-        @rtype: Deferred(list)
+        @param start_date: optional epoch time of the first entry
+        @param limit: maximum number of entries to fetch
+        @param cursor: cursor of the previous page of the entries
+        @rtype: Deferred(L{feat.agencies.journaler.Page})
         '''
 
     def get_bare_journal_entries(limit):
@@ -331,7 +339,7 @@ class IJournalReader(Interface):
         "from the top of the table" meaning with lowest timestamp.
         '''
 
-    def get_log_entries(start_date, end_data, filters, limit):
+    def get_log_entries(start_date, end_data, filters, limit, cursor):
         '''
         Fetches the log entries for the given period of time and filters.
         All parameters are optional, by default this query will return
@@ -357,7 +365,9 @@ class IJournalReader(Interface):
                   for the filter. If multiple filters are specified they are
                   combined with the OR operator in the query.
         @param limit: maxium number of log entries to fetch
-        @rtype: Deferred
+        @param cursor: cursor of the previous page of the entries, the
+                       pages are fetched in the order of the timestamps
+        @rtype: Deferred(L{feat.agencies.journaler.Page})
         '''
 
     def get_log_hostnames(start_date, end_date):
@@ -23,12 +23,14 @@
 # vi:si:et:sw=4:sts=4:ts=4
 import socket
 import sqlite3
+import zlib
 import operator
 import types
 import sys
 
 from zope.interface import implements
 from twisted.enterprise import adbapi
+from twisted.internet import threads
 from twisted.spread import pb
 from twisted.python import log as twisted_log, failure
 
@@ -36,7 +38,7 @@ from feat.common import (log, text_helper, defer,
                          formatable, enum, decorator, time, manhole,
                          fiber, signal, error, connstr)
 from feat.agencies import common
-from feat.common.serialization import banana
+from feat.common.serialization import banana, sexp
 from feat.extern.log import log as flulog
 
 from feat.interface.journal import IJournalSideEffect, IJournalEntry
@@ -57,14 +59,42 @@ class State(enum.Enum):
 class EntriesCache(object):
     '''
     Helper class storing the data and giving the back in transactional way.
+    Entries appended as not ready are kept in order but not given back,
+    neither are the ones following them, until they are marked ready.
     '''
 
     def __init__(self):
         self._cache = list()
         self._fetched = None
+        # ids of the entries which are not ready yet
+        self._pending = set()
 
-    def append(self, entry):
+    def append(self, entry, ready=True):
         self._cache.append(entry)
+        if not ready:
+            self._pending.add(id(entry))
+
+    def set_ready(self, entry):
+        self._pending.discard(id(entry))
+
+    def remove(self, entry):
+        '''
+        Removes the entry which is not ready, it is never given by fetch().
+        '''
+        if id(entry) not in self._pending:
+            raise ValueError("Only the entries which are not ready can be "
+                             "removed")
+        self._pending.discard(id(entry))
+        for index in xrange(len(self._cache) - 1, -1, -1):
+            if self._cache[index] is entry:
+                del self._cache[index]
+                break
+
+    def is_ready(self):
+        '''
+        Tells if there is something fetch() would give.
+        '''
+        return bool(self._cache) and id(self._cache[0]) not in self._pending
 
     def fetch(self):
         '''
@@ -77,6 +107,11 @@ class EntriesCache(object):
                                'not yet been applied. Not supported')
         if self._cache:
             self._fetched = len(self._cache)
+            if self._pending:
+                for index, entry in enumerate(self._cache):
+                    if id(entry) in self._pending:
+                        self._fetched = index
+                        break
         return self._cache[0:self._fetched]
 
     def commit(self):
@@ -103,6 +138,110 @@ class EntriesCache(object):
         return len(self._cache)
 
 
+# Fields of the journal entries holding banana encoded values
+ENCODED_FIELDS = ('args', 'kwargs', 'result', 'side_effects')
+
+
+class Unencoded(object):
+    '''
+    Value of a journal entry already converted by the serializer but
+    still waiting for the banana encoding, see L{Journaler.insert_entry}.
+    '''
+
+    __slots__ = ('value', )
+
+    def __init__(self, value):
+        self.value = value
+
+
+def encode_entry(codec, entry):
+    for key in ENCODED_FIELDS:
+        value = entry.get(key)
+        if isinstance(value, Unencoded):
+            entry[key] = codec.encode(value.value)
+    return entry
+
+
+class EncodingWorker(log.Logger):
+    '''
+    Banana encodes the journal entries in a thread instead of the reactor.
+    Whatever is queued is encoded by a single job, and there is only one
+    job running at a time, so the entries are encoded in the order they
+    came. When max_pending entries are already waiting the new ones
+    are encoded in place, slowing the producers down instead of letting
+    the queue grow.
+    '''
+
+    max_pending = 1000
+
+    def __init__(self, logger, callback, errback):
+        log.Logger.__init__(self, logger)
+        # called in the reactor thread with every encoded entry
+        self._callback = callback
+        # called in the reactor thread with the entries failing to encode
+        # and the failure, they are dropped
+        self._errback = errback
+        self._queue = list()
+        self._running = 0
+        # codecs keep state, each thread has its own
+        self._codec = banana.BananaCodec()
+        self._thread_codec = banana.BananaCodec()
+
+    def encode(self, entry):
+        if len(self._queue) + self._running >= self.max_pending:
+            if self._encode_in_place(entry):
+                self._callback(entry)
+            return
+        self._queue.append(entry)
+        if not self._running:
+            self._start()
+
+    ### private ###
+
+    def _start(self):
+        batch, self._queue = self._queue, list()
+        self._running = len(batch)
+        d = threads.deferToThread(self._encode_batch, batch)
+        d.addErrback(self._encoding_failed, batch)
+        d.addBoth(self._batch_encoded)
+
+    def _encode_batch(self, batch):
+        for entry in batch:
+            encode_entry(self._thread_codec, entry)
+        return batch
+
+    def _encode_in_place(self, entry):
+        try:
+            encode_entry(self._codec, entry)
+        except Exception:
+            fail = failure.Failure()
+            error.handle_failure(self, fail, "Failed encoding the journal "
+                                 "entry %s, dropping it",
+                                 entry.get('function_id'))
+            self._errback(entry, fail)
+            return False
+        return True
+
+    def _encoding_failed(self, fail, batch):
+        error.handle_failure(self, fail, "Failed encoding %d journal entries "
+                             "in a thread, encoding them in place",
+                             len(batch))
+        return [x for x in batch if self._encode_in_place(x)]
+
+    def _batch_encoded(self, batch):
+        self._running = 0
+        try:
+            if isinstance(batch, failure.Failure):
+                error.handle_failure(self, batch, "Failed passing the "
+                                     "encoded journal entries")
+            else:
+                for entry in batch:
+                    self._callback(entry)
+        finally:
+            if self._queue:
+                self._start()
+
+
 @decorator.parametrized_function
 def in_state(func, *states):
 
@@ -125,7 +264,7 @@ class Journaler(log.Logger, common.StateMachineMixin, manhole.Manhole):
     log_category = 'journaler'
 
     def __init__(self, on_rotate_cb=None, on_switch_writer_cb=None,
-                 hostname=None):
+                 hostname=None, encode_in_thread=False):
         log.Logger.__init__(self, log.get_default() or self)
 
         common.StateMachineMixin.__init__(self, State.disconnected)
@@ -133,6 +272,11 @@ class Journaler(log.Logger, common.StateMachineMixin, manhole.Manhole):
         self._flush_task = None
         self._cache = EntriesCache()
         self._notifier = defer.Notifier()
+        self._codec = banana.BananaCodec()
+        self._encoder = None
+        if encode_in_thread:
+            self._encoder = EncodingWorker(self, self._entry_encoded,
+                                           self._entry_failed)
 
         self._on_rotate_cb = on_rotate_cb
         self._on_switch_writer_cb = on_switch_writer_cb
@@ -274,6 +418,15 @@ class Journaler(log.Logger, common.StateMachineMixin, manhole.Manhole):
         return Record(self)
 
     def insert_entry(self, **data):
+        if any(isinstance(data.get(key), Unencoded)
+               for key in ENCODED_FIELDS):
+            if self._encoder is not None:
+                self._cache.append(data, ready=False)
+                d = self._notifier.wait(('encoded', id(data)))
+                d.addCallback(defer.drop_param, self._notifier.wait, 'flush')
+                self._encoder.encode(data)
+                return d
+            encode_entry(self._codec, data)
         self._cache.append(data)
         self._schedule_flush()
         return self._notifier.wait('flush')
@@ -381,9 +534,19 @@ class Journaler(log.Logger, common.StateMachineMixin, manhole.Manhole):
             self._cache.commit()
         self._flush_task = None
         self._notifier.callback('flush', None)
-        if len(self._cache) > 0:
+        if self._cache.is_ready():
             self._schedule_flush()
 
+    def _entry_encoded(self, entry):
+        self._cache.set_ready(entry)
+        self._schedule_flush()
+        self._notifier.callback(('encoded', id(entry)), None)
+
+    def _entry_failed(self, entry, fail):
+        self._cache.remove(entry)
+        self._schedule_flush()
+        self._notifier.errback(('encoded', id(entry)), fail)
+
     def _flush_error(self, fail):
         self._cache.rollback()
         error.handle_failure(self, fail,
@@ -491,16 +654,53 @@ class BrokerProxyWriter(log.Logger, common.StateMachineMixin):
         self._set_journaler(None)
 
 
+_INSERT_ENTRY = ("INSERT INTO entries "
+                 "VALUES (null, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)")
+_INSERT_LOG = "INSERT INTO logs VALUES (null, ?, ?, ?, ?, ?, ?, ?)"
+
+
 class SqliteWriter(log.Logger, log.LogProxy, common.StateMachineMixin):
 
 
     implements(IJournalWriter, IJournalReader)
 
+    # settings applied to the connections of the file based journals,
+    # WAL with NORMAL synchronization only syncs at the checkpoints
+    journal_mode = 'WAL'
+    synchronous = 'NORMAL'
+
+    # blobs of the journal entries which are subject to compression
+    compressed_fields = ('args', 'kwargs', 'side_effects', 'result')
+    compression_level = 1
+    # blobs smaller than this are not worth compressing
+    compression_threshold = 128
+
+    # number of entries removed in a single transaction by delete_top_*()
+    delete_batch_size = 1000
+
+    # Secondary indexes, they are added to the journals created by
+    # the previous versions when they are opened.
+    indexes = [
+        "CREATE INDEX IF NOT EXISTS history_idx ON entries(history_id)",
+        "CREATE INDEX IF NOT EXISTS instance_idx ON "
+        "histories(agent_id, instance_id)",
+        "CREATE INDEX IF NOT EXISTS entries_history_timestamp_idx ON "
+        "entries(history_id, timestamp)",
+        "CREATE INDEX IF NOT EXISTS entries_timestamp_idx ON "
+        "entries(timestamp)",
+        "CREATE INDEX IF NOT EXISTS logs_timestamp_idx ON logs(timestamp)",
+        "CREATE INDEX IF NOT EXISTS logs_category_idx ON "
+        "logs(category, log_name, timestamp)"]
+
     def __init__(self, logger, filename=":memory:", encoding=None,
-                 hostname=None):
+                 hostname=None, compression=None):
         '''
         @param encoding: Optional encoding to be used for blob fields.
         @type encoding: Should be a valid parameter for str.encode() method.
+        @param compression: Optional compression of the serialized
+                            arguments, side effects and result of the
+                            journal entries. The only supported value
+                            is 'zlib'.
         @param filename: File to use for entries. Defaults to :memory:
         @param logger: ILogger to use
         '''
@@ -508,7 +708,11 @@ class SqliteWriter(log.Logger, log.LogProxy, common.StateMachineMixin):
         log.LogProxy.__init__(self, logger)
         common.StateMachineMixin.__init__(self, State.disconnected)
 
+        if compression not in (None, 'zlib'):
+            raise ValueError("Unknown compression %r" % (compression, ))
+
         self._encoding = encoding
+        self._compression = compression
         self._db = None
         self._filename = filename
         self._hostname = hostname
@@ -526,6 +730,7 @@ class SqliteWriter(log.Logger, log.LogProxy, common.StateMachineMixin):
         self.debug("Initiating sqlite journal writer.")
         self._db = adbapi.ConnectionPool('sqlite3', self._filename,
                                          cp_min=1, cp_max=1, cp_noisy=True,
+                                         cp_openfun=self._configure_connection,
                                          check_same_thread=False,
                                          timeout=10)
         self._install_sighup()
@@ -578,7 +783,7 @@ class SqliteWriter(log.Logger, log.LogProxy, common.StateMachineMixin):
                entries.timestamp
           FROM entries
           LEFT JOIN histories ON histories.id = entries.history_id
-          ORDER BY entries.timestamp ASC
+          ORDER BY entries.timestamp, entries.id
           LIMIT ?""")
         d = self._db.runQuery(command, (limit, ))
         d.addCallback(self._decode, entry_type='journal')
@@ -586,17 +791,10 @@ class SqliteWriter(log.Logger, log.LogProxy, common.StateMachineMixin):
 
     @in_state(State.connected)
     def delete_top_journal_entries(self, num):
-        command = text_helper.format_block("""
-        DELETE FROM entries
-        WHERE id IN (
-           SELECT id FROM entries
-           ORDER BY timestamp, rowid
-           LIMIT ?)
-        """)
-        return self._db.runQuery(command, (num, ))
+        return self._db.runWithConnection(self._delete_top, 'entries', num)
 
     @in_state(State.connected)
-    def get_entries(self, history, start_date=0, limit=None):
+    def get_entries(self, history, start_date=0, limit=None, cursor=None):
         if not isinstance(history, History):
             raise AttributeError(
                 'First paremeter is expected to be History instance, got %r'
@@ -613,22 +811,30 @@ class SqliteWriter(log.Logger, log.LogProxy, common.StateMachineMixin):
                entries.kwargs,
                entries.side_effects,
                entries.result,
-               entries.timestamp
+               entries.timestamp,
+               entries.id
           FROM entries
           LEFT JOIN histories ON histories.id = entries.history_id
           WHERE entries.history_id = ?""")
+        params = (history.history_id, )
         if start_date:
-            command += " AND entries.timestamp >= %s" % (start_date, )
-        command += " ORDER BY entries.rowid ASC"
+            command += " AND entries.timestamp >= ?"
+            params += (start_date, )
+        if cursor is not None:
+            command += " AND entries.id > ?"
+            params += (cursor, )
+        command += " ORDER BY entries.id ASC"
         if limit:
-            command += " LIMIT %s" % (limit, )
-        d = self._db.runQuery(command, (history.history_id, ))
-        d.addCallback(self._decode, entry_type='journal')
+            command += " LIMIT ?"
+            params += (limit, )
+        d = self._db.runQuery(command, params)
+        d.addCallback(self._paginate, 'journal', limit,
+                      operator.itemgetter(-1))
         return d
 
     @in_state(State.connected)
     def get_log_entries(self, start_date=None, end_date=None, filters=list(),
-                        limit=None):
+                        limit=None, cursor=None):
         '''
         See feat.agencies.interface.IJournalReader.get_log_entres
         '''
@@ -640,47 +846,56 @@ class SqliteWriter(log.Logger, log.LogProxy, common.StateMachineMixin):
                logs.log_name,
                logs.file_path,
                logs.line_num,
-               logs.timestamp
+               logs.timestamp,
+               logs.id
         FROM logs
         WHERE 1
         ''')
         query = self._add_timestamp_condition_sql(query, start_date, end_date)
+        params = tuple()
 
         def transform_filter(filter):
+            params = tuple()
             level = filter.get('level', None)
             category = filter.get('category', None)
             name = filter.get('name', None)
             if level is None:
                 raise AttributeError("level is mandatory parameter.")
-            resp = "(logs.level <= %d" % (int(level), )
+            resp = "(logs.level <= ?"
+            params += (int(level), )
             if category is not None:
-                resp += " AND logs.category == '%s'" % (category, )
+                resp += " AND logs.category = ?"
+                params += (category, )
             if name is not None:
-                resp += " AND logs.log_name == '%s'" % (name, )
+                resp += " AND logs.log_name = ?"
+                params += (name, )
             resp += ')'
-            return resp
+            return resp, params
 
-        filter_strings = map(transform_filter, filters)
-        if filter_strings:
+        parsed_filters = map(transform_filter, filters)
+        if parsed_filters:
+            filter_strings = [x[0] for x in parsed_filters]
             query += " AND (%s)\n" % (' OR '.join(filter_strings), )
-        query += " ORDER BY logs.timestamp, rowid"
+            for _, filter_params in parsed_filters:
+                params += filter_params
+        if cursor is not None:
+            # keyset pagination, the order is given by the timestamp index
+            query += (" AND (logs.timestamp > ? OR "
+                      "(logs.timestamp = ? AND logs.id > ?))\n")
+            params += (cursor[0], cursor[0], cursor[1])
+        query += " ORDER BY logs.timestamp, logs.id"
         if limit:
-            query += " LIMIT %s" % (limit, )
+            query += " LIMIT ?"
+            params += (limit, )
 
-        d = self._db.runQuery(query)
-        d.addCallback(self._decode, entry_type='log')
+        d = self._db.runQuery(query, params)
+        d.addCallback(self._paginate, 'log', limit,
+                      operator.itemgetter(-2, -1))
         return d
 
     @in_state(State.connected)
     def delete_top_log_entries(self, num):
-        command = text_helper.format_block("""
-        DELETE FROM logs
-        WHERE id IN (
-           SELECT id FROM logs
-           ORDER BY timestamp, rowid
-           LIMIT ?)
-        """)
-        return self._db.runQuery(command, (num, ))
+        return self._db.runWithConnection(self._delete_top, 'logs', num)
 
     @in_state(State.connected)
     def get_log_hostnames(self, start_date=None, end_date=None):
@@ -763,16 +978,54 @@ class SqliteWriter(log.Logger, log.LogProxy, common.StateMachineMixin):
             query += "  AND logs.timestamp <= %d\n" % (int(end_date), )
         return query
 
+    def _paginate(self, rows, entry_type, limit, get_cursor):
+        cursor = None
+        if limit and len(rows) == limit:
+            cursor = get_cursor(rows[-1])
+        return Page(self._decode(rows, entry_type), cursor)
+
+    def _delete_top(self, connection, table, num):
+        '''
+        Deletes the oldest entries in batches, each in its own transaction.
+        The batches are selected through the timestamp index of the table.
+
+        BEWARE: This method runs in a thread.
+        '''
+        command = text_helper.format_block("""
+        DELETE FROM %s
+        WHERE id IN (
+           SELECT id FROM %s
+           ORDER BY timestamp, id
+           LIMIT ?)
+        """) % (table, table)
+        while num > 0:
+            batch = min(num, self.delete_batch_size)
+            cursor = connection.cursor()
+            cursor.execute(command, (batch, ))
+            connection.commit()
+            if cursor.rowcount < batch:
+                break
+            num -= batch
+
     def _reset_history_id_cache(self):
         # (agent_id, instance_id, ) -> history_id
         self._history_id_cache = dict()
 
+    def _configure_connection(self, connection):
+        # BEWARE: This method runs in a thread.
+        if self._filename == ':memory:':
+            return
+        connection.execute('PRAGMA journal_mode=%s' % (self.journal_mode, ))
+        connection.execute('PRAGMA synchronous=%s' % (self.synchronous, ))
+
     def _sighup_handler(self, signum, frame):
         self.debug("Received SIGHUP, reopening the journal.")
         if self._journaler:
             time.call_next(self._journaler.on_rotate)
-        self.close()
-        self.initiate()
+        # The new file can only be opened after the old one is closed,
+        # otherwise both connections would share the write-ahead log.
+        d = self.close()
+        d.addCallback(defer.drop_param, self.initiate)
 
     def _install_sighup(self):
         if self._sighup_installed:
@@ -801,26 +1054,34 @@ class SqliteWriter(log.Logger, log.LogProxy, common.StateMachineMixin):
         and appends information about entry type to the rows.
         '''
 
+        if entry_type == 'log':
+            mapping = ['hostname', 'message', 'level', 'category',
+                       'log_name', 'file_path', 'line_num', 'timestamp']
+        elif entry_type == 'journal':
+            mapping = ['agent_id', 'instance_id', 'journal_id', 'function_id',
+                       'fiber_id', 'fiber_depth', 'args', 'kwargs',
+                       'side_effects', 'result', 'timestamp']
+        else:
+            raise ValueError('Unknown entry_type %r' % (entry_type, ))
+
+        compressed = set()
+        if self._compression and entry_type == 'journal':
+            compressed = set(mapping.index(x)
+                             for x in self.compressed_fields)
+
         def decode_blobs(row):
             row = list(row)
             for index, value in zip(range(len(row)), row):
                 if isinstance(value, types.BufferType):
                     value = str(value)
+                    if index in compressed:
+                        value = self._decompress(value)
                     if self._encoding:
                         value = value.decode(self._encoding)
                     row[index] = value
             return row
 
         decoded = map(decode_blobs, entries)
-        if entry_type == 'log':
-            mapping = ['hostname', 'message', 'level', 'category',
-                       'log_name', 'file_path', 'line_num', 'timestamp']
-        elif entry_type == 'journal':
-            mapping = ['agent_id', 'instance_id', 'journal_id', 'function_id',
-                       'fiber_id', 'fiber_depth', 'args', 'kwargs',
-                       'side_effects', 'result', 'timestamp']
-        else:
-            raise ValueError('Unknown entry_type %r' % (entry_type, ))
 
         def parse(row, mapping, entry_type):
             resp = dict(zip(mapping, row))
@@ -871,18 +1132,45 @@ class SqliteWriter(log.Logger, log.LogProxy, common.StateMachineMixin):
                                    "in the journal")
                         safe = "".encode(self._encoding)
 
+            if self._compression and key in self.compressed_fields:
+                safe = self._compress(safe)
+
             result[key] = sqlite3.Binary(safe)
 
         return result
 
+    def _compress(self, value):
+        # The blobs are prefixed with a flag telling if they are compressed.
+        # The small ones are usually not worth it and are stored as they are.
+        if len(value) >= self.compression_threshold:
+            compressed = zlib.compress(value, self.compression_level)
+            if len(compressed) < len(value):
+                return 'z' + compressed
+        return '-' + value
+
+    def _decompress(self, value):
+        if value[:1] == 'z':
+            return zlib.decompress(value[1:])
+        return value[1:]
+
     def _check_schema(self):
         d = self._db.runQuery(
             'SELECT value FROM metadata WHERE name = "encoding"')
         d.addCallbacks(self._got_encoding, self._create_schema)
+        d.addCallback(defer.drop_param, self._load_compression)
         d.addCallback(defer.drop_param, self._load_hostname)
+        d.addCallback(defer.drop_param, self._create_indexes)
         d.addCallback(defer.drop_param, self._initiated_ok)
         return d
 
+    def _create_indexes(self):
+
+        def run_all(connection):
+            for command in self.indexes:
+                connection.execute(command)
+
+        return self._db.runWithConnection(run_all)
+
     def _got_encoding(self, res):
         encoding = res[0][0]
         if encoding == 'None':
@@ -894,6 +1182,24 @@ class SqliteWriter(log.Logger, log.LogProxy, common.StateMachineMixin):
                          self._encoding, encoding, encoding)
         self._encoding = encoding
 
+    def _load_compression(self):
+
+        def callback(res):
+            # journals created before the compression was introduced
+            # don't have the entry in the metadata
+            compression = res[0][0] if res else None
+            if compression == 'None':
+                compression = None
+            if compression != self._compression:
+                self.debug("Using the compression of the existing "
+                           "journal: %r", compression)
+            self._compression = compression
+
+        d = self._db.runQuery(
+            'SELECT value FROM metadata WHERE name = "compression"')
+        d.addCallback(callback)
+        return d
+
     def _load_hostname(self):
 
         def callback(res):
@@ -950,12 +1256,6 @@ class SqliteWriter(log.Logger, log.LogProxy, common.StateMachineMixin):
               name VARCHAR(100),
               value VARCHAR(100)
             )
-            """),
-            text_helper.format_block("""
-            CREATE INDEX history_idx ON entries(history_id)
-            """),
-            text_helper.format_block("""
-            CREATE INDEX instance_idx ON histories(agent_id, instance_id)
             """)]
 
         def run_all(connection, commands):
@@ -965,6 +1265,7 @@ class SqliteWriter(log.Logger, log.LogProxy, common.StateMachineMixin):
 
         insert_meta = "INSERT INTO metadata VALUES('%s', '%s')"
         commands += [insert_meta % (u'encoding', self._encoding, )]
+        commands += [insert_meta % (u'compression', self._compression, )]
 
         hostname = self._hostname
         if hostname is None:
@@ -973,7 +1274,14 @@ class SqliteWriter(log.Logger, log.LogProxy, common.StateMachineMixin):
             hostname = socket.gethostname()
         commands += [insert_meta % (u'hostname', hostname, )]
 
-        self._reset_history_id_cache()
+        # After the rotation the histories known so far are recreated with
+        # the same ids, so that the cache of history ids stays valid.
+        insert_history = "INSERT INTO histories VALUES(%d, '%s', %d)"
+        for (agent_id, instance_id), history_id in sorted(
+            self._history_id_cache.iteritems(), key=operator.itemgetter(1)):
+            commands += [insert_history % (history_id,
+                                           agent_id.replace("'", "''"),
+                                           instance_id)]
 
         d = self._db.runWithConnection(run_all, commands)
         d.addErrback(lambda fail: error.handle_failure(
@@ -988,41 +1296,37 @@ class SqliteWriter(log.Logger, log.LogProxy, common.StateMachineMixin):
 
     def _perform_inserts(self, cache):
 
-        def do_insert_entry(connection, history_id, data):
-            command = text_helper.format_block("""
-            INSERT INTO entries VALUES (null, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """)
-            connection.execute(
-                command, (history_id,
-                          data['journal_id'], data['function_id'],
-                          data['fiber_id'], data['fiber_depth'],
-                          data['args'], data['kwargs'],
-                          data['side_effects'], data['result'],
-                          int(data['timestamp'])))
-
-        def do_insert_log(connection, data):
-            command = text_helper.format_block("""
-            INSERT INTO logs VALUES (null, ?, ?, ?, ?, ?, ?, ?)
-            """)
-            connection.execute(
-                command, (data['message'], int(data['level']),
-                          data['category'], data['log_name'],
-                          data['file_path'], data['line_num'],
-                          int(data['timestamp'])))
-
         def transaction(connection, cache):
             entries = cache.fetch()
             if not entries:
                 return
             try:
-                entries = map(self._encode, entries)
+                journal_rows = list()
+                log_rows = list()
                 for data in entries:
+                    data = self._encode(data)
                     if data['entry_type'] == 'journal':
                         history_id = self._get_history_id(
                             connection, data['agent_id'], data['instance_id'])
-                        do_insert_entry(connection, history_id, data)
+                        journal_rows.append(
+                            (history_id,
+                             data['journal_id'], data['function_id'],
+                             data['fiber_id'], data['fiber_depth'],
+                             data['args'], data['kwargs'],
+                             data['side_effects'], data['result'],
+                             int(data['timestamp'])))
                     elif data['entry_type'] == 'log':
-                        do_insert_log(connection, data)
+                        log_rows.append(
+                            (data['message'], int(data['level']),
+                             data['category'], data['log_name'],
+                             data['file_path'], data['line_num'],
+                             int(data['timestamp'])))
+                # The statements are the same for all the batches, so they
+                # are prepared once and reused by the statement cache.
+                if journal_rows:
+                    connection.executemany(_INSERT_ENTRY, journal_rows)
+                if log_rows:
+                    connection.executemany(_INSERT_LOG, log_rows)
                 cache.commit()
             except Exception:
                 cache.rollback()
@@ -1081,9 +1385,31 @@ class Record(object):
         self._journaler.insert_entry(**data)
 
 
+class SnapshotBase(object):
+    '''
+    Last full snapshot of an agent, the delta snapshots are relative to it.
+    '''
+
+    def __init__(self, tree):
+        self.tree = tree
+        self.deltas = 0
+        self._size = None
+
+    @property
+    def size(self):
+        if self._size is None:
+            self._size = sexp.tree_size(self.tree)
+        return self._size
+
+
 class JournalerConnection(log.Logger, log.LogProxy):
     implements(IJournalerConnection)
 
+    # How many delta snapshots can follow a full one
+    snapshot_deltas = 10
+    # Deltas bigger than this part of the full snapshot are not worth it
+    max_delta_ratio = 0.5
+
     def __init__(self, journaler, externalizer):
         log.LogProxy.__init__(self, journaler)
         log.Logger.__init__(self, self)
@@ -1092,6 +1418,12 @@ class JournalerConnection(log.Logger, log.LogProxy):
         self.snapshot_serializer = banana.Serializer()
         self.journaler = IJournaler(journaler)
 
+        # (agent_id, instance_id) -> SnapshotBase
+        self._snapshots = dict()
+        self._snapshot_stats = dict(full_snapshots=0, delta_snapshots=0,
+                                    full_snapshot_bytes=0,
+                                    delta_snapshot_bytes=0, saved_bytes=0)
+
     ### IJournalerConnection ###
 
     def new_entry(self, agent_id, instance_id, journal_id, function_id,
@@ -1102,11 +1434,53 @@ class JournalerConnection(log.Logger, log.LogProxy):
             journal_id, function_id, *args, **kwargs)
         return entry
 
-    def snapshot(self, agent_id, instance_id, snapshot):
+    def snapshot(self, agent_id, instance_id, snapshot, full=True):
+        key = (agent_id, instance_id)
+        base = self._snapshots.pop(key, None)
+        try:
+            tree = self.snapshot_serializer.convert_unencoded((snapshot, ))
+        except TypeError:
+            # the entry will store the error
+            self._commit_snapshot(agent_id, instance_id, 'snapshot',
+                                  value=snapshot)
+            return
+
+        if (base is not None and not full
+            and base.deltas < self.snapshot_deltas):
+            delta = sexp.diff_tree(base.tree, tree)
+            size = sexp.tree_size(delta)
+            if size <= base.size * self.max_delta_ratio:
+                base.deltas += 1
+                self._snapshots[key] = base
+                self._snapshot_stats['delta_snapshots'] += 1
+                self._snapshot_stats['delta_snapshot_bytes'] += size
+                self._snapshot_stats['saved_bytes'] += base.size - size
+                self._commit_snapshot(agent_id, instance_id,
+                                      'snapshot_delta', value=delta)
+                return
+
+        base = SnapshotBase(tree)
+        self._snapshots[key] = base
+        self._snapshot_stats['full_snapshots'] += 1
+        self._snapshot_stats['full_snapshot_bytes'] += base.size
+        self._commit_snapshot(agent_id, instance_id, 'snapshot', tree=tree)
+
+    def forget_snapshot(self, agent_id, instance_id):
+        self._snapshots.pop((agent_id, instance_id), None)
+
+    def get_snapshot_stats(self):
+        return dict(self._snapshot_stats)
+
+    ### private ###
+
+    def _commit_snapshot(self, agent_id, instance_id, function_id,
+                         value=None, tree=None):
         record = self.journaler.prepare_record()
         entry = AgencyJournalEntry(
             self.snapshot_serializer, record, agent_id, instance_id,
-            'agency', 'snapshot', snapshot)
+            'agency', function_id, value)
+        if tree is not None:
+            entry.set_unencoded_arguments(tree)
         entry.set_result(None)
         entry.commit()
         f = entry.get_result()
@@ -1164,6 +1538,18 @@ class History(formatable.Formatable, pb.Copyable):
     formatable.field('hostname', None)
 
 
+class Page(list):
+    '''
+    Entries returned by the paginated queries. To fetch the following
+    entries pass the cursor to the next call, it is None if there are
+    no more entries to fetch.
+    '''
+
+    def __init__(self, entries, cursor=None):
+        list.__init__(self, entries)
+        self.cursor = cursor
+
+
 class AgencyJournalEntry(object):
 
     implements(IJournalEntry)
@@ -1203,6 +1589,14 @@ class AgencyJournalEntry(object):
     def get_result(self):
         return self._not_serialized['result']
 
+    def set_unencoded_arguments(self, args):
+        '''
+        Sets the arguments tuple already converted by the serializer's
+        convert_unencoded(), so they are not converted again on commit.
+        '''
+        assert self._record is not None
+        self._not_serialized['args'] = Unencoded(args)
+
     def new_side_effect(self, function_id, *args, **kwargs):
         assert self._record is not None
         record = []
@@ -1211,15 +1605,22 @@ class AgencyJournalEntry(object):
                                        function_id, *args, **kwargs)
 
     def commit(self):
+        # Only the conversion of the live values is done here, the banana
+        # encoding is left to the journaler which may do it in a thread.
         try:
-            self._data['args'] = self._serializer.convert(
-                    self._not_serialized['args'])
-            self._data['kwargs'] = self._serializer.convert(
-                    self._not_serialized['kwargs'])
-            self._data['result'] = self._serializer.freeze(
-                    self._not_serialized['result'])
-            self._data['side_effects'] = self._serializer.convert(
-                    self._data['side_effects'])
+            args = self._not_serialized['args']
+            if not isinstance(args, Unencoded):
+                args = Unencoded(self._serializer.convert_unencoded(args))
+            self._data['args'] = args
+            self._data['kwargs'] = Unencoded(
+                self._serializer.convert_unencoded(
+                    self._not_serialized['kwargs']))
+            self._data['result'] = Unencoded(
+                self._serializer.freeze_unencoded(
+                    self._not_serialized['result']))
+            self._data['side_effects'] = Unencoded(
+                self._serializer.convert_unencoded(
+                    self._data['side_effects']))
             self._record.commit(**self._data)
             self._record = None
             return self
@@ -1544,7 +1945,7 @@ class PostgresReader(log.Logger, log.LogProxy, common.StateMachineMixin,
         """)
         return self._db.runOperation(command, (num, ))
 
-    def get_entries(self, history, start_date=0, limit=None):
+    def get_entries(self, history, start_date=0, limit=None, cursor=None):
         if not self._ensure_state(State.connected):
             return
 
@@ -1556,20 +1957,23 @@ class PostgresReader(log.Logger, log.LogProxy, common.StateMachineMixin,
         command = text_helper.format_block("""
         SELECT agent_id, instance_id, journal_id, function_id, fiber_id,
                fiber_depth, args, kwargs, side_effects, result,
-               date_part('epoch', timestamp)
+               date_part('epoch', timestamp), timestamp, id
           FROM feat.entries
           WHERE agent_id = %s AND instance_id = %s""")
         params = (history.agent_id, history.instance_id)
         if start_date:
             command += " AND date_part('epoch', timestamp) >= %s"
             params += (start_date, )
+        if cursor is not None:
+            command += " AND (timestamp, entries.id) > (%s, %s)"
+            params += tuple(cursor)
 
         command += " ORDER BY timestamp, entries.id"
         if limit:
             command += " LIMIT %s"
             params += (limit, )
         d = self._db.runQuery(command, params)
-        d.addCallback(self._decode, entry_type='journal')
+        d.addCallback(self._paginate, 'journal', limit)
         return d
 
     def get_log_hostnames(self, start_date=None, end_date=None):
@@ -1585,14 +1989,14 @@ class PostgresReader(log.Logger, log.LogProxy, common.StateMachineMixin,
         return d
 
     def get_log_entries(self, start_date=None, end_date=None, filters=list(),
-                        limit=None):
+                        limit=None, cursor=None):
         if not self._ensure_state(State.connected):
             return
 
-
         query = text_helper.format_block("""
         SELECT hosts.hostname, message, level, category, log_name,
-               file_path, line_num, date_part('epoch', timestamp)
+               file_path, line_num, date_part('epoch', timestamp),
+               timestamp, logs.id
           FROM feat.logs
           LEFT JOIN feat.hosts ON logs.host_id = hosts.id
           WHERE true
@@ -1629,12 +2033,15 @@ class PostgresReader(log.Logger, log.LogProxy, common.StateMachineMixin,
             query += " AND (" + ' OR '.join(filter_strings) + ')'
             filter_params = [x[1] for x in parsed_filters]
             params += reduce(lambda x, y: x + y, filter_params)
+        if cursor is not None:
+            query += " AND (timestamp, logs.id) > (%s, %s)"
+            params += tuple(cursor)
+        query += " ORDER BY timestamp, logs.id"
         if limit:
             query += " LIMIT %s"
             params += (limit, )
-        query += " ORDER BY timestamp, logs.id"
         d = self._db.runQuery(query, params)
-        d.addCallback(self._decode, entry_type='log')
+        d.addCallback(self._paginate, 'log', limit)
         return d
 
     def delete_top_log_entries(self, num):
@@ -1707,6 +2114,13 @@ class PostgresReader(log.Logger, log.LogProxy, common.StateMachineMixin,
 
     ### private helper used by querying functions ###
 
+    def _paginate(self, rows, entry_type, limit):
+        # the rows of paginated queries end with the timestamp and id
+        cursor = None
+        if limit and len(rows) == limit:
+            cursor = tuple(rows[-1][-2:])
+        return Page(self._decode(rows, entry_type), cursor)
+
     def _decode(self, entries, entry_type):
         '''
         Takes the list of rows returned by postgres.
@@ -1768,7 +2182,7 @@ def parse_connstr(conn):
         resp = connstr.parse(conn)
         if resp['protocol'] == 'sqlite':
             klass = SqliteWriter
-            params = dict(filename=resp['host'], encoding='zip')
+            params = dict(filename=resp['host'], compression='zlib')
         elif resp['protocol'] == 'postgres':
             klass = PostgresWriter
             host, dbname = resp['host'].split('/')
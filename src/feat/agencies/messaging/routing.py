@@ -1,4 +1,4 @@
-import operator
+import bisect
 
 from zope.interface import implements
 
@@ -31,10 +31,7 @@ class Route(object):
         return Route(**new_params)
 
     def match(self, message):
-        if not isinstance(message, BaseMessage):
-            raise AttributeError("Expected BaseMessage got %r" % (message, ))
-        msg_key = (message.recipient.key, message.recipient.route)
-        return msg_key == self.key
+        return message_key(message) == self.key
 
     def __repr__(self):
         return ("<Route: key=%s, priority=%d, final=%r, sink=%s>" %
@@ -62,7 +59,8 @@ class Table(log.Logger):
     def __init__(self, logger, time_provider=None):
         log.Logger.__init__(self, logger)
 
-        self._routes = list()
+        # {(key, route): [Route]}, each list ordered by priority
+        self._routes = dict()
         self._outgoing_sink = None
 
         self._time_provider = time_provider and ITimeProvider(time_provider)
@@ -97,33 +95,40 @@ class Table(log.Logger):
         for message in to_deliver:
                 self._send_to_route(message, route)
 
-        self._routes.append(route)
-        self._fix_order()
+        routes = self._routes.setdefault(route.key, list())
+        # keep the insertion order for routes of the same priority
+        priorities = [x.priority for x in routes]
+        index = bisect.bisect_right(priorities, route.priority)
+        routes.insert(index, route)
 
     def remove_route(self, route):
+        routes = self._routes.get(route.key)
         try:
-            self._routes.remove(route)
-        except ValueError:
+            routes.remove(route)
+        except (AttributeError, ValueError):
             self.warning("Trying to remove nonexisting route: %r", route)
+            return
+        if not routes:
+            del self._routes[route.key]
 
     def remove_sink(self, sink):
-        for route in self._routes:
-            if route.owner == sink:
-                self.remove_route(route)
+        for routes in self._routes.values():
+            for route in list(routes):
+                if route.owner == sink:
+                    self.remove_route(route)
 
         if self._outgoing_sink == sink:
             self.info("Outgoing sink removed, setting to None.")
             self._outgoing_sink = None
 
     def dispatch(self, message, outgoing=True):
-
-        for route in self._routes:
-            self.log("Analizing route %r, matching=%r", route,
-                     route.match(message))
-            if route.match(message):
-                self._send_to_route(message, route)
-                if route.final:
-                    return
+        # copy, the list might get modified by the sinks we deliver to
+        routes = list(self._routes.get(message_key(message), ()))
+        for route in routes:
+            self.log("Matched route %r", route)
+            self._send_to_route(message, route)
+            if route.final:
+                return
 
         self._message_store.insert(message)
 
@@ -134,15 +139,18 @@ class Table(log.Logger):
 
     ### private ###
 
-    def _fix_order(self):
-        self._routes = sorted(self._routes,
-                              key=operator.attrgetter('priority'))
-
     def _send_to_route(self, message, route):
         message = message.clone()
         route.owner.on_message(message)
 
 
+def message_key(message):
+    '''Returns the key used for matching the message to the routes.'''
+    if not isinstance(message, BaseMessage):
+        raise AttributeError("Expected BaseMessage got %r" % (message, ))
+    return (message.recipient.key, message.recipient.route)
+
+
 class MessageStore(object):
     """
     I'm a class responsible for holding the message until they expiration
@@ -150,7 +158,10 @@ class MessageStore(object):
     """
 
     def __init__(self, time_provider):
-        self._store = container.ExpDict(time_provider)
+        self._store = container.ExpDict(time_provider,
+                                        on_expire=self._on_expire)
+        # {(key, route): set([message_id])}
+        self._index = dict()
 
     def insert(self, message):
         if not isinstance(message, BaseMessage):
@@ -160,18 +171,39 @@ class MessageStore(object):
         if message.expiration_time is not None:
             self._store.set(message.message_id, message,
                             message.expiration_time)
+            if message.message_id in self._store:
+                key = message_key(message)
+                self._index.setdefault(key, set()).add(message.message_id)
 
     def remove(self, message):
         if not isinstance(message, BaseMessage):
             raise TypeError('Expected BaseMessage got %r' % (message, ))
 
         self._store.pop(message.message_id, None)
+        self._unindex(message)
 
     def match_to_route(self, route):
         if not isinstance(route, Route):
             raise TypeError('Expected Route got %r' % (route, ))
 
-        matching = [x for x in self._store.itervalues() if route.match(x)]
+        # copy, expiring messages get removed from the index
+        message_ids = list(self._index.get(route.key, ()))
+        matching = [x for x in map(self._store.get, message_ids)
+                    if x is not None]
         if route.final:
             [self.remove(x) for x in matching]
         return matching
+
+    ### private ###
+
+    def _on_expire(self, message):
+        self._unindex(message)
+
+    def _unindex(self, message):
+        key = message_key(message)
+        message_ids = self._index.get(key)
+        if message_ids is None:
+            return
+        message_ids.discard(message.message_id)
+        if not message_ids:
+            del self._index[key]
@@ -346,17 +346,22 @@ class Backend(_BaseTunnelBackend):
     log_category = "tunneling"
 
     def __init__(self, host, port_range, version=None, registry=None,
-                 server_security_policy=None, client_security_policy=None):
+                 server_security_policy=None, client_security_policy=None,
+                 batch_delay=None, batch_size=tunnel.DEFAULT_BATCH_SIZE):
         _BaseTunnelBackend.__init__(self, version, registry)
 
         t = tunnel.Tunnel(self, port_range, self, public_host=host,
                           version=version, registry=registry,
                           server_security_policy=server_security_policy,
-                          client_security_policy=client_security_policy)
+                          client_security_policy=client_security_policy,
+                          batch_delay=batch_delay, batch_size=batch_size)
         self._tunnel = t
 
     def _post_message(self, uri, message):
-        return self._tunnel.post(uri, message)
+        expiration = None
+        if message.expiration_time is not None:
+            expiration = message.expiration_time - time.time()
+        return self._tunnel.post(uri, message, expiration)
 
     ### ITunnelBackend ###
 
@@ -3,7 +3,7 @@ import functools
 from zope.interface import implements
 from twisted.spread import pb
 
-from feat.common import log, defer, first
+from feat.common import log, defer, first, time
 from feat.common.serialization import banana
 
 from feat.agencies.messaging import routing, debug_message
@@ -29,6 +29,9 @@ class Master(log.Logger, log.LogProxy, common.ConnectionManager,
         self._messaging = None
         # routing key -> SlaveReference
         self._slaves = dict()
+        # pb.RemoteReference -> BatchDispatcher
+        self._dispatchers = dict()
+        self._stats = DispatchStats()
 
         # We do banana over banana ...
         self._serializer = banana.Serializer()
@@ -38,6 +41,7 @@ class Master(log.Logger, log.LogProxy, common.ConnectionManager,
 
     def initiate(self, messaging):
         self._messaging = messaging
+        self._broker.set_backend(self)
         self._on_connected()
 
     def binding_created(self, binding):
@@ -76,8 +80,13 @@ class Master(log.Logger, log.LogProxy, common.ConnectionManager,
         else:
             debug_message("<--M", message)
             data = self._serializer.convert(message)
-            d = [s.dispatch(data) for s in self._slaves[key]]
-            return defer.DeferredList(d, consumeErrors=True)
+            for reference in self._slaves[key]:
+                self._dispatchers[reference.slave].dispatch(data)
+
+    ### public ###
+
+    def get_stats(self):
+        return self._stats.get_stats()
 
     ### Methods called by Slave ###
 
@@ -97,6 +106,10 @@ class Master(log.Logger, log.LogProxy, common.ConnectionManager,
         debug_message("M-->", message)
         self._messaging.dispatch(message, outgoing=True)
 
+    def remote_dispatch_batch(self, batch):
+        for data in batch:
+            self.remote_dispatch(data)
+
     def remote_create_external_route(self, backend_id, **kwargs):
         return self._messaging.create_external_route(backend_id, **kwargs)
 
@@ -109,6 +122,9 @@ class Master(log.Logger, log.LogProxy, common.ConnectionManager,
         if key not in self._slaves:
             self._slaves[key] = list()
         self._slaves[key].append(slave)
+        if slave.slave not in self._dispatchers:
+            self._dispatchers[slave.slave] = BatchDispatcher(
+                self, slave.slave, self._stats)
 
     def _remove(self, key, slave):
         if key not in self._slaves:
@@ -125,6 +141,12 @@ class Master(log.Logger, log.LogProxy, common.ConnectionManager,
                 self._messaging.remove_binding(found)
             if not self._slaves[key]:
                 del(self._slaves[key])
+            if not any(s.slave == slave
+                       for slaves in self._slaves.itervalues()
+                       for s in slaves):
+                dispatcher = self._dispatchers.pop(slave, None)
+                if dispatcher is not None:
+                    dispatcher.cancel()
 
 
 class SlaveReference(object):
@@ -191,6 +213,9 @@ class Slave(log.Logger, log.LogProxy, common.ConnectionManager,
         self._messaging = None
         # PBReference to Master137
         self._master = None
+        # BatchDispatcher sending to the master
+        self._dispatcher = None
+        self._stats = DispatchStats()
 
         # We do banana over banana ...
         self._serializer = banana.Serializer()
@@ -202,9 +227,11 @@ class Slave(log.Logger, log.LogProxy, common.ConnectionManager,
 
         def setter(value):
             self._master = value
+            self._dispatcher = BatchDispatcher(self, value, self._stats)
             self.log("Got master reference, %r", value)
 
         self._messaging = messaging
+        self._broker.set_backend(self)
         d = self._broker.get_broker_backend()
         d.addCallback(setter)
         d.addCallback(defer.drop_param, self._on_connected)
@@ -227,6 +254,8 @@ class Slave(log.Logger, log.LogProxy, common.ConnectionManager,
                                        backend_id, **kwargs)
 
     def disconnect(self):
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
         return defer.succeed(None)
 
     # is_disconnected() from common.ConnectionManager
@@ -242,7 +271,12 @@ class Slave(log.Logger, log.LogProxy, common.ConnectionManager,
     def on_message(self, message):
         debug_message("<--S", message)
         data = self._serializer.convert(message)
-        return self._master.callRemote('dispatch', data)
+        self._dispatcher.dispatch(data)
+
+    ### public ###
+
+    def get_stats(self):
+        return self._stats.get_stats()
 
     ### Called by Master ###
 
@@ -250,3 +284,110 @@ class Slave(log.Logger, log.LogProxy, common.ConnectionManager,
         message = self._unserializer.convert(data)
         debug_message("S-->", message)
         self._messaging.dispatch(message, outgoing=False)
+
+    def remote_dispatch_batch(self, batch):
+        for data in batch:
+            self.remote_dispatch(data)
+
+
+class DispatchStats(object):
+    '''Counters of the messages going through the L{BatchDispatcher}s
+    of a unix backend.'''
+
+    def __init__(self):
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self.flushes = 0
+        self.flushed = 0
+        self.max_flush_size = 0
+
+    def queued(self):
+        self.queue_depth += 1
+        self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+
+    def dequeued(self, size, flushed=True):
+        self.queue_depth -= size
+        if flushed:
+            self.flushes += 1
+            self.flushed += size
+            self.max_flush_size = max(self.max_flush_size, size)
+
+    def get_stats(self):
+        mean = float(self.flushed) / self.flushes if self.flushes else 0.0
+        return dict(queue_depth=self.queue_depth,
+                    max_queue_depth=self.max_queue_depth,
+                    flushes=self.flushes,
+                    flushed_messages=self.flushed,
+                    max_flush_size=self.max_flush_size,
+                    mean_flush_size=mean)
+
+
+class BatchDispatcher(object):
+    '''
+    Queues the serialized messages for a remote backend and delivers
+    them on the next reactor iteration with a single remote call.
+    The messages are delivered in the order they were queued, a batch
+    holds at most max_batch_size of them. The remotes running a version
+    without dispatch_batch get the messages one by one.
+    '''
+
+    max_batch_size = 1024
+
+    def __init__(self, logger, remote, stats=None):
+        self._logger = logger
+        self._remote = remote
+        self._stats = stats or DispatchStats()
+        self._queue = list()
+        self._call = None
+        # False once the remote turns out not to know dispatch_batch
+        self._batching = True
+
+    def dispatch(self, data):
+        self._queue.append(data)
+        self._stats.queued()
+        if self._call is None:
+            self._call = time.call_next(self._flush)
+
+    def cancel(self):
+        if self._call is not None:
+            self._call.cancel()
+            self._call = None
+        if self._queue:
+            self._logger.debug("Dropping %d queued messages",
+                               len(self._queue))
+            self._stats.dequeued(len(self._queue), flushed=False)
+            self._queue = list()
+
+    ### private ###
+
+    def _flush(self):
+        self._call = None
+        queue, self._queue = self._queue, list()
+        if not self._batching:
+            self._stats.dequeued(len(queue))
+            self._dispatch_each(queue)
+            return
+        for index in xrange(0, len(queue), self.max_batch_size):
+            batch = queue[index:index + self.max_batch_size]
+            self._stats.dequeued(len(batch))
+            d = self._remote.callRemote('dispatch_batch', batch)
+            d.addErrback(self._dispatch_batch_failed, batch)
+
+    def _dispatch_each(self, queue):
+        for data in queue:
+            d = self._remote.callRemote('dispatch', data)
+            d.addErrback(self._dispatch_failed, 1)
+
+    def _dispatch_batch_failed(self, fail, batch):
+        if not fail.check(pb.NoSuchMethod):
+            return self._dispatch_failed(fail, len(batch))
+        if self._batching:
+            self._logger.info("Remote doesn't support dispatching batches, "
+                              "falling back to dispatching messages one "
+                              "by one")
+            self._batching = False
+        self._dispatch_each(batch)
+
+    def _dispatch_failed(self, fail, size):
+        self._logger.warning("Failed to dispatch %d messages: %s",
+                             size, fail.getErrorMessage())
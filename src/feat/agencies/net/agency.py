@@ -49,6 +49,9 @@ from feat.agencies.interface import AgencyRoles
 GATEWAY_PORT_COUNT = 100
 TUNNELING_PORT_COUNT = 100
 
+# identities of the gateway models listing the agents
+AGENT_LISTINGS = ("feat.agents", "feat.agency.agents")
+
 
 class AgencyAgent(agency.AgencyAgent):
 
@@ -76,7 +79,8 @@ class Startup(agency.Startup):
         self._journaler = journaler.Journaler(
             on_rotate_cb=self.friend._force_snapshot_agents,
             on_switch_writer_cb=self.friend._on_journal_writer_switch,
-            hostname=self.friend.get_hostname())
+            hostname=self.friend.get_hostname(),
+            encode_in_thread=True)
         # add the journaler to the LogTee which is the default keeper
         # dump the buffer with entries so far and remove it from the tee
         # at this point in future if we decide not to log to text files
@@ -435,14 +439,21 @@ class Agency(agency.Agency):
     def register_agent(self, medium):
         agency.Agency.register_agent(self, medium)
         self._broker.register_agent(medium)
+        self._invalidate_gateway_cache(medium.get_agent_id(),
+                                       *AGENT_LISTINGS)
 
     def unregister_agent(self, medium):
         agency.Agency.unregister_agent(self, medium)
         agent_id = medium.get_agent_id()
         self._broker.push_event(agent_id, 'unregistered')
         self._broker.unregister_agent(medium)
+        self._invalidate_gateway_cache(agent_id, *AGENT_LISTINGS)
         self._start_host_agent()
 
+    def descriptor_changed(self, medium):
+        agency.Agency.descriptor_changed(self, medium)
+        self._invalidate_gateway_cache(medium.get_agent_id())
+
     @manhole.expose()
     @serialization.freeze_tag('IAgency.start_agent')
     def start_agent(self, descriptor, **kwargs):
@@ -526,12 +537,24 @@ class Agency(agency.Agency):
     @manhole.expose()
     def show_connections(self):
         t = text_helper.Table(
-            fields=("Connection", "Connected", "Host", "Port", "Reconnect in"),
-            lengths=(20, 15, 30, 10, 15))
+            fields=("Connection", "Connected", "Host", "Port", "Reconnect in",
+                    "Cache"),
+            lengths=(20, 15, 30, 10, 15, 20))
         connections = [self._database, self._messaging]
         iterator = (x.show_connection_status() for x in connections)
         return t.render(iterator)
 
+    @manhole.expose()
+    def get_database_stats(self):
+        '''Gives the latencies and the state of the connections to the
+        database, the durations are in seconds.'''
+        return self._database.get_pool_stats()
+
+    @manhole.expose()
+    def get_gateway_cache_stats(self):
+        '''Gives the hit rate and the size of the gateway render cache.'''
+        return self._gateway and self._gateway.render_cache.get_stats()
+
     @manhole.expose()
     def show_locked_db_documents(self):
         return ("_document_locks: %r\n_pending_notifications: %r" %
@@ -676,6 +699,10 @@ class Agency(agency.Agency):
             self._snapshot_task.cancel()
         self._snapshot_task = None
 
+    def _invalidate_gateway_cache(self, *tags):
+        if self._gateway:
+            self._gateway.render_cache.invalidate(*tags)
+
     def _create_gateway(self, gconfig):
         assert isinstance(gconfig, config.GatewayConfig), str(type(gconfig))
         try:
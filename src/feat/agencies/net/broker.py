@@ -185,6 +185,8 @@ class Broker(log.Logger, log.LogProxy, common.StateMachineMixin,
         self.on_master_missing_cb = on_master_missing_cb
 
         self.shared_state = SharedState(self)
+        # unix messaging backend (Master or Slave) of this broker
+        self._backend = None
         self._set_idle(True)
 
     def is_master(self):
@@ -372,6 +374,7 @@ class Broker(log.Logger, log.LogProxy, common.StateMachineMixin,
     def become_disconnected(self):
         previous_state = self.state
         self._set_state(BrokerRole.disconnected)
+        self._backend = None
         if callable(self.on_disconnected_cb):
             return self.on_disconnected_cb(previous_state)
 
@@ -505,6 +508,20 @@ class Broker(log.Logger, log.LogProxy, common.StateMachineMixin,
         else:
             return self.agency.get_broker_backend()
 
+    def set_backend(self, backend):
+        self._backend = backend
+
+    @manhole.expose()
+    def get_dispatch_stats(self):
+        '''
+        Returns the counters of the batched message dispatch over
+        the unix socket: current and maximum queue depth, number of
+        flushes and flushed messages, maximum and mean flush size.
+        '''
+        if self._backend is None:
+            return dict()
+        return self._backend.get_stats()
+
     def is_standalone(self):
         return self._is_standalone
 
@@ -27,7 +27,7 @@ from zope.interface import implements, classProvides
 
 from feat.common import serialization, log, text_helper, deep_compare, error
 from feat.agents.base import replay
-from feat.common.serialization import banana
+from feat.common.serialization import banana, sexp
 
 from feat.interface.agent import IAgencyAgent
 from feat.interface.generic import ITimeProvider
@@ -348,6 +348,8 @@ class Replay(log.LogProxy, log.Logger):
 
         self.agent_type = None
         self.agent_id = agent_id
+        # encoded arguments of the last full snapshot, the base for deltas
+        self._snapshot_base = None
         Factory(self, 'agent-medium', AgencyAgent)
         Factory(self, 'db-connection', Connection)
         Factory(self, 'replier-medium', AgencyReplier)
@@ -444,6 +446,9 @@ class Replay(log.LogProxy, log.Logger):
         if entry.function_id == "snapshot":
             self.apply_snapshot(entry)
             return
+        if entry.function_id == "snapshot_delta":
+            self.apply_snapshot_delta(entry)
+            return
 
         self._log_entry(entry)
 
@@ -486,12 +491,24 @@ class Replay(log.LogProxy, log.Logger):
         if not args:
             # we can get entry without the arguments in case it was
             # impossible to serialize the snapshot of the agent
+            self._snapshot_base = None
             raise ReplayError("Malformed agent snapshot, reason: %r" %
                               (entry.result, ))
-        snapshot = args[0]
-        self._restore_snapshot(snapshot)
-        self._check_snapshot(old_agent, old_protocols)
-        self.agent_type = self.agent.descriptor_type
+        self._snapshot_base = entry._args
+        self._apply_snapshot(args[0], old_agent, old_protocols)
+
+    def apply_snapshot_delta(self, entry):
+        if self._snapshot_base is None:
+            raise ReplayError("Delta snapshot found without the full "
+                              "snapshot it is relative to")
+        old_agent, old_protocols = self.agent, self.protocols
+        self.reset()
+        self.set_current_time(entry._timestamp)
+        (delta, ), _kwargs = replay.replay(entry, entry.get_arguments)
+        base = self.unserializer.decode(self._snapshot_base)
+        tree = sexp.patch_tree(base, delta)
+        args = replay.replay(entry, self.unserializer.convert_decoded, tree)
+        self._apply_snapshot(args[0], old_agent, old_protocols)
 
     # Managing the dummy registry:
 
@@ -536,6 +553,11 @@ class Replay(log.LogProxy, log.Logger):
         if self.agent is None:
             raise NoHamsterballError()
 
+    def _apply_snapshot(self, snapshot, old_agent, old_protocols):
+        self._restore_snapshot(snapshot)
+        self._check_snapshot(old_agent, old_protocols)
+        self.agent_type = self.agent.descriptor_type
+
     def _restore_snapshot(self, snapshot):
         self.agent, self.protocols = snapshot
 
@@ -712,6 +734,10 @@ class Connection(BaseReplayDummy):
     def save_document(self, doc):
         raise RuntimeError('save_document() should never be called!')
 
+    @serialization.freeze_tag('IDatabaseClient.save_documents')
+    def save_documents(self, docs):
+        raise RuntimeError('save_documents() should never be called!')
+
     @serialization.freeze_tag('IDatabaseClient.get_attachment_body')
     def get_attachment_body(self, attachment):
         raise RuntimeError('get_attachment_body() should never be called!')
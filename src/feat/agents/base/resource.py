@@ -22,6 +22,7 @@
 # -*- Mode: Python -*-
 # vi:si:et:sw=4:sts=4:ts=4
 
+import bisect
 import sys
 
 from pprint import pformat
@@ -49,7 +50,14 @@ class IResourceDefinition(Interface):
 
     name = Attribute("resource name")
 
-    def allocate(allocations, *args):
+    def create_index():
+        """
+        Create an empty index of the allocated resources. Resources keeps
+        it up to date with its set(key, allocated) and discard(key)
+        methods and passes it to the other methods of the definition.
+        """
+
+    def allocate(index, *args):
         """
         Generate IAllocatedResource object for the given parameters.
         The params will differ for different types of resource.
@@ -57,27 +65,28 @@ class IResourceDefinition(Interface):
         This method should raise NotEnoughResource in case it cannot comply
         or DeclarationError if argument doesn't make sense.
 
-        @param: [L{IAllocatedResource}]
+        @param index: index of allocated and preallocated and modified
+                      resources created by create_index()
         @return: L{IAllocatedResource}
         """
 
-    def modify(allocations, resource, *args):
+    def modify(index, resource, *args):
         """
         Generate IAllocatedResource representing change done in the allocated
         resource.
 
         This method may raise NotEnoughResource or DeclarationError.
 
-        @param allocations: [L{IAllocatedResource}] list of allocated and
-                            preallocated and modified resources.
+        @param index: index of allocated and preallocated and modified
+                      resources created by create_index()
         @param resource: The resource being modified or None in case Allocation
                          doesn't include this resource.
         @return: L{IAllocatedResource}
         """
 
-    def reduce(allocations):
+    def reduce(index):
         '''
-        Reduce list of IAllocatedResource to single displayable value.
+        Reduce the index of IAllocatedResource to single displayable value.
         '''
 
     def get_total():
@@ -143,11 +152,15 @@ class Range(serialization.Serializable):
 
     ### IResourceDefinition ###
 
-    def allocate(self, allocations, number):
-        values = self._find_free_values(allocations, number)
+    @staticmethod
+    def create_index():
+        return RangeIndex()
+
+    def allocate(self, index, number):
+        values = self._find_free_values(index, number)
         return AllocatedRange(values)
 
-    def modify(self, allocations, resource, *args):
+    def modify(self, index, resource, *args):
         '''
         Correct format of args here is:
         cmd1, param1, param2, cmd2, param1, ...
@@ -164,11 +177,11 @@ class Range(serialization.Serializable):
             elif last_cmd is None:
                 raise DeclarationError("First parameter should be a command")
             elif last_cmd == 'add':
-                values = self._find_free_values(allocations, param)
+                values = self._find_free_values(index, param)
                 for p in values:
                     res.add_value(p)
             elif last_cmd == 'add_specific':
-                if not self._value_free(allocations, param):
+                if index.is_used(param):
                     raise NotEnoughResource(
                         'Value %r of resource %s is allocated' %
                         (param, self.name, ))
@@ -186,10 +199,9 @@ class Range(serialization.Serializable):
                                        (last_cmd, ))
         return res
 
-    def reduce(self, allocations):
+    def reduce(self, index):
         # gives list of allocated values
-        return [x for x in range(self.first, self.last + 1)
-                if not self._value_free(allocations, x)]
+        return index.used_between(self.first, self.last)
 
     def get_total(self):
         return (self.first, self.last)
@@ -200,15 +212,15 @@ class Range(serialization.Serializable):
 
     ### private ####
 
-    def _find_free_values(self, allocations, number):
+    def _find_free_values(self, index, number):
         to_allocate = number
         res = list()
-        for x in range(self.first, self.last + 1):
-            if number < 1:
-                break
-            if self._value_free(allocations, x):
+        if number > 0:
+            for x in index.iter_free(self.first, self.last):
                 res.append(x)
                 number -= 1
+                if number < 1:
+                    break
 
         if number > 0:
             total_allocated = self.last - self.first - to_allocate + number
@@ -217,10 +229,6 @@ class Range(serialization.Serializable):
                                     (self.name, total_allocated, to_allocate))
         return res
 
-    def _value_free(self, allocations, value):
-        included = any(map(lambda x: value in x.values, allocations))
-        return not included
-
     def __eq__(self, other):
         if not isinstance(other, type(self)):
             return NotImplemented
@@ -234,6 +242,99 @@ class Range(serialization.Serializable):
         return not self.__eq__(other)
 
 
+class RangeIndex(object):
+    '''
+    Sorted index of the values used by the range allocations, kept up to
+    date as the allocations change. Runs of consecutive used values are
+    skipped with a binary search when looking for the free ones.
+    '''
+
+    def __init__(self, allocations=()):
+        # key -> values of the allocation
+        self._entries = dict()
+        # value -> number of allocations using it
+        self._counts = dict()
+        # sorted list of the used values
+        self._used = list()
+        for key, allocated in enumerate(allocations):
+            self.set(key, allocated)
+
+    def set(self, key, allocated):
+        self.discard(key)
+        values = tuple(allocated.values)
+        self._entries[key] = values
+        for value in values:
+            count = self._counts.get(value, 0)
+            if not count:
+                bisect.insort(self._used, value)
+            self._counts[value] = count + 1
+
+    def discard(self, key):
+        for value in self._entries.pop(key, ()):
+            count = self._counts.pop(value) - 1
+            if count:
+                self._counts[value] = count
+            else:
+                del self._used[bisect.bisect_left(self._used, value)]
+
+    def is_used(self, value):
+        return value in self._counts
+
+    def used_between(self, first, last):
+        used = self._used
+        return used[bisect.bisect_left(used, first):
+                    bisect.bisect_right(used, last)]
+
+    def iter_free(self, first, last):
+        '''Iterates over the free values between first and last
+        in ascending order.'''
+        used = self._used
+        index = bisect.bisect_left(used, first)
+        end = bisect.bisect_right(used, last)
+        current = first
+        while current <= last:
+            if index < end and used[index] == current:
+                # used[i] - i is constant along a run of consecutive values
+                offset = current - index
+                low, high = index, end
+                while low < high:
+                    middle = (low + high) // 2
+                    if used[middle] - middle == offset:
+                        low = middle + 1
+                    else:
+                        high = middle
+                index = low
+                current = used[index - 1] + 1
+                continue
+            stop = used[index] if index < end else last + 1
+            for value in xrange(current, stop):
+                yield value
+            current = stop
+
+
+class ScalarIndex(object):
+    '''
+    Total of the scalar allocations, kept up to date as the allocations
+    change.
+    '''
+
+    def __init__(self, allocations=()):
+        # key -> value of the allocation
+        self._entries = dict()
+        self.total = 0
+        for key, allocated in enumerate(allocations):
+            self.set(key, allocated)
+
+    def set(self, key, allocated):
+        self.discard(key)
+        value = max([allocated.value, 0])
+        self._entries[key] = value
+        self.total += value
+
+    def discard(self, key):
+        self.total -= self._entries.pop(key, 0)
+
+
 @feat.register_restorator
 class Scalar(serialization.Serializable):
     implements(IResourceDefinition)
@@ -253,7 +354,11 @@ class Scalar(serialization.Serializable):
 
     ### IResourceDefinition ###
 
-    def allocate(self, allocations, value):
+    @staticmethod
+    def create_index():
+        return ScalarIndex()
+
+    def allocate(self, index, value):
         try:
             value = int(value)
             if value <= 0:
@@ -262,7 +367,7 @@ class Scalar(serialization.Serializable):
             raise DeclarationError("Bad ammount: %s. Exp: %r"
                                    % (value, e, )), None, sys.exc_info()[2]
 
-        total_allocated = self.reduce(allocations)
+        total_allocated = self.reduce(index)
         if self.total < total_allocated + value:
             raise NotEnoughResource('Not enough %s. Allocated already: %d '
                                     'New value: %d' %
@@ -270,7 +375,7 @@ class Scalar(serialization.Serializable):
                                      total_allocated + value))
         return AllocatedScalar(value)
 
-    def modify(self, allocations, resource, value):
+    def modify(self, index, resource, value):
         try:
             value = int(value)
             current_value = resource.value if resource else 0
@@ -278,7 +383,7 @@ class Scalar(serialization.Serializable):
                 raise ValueError("Tried to release more than was allocated.")
         except ValueError as e:
             raise DeclarationError("Bad ammount: %s. Exp: %r" % (value, e, ))
-        total_allocated = self.reduce(allocations)
+        total_allocated = self.reduce(index)
         if self.total < total_allocated + value:
             raise NotEnoughResource('Not enough %s. Allocated already: %d '
                                     'New value: %d' %
@@ -286,8 +391,8 @@ class Scalar(serialization.Serializable):
                                      total_allocated + value))
         return ScalarModification(value)
 
-    def reduce(self, allocations):
-        return sum([max([x.value, 0]) for x in allocations])
+    def reduce(self, index):
+        return index.total
 
     def get_total(self):
         return self.total
@@ -591,6 +696,9 @@ class Resources(log.Logger, log.LogProxy, replay.Replayable):
     preallocation_timeout = ALLOCATION_TIMEOUT
 
     def __init__(self, agent):
+        # resource_name -> (index of allocated, index of modifications),
+        # they are not part of the state, built when first needed
+        self._indexes = dict()
         log.Logger.__init__(self, agent)
         log.LogProxy.__init__(self, agent)
         replay.Replayable.__init__(self, agent)
@@ -601,13 +709,16 @@ class Resources(log.Logger, log.LogProxy, replay.Replayable):
         state.definitions = dict()
         state.id_autoincrement = 1
         # id -> temporal_objects (Allocation)
-        state.modifications = ExpDict(agent)
+        state.modifications = ExpDict(agent,
+                                      on_expire=self._unindex_transient)
 
     @replay.immutable
     def restored(self, state):
         log.Logger.__init__(self, state.agent)
         log.LogProxy.__init__(self, state.agent)
         replay.Replayable.restored(self)
+        self._indexes = dict()
+        state.modifications.set_on_expire(self._unindex_transient)
 
     # Public API
 
@@ -619,6 +730,7 @@ class Resources(log.Logger, log.LogProxy, replay.Replayable):
                  "definition %r", name, definition)
         if name in state.definitions:
             self.log("Overwriting old definition.")
+            self._indexes.pop(name, None)
         state.definitions[name] = definition
 
     @replay.mutable
@@ -632,6 +744,7 @@ class Resources(log.Logger, log.LogProxy, replay.Replayable):
             state.modifications.set(alloc.id, alloc,
                                     expiration=self.preallocation_timeout,
                                     relative=True)
+            self._index_transient(alloc)
             return alloc
         except NotEnoughResource:
             return None
@@ -639,7 +752,9 @@ class Resources(log.Logger, log.LogProxy, replay.Replayable):
     @replay.mutable
     def confirm(self, state, allocation_id):
         alloc = state.modifications.pop(allocation_id, None)
-        if alloc is None:
+        if alloc is not None:
+            self._unindex_transient(alloc)
+        else:
             alloc = self._get_confirmed().get(allocation_id, None)
             if alloc is not None:
                 self.log('confirm() called on already confirmed allocation. '
@@ -667,6 +782,7 @@ class Resources(log.Logger, log.LogProxy, replay.Replayable):
             state.modifications.set(change.id, change,
                                     expiration=ALLOCATION_TIMEOUT,
                                     relative=True)
+            self._index_transient(change)
             return change
         except NotEnoughResource:
             return None
@@ -727,7 +843,7 @@ class Resources(log.Logger, log.LogProxy, replay.Replayable):
             to_remove = self._get_confirmed()[allocation_id]
             return self._remove_allocation_from_descriptor(to_remove)
         if transient:
-            del(state.modifications[allocation_id])
+            self._unindex_transient(state.modifications.pop(allocation_id))
             return
         raise AllocationNotFound("Allocation with id=%s not found" %
                                  allocation_id)
@@ -736,18 +852,17 @@ class Resources(log.Logger, log.LogProxy, replay.Replayable):
     def allocated(self, state):
         resp = dict()
         for x in state.definitions.itervalues():
-            allocs = self._get_allocated(x.name)
-            resp[x.name] = x.reduce(allocs)
+            allocated, _ = self._get_indexes(x.name)
+            resp[x.name] = x.reduce(allocated)
         return resp
 
     @replay.immutable
     def get_usage(self, state):
         resp = dict()
         for x in state.definitions.itervalues():
-            alloc = self._get_allocated(x.name)
-            modif = self._get_modified(x.name)
+            allocated, modified = self._get_indexes(x.name)
             resp[x.name] = (x.type_name, x.get_total(),
-                            x.reduce(alloc), x.reduce(modif))
+                            x.reduce(allocated), x.reduce(modified))
         return resp
 
     ### methods used by tests ###
@@ -761,8 +876,8 @@ class Resources(log.Logger, log.LogProxy, replay.Replayable):
     def preallocated(self, state):
         resp = dict()
         for x in state.definitions.itervalues():
-            allocs = self._get_modified(x.name)
-            resp[x.name] = x.reduce(allocs)
+            _, modified = self._get_indexes(x.name)
+            resp[x.name] = x.reduce(modified)
         return resp
 
     ### handling allocation list in descriptor ###
@@ -790,6 +905,7 @@ class Resources(log.Logger, log.LogProxy, replay.Replayable):
 
         f = fiber.Fiber()
         f.add_callback(state.agent.update_descriptor, allocation)
+        f.add_callback(self._index_confirmed)
         return f.succeed(action)
 
     @replay.journaled
@@ -806,8 +922,71 @@ class Resources(log.Logger, log.LogProxy, replay.Replayable):
 
         f = fiber.Fiber()
         f.add_callback(state.agent.update_descriptor, allocation)
+        f.add_callback(self._unindex_confirmed, allocation.id)
         return f.succeed(do_remove)
 
+    ### keeping the indexes up to date ###
+
+    @replay.immutable
+    def _get_indexes(self, state, name):
+        '''
+        Gives the indexes of the allocated and of the modified resources
+        for the given resource name.
+        '''
+        # removes the expired modifications from the indexes
+        state.modifications.pack()
+        indexes = self._indexes.get(name)
+        if indexes is None:
+            definition = self._get_definition(name)
+            allocated = definition.create_index()
+            modified = definition.create_index()
+            for alloc in self._get_confirmed().itervalues():
+                resource = alloc.allocated_for(name)
+                if resource is not None:
+                    allocated.set(('confirmed', alloc.id), resource)
+            for alloc in state.modifications.itervalues():
+                resource = alloc.allocated_for(name)
+                if resource is not None:
+                    allocated.set(('transient', alloc.id), resource)
+                    modified.set(alloc.id, resource)
+            indexes = self._indexes[name] = (allocated, modified)
+        return indexes
+
+    @replay.mutable
+    def _index_confirmed(self, state, allocation):
+        # allocation is the result of updating the descriptor
+        key = ('confirmed', allocation.id)
+        for name, (allocated, _) in self._indexes.iteritems():
+            resource = allocation.allocated_for(name)
+            if resource is None:
+                allocated.discard(key)
+            else:
+                allocated.set(key, resource)
+        return allocation
+
+    @replay.mutable
+    def _unindex_confirmed(self, state, result, allocation_id):
+        key = ('confirmed', allocation_id)
+        for allocated, _ in self._indexes.itervalues():
+            allocated.discard(key)
+        return result
+
+    def _index_transient(self, alloc):
+        # alloc is an Allocation or an AllocationChange
+        key = ('transient', alloc.id)
+        for name, (allocated, modified) in self._indexes.iteritems():
+            resource = alloc.allocated_for(name)
+            if resource is not None:
+                allocated.set(key, resource)
+                modified.set(alloc.id, resource)
+
+    def _unindex_transient(self, alloc):
+        # also called when the modification expires
+        key = ('transient', alloc.id)
+        for allocated, modified in self._indexes.itervalues():
+            allocated.discard(key)
+            modified.discard(alloc.id)
+
     ### private ###
 
     @replay.immutable
@@ -825,7 +1004,7 @@ class Resources(log.Logger, log.LogProxy, replay.Replayable):
             if not isinstance(args, (tuple, list)):
                 args = (args, )
 
-            allocated = self._get_allocated(name)
+            allocated, _ = self._get_indexes(name)
             allocated_resource = definition.allocate(allocated, *args)
             resource_allocations[name] = allocated_resource
         a_id = self._next_id()
@@ -843,7 +1022,7 @@ class Resources(log.Logger, log.LogProxy, replay.Replayable):
             if not isinstance(args, (tuple, list)):
                 args = (args, )
 
-            allocated = self._get_allocated(name)
+            allocated, _ = self._get_indexes(name)
             resource = alloc.alloc.get(name, None)
             allocated_resource = definition.modify(allocated, resource, *args)
             deltas[name] = allocated_resource
@@ -865,24 +1044,6 @@ class Resources(log.Logger, log.LogProxy, replay.Replayable):
         state.id_autoincrement += 1
         return str(ret)
 
-    @replay.immutable
-    def _get_allocated(self, state, name):
-        '''
-        Gives list of IAllocatedResource objects for the given resource name.
-        '''
-        resp = list()
-        allocations = self._get_confirmed().values() + \
-                      state.modifications.values()
-        for alloc in allocations:
-            resp.append(alloc.allocated_for(name))
-        return filter(None, resp)
-
-    @replay.immutable
-    def _get_modified(self, state, name):
-        allocs = [a.allocated_for(name)
-                  for a in state.modifications.itervalues()]
-        return filter(None, allocs)
-
     ### python specific ###
 
     @replay.immutable
@@ -22,6 +22,10 @@ class HostAgent(models.Agent):
                 view=call.source_call('get_static_agents'))
     model.item_meta('static_agents', 'html-render', 'array, 1')
 
+    def get_revision(self):
+        # the running static agents are not versioned
+        return None
+
 
 @featmodels.register_model
 class StaticAgents(model.Collection):
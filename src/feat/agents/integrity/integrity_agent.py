@@ -1,7 +1,5 @@
 import urlparse
 
-from twisted.internet import task as itask
-
 from feat.agents.application import feat
 from feat.agents.base import agent, descriptor, replay, task, alert
 from feat.common import error, fiber, defer
@@ -168,19 +166,40 @@ class IntegrityAgent(agent.BaseAgent):
     def handle_conflicts(self, ids):
         self.info("Detected %d conflicts", len(ids))
         if ids:
-            return itask.coiterate(
-                (self.conflict_cb(doc_id) for doc_id in ids))
+            # the documents are fetched in bulk and solved concurrently
+            d = conflicts.check_conflicts(self.get_database(), ids)
+            d.addCallback(self._solve_conflicts)
+            return d
         else:
             self.resolve_alert(ALERT_NAME, 'ok')
 
     @replay.immutable
     def conflict_cb(self, state, doc_id, rev=None, deleted=False,
-            own_change=False):
-        d = conflicts.solve(state.medium.get_database(), doc_id)
+            own_change=False, plain_doc=None):
+        d = conflicts.solve(state.medium.get_database(), doc_id, plain_doc)
         d.addCallbacks(self._solve_cb, self._solve_err,
                        callbackArgs=(doc_id, ))
         return d
 
+    @replay.immutable
+    def _solve_conflicts(self, state, documents):
+        started = self.get_time()
+        semaphore = defer.DeferredSemaphore(conflicts.SOLVE_WINDOW)
+        defers = [semaphore.run(self.conflict_cb, doc_id,
+                                plain_doc=raw_doc)
+                  for doc_id, (_, raw_doc) in documents.iteritems()]
+        d = defer.DeferredList(defers, consumeErrors=True)
+        d.addCallback(defer.drop_param, self._conflicts_solved,
+                      len(defers), started)
+        return d
+
+    @replay.immutable
+    def _conflicts_solved(self, state, count, started):
+        elapsed = max(self.get_time() - started, 0.001)
+        self.info("Processed %d conflicts in %.1f seconds (%.1f "
+                  "conflicts/s), %d of them are unsolvable", count,
+                  elapsed, count / elapsed, len(state.unsolvable_conflicts))
+
     @replay.immutable
     def _solve_cb(self, state, _ignored, doc_id):
         # resolve the alert only if we previously raised the alert
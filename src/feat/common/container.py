@@ -363,9 +363,10 @@ class RunningAverage(object):
 @serialization.register
 class ExpDict(ExpBase):
     """
-    @warning: Getting the length, and therefore construct like
-              "if exp_dict: ..." or "bool(exp_dict)",
-              will iterate over all elements.
+    Expiring entries are indexed in a heap ordered by expiration time,
+    they are removed as soon as the dictionary is accessed after
+    their expiration. This makes the expiration cost proportional
+    to the number of expired entries and getting the length O(1).
     @warning: Comparison operations are very expensive.
     """
 
@@ -376,26 +377,35 @@ class ExpDict(ExpBase):
     classProvides(serialization.IRestorator)
     implements(serialization.ISerializable)
 
-    __slots__ = ("_time", "_items", "_max_size", "_last_pack")
+    __slots__ = ("_time", "_items", "_heap", "_max_size", "_on_expire")
 
-    def __init__(self, time_provider, max_size=None):
+    def __init__(self, time_provider, max_size=None, on_expire=None):
         """Create an expiration dictionary.
         @param time_provider: who provide the time
         @type time_provider: L{ITimeProvider}
-        @param max_size: maximum size before forced packing
-        @type max_size: int"""
+        @param max_size: minimum number of stale entries in the expiration
+                         index before it gets rebuilt
+        @type max_size: int
+        @param on_expire: callable called with the value of expired entries
+        @type on_expire: callable"""
         self._time = ITimeProvider(time_provider)
         self._items = {} # {KEY: ExpItem(TIME, VALUE)}
+        self._heap = [] # [(TIME, KEY)]
         self._max_size = RunningAverage(max_size or self.DEFAULT_MAX_SIZE)
-        self._last_pack = 0
+        self._on_expire = on_expire
 
     def clear(self):
         """Removes all items from the dictionary."""
         self._items.clear()
+        self._heap = []
 
     def pack(self):
-        """Packs the dictionary by removing all expired items."""
-        self._pack(self._time.get_time())
+        """Packs the dictionary by removing all expired items
+        and the stale entries of the expiration index."""
+        self._expire()
+        if len(self._heap) > len(self._items):
+            self._rebuild_heap()
+        self._max_size.add_point(len(self._items))
 
     def set(self, key, value=None, expiration=None, relative=False):
         """Adds an entry to the dictionary with specified expiration and value.
@@ -409,14 +419,18 @@ class ExpDict(ExpBase):
                          to EPOC UTC or from now.
         @type relative: bool
         @return: nothing"""
-        self._lazy_pack()
-        if expiration is not None:
+        if expiration is None:
+            self._expire()
+        else:
             now = self._time.get_time()
             if relative:
                 expiration = now + expiration
             if expiration <= now:
                 return
+            self._expire(now)
+            heapq.heappush(self._heap, (expiration, key))
         self._items[key] = ExpItem(expiration, value)
+        self._check_heap()
 
     def remove(self, key):
         """Removes the dictionary entry with with specified key .
@@ -424,13 +438,8 @@ class ExpDict(ExpBase):
         @type key: any immutable
         @return: item value
         @rtype: any python structure or L{ISerializable}"""
-        self._lazy_pack()
-        now = self._time.get_time()
-        if self._items:
-            item = self._items.pop(key)
-            if item.exp is None or item.exp > now:
-                return item.value
-        raise KeyError(key)
+        self._expire()
+        return self._items.pop(key).value
 
     def pop(self, key, *default):
         """Pops and returns the dictionary entry with with specified key.
@@ -438,19 +447,13 @@ class ExpDict(ExpBase):
         @type key: any immutable
         @return: value
         @rtype: any python structure or L{ISerializable}"""
-        self._lazy_pack()
-        now = self._time.get_time()
-        if self._items:
-            try:
-                item = self._items.pop(key)
-                if item.exp is None or item.exp > now:
-                    return item.value
-                raise KeyError(key)
-            except KeyError:
-                if len(default) == 1:
-                    return default[0]
-                else:
-                    raise
+        self._expire()
+        item = self._items.pop(key, None)
+        if item is not None:
+            return item.value
+        if len(default) == 1:
+            return default[0]
+        raise KeyError(key)
 
     def get(self, key, default=None):
         """Retrieve value from the entry with specified key.
@@ -463,6 +466,12 @@ class ExpDict(ExpBase):
         item = self._get_item(key)
         return default if item is None else item.value
 
+    def set_on_expire(self, on_expire):
+        """Sets the callable called with the value of expired entries.
+        It is not serialized, restored dictionaries need it set again.
+        @type on_expire: callable"""
+        self._on_expire = on_expire
+
     def get_expiration(self, key):
         item = self._get_item(key)
         if item is None:
@@ -471,21 +480,11 @@ class ExpDict(ExpBase):
 
     def iterkeys(self):
         """Returns an iterator over the dictionary keys."""
-        self._lazy_pack()
-        now = self._time.get_time()
-        for key, item in self._items.iteritems():
-            if item.exp is None or item.exp > now:
-                yield key
-                now = self._time.get_time()
+        return (key for key, _ in self._iter_items())
 
     def itervalues(self):
         """Returns an iterator over the dictionary values."""
-        self._lazy_pack()
-        now = self._time.get_time()
-        for item in self._items.itervalues():
-            if item.exp is None or item.exp > now:
-                yield item.value
-                now = self._time.get_time()
+        return (item.value for _, item in self._iter_items())
 
     def values(self):
         return list(self.itervalues())
@@ -495,20 +494,17 @@ class ExpDict(ExpBase):
 
     def iteritems(self):
         """Returns an iterator over tuples (key, value)."""
-        self._lazy_pack()
-        now = self._time.get_time()
-        for key, item in self._items.iteritems():
-            if item.exp is None or item.exp > now:
-                yield key, item.value
-                now = self._time.get_time()
+        return ((key, item.value) for key, item in self._iter_items())
 
     def size(self):
-        """Returns the current size counting expired elements."""
+        """Returns the current size counting expired elements
+        not removed yet."""
         return len(self._items)
 
     def __setitem__(self, key, value):
-        self._lazy_pack()
+        self._expire()
         self._items[key] = ExpItem(None, value)
+        self._check_heap()
 
     def __getitem__(self, key):
         item = self._get_item(key)
@@ -517,11 +513,8 @@ class ExpDict(ExpBase):
         raise KeyError(key)
 
     def __delitem__(self, key):
-        item = self._get_item(key)
-        if item is not None:
-            del self._items[key]
-            return
-        raise KeyError(key)
+        self._expire()
+        del self._items[key]
 
     def __contains__(self, key):
         return self._get_item(key) is not None
@@ -530,20 +523,16 @@ class ExpDict(ExpBase):
         return self.iterkeys()
 
     def __len__(self):
-        now = self._time.get_time()
-        return len([i for i in self._items.itervalues()
-                    if i.exp is None or i.exp > now])
+        self._expire()
+        return len(self._items)
 
     def __eq__(self, other):
         if not issubclass(type(other), type(self)):
             return NotImplemented
-        now = self._time.get_time()
-        a = [(k, i.pri, i.value)
-             for k, i in self._items.iteritems()
-             if i.exp is None or i.exp > now]
-        b = [(k, i.pri, i.value)
-             for k, i in other._items.iteritems()
-             if i.exp is None or i.exp > now]
+        self._expire()
+        other._expire()
+        a = [(k, i.pri, i.value) for k, i in self._items.iteritems()]
+        b = [(k, i.pri, i.value) for k, i in other._items.iteritems()]
         a.sort()
         b.sort()
         return a == b
@@ -567,32 +556,54 @@ class ExpDict(ExpBase):
         self._max_size = RunningAverage(max_size)
         self._items = dict([(k, ExpItem.restore(s))
                             for k, s in data.iteritems()])
-        self._last_pack = 0
+        self._on_expire = None
+        self._rebuild_heap()
 
     ### Private Methods ###
 
-    def _lazy_pack(self):
-        if len(self._items) > self._max_size.get_value() * 1.25:
+    def _expire(self, now=None):
+        heap = self._heap
+        if not heap:
+            # Nothing can expire, no need to ask for the time
+            return
+        if now is None:
             now = self._time.get_time()
-            # Regulate lazy packing rate
-            if (now - self._last_pack) >= (1.0 / MAX_LAZY_PACK_PER_SECOND):
-                self._pack(now)
+        items = self._items
+        while heap and heap[0][0] <= now:
+            exp, key = heapq.heappop(heap)
+            item = items.get(key)
+            # The entry could have been removed or replaced since
+            if item is not None and item.exp == exp:
+                del items[key]
+                if callable(self._on_expire):
+                    self._on_expire(item.value)
 
-    def _pack(self, now):
-        self._items = dict([(k, i) for k, i in self._items.iteritems()
-                            if i.exp is None or i.exp > now])
-        self._last_pack = now
-        self._max_size.add_point(len(self._items))
+    def _check_heap(self):
+        # Removed and replaced entries leave stale elements in the heap,
+        # rebuild it when they outnumber the live ones
+        limit = len(self._items) + self._max_size.get_value()
+        if len(self._heap) > 2 * limit:
+            self._rebuild_heap()
+
+    def _rebuild_heap(self):
+        self._heap = [(i.exp, k) for k, i in self._items.iteritems()
+                      if i.exp is not None]
+        heapq.heapify(self._heap)
+
+    def _iter_items(self):
+        self._expire()
+        # iterate over a copy, the dictionary could change meanwhile
+        items = self._items.items()
+        now = self._time.get_time() if self._heap else None
+        for key, item in items:
+            if item.exp is None or item.exp > now:
+                yield key, item
+                if item.exp is not None:
+                    now = self._time.get_time()
 
     def _get_item(self, key):
-        self._lazy_pack()
-        now = self._time.get_time()
-        item = self._items.get(key, None)
-        if item is not None:
-            if item.exp is None or item.exp > now:
-                return item
-            del self._items[key]
-        return None
+        self._expire()
+        return self._items.get(key, None)
 
 
 @serialization.register
@@ -65,12 +65,14 @@ FUNCTION_ATOM = '.banana_function'
 
 class Serializer(sexp.Serializer, BananaCodec):
 
-    def __init__(self, externalizer=None, source_ver=None, target_ver=None):
+    def __init__(self, externalizer=None, source_ver=None, target_ver=None,
+                 tree=False):
         sexp.Serializer.__init__(
             self, externalizer=externalizer,
             converter_caps=base.DEFAULT_CONVERTER_CAPS | BANANA_CONVERTER_CAPS,
             freezer_caps=base.DEFAULT_FREEZER_CAPS | BANANA_CONVERTER_CAPS,
-                                 source_ver=source_ver, target_ver=target_ver)
+                                 source_ver=source_ver, target_ver=target_ver,
+                                 tree=tree)
         BananaCodec.__init__(self)
 
     def pack_method(self, data):
@@ -84,6 +86,16 @@ class Serializer(sexp.Serializer, BananaCodec):
     def pack_function(self, data):
         return [FUNCTION_ATOM, reflect.canonical_name(data)]
 
+    def convert_unencoded(self, data):
+        '''Converts the data to the s-expression that would be encoded,
+        the result only holds basic python types and can be encoded
+        later, even from another thread, with L{BananaCodec.encode}.'''
+        return self._pack(data, self.converter_capabilities, False)
+
+    def freeze_unencoded(self, data):
+        '''Same as L{convert_unencoded} but freezing the data.'''
+        return self._pack(data, self.freezer_capabilities, True)
+
     ### Overridden Methods ###
 
     def post_convertion(self, data):
@@ -101,6 +113,11 @@ class Unserializer(sexp.Unserializer, BananaCodec):
                                    target_ver=target_ver)
         BananaCodec.__init__(self)
 
+    def convert_decoded(self, data):
+        '''Unserializes an s-expression already decoded with
+        L{BananaCodec.decode}.'''
+        return self._unpack(data)
+
     ### Overridden Methods ###
 
     def pre_convertion(self, data):
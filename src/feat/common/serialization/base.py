@@ -358,6 +358,17 @@ class Serializer(object):
 
     Sub classes can override the packing functions used for each types.
 
+    As long as no value is referenced twice, the two passes are not needed.
+    The values are first packed in a single pass using packing plans
+    compiled once per python type. The reference of the visited containers
+    are only remembered to detect a value referenced a second time,
+    in which case the value is serialized again using the two pass
+    algorithm described above, so the result is always the same.
+    If the caller knows the structure is a tree (like documents)
+    it can pass tree=True at construction time to skip even this
+    detection. Values referenced multiple times are then serialized
+    multiple times and circular references are not supported.
+
     NOTE: because the flatten methods lookup table is done at class
     declaration time, overriding most of flatten_* method will not work.
     Only flatten_value, flatten_key, flatten_item, flatten_unknown,
@@ -400,7 +411,7 @@ class Serializer(object):
 
     def __init__(self, converter_caps=None, freezer_caps=None,
                  post_converter=None, externalizer=None, registry=None,
-                 source_ver=None, target_ver=None):
+                 source_ver=None, target_ver=None, tree=False):
         global _global_registry
         assert ((source_ver is None) and (target_ver is None)) \
                or ((source_ver is not None) and (target_ver is not None))
@@ -411,6 +422,8 @@ class Serializer(object):
         self._registry = IRegistry(registry) if registry else _global_registry
         self._source_ver = source_ver
         self._target_ver = target_ver
+        self.tree = tree
+        self._packers = {} # {FREEZING: PACK_FUNCTION}
         self.reset()
 
     ### IFreezer ###
@@ -466,6 +479,7 @@ class Serializer(object):
         self._references = {} # {OBJ_ID: REFERENCE_CONTAINER}
         self._memory = []
         self._refid = 0
+        self._visited = None if self.tree else set() # {OBJ_ID}
 
     def flatten_unknown_value(self, value, caps, freezing):
         # Flatten enums
@@ -751,13 +765,24 @@ class Serializer(object):
     ### private ###
 
     def _convert(self, data, caps, freezing):
+        # Post-convert the data if a convert was specified
+        return self.post_convertion(self._pack(data, caps, freezing))
+
+    def _pack(self, data, caps, freezing):
         try:
-            # Flatten the value to the list-only format with packer function
-            flattened = self.flatten_value(data, caps, freezing)
-            # Pack all the value with there own packer functions
-            packed = self.pack_value(flattened)
-            # Post-convert the data if a convert was specified
-            return self.post_convertion(packed)
+            try:
+                # Try packing the value in a single pass
+                packed = self._get_packer(caps, freezing)(data)
+                if self._refids:
+                    # Customized key flattening referenced some value
+                    raise _ValueReferenced()
+            except _ValueReferenced:
+                self.reset()
+                # Flatten the value to the list-only format with packer
+                flattened = self.flatten_value(data, caps, freezing)
+                # Pack all the value with there own packer functions
+                packed = self.pack_value(flattened)
+            return packed
         finally:
             # Reset the state to cleanup all references
             self.reset()
@@ -816,6 +841,213 @@ class Serializer(object):
         # Otherwise return the value itself
         return container
 
+    def _visit(self, value):
+        ident = id(value)
+        if ident in self._visited:
+            raise _ValueReferenced()
+        self._visited.add(ident)
+        # Keep the value alive, so its id cannot be reused
+        self._memory.append(value)
+
+    def _get_packer(self, caps, freezing):
+        packer = self._packers.get(freezing)
+        if packer is not None:
+            return packer
+
+        cls = type(self)
+        for name in _DIRECT_PACKING_FLATTENERS:
+            if (getattr(cls, name).__func__
+                is not getattr(Serializer, name).__func__):
+                # Flattening is customized, always use the two passes
+                self._packers[freezing] = _two_passes_packer
+                return _two_passes_packer
+
+        value_plans = {} # {TYPE: PLAN}
+        key_plans = {} # {TYPE: PLAN}
+
+        def pack_value(value):
+            vtype = type(value)
+            plan = value_plans.get(vtype)
+            if plan is None:
+                plan = self._compile_value_plan(vtype, caps, freezing,
+                                                pack_value, pack_key)
+                value_plans[vtype] = plan
+            return plan(value)
+
+        def pack_key(key):
+            ktype = type(key)
+            plan = key_plans.get(ktype)
+            if plan is None:
+                plan = self._compile_key_plan(ktype, caps, freezing,
+                                              pack_value)
+                key_plans[ktype] = plan
+            return plan(key)
+
+        self._packers[freezing] = pack_value
+        return pack_value
+
+    def _compile_value_plan(self, vtype, caps, freezing, pack, pack_key):
+        flattener = self._value_lookup.get(vtype)
+        if flattener is None:
+            if issubclass(vtype, enum.Enum):
+                flattener = Serializer.flatten_enum_value
+            elif issubclass(vtype, (type, InterfaceClass)):
+                flattener = Serializer.flatten_type_value
+            else:
+                return self._compile_instance_plan(vtype, caps, freezing,
+                                                   pack)
+
+        cap, packer_name = _DIRECT_PACKING_VALUES.get(flattener.__name__,
+                                                      (None, None))
+        if cap is None or cap not in caps:
+            # Values needing the flattener logic, or raising an error
+            return self._compile_generic_plan(flattener, caps, freezing)
+
+        packer = getattr(self, packer_name)
+        if flattener.__name__ == "flatten_dict_value":
+            return self._compile_dict_plan(packer, freezing, pack, pack_key)
+        if flattener.__name__ in _CONTAINER_FLATTENERS:
+            return self._compile_sequence_plan(packer, pack)
+        return packer if packer is not None else _identity
+
+    def _compile_key_plan(self, ktype, caps, freezing, pack):
+        if (type(self).flatten_key.__func__
+            is not Serializer.flatten_key.__func__):
+
+            def plan(key):
+                return self.pack_value(self.flatten_key(key, caps, freezing))
+
+            return plan
+
+        flattener = self._key_lookup.get(ktype)
+        if flattener is None:
+            if issubclass(ktype, enum.Enum):
+                flattener = Serializer.flatten_enum_key
+            elif issubclass(ktype, (type, InterfaceClass)):
+                flattener = Serializer.flatten_type_key
+            else:
+                flattener = Serializer.flatten_unknown_key
+
+        cap, packer_name = _DIRECT_PACKING_KEYS.get(flattener.__name__,
+                                                    (None, None))
+        if cap is None or cap not in caps:
+            return self._compile_generic_plan(flattener, caps, freezing)
+
+        packer = getattr(self, packer_name)
+        if flattener.__name__ == "flatten_tuple_key":
+            return self._compile_sequence_plan(packer, pack)
+        return packer if packer is not None else _identity
+
+    def _compile_generic_plan(self, flattener, caps, freezing):
+
+        def plan(value):
+            return self.pack_value(flattener(self, value, caps, freezing))
+
+        return plan
+
+    def _compile_sequence_plan(self, packer, pack):
+
+        def plan(value):
+            if self._visited is not None:
+                self._visit(value)
+            packed = [pack(v) for v in value]
+            if packer is not None:
+                return packer(packed)
+            return packed
+
+        return plan
+
+    def _compile_dict_plan(self, packer, freezing, pack, pack_key):
+        pack_item = self.pack_item
+
+        def plan(value):
+            if self._visited is not None:
+                self._visit(value)
+            items = value.items()
+            if freezing:
+                items = sorted(items, key=operator.itemgetter(0))
+            packed = []
+            for k, v in items:
+                item = [pack_key(k), pack(v)]
+                if pack_item is not None:
+                    item = pack_item(item)
+                packed.append(item)
+            if packer is not None:
+                return packer(packed)
+            return packed
+
+        return plan
+
+    def _compile_instance_plan(self, vtype, caps, freezing, pack):
+        iface = ISnapshotable if freezing else ISerializable
+        # Instances of types implementing the interface adapt to themselves
+        adapted = (iface.implementedBy(vtype)
+                   and not hasattr(vtype, '__conform__'))
+        versioned = IVersionAdapter.implementedBy(vtype)
+        externalizer = self._externalizer
+        if freezing:
+            external_packer = self.pack_frozen_external
+        else:
+            external_packer = self.pack_external
+
+        def plan(value):
+            if externalizer is not None:
+                extid = externalizer.identify(value)
+                if extid is not None:
+                    self.check_capabilities(Capabilities.external_values,
+                                            extid, caps, freezing)
+                    packed = [pack(extid)]
+                    if external_packer is not None:
+                        return external_packer(packed)
+                    return packed
+
+            if adapted:
+                instance = value
+            else:
+                try:
+                    instance = iface(value)
+                except TypeError:
+                    # Let the flattener raise the error
+                    return self.pack_value(
+                        self.flatten_unknown_value(value, caps, freezing))
+            return self._pack_instance(instance, caps, freezing, pack,
+                                       versioned or
+                                       IVersionAdapter.providedBy(instance))
+
+        return plan
+
+    def _pack_instance(self, value, caps, freezing, pack, versioned):
+        self.check_capabilities(Capabilities.instance_values, value,
+                                caps, freezing)
+
+        if (self._visited is not None
+            and getattr(value, "referenceable", True)):
+            self._visit(value)
+
+        snapshot = value.snapshot()
+
+        if versioned:
+            source = self.get_source_ver(value, snapshot)
+            target = self.get_target_ver(value, snapshot)
+            if target is not None:
+                if target != source:
+                    snapshot = value.adapt_version(snapshot, source, target)
+                value.store_version(snapshot, target)
+
+        dump = pack(snapshot)
+
+        if freezing:
+            packer, data = self.pack_frozen_instance, [dump]
+        else:
+            type_name = value.type_name
+            if self.pack_type_name is not None:
+                type_name = self.pack_type_name(type_name)
+            packer, data = self.pack_instance, [type_name, dump]
+
+        if packer is not None:
+            return packer(data)
+        return data
+
     def get_target_ver(self, instance, snapshot):
         return self._target_ver
 
@@ -823,6 +1055,53 @@ class Serializer(object):
         return self._source_ver
 
 
+class _ValueReferenced(Exception):
+    """Raised when packing a value in a single pass finds a value
+    referenced for the second time."""
+
+
+def _identity(value):
+    return value
+
+
+def _two_passes_packer(value):
+    raise _ValueReferenced()
+
+
+# Flattener methods which, if overridden, disable the single pass packing
+_DIRECT_PACKING_FLATTENERS = ("flatten_value", "flatten_unknown_value",
+                              "flatten_item", "flatten_instance",
+                              "flatten_external")
+
+# {FLATTENER_NAME: (CAPABILITY, PACKER_NAME)} of the values packed directly
+_DIRECT_PACKING_VALUES = {
+    "flatten_str_value": (Capabilities.str_values, "pack_str"),
+    "flatten_unicode_value": (Capabilities.unicode_values, "pack_unicode"),
+    "flatten_int_value": (Capabilities.int_values, "pack_int"),
+    "flatten_long_value": (Capabilities.long_values, "pack_long"),
+    "flatten_float_value": (Capabilities.float_values, "pack_float"),
+    "flatten_none_value": (Capabilities.none_values, "pack_none"),
+    "flatten_bool_value": (Capabilities.bool_values, "pack_bool"),
+    "flatten_tuple_value": (Capabilities.tuple_values, "pack_tuple"),
+    "flatten_list_value": (Capabilities.list_values, "pack_list"),
+    "flatten_set_value": (Capabilities.set_values, "pack_set"),
+    "flatten_dict_value": (Capabilities.dict_values, "pack_dict")}
+
+# {FLATTENER_NAME: (CAPABILITY, PACKER_NAME)} of the keys packed directly
+_DIRECT_PACKING_KEYS = {
+    "flatten_str_key": (Capabilities.str_keys, "pack_str"),
+    "flatten_unicode_key": (Capabilities.unicode_keys, "pack_unicode"),
+    "flatten_int_key": (Capabilities.int_keys, "pack_int"),
+    "flatten_long_key": (Capabilities.long_keys, "pack_long"),
+    "flatten_float_key": (Capabilities.float_keys, "pack_float"),
+    "flatten_none_key": (Capabilities.none_keys, "pack_none"),
+    "flatten_bool_key": (Capabilities.bool_keys, "pack_bool"),
+    "flatten_tuple_key": (Capabilities.tuple_keys, "pack_tuple")}
+
+_CONTAINER_FLATTENERS = ("flatten_tuple_value", "flatten_list_value",
+                         "flatten_set_value")
+
+
 class DelayPacking(Exception):
     """Exception raised when unpacking a dereference to an unknown
     reference. This allows to delay unpacking of mutable object
@@ -862,9 +1141,13 @@ class Unserializer(object):
     ### IConverter ###
 
     def convert(self, data):
+        # Pre-convert the data if a convertor was specified
+        return self._unpack(self.pre_convertion(data))
+
+    ### protected ###
+
+    def _unpack(self, converted):
         try:
-            # Pre-convert the data if a convertor was specified
-            converted = self.pre_convertion(data)
             # Unpack the first level of values
             unpacked = self.unpack_data(converted)
             # Continue unpacking level by level
@@ -880,8 +1163,6 @@ class Unserializer(object):
             # Reset the state to cleanup all references
             self.reset()
 
-    ### protected ###
-
     def pre_convertion(self, data):
         if self._pre_converter is not None:
             return self._pre_converter.convert(data)
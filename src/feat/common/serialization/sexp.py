@@ -50,13 +50,14 @@ class Serializer(base.Serializer):
 
     def __init__(self, post_converter=None, externalizer=None,
                  converter_caps=None, freezer_caps=None,
-                 source_ver=None, target_ver=None):
+                 source_ver=None, target_ver=None, tree=False):
         base.Serializer.__init__(self, post_converter=post_converter,
                                  externalizer=externalizer,
                                  converter_caps=converter_caps,
                                  freezer_caps=freezer_caps,
                                  source_ver=source_ver,
-                                 target_ver=target_ver)
+                                 target_ver=target_ver,
+                                 tree=tree)
 
     def pack_unicode(self, value):
         return [UNICODE_ATOM, value.encode(UNICODE_FORMAT_ATOM)]
@@ -225,7 +226,101 @@ def unserialize(data):
     return _unserializer.convert(data)
 
 
+def diff_tree(old, new):
+    '''
+    Gives the list of operations L{patch_tree} needs to turn the old
+    s-expression into the new one. Each operation is a tuple
+    (path, start, stop, value): with start set to None the node
+    at the path is replaced by the value, otherwise the value replaces
+    the slice start:stop of the list at the path.
+    '''
+    operations = []
+    _diff(old, new, (), operations)
+    return operations
+
+
+def patch_tree(tree, operations):
+    '''
+    Applies operations given by L{diff_tree}. The lists of the tree
+    that need to change are copied, so the tree itself is not modified.
+    '''
+    holder = [tree]
+    copied = set()
+    for path, start, stop, value in operations:
+        path = (0, ) + tuple(path)
+        if start is None:
+            parent = _writable(holder, path[:-1], copied)
+            parent[path[-1]] = value
+        else:
+            node = _writable(holder, path, copied)
+            node[start:stop] = value
+    return holder[0]
+
+
+def tree_size(tree):
+    '''Estimates the size of the s-expression once encoded.'''
+    if isinstance(tree, (list, tuple)):
+        return 2 + sum(tree_size(item) for item in tree)
+    if type(tree) is str:
+        return 2 + len(tree)
+    return 3
+
+
 ### Private Stuff ###
 
+
+def _diff(old, new, path, operations):
+    if type(old) is not list or type(new) is not list:
+        if not _same(old, new):
+            operations.append((path, None, None, new))
+        return
+
+    if len(old) == len(new):
+        for index, (a, b) in enumerate(zip(old, new)):
+            if not _same(a, b):
+                _diff(a, b, path + (index, ), operations)
+        return
+
+    # Items were added or removed, only the part in between
+    # the common head and tail is replaced.
+    limit = min(len(old), len(new))
+    head = 0
+    while head < limit and _same(old[head], new[head]):
+        head += 1
+    tail = 0
+    while tail < limit - head and _same(old[-1 - tail], new[-1 - tail]):
+        tail += 1
+    operations.append((path, head, len(old) - tail,
+                       new[head:len(new) - tail]))
+
+
+def _same(a, b):
+    # 1 == 1.0 == 1L, the types need to be the same at every level
+    # for the patched tree to unserialize to the same values
+    if type(a) is not type(b) or a != b:
+        return False
+    if type(a) is list or type(a) is tuple:
+        for x, y in zip(a, b):
+            if not _same(x, y):
+                return False
+    elif type(a) is dict:
+        for key, value in a.iteritems():
+            if not _same(value, b[key]):
+                return False
+    return True
+
+
+def _writable(holder, path, copied):
+    node = holder
+    for index in path:
+        child = node[index]
+        if id(child) not in copied:
+            child = list(child)
+            node[index] = child
+            copied.add(id(child))
+        node = child
+    return node
+
+
 _serializer = Serializer()
 _unserializer = Unserializer()
@@ -3,6 +3,7 @@ import pprint
 from feat.gateway.application import featmodels
 
 from feat.database import driver
+from feat.web import httpclient
 from feat.models import model, value, getter, response, action, call, setter
 
 from feat.models.interface import IModel, ActionCategories
@@ -14,12 +15,122 @@ class Database(model.Model):
 
     model.identity('feat.database.Database')
     model.child('cache', source=getter.source_attr('_cache'))
+    model.child('pool', source=getter.source_attr('couchdb'),
+                label="Connection pool")
     model.attribute('host', value.String(), getter.source_attr('host'))
     model.attribute('port', value.Integer(), getter.source_attr('port'))
     model.attribute('connected', value.Boolean(),
                     call.source_call('is_connected'))
+    model.attribute('change_feeds', value.Integer(),
+                    desc="Number of continuous changes feeds opened.",
+                    getter=call.model_call('get_changes_stat', 'feeds'))
+    model.attribute('changes_received', value.Integer(),
+                    getter=call.model_call('get_changes_stat', 'changes'))
+    model.attribute('changes_bytes', value.Integer(),
+                    desc="Bytes received through the changes feeds.",
+                    getter=call.model_call('get_changes_stat', 'bytes'))
 
-    model.meta("html-order", "host, port, connected, cache")
+    def get_changes_stat(self, name):
+        return self.source.get_changes_stats()[name]
+
+    model.meta("html-order", "host, port, connected, change_feeds, "
+               "changes_received, changes_bytes, cache, pool")
+
+
+@featmodels.register_adapter(httpclient.ConnectionPool, IModel)
+@featmodels.register_model
+class ConnectionPool(model.Model):
+
+    model.identity('feat.database.ConnectionPool')
+    model.attribute('maximum_connections', value.Integer(),
+                    getter=getter.source_attr('_max'))
+    model.attribute('connected', value.Integer(),
+                    desc="Number of established connections.",
+                    getter=call.model_call('get_stat', 'connected'))
+    model.attribute('idle', value.Integer(),
+                    desc="Number of connections waiting for a request.",
+                    getter=call.model_call('get_stat', 'idle'))
+    model.attribute('awaiting', value.Integer(),
+                    desc="Number of requests waiting for a connection.",
+                    getter=call.model_call('get_stat', 'awaiting'))
+    model.attribute('connecting', value.Integer(),
+                    getter=call.model_call('get_stat', 'connecting'))
+    model.attribute('requests', value.Integer(),
+                    getter=call.model_call('get_stat', 'requests'))
+    model.attribute('pipelined', value.Integer(),
+                    desc="Number of requests pipelined on a busy connection.",
+                    getter=call.model_call('get_stat', 'pipelined'))
+    model.attribute('retries', value.Integer(),
+                    desc="Number of requests retried after their connection "
+                         "was reset.",
+                    getter=call.model_call('get_stat', 'retries'))
+    model.attribute('failures', value.Integer(),
+                    getter=call.model_call('get_stat', 'failures'))
+    model.attribute('connections_made', value.Integer(),
+                    getter=call.model_call('get_stat', 'connections_made'))
+    model.attribute('connections_lost', value.Integer(),
+                    getter=call.model_call('get_stat', 'connections_lost'))
+    model.attribute('connections_failed', value.Integer(),
+                    getter=call.model_call('get_stat', 'connections_failed'))
+    model.collection('endpoints',
+                     child_names=call.model_call('get_endpoint_names'),
+                     child_source=getter.model_get('get_endpoint'),
+                     child_model='feat.database.Endpoint',
+                     meta=[('html-render', 'array, 4')],
+                     model_meta=[('html-render',
+                                  'array-columns, requests, failures, '
+                                  'wait_p99, connect_p99, response_p50, '
+                                  'response_p99, response_max')])
+
+    def get_stat(self, name):
+        return self.source.get_stat(name)
+
+    def get_endpoint_names(self):
+        return [x.name for x in self.source.statistics.iter_endpoints()]
+
+    def get_endpoint(self, name):
+        for endpoint in self.source.statistics.iter_endpoints():
+            if endpoint.name == name:
+                return endpoint
+
+    model.meta("html-order", "maximum_connections, connected, idle, "
+               "awaiting, connecting, requests, pipelined, retries, "
+               "failures, connections_made, connections_lost, "
+               "connections_failed, endpoints")
+
+
+@featmodels.register_adapter(httpclient.EndpointStatistics, IModel)
+@featmodels.register_model
+class Endpoint(model.Model):
+    '''Latencies of the requests to an endpoint, in seconds.'''
+
+    model.identity('feat.database.Endpoint')
+    model.attribute('requests', value.Integer(),
+                    getter=call.model_call('get_count'))
+    model.attribute('failures', value.Integer(),
+                    getter=getter.source_attr('failures'))
+    model.attribute('wait_p99', value.Float(),
+                    desc="Time spent waiting for a connection.",
+                    getter=call.model_call('get_percentile', 'wait', 0.99))
+    model.attribute('connect_p99', value.Float(),
+                    desc="Time spent connecting, for the requests which "
+                         "waited for a new connection.",
+                    getter=call.model_call('get_percentile', 'connect', 0.99))
+    model.attribute('response_p50', value.Float(),
+                    getter=call.model_call('get_percentile', 'response', 0.5))
+    model.attribute('response_p99', value.Float(),
+                    getter=call.model_call('get_percentile', 'response', 0.99))
+    model.attribute('response_max', value.Float(),
+                    getter=call.model_call('get_max', 'response'))
+
+    def get_count(self):
+        return self.source.response.count
+
+    def get_percentile(self, name, fraction):
+        return getattr(self.source, name).get_percentile(fraction)
+
+    def get_max(self, name):
+        return getattr(self.source, name).max
 
 
 @featmodels.register_adapter(driver.Cache, IModel)
@@ -46,6 +157,18 @@ class Cache(model.Model):
                     desc=("Internal counter of operations used to "
                           "determine when to call cleanup()"),
                     getter=getter.source_attr('_operation'))
+    model.attribute('hits', value.Integer(),
+                    desc="Number of lookups which found a cached entry.",
+                    getter=getter.source_attr('hits'))
+    model.attribute('misses', value.Integer(),
+                    desc="Number of lookups which didn't find an entry.",
+                    getter=getter.source_attr('misses'))
+    model.attribute('evictions', value.Integer(),
+                    desc="Number of entries evicted to fit the desired size.",
+                    getter=getter.source_attr('evictions'))
+    model.attribute('revalidations', value.Integer(),
+                    desc="Number of 304 Not Modified responses received.",
+                    getter=getter.source_attr('revalidations'))
     model.collection('entries',
                      child_names=call.source_call('keys'),
                      child_source=getter.source_get('get'),
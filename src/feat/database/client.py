@@ -21,10 +21,14 @@
 # Headers in this file shall remain intact.
 # -*- Mode: Python -*-
 # vi:si:et:sw=4:sts=4:ts=4
+import copy
 import inspect
+import operator
 import uuid
 import urllib
 
+from collections import OrderedDict
+
 from twisted.internet import reactor
 from twisted.python import failure
 from zope.interface import implements
@@ -37,6 +41,7 @@ from feat.database.interface import IDatabaseClient, IDatabaseDriver
 from feat.database.interface import IRevisionStore, IDocument, IViewFactory
 from feat.database.interface import NotFoundError, ConflictResolutionStrategy
 from feat.database.interface import ResignFromModifying, ConflictError
+from feat.database.interface import DatabaseError
 from feat.database.interface import IVersionedDocument, NotMigratable
 from feat.interface.generic import ITimeProvider
 from feat.interface.serialization import ISerializable
@@ -81,10 +86,12 @@ class DocIdFilter(object):
         self.name = 'doc_ids'
         # doc_ids -> [(callback, listener_id)]
         self._listeners = {}
+        # listener_id -> [doc_id]
+        self._doc_ids = {}
 
     def match(self, doc):
         # used only by emu
-        return doc['_id'] in self._listeners.keys()
+        return doc['_id'] in self._listeners
 
     def notified(self, doc_id, rev, deleted):
         listeners = self._listeners.get(doc_id, list())
@@ -96,28 +103,34 @@ class DocIdFilter(object):
             cur = self._listeners.get(doc_id, list())
             cur.append((callback, listener_id, ))
             self._listeners[doc_id] = cur
+        self._doc_ids.setdefault(listener_id, list()).extend(doc_ids)
 
     def cancel_listener(self, listener_id):
-        changed = False
-        for values in self._listeners.itervalues():
-            iterator = (x for x in values if x[1] == listener_id)
-            for matching in iterator:
-                changed = True
-                values.remove(matching)
-        for key, values in self._listeners.items():
-            # cleanup empty entry
-            if not values:
-                del(self._listeners[key])
-
-        return changed
+        doc_ids = self._doc_ids.pop(listener_id, None)
+        if doc_ids is None:
+            return False
+
+        for doc_id in doc_ids:
+            values = self._listeners.get(doc_id)
+            if values is None:
+                # the same document was given more than once
+                continue
+            values = [x for x in values if x[1] != listener_id]
+            if values:
+                self._listeners[doc_id] = values
+            else:
+                # cleanup empty entry
+                del(self._listeners[doc_id])
+
+        return True
 
     def extract_params(self):
         if not self._listeners:
             # returning None prevents channel for being established
             return
-        # FIXME: after upgrading couchdb to a version supporting builting
-        # filter for doc_ids, pass here the correct params to trigger using it
-        return dict()
+        # the ids are posted in the body of the request
+        # to the builtin filter of CouchDB
+        return dict(filter='_doc_ids', doc_ids=sorted(self._listeners))
 
 
 class ChangeListener(log.Logger):
@@ -178,11 +191,18 @@ class Connection(log.Logger, log.LogProxy):
 
     implements(IDatabaseClient, ITimeProvider, IRevisionStore, ISerializable)
 
-    def __init__(self, database, unserializer=None):
+    def __init__(self, database, unserializer=None, cache_documents=False):
         log.Logger.__init__(self, database)
         log.LogProxy.__init__(self, database)
         self._database = IDatabaseDriver(database)
-        self._serializer = json.Serializer(sort_keys=True, force_unicode=True)
+        # raw documents fetched by this connection, None if not caching
+        self.document_cache = DocumentCache() if cache_documents else None
+        if cache_documents:
+            # the changes might be missed until the database reconnects
+            self._database.add_disconnected_cb(self.document_cache.untrust)
+        # documents are trees, there is no need to look for references
+        self._serializer = json.Serializer(sort_keys=True, force_unicode=True,
+                                           tree=True)
         self._unserializer = (unserializer or common.CouchdbUnserializer())
 
 
@@ -265,26 +285,64 @@ class Connection(log.Logger, log.LogProxy):
             else:
                 following_attachments = dict()
                 doc_id = doc.get('_id')
+            self._forget_cached(doc_id)
             resp = yield self._database.save_doc(serialized, doc_id,
                                                  following_attachments)
             self._update_id_and_rev(resp, doc)
             for attachment in following_attachments.itervalues():
                 attachment.set_saved()
 
-            # now process all the documents which have been registered to
-            # be saved together with this document
-            if IDocument.providedBy(doc):
-                while doc.links.to_save:
-                    to_link, linker_roles, linkee_roles = (
-                        doc.links.to_save.pop(0))
-                    to_link.links.create(doc=doc, linker_roles=linker_roles,
-                                         linkee_roles=linkee_roles)
-                    yield self.save_document(to_link)
-
+            yield self._save_linked(doc)
             defer.returnValue(doc)
         finally:
             self._unlock_notifications()
 
+    @serialization.freeze_tag('IDatabaseClient.save_documents')
+    @defer.inlineCallbacks
+    def save_documents(self, docs):
+        docs = list(docs)
+        try:
+            self._lock_notifications()
+
+            results = [None] * len(docs)
+            bulk = list()
+            single = list()
+            for index, doc in enumerate(docs):
+                assert IDocument.providedBy(doc) or isinstance(doc, dict), \
+                       repr(doc)
+                if (IDocument.providedBy(doc) and
+                    any(not x.saved
+                        for x in doc.get_attachments().itervalues())):
+                    # the attachments cannot be sent with _bulk_docs
+                    d = self.save_document(doc)
+                    d.addErrback(operator.attrgetter('value'))
+                    single.append((index, d))
+                else:
+                    bulk.append(index)
+
+            linked = list()
+            if bulk:
+                serialized = [self._serializer.convert(docs[index])
+                              for index in bulk]
+                for index in bulk:
+                    self._forget_cached(_get_doc_id(docs[index]))
+                resp = yield self._database.bulk_docs(serialized)
+                for index, result in zip(bulk, resp):
+                    error = bulk_docs_error(result)
+                    if error is None:
+                        self._update_id_and_rev(result, docs[index])
+                        linked.append(self._save_linked(docs[index]))
+                    results[index] = error or docs[index]
+
+            for index, d in single:
+                results[index] = yield d
+
+            yield _gather(linked)
+
+            defer.returnValue(results)
+        finally:
+            self._unlock_notifications()
+
     @serialization.freeze_tag('IDatabaseClient.get_attachment_body')
     def get_attachment_body(self, attachment):
         d = self._database.get_attachment(attachment.doc_id, attachment.name)
@@ -292,7 +350,10 @@ class Connection(log.Logger, log.LogProxy):
 
     @serialization.freeze_tag('IDatabaseClient.get_document')
     def get_document(self, doc_id, raw=False, **extra):
-        d = self._database.open_doc(doc_id, **extra)
+        if self.document_cache is not None and not extra:
+            d = self._open_cached_doc(doc_id)
+        else:
+            d = self._database.open_doc(doc_id, **extra)
         if not raw:
             d.addCallback(self.unserialize_document)
         d.addCallback(self._notice_doc_revision)
@@ -313,10 +374,13 @@ class Connection(log.Logger, log.LogProxy):
 
     @serialization.freeze_tag('IDatabaseClient.get_revision')
     def get_revision(self, doc_id):
-        # FIXME: this could be done by lightweight HEAD request
-        d = self._database.open_doc(doc_id)
-        d.addCallback(lambda doc: doc['_rev'])
-        return d
+        cache = self.document_cache
+        if cache is not None and self._is_listened(doc_id):
+            rev = cache.get_revision(doc_id)
+            if rev is not None:
+                cache.hits += 1
+                return defer.succeed(rev)
+        return self._database.head_doc(doc_id)
 
     @serialization.freeze_tag('IDatabaseClient.reload_database')
     def reload_document(self, doc):
@@ -345,6 +409,7 @@ class Connection(log.Logger, log.LogProxy):
 
         serialized = self._serializer.convert(body)
         self._lock_notifications()
+        self._forget_cached(body["_id"])
         d = self._database.save_doc(serialized, body["_id"])
         d.addCallback(self._update_id_and_rev, doc)
         d.addBoth(defer.bridge_param, self._unlock_notifications)
@@ -362,6 +427,7 @@ class Connection(log.Logger, log.LogProxy):
             raise TypeError(type(doc_or_id))
         if not doc_id:
             raise ValueError("Cannot determine doc id from %r" % (doc_or_id, ))
+        self._forget_cached(destination_id)
         return self._database.copy_doc(doc_id, destination_id, rev)
 
     @serialization.freeze_tag('IDatabaseClient.changes_listener')
@@ -369,7 +435,13 @@ class Connection(log.Logger, log.LogProxy):
         assert callable(callback)
 
         r = RevisionAnalytic(self, callback)
-        d = self._database.listen_changes(filter_, r.on_change, kwargs)
+
+        def on_change(doc_id, rev, deleted):
+            if self.document_cache is not None:
+                self.document_cache.changed(doc_id, rev, deleted)
+            r.on_change(doc_id, rev, deleted)
+
+        d = self._database.listen_changes(filter_, on_change, kwargs)
 
         def set_listener_id(l_id, filter_):
             self._listeners[l_id] = filter_
@@ -389,13 +461,50 @@ class Connection(log.Logger, log.LogProxy):
                 self._cancel_listener(l_id)
 
     @serialization.freeze_tag('IDatabaseClient.query_view')
-    def query_view(self, factory, parse_results=True, **options):
+    def query_view(self, factory, parse_results=True, consumer=None,
+                   **options):
         factory = IViewFactory(factory)
+        if consumer is not None:
+            if parse_results:
+                parse = lambda row: self.parse_view_results(
+                    [row], factory, options)
+            else:
+                parse = lambda row: [row]
+            consumer = RowsConsumer(consumer, parse)
+            d = self._database.query_view(factory, consumer=consumer,
+                                          **options)
+            d.addCallback(defer.drop_param, consumer.wait)
+            return d
+
         d = self._database.query_view(factory, **options)
         if parse_results:
-            d.addCallback(self._parse_view_results, factory, options)
+            d.addCallback(self.parse_view_results, factory, options)
         return d
 
+    def parse_view_results(self, rows, factory, options):
+        '''
+        Parses the rows of the view queried with the options and
+        parse_results=False, the way query_view() does it otherwise.
+        The rows here should be a list of tuples:
+         - (key, value) for reduce views
+         - (key, value, id) for nonreduce views without include docs
+         - (key, value, id, doc) for nonreduce with with include docs
+        '''
+        kwargs = dict()
+        kwargs['reduced'] = factory.use_reduce and options.get('reduce', True)
+        kwargs['include_docs'] = options.get('include_docs', False)
+        # Lines below pass extra arguments to the parsing function if they
+        # are expected. These arguments are bound method unserialize() and
+        # unserialize_list(). They methods perform the magic of parsing and
+        # upgrading if necessary the loaded documents.
+
+        spec = inspect.getargspec(factory.parse_view_result)
+        if 'unserialize' in spec.args:
+            kwargs['unserialize'] = self.unserialize_document
+        if 'unserialize_list' in spec.args:
+            kwargs['unserialize_list'] = self.unserialize_list_of_documents
+        return factory.parse_view_result(rows, **kwargs)
+
     @serialization.freeze_tag('IDatabaseClient.disconnect')
     @journal.named_side_effect('IDatabaseClient.disconnect')
     def disconnect(self):
@@ -407,15 +516,36 @@ class Connection(log.Logger, log.LogProxy):
         return self._database.get_update_seq()
 
     @serialization.freeze_tag('IDatabaseClient.get_changes')
-    def get_changes(self, filter_=None, limit=None, since=0):
+    def get_changes(self, filter_=None, limit=None, since=0, consumer=None):
         if IViewFactory.providedBy(filter_):
             filter_ = ViewFilter(filter_, params=dict())
         elif filter_ is not None:
             raise ValueError("%r should provide IViewFacory" % (filter_, ))
+        if consumer is not None:
+            return self._database.get_changes(filter_, limit, since,
+                                              consumer=consumer)
         return self._database.get_changes(filter_, limit, since)
 
     @serialization.freeze_tag('IDatabaseClient.bulk_get')
-    def bulk_get(self, doc_ids, consume_errors=True):
+    def bulk_get(self, doc_ids, consume_errors=True, consumer=None):
+
+        def parse_row(row):
+            if 'error' in row or 'deleted' in row['value']:
+                if not consume_errors:
+                    return [NotFoundError(row['key'])]
+                self.debug("Bulk get parser consumed error row: %r", row)
+                return []
+            d = self.unserialize_document(row['doc'])
+            if isinstance(d, defer.Deferred):
+                d.addCallback(lambda doc: [doc])
+                return d
+            return [d]
+
+        if consumer is not None:
+            consumer = RowsConsumer(consumer, parse_row)
+            d = self._database.bulk_get(doc_ids, consumer=consumer)
+            d.addCallback(defer.drop_param, consumer.wait)
+            return d
 
         def parse_bulk_response(resp):
             assert isinstance(resp, dict), repr(resp)
@@ -449,8 +579,10 @@ class Connection(log.Logger, log.LogProxy):
         '''
 
         def parse_response(doc):
-            self._database_tag = doc['tag']
-            return self._database_tag
+            # the tag is cached by the driver, so that it's shared
+            # by all the connections to the database
+            self._database.database_tag = doc['tag']
+            return doc['tag']
 
         def create_new(fail):
             fail.trap(NotFoundError)
@@ -462,7 +594,8 @@ class Connection(log.Logger, log.LogProxy):
             return self.get_database_tag()
 
 
-        if not hasattr(self, '_database_tag'):
+        tag = getattr(self._database, 'database_tag', None)
+        if tag is None:
             doc_id = u'_local/database_tag'
             d = self.get_document(doc_id)
             d.addErrback(create_new)
@@ -470,7 +603,7 @@ class Connection(log.Logger, log.LogProxy):
             d.addCallback(parse_response)
             return d
         else:
-            return defer.succeed(self._database_tag)
+            return defer.succeed(tag)
 
     ### ISerializable Methods ###
 
@@ -479,35 +612,82 @@ class Connection(log.Logger, log.LogProxy):
 
     ### private
 
+    def _save_linked(self, doc):
+        # now process all the documents which have been registered to
+        # be saved together with this document, they are saved
+        # concurrently so the writes are coalesced
+        if not IDocument.providedBy(doc) or not doc.links.to_save:
+            return defer.succeed(doc)
+
+        to_save = list()
+        while doc.links.to_save:
+            to_link, linker_roles, linkee_roles = doc.links.to_save.pop(0)
+            to_link.links.create(doc=doc, linker_roles=linker_roles,
+                                 linkee_roles=linkee_roles)
+            if not any(x is to_link for x in to_save):
+                to_save.append(to_link)
+        d = _gather([self.save_document(x) for x in to_save])
+        d.addCallback(defer.override_result, doc)
+        return d
+
     def _cancel_listener(self, lister_id):
         self._database.cancel_listener(lister_id)
+        if self.document_cache is not None:
+            # the changes are not followed until listening again
+            self.document_cache.untrust()
         try:
             del(self._listeners[lister_id])
         except KeyError:
             self.warning('Tried to remove nonexistining listener id %r.',
                          lister_id)
 
-    def _parse_view_results(self, rows, factory, options):
-        '''
-        rows here should be a list of tuples:
-         - (key, value) for reduce views
-         - (key, value, id) for nonreduce views without include docs
-         - (key, value, id, doc) for nonreduce with with include docs
-        '''
-        kwargs = dict()
-        kwargs['reduced'] = factory.use_reduce and options.get('reduce', True)
-        kwargs['include_docs'] = options.get('include_docs', False)
-        # Lines below pass extra arguments to the parsing function if they
-        # are expected. These arguments are bound method unserialize() and
-        # unserialize_list(). They methods perform the magic of parsing and
-        # upgrading if necessary the loaded documents.
+    ### private parts of the document cache ###
+
+    def _open_cached_doc(self, doc_id):
+        cache = self.document_cache
+        # the documents covered by the changes listeners of this connection
+        # are trusted, the notification about a new revision would have
+        # removed them from the cache
+        listened = self._is_listened(doc_id)
+        cached, trusted = cache.get(doc_id)
+        if cached is not None and trusted and listened:
+            cache.hits += 1
+            return defer.succeed(cached)
+
+        rev = cached['_rev'] if cached is not None else None
+        token = cache.fetching(doc_id)
+        d = self._database.open_doc(doc_id, if_none_match=rev)
+        d.addCallbacks(self._opened_cached_doc, self._open_cached_failed,
+                       callbackArgs=(doc_id, token, cached, listened),
+                       errbackArgs=(doc_id, token))
+        return d
 
-        spec = inspect.getargspec(factory.parse_view_result)
-        if 'unserialize' in spec.args:
-            kwargs['unserialize'] = self.unserialize_document
-        if 'unserialize_list' in spec.args:
-            kwargs['unserialize_list'] = self.unserialize_list_of_documents
-        return factory.parse_view_result(rows, **kwargs)
+    def _opened_cached_doc(self, raw, doc_id, token, cached, listened):
+        cache = self.document_cache
+        if raw is None:
+            # 304 Not Modified
+            cache.revalidations += 1
+            raw = cached
+        else:
+            cache.misses += 1
+        # the notification of a change done during the fetch
+        # could not remove the document we have just received
+        unchanged = cache.fetched(doc_id, token)
+        cache.store(raw, trusted=listened and unchanged)
+        return raw
+
+    def _open_cached_failed(self, fail, doc_id, token):
+        self.document_cache.fetched(doc_id, token)
+        self.document_cache.forget(doc_id)
+        return fail
+
+    def _forget_cached(self, doc_id):
+        if self.document_cache is not None and doc_id:
+            self.document_cache.forget(doc_id)
+
+    def _is_listened(self, doc_id):
+        return any(isinstance(filter_, (list, tuple)) and doc_id in filter_
+                   for filter_ in self._listeners.itervalues())
 
     def _update_id_and_rev(self, resp, doc):
         if IDocument.providedBy(doc):
@@ -662,11 +842,186 @@ class Connection(log.Logger, log.LogProxy):
         return d
 
 
+class RowsConsumer(object):
+    '''
+    Restores the rows of the streamed responses and passes the results
+    to the consumer in the order of the rows. Restoring a row can be
+    asynchronous (the document might need to be upgraded), the rows
+    following it are passed after it. wait() fires when all of them are
+    done, or fails with the first failure.
+    '''
+
+    def __init__(self, consumer, parse):
+        self._consumer = consumer
+        self._parse = parse
+        # Deferred passing the rows waiting for an asynchronous one
+        self._chain = None
+
+    def __call__(self, row):
+        parsed = self._parse(row)
+        if self._chain is None:
+            if not isinstance(parsed, defer.Deferred):
+                self._consume(parsed)
+                return
+            self._chain = defer.succeed(None)
+        if isinstance(parsed, defer.Deferred):
+            self._chain.addBoth(self._wait_for, parsed)
+        else:
+            self._chain.addCallback(defer.override_result, parsed)
+        self._chain.addCallback(self._consume)
+
+    def wait(self):
+        return self._chain
+
+    def _wait_for(self, result, parsed):
+        if isinstance(result, failure.Failure):
+            # the first failure is reported, this row is dropped
+            parsed.addErrback(defer.override_result, None)
+            return result
+        return parsed
+
+    def _consume(self, values):
+        for value in values:
+            self._consumer(value)
+
+
+def bulk_docs_error(result):
+    '''
+    Gives the exception for the result of a document written
+    with _bulk_docs, or None if it has been saved.
+    '''
+    if 'error' not in result:
+        return None
+    msg = ("Writing document %s failed with %s: %s"
+           % (result.get('id'), result['error'], result.get('reason')))
+    if result['error'] == 'conflict':
+        return ConflictError(msg)
+    return DatabaseError(msg)
+
+
+def _gather(defers):
+    # fails with the first failure of the deferreds
+    d = defer.DeferredList(defers, fireOnOneErrback=True, consumeErrors=True)
+    d.addCallbacks(lambda results: [x for _, x in results],
+                   lambda f: f.value.subFailure)
+    return d
+
+
+def _get_doc_id(doc):
+    if IDocument.providedBy(doc):
+        return doc.doc_id
+    return doc.get('_id')
+
+
 def _parse_doc_revision(rev):
     rev_index, rev_hash = rev.split("-", 1)
     return int(rev_index), rev_hash
 
 
+class DocumentCache(object):
+    '''
+    doc_id -> raw document fetched by the connection. The least recently
+    used documents are evicted above the desired number of them.
+    The trusted documents are served without asking the database as long
+    as they are covered by the changes listeners of the connection,
+    the rest is revalidated using the revision as the ETag, so that an
+    unchanged document costs a 304 response without the body.
+    A document changed while it is fetched or missing notifications
+    is not trusted.
+    '''
+
+    DEFAULT_DESIRED_SIZE = 1000
+
+    def __init__(self, desired_size=None):
+        self.desired_size = desired_size or self.DEFAULT_DESIRED_SIZE
+        # doc_id -> (raw document, trusted flag)
+        self._documents = OrderedDict()
+        # doc_id -> [fetches in progress, changes notified during them]
+        self._fetching = dict()
+        # incremented every time the documents stop being trusted
+        self._epoch = 0
+
+        # public statistics
+        self.hits = 0
+        self.revalidations = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+
+    def get(self, doc_id):
+        '''
+        Returns the tuple of the copy of the document and the flag
+        telling if it is trusted, or (None, False).
+        '''
+        entry = self._documents.pop(doc_id, None)
+        if entry is None:
+            return None, False
+        self._documents[doc_id] = entry
+        raw, trusted = entry
+        return copy.deepcopy(raw), trusted
+
+    def get_revision(self, doc_id):
+        entry = self._documents.get(doc_id)
+        if entry is not None and entry[1]:
+            return entry[0]['_rev']
+
+    def store(self, raw, trusted=False):
+        doc_id = raw['_id']
+        self._documents.pop(doc_id, None)
+        self._documents[doc_id] = (copy.deepcopy(raw), trusted)
+        while len(self._documents) > self.desired_size:
+            self._documents.popitem(last=False)
+            self.evictions += 1
+
+    def forget(self, doc_id):
+        self._documents.pop(doc_id, None)
+
+    def fetching(self, doc_id):
+        '''
+        Notes the document is being fetched, returns the token
+        to give to fetched() once it is done.
+        '''
+        fetching = self._fetching.setdefault(doc_id, [0, 0])
+        fetching[0] += 1
+        return fetching[1], self._epoch
+
+    def fetched(self, doc_id, token):
+        '''
+        Notes the fetch of the document is done, returns True if it
+        can be trusted because no change was notified in the meantime.
+        '''
+        fetching = self._fetching[doc_id]
+        fetching[0] -= 1
+        if not fetching[0]:
+            del self._fetching[doc_id]
+        return token == (fetching[1], self._epoch)
+
+    def untrust(self):
+        '''Stops trusting the documents, the changes might be missed.'''
+        self._epoch += 1
+        for doc_id, (raw, trusted) in self._documents.items():
+            if trusted:
+                self._documents[doc_id] = (raw, False)
+
+    def changed(self, doc_id, rev, deleted):
+        fetching = self._fetching.get(doc_id)
+        if fetching is not None:
+            fetching[1] += 1
+        entry = self._documents.get(doc_id)
+        if entry is not None and (deleted or entry[0]['_rev'] != rev):
+            del self._documents[doc_id]
+            self.invalidations += 1
+
+    def get_stats(self):
+        lookups = self.hits + self.revalidations + self.misses
+        hit_ratio = (float(self.hits + self.revalidations) / lookups
+                     if lookups else 0.0)
+        return dict(hits=self.hits, revalidations=self.revalidations,
+                    misses=self.misses, invalidations=self.invalidations,
+                    evictions=self.evictions, entries=len(self._documents),
+                    hit_ratio=hit_ratio)
+
+
 class RevisionAnalytic(log.Logger):
     '''
     The point of this class is to analyze if the document change notification
@@ -1,18 +1,23 @@
 import operator
 
 from twisted.python.failure import Failure
-from twisted.internet import task as itask
 
 
 from feat.agents.application import feat
 from feat.common.text_helper import format_block
-from feat.common import defer, error, first
+from feat.common import defer, error, first, time
 from feat.database import view, driver, update
 
-from feat.database.interface import NotFoundError, IDocument
+from feat.database.interface import NotFoundError, IDocument, ConflictError
 from feat.database.interface import ConflictResolutionStrategy
 
 
+# Number of documents fetched or deleted together
+BATCH_SIZE = 100
+# Maximum number of conflicts solved concurrently
+SOLVE_WINDOW = 10
+
+
 class UnsolvableConflict(error.NonCritical):
 
     def __init__(self, msg, doc, *args, **kwargs):
@@ -154,11 +159,17 @@ def configure_replicator_database(host, port, username=None, password=None):
 
 
 @defer.inlineCallbacks
-def solve(connection, doc_id):
+def solve(connection, doc_id, plain_doc=None):
+    '''
+    Solves the conflict of the document. The raw document with its
+    _conflicts can be passed if it has been fetched with
+    check_conflicts() already.
+    '''
     connection.info('Solving conflicts for document: %s', doc_id)
 
-    plain_doc = yield connection.get_document(doc_id, raw=True,
-                                              conflicts=True)
+    if plain_doc is None:
+        plain_doc = yield connection.get_document(doc_id, raw=True,
+                                                  conflicts=True)
     if '_conflicts' not in plain_doc:
         connection.debug('Document:%s is not in state conflict, aborting.',
                          doc_id)
@@ -402,24 +413,14 @@ def cleanup_logs(connection, rconnection):
                     for name, replications in statuses.iteritems())
     cleanup_seq = min(counters.values()) if statuses else None
     own_tag = yield connection.get_database_tag()
-
-    context = dict()
-    context['deletes_count'] = 0 # this is returned as a result
-    context['connection'] = connection
+    started = time.time()
 
     # this is cleanup for the update logs created locally
     keys = UpdateLogs.until_seq(own_tag, cleanup_seq)
     rows = yield connection.query_view(UpdateLogs, **keys)
-
-    @defer.inlineCallbacks
-    def clean_local(context, row):
-        connection = context['connection']
-        in_conflict, raw_doc = yield _check_conflict(connection, row[1])
-        if not in_conflict:
-            context['deletes_count'] += 1
-            yield _cleanup_update_log(connection, row[2])
-
-    yield itask.coiterate((clean_local(context, row) for row in rows))
+    owners = yield check_conflicts(connection, set(row[1] for row in rows))
+    to_delete = [row[2] for row in rows if not owners[row[1]][0]]
+    kept = len(rows) - len(to_delete)
 
     # this is cleanup of the update logs imported from remote partinions
     # they should be cleaned up if the document is not in conflict state
@@ -429,28 +430,52 @@ def cleanup_logs(connection, rconnection):
                           key=lambda row: (row[0][1], row[0][2]),
                           # (rev, doc_id)
                           value=lambda row: (row[0][3], row[2]))
-
-    @defer.inlineCallbacks
-    def clean_imported(context, partition_tag, owner_id, entries):
-        connection = context['connection']
-        if partition_tag == own_tag:
-            # this is local update log, this is handeled by the code above
-            return
-
-        in_conflict, raw_doc = yield _check_conflict(connection, owner_id)
+    # the local update logs are handeled by the code above
+    grouped = dict((key, entries) for key, entries in grouped.iteritems()
+                   if key[0] != own_tag)
+    owners = yield check_conflicts(
+        connection, set(owner_id for _, owner_id in grouped))
+
+    for (partition_tag, owner_id), entries in grouped.iteritems():
+        in_conflict, raw_doc = owners[owner_id]
         last_rev = entries[-1][0]
         if (not in_conflict and
             (raw_doc.get('_deleted') or
              parse_rev(last_rev) <= parse_rev(raw_doc['_rev']))):
-            for (rev, doc_id) in entries:
-                context['deletes_count'] += 1
-                yield _cleanup_update_log(connection, doc_id)
+            to_delete.extend(doc_id for rev, doc_id in entries)
+        else:
+            kept += len(entries)
 
-    yield itask.coiterate((
-        clean_imported(context, partition_tag, owner_id, entries)
-        for (partition_tag, owner_id), entries in grouped.iteritems()))
+    yield _cleanup_update_logs(connection, to_delete)
 
-    defer.returnValue(context['deletes_count'])
+    elapsed = max(time.time() - started, 0.001)
+    connection.info("Deleted %d update logs in %.1f seconds (%.1f logs/s), "
+                    "%d update logs are left for later", len(to_delete),
+                    elapsed, len(to_delete) / elapsed, kept)
+    defer.returnValue(len(to_delete))
+
+
+@defer.inlineCallbacks
+def check_conflicts(connection, doc_ids):
+    '''
+    Fetches the documents together with their conflicting revisions
+    using _all_docs, BATCH_SIZE of them with a single request.
+    Returns a C{dict} doc_id -> (in_conflict, raw_doc), the missing
+    documents are given as deleted ones.
+    '''
+    doc_ids = list(doc_ids)
+    result = dict()
+    for index in range(0, len(doc_ids), BATCH_SIZE):
+        chunk = doc_ids[index:index + BATCH_SIZE]
+        response = yield connection.database.bulk_get(chunk, conflicts=True)
+        for row in response['rows']:
+            doc_id = row['key']
+            raw_doc = row.get('doc')
+            if not raw_doc or raw_doc.get('_deleted'):
+                result[doc_id] = (False, {'_id': doc_id, '_deleted': True})
+            else:
+                result[doc_id] = ('_conflicts' in raw_doc, raw_doc)
+    defer.returnValue(result)
 
 
 def parse_rev(rev):
@@ -462,23 +487,21 @@ def parse_rev(rev):
 
 
 @defer.inlineCallbacks
-def _check_conflict(connection, doc_id):
-    try:
-        raw_doc = yield connection.get_document(doc_id, raw=True,
-                                                conflicts=True)
-    except NotFoundError:
-        in_conflict = False
-        raw_doc = {'_id': doc_id, '_deleted': True}
-    else:
-        in_conflict = '_conflicts' in raw_doc
-    defer.returnValue((in_conflict, raw_doc))
-
-
-def _cleanup_update_log(connection, doc_id):
-    d = connection.update_document(doc_id, update.delete)
-    # this is normal if there is a concurrent cleanup running
-    d.addErrback(Failure.trap, NotFoundError)
-    return d
+def _cleanup_update_logs(connection, doc_ids):
+    # the update logs of a chunk are deleted concurrently, so that
+    # the driver writes them with a single _bulk_docs request
+    for index in range(0, len(doc_ids), BATCH_SIZE):
+        logs = yield connection.bulk_get(doc_ids[index:index + BATCH_SIZE])
+        defers = list()
+        for log in logs:
+            d = connection.delete_document(log)
+            # this is normal if there is a concurrent cleanup running
+            d.addErrback(Failure.trap, NotFoundError, ConflictError)
+            defers.append(d)
+        results = yield defer.DeferredList(defers, consumeErrors=True)
+        for success, result in results:
+            if not success:
+                result.raiseException()
 
 
 def _group_rows(rows, key, value):
@@ -19,8 +19,10 @@
 # See "LICENSE.GPL" in the source distribution for more information.
 
 # Headers in this file shall remain intact.
+import re
 import types
 import operator
+from collections import OrderedDict
 from urllib import urlencode, quote
 
 from zope.interface import implements
@@ -31,6 +33,7 @@ from twisted.web.http import _DataLoss as DataLoss
 
 
 from feat.database.client import Connection, ChangeListener
+from feat.database.client import bulk_docs_error
 from feat.common import log, defer, time, error, enum, container
 from feat.agencies import common
 from feat.web import http, httpclient, auth, security
@@ -50,6 +53,15 @@ DEFAULT_DB_NAME = "feat"
 
 BOUNDARY = '32c90c040f034b15959861e58b8ec35d'
 
+# Path segments followed by a name which is kept in the path templates
+NAMED_SEGMENTS = ('_design', '_view', '_list', '_show', '_update')
+# Path segments of requests which can take long to be handled
+SLOW_SEGMENTS = ('_view', '_list', '_all_docs')
+# Seconds the restart of a changes feed is delayed when its listeners change
+NOTIFIER_RESTART_DELAY = 0.1
+# Maximum number of documents written with a single _bulk_docs request
+DEFAULT_BULK_SIZE = 100
+
 
 class Methods(http.Methods):
     '''
@@ -93,8 +105,14 @@ class ChangeReceiver(basic.LineReceiver):
             f.cleanFailure()
             d.errback(f)
 
+    def dataReceived(self, data):
+        self._notifier.bytes_received += len(data)
+        basic.LineReceiver.dataReceived(self, data)
+
     def lineReceived(self, line):
-        if not line:
+        if not line or self.stopping:
+            # the changes received after stopping are
+            # delivered by the feed resuming from the last sequence
             return
 
         change = json.loads(line)
@@ -127,7 +145,148 @@ class ChangeReceiver(basic.LineReceiver):
             self._notifier.connectionLost(reason)
 
 
+class RowsParser(object):
+    '''
+    Incremental parser of the CouchDB responses carrying a list of rows
+    (views, _all_docs and _changes). The elements of the list are decoded
+    and passed to the callback as soon as their text is complete, so only
+    a single row is kept in memory. What is left of the response (with
+    an empty list of rows) is parsed by finish().
+    '''
+
+    tokens = re.compile(r'"(?:[^"\\]|\\.)*"|"|[{}\[\]]')
+    list_key = re.compile(r'"(?:rows|results)"\s*:\s*$')
+
+    def __init__(self, callback):
+        self._callback = callback
+        self._buffer = ''
+        # position in the buffer to continue scanning from
+        self._position = 0
+        self._depth = 0
+        # text of the response up to the opening bracket of the list
+        self._head = None
+        # position of the row being received
+        self._row_start = None
+        self._finished_list = False
+
+    def feed(self, data):
+        buf = self._buffer + data
+        if self._finished_list:
+            self._buffer = buf
+            return
+
+        pos = self._position
+        consumed = 0
+        while True:
+            match = self.tokens.search(buf, pos)
+            if match is None:
+                pos = len(buf)
+                break
+            token = match.group()
+            if token == '"':
+                # unterminated string, wait for the rest of it
+                pos = match.start()
+                break
+            pos = match.end()
+            if token[0] == '"':
+                continue
+
+            if token in '{[':
+                self._depth += 1
+                if self._head is None:
+                    if (token == '[' and self._depth == 2 and
+                        self.list_key.search(buf, 0, match.start())):
+                        self._head = buf[:pos]
+                        consumed = pos
+                elif self._depth == 3:
+                    self._row_start = match.start()
+                continue
+
+            self._depth -= 1
+            if self._head is None:
+                continue
+            if self._depth == 2 and self._row_start is not None:
+                row = buf[self._row_start:pos]
+                self._row_start = None
+                consumed = pos
+                self._callback(json.loads(row))
+            elif self._depth == 1:
+                self._finished_list = True
+                consumed = match.start()
+                break
+
+        if self._head is None:
+            # keep all the data until the list is found
+            consumed = 0
+        elif self._row_start is not None:
+            consumed = self._row_start
+            self._row_start = 0
+        self._buffer = buf[consumed:]
+        self._position = pos - consumed
+
+    def finish(self):
+        '''
+        Parses the rest of the response. If the list of rows has been
+        streamed it is empty in the result.
+        '''
+        if self._head is None:
+            return json.loads(self._buffer)
+        if not self._finished_list:
+            raise ValueError("Response ended inside the list of rows")
+        return json.loads(self._head + self._buffer)
+
+
+class RowsDecoder(httpclient.ResponseDecoder):
+    '''
+    Response decoder streaming the rows of successful JSON responses
+    through the RowsParser. The body of the response is left with what
+    remains of the JSON document, so it can be processed with the usual
+    parsers. Other responses are buffered as a whole.
+    '''
+
+    def __init__(self, callback):
+        httpclient.ResponseDecoder.__init__(self)
+        self._parser = RowsParser(callback)
+        self._streaming = None
+        self._failure = None
+
+    def dataReceived(self, data):
+        if self._streaming is None:
+            self._streaming = (self.status < 300 and
+                               self.headers.get('content-type') ==
+                               'application/json')
+        if not self._streaming:
+            httpclient.ResponseDecoder.dataReceived(self, data)
+            return
+        if self._failure is not None:
+            # consume the rest of the body, the request has failed
+            return
+        try:
+            self._parser.feed(data)
+        except Exception:
+            self._failure = failure.Failure()
+
+    def connectionLost(self, reason=None):
+        if reason is None and self._streaming:
+            if self._failure is not None:
+                self._deferred.errback(self._failure)
+                return
+            try:
+                rest = self._parser.finish()
+            except Exception:
+                self._deferred.errback(failure.Failure())
+                return
+            # the rest is already parsed, reencode it for parse_response()
+            self._buffer = [json.dumps(rest)]
+        httpclient.ResponseDecoder.connectionLost(self, reason)
+
+
 class Notifier(object):
+    '''
+    I'm keeping a continuous changes feed open for a single filter,
+    evaluated by CouchDB. When the feed is restarted it resumes from the
+    last sequence received, so no change is lost in between.
+    '''
 
     def __init__(self, db, filter_):
         self._db = db
@@ -135,13 +294,86 @@ class Notifier(object):
         self.name = self._filter.name
         self._params = None
         self._changes = None
+        # sequence of the last change received
+        self._last_seq = None
+        # delayed restart coalescing the changes of the listeners
+        self._restart_call = None
+        self._restarts = defer.Notifier()
+
+        # statistics of the feed
+        self.changes_received = 0
+        self.bytes_received = 0
+
+    @property
+    def connected(self):
+        return self._changes is not None
+
+    def extract_params(self):
+        return self._filter.extract_params()
 
     def setup(self):
-        new_params = self._filter.extract_params()
+        new_params = self.extract_params()
+        if self._changes is not None and new_params is not None:
+            if new_params == self._params:
+                return defer.succeed(None)
+            # the listeners are usually registered in bursts,
+            # restart the feed only once for all of them
+            d = self._restarts.wait('restarted')
+            if self._restart_call is None:
+                self._restart_call = time.callLater(
+                    NOTIFIER_RESTART_DELAY, self._delayed_restart)
+            return d
+        return self._restart()
+
+    ### paisleys ChangeListener interface
+
+    def changed(self, change):
+        # The change parameter is just an ugly effect of json unserialization
+        # of the couchdb output. It can be many different things, hence the
+        # strange logic above.
+        self.changes_received += 1
+        if 'seq' in change:
+            self._last_seq = change['seq']
+        if "changes" in change:
+            self.dispatch(change)
+        else:
+            self._db.info('Bizare notification received from CouchDB: %r',
+                          change)
+
+    def connectionLost(self, reason):
+        self._changes = None
+        if reason.check(NotFoundError):
+            return reason
+        self._db.connectionLost(reason)
+
+    ### protected ###
+
+    def dispatch(self, change):
+        doc_id = change['id']
+        deleted = change.get('deleted', False)
+        for line in change['changes']:
+            self._filter.notified(doc_id, line['rev'], deleted)
+
+    ### private ###
+
+    def _delayed_restart(self):
+        self._restart_call = None
+        d = self._restart()
+        # the failures are given to the listeners waiting for the restart
+        d.addErrback(defer.override_result, None)
+
+    def _restart(self):
+        if self._restart_call is not None:
+            self._restart_call.cancel()
+            self._restart_call = None
+
+        new_params = self.extract_params()
         if (self._params is not None and
             new_params == self._params and
             self._changes is not None):
-            return defer.succeed(None)
+            d = defer.succeed(None)
+            d.addBoth(self._restarted)
+            return d
 
         self._params = new_params
 
@@ -149,7 +381,6 @@ class Notifier(object):
             self._changes.stop()
             self._changes = None
 
-
         d = defer.succeed(None)
         if new_params is not None:
             self._changes = ChangeReceiver(self)
@@ -158,49 +389,116 @@ class Notifier(object):
             query = dict(new_params)
             query['feed'] = 'continuous'
             query['heartbeat'] = 1000
+            if 'since' not in query and self._last_seq is not None:
+                # resume where the previous feed has stopped
+                query['since'] = self._last_seq
             if 'since' not in query:
                 url = '/%s/' % (self._db.db_name, )
                 d.addCallback(defer.drop_param, self._db.couchdb_call,
                               self._db.couchdb.get, url)
 
                 def set_since(resp):
+                    # only the changes done from now on are interesting
                     query['since'] = resp['update_seq']
+                    if self._last_seq is None:
+                        self._last_seq = resp['update_seq']
 
                 d.addCallback(set_since)
 
             def request_changes(decoder, query):
+                doc_ids = query.pop('doc_ids', None)
                 url = '/%s/_changes?%s' % (self._db.db_name, urlencode(query))
-                return self._db.couchdb.get(url, decoder=decoder,
-                                            outside_of_the_pool=True,
-                                            headers={'connection': 'close'})
+                headers = {'connection': 'close'}
+                if doc_ids is None:
+                    return self._db.couchdb.get(url, decoder=decoder,
+                                                outside_of_the_pool=True,
+                                                headers=headers)
+                body = json.dumps(dict(doc_ids=doc_ids))
+                return self._db.couchdb.post(url, body, decoder=decoder,
+                                             outside_of_the_pool=True,
+                                             headers=headers)
 
             d.addCallback(defer.drop_param, request_changes, self._changes,
                           query)
         else:
             self._db.log("Stopping notifier: %r", self.name)
+            # the changes done without listeners are not interesting
+            self._last_seq = None
         d.addErrback(self.connectionLost)
         d.addErrback(failure.Failure.trap, NotConnectedError)
+        d.addBoth(self._restarted)
         return d
 
-    ### paisleys ChangeListener interface
-
-    def changed(self, change):
-        # The change parameter is just an ugly effect of json unserialization
-        # of the couchdb output. It can be many different things, hence the
-        # strange logic above.
-        if "changes" in change:
-            doc_id = change['id']
-            deleted = change.get('deleted', False)
-            for line in change['changes']:
-                self._filter.notified(doc_id, line['rev'], deleted)
+    def _restarted(self, result):
+        if isinstance(result, failure.Failure):
+            self._restarts.errback('restarted', result)
         else:
-            self.info('Bizare notification received from CouchDB: %r', change)
+            self._restarts.callback('restarted', None)
+        return result
 
-    def connectionLost(self, reason):
-        self._changes = None
-        if reason.check(NotFoundError):
-            return reason
-        self._db.connectionLost(reason)
+
+class BulkWriter(object):
+    '''
+    I'm coalescing the documents written during one iteration of the
+    reactor, or up to the size limit, into a single _bulk_docs request.
+    The results are dispatched to the Deferreds of each write, the
+    conflicting documents fail with ConflictError.
+    '''
+
+    def __init__(self, db, max_size=DEFAULT_BULK_SIZE):
+        self._db = db
+        self.max_size = max_size
+        # [(serialized document, Deferred)]
+        self._pending = list()
+        self._flush_call = None
+
+        # statistics of the writes
+        self.requests = 0
+        self.documents = 0
+
+    def write(self, doc):
+        d = defer.Deferred()
+        self._pending.append((doc, d))
+        if len(self._pending) >= self.max_size:
+            self.flush()
+        elif self._flush_call is None:
+            self._flush_call = time.callLater(0, self.flush)
+        return d
+
+    def flush(self):
+        if self._flush_call is not None:
+            if self._flush_call.active():
+                self._flush_call.cancel()
+            self._flush_call = None
+
+        batch, self._pending = self._pending, list()
+        if not batch:
+            return
+
+        self.requests += 1
+        self.documents += len(batch)
+        d = self._db.bulk_docs([doc for doc, _ in batch])
+        d.addCallbacks(self._written, self._failed,
+                       callbackArgs=(batch, ), errbackArgs=(batch, ))
+
+    ### private ###
+
+    def _written(self, results, batch):
+        if not isinstance(results, list) or len(results) != len(batch):
+            msg = ("Expected %d results of _bulk_docs, got: %r"
+                   % (len(batch), results))
+            return self._failed(failure.Failure(DatabaseError(msg)), batch)
+
+        for (_, d), result in zip(batch, results):
+            error = bulk_docs_error(result)
+            if error is None:
+                d.callback(result)
+            else:
+                d.errback(error)
+
+    def _failed(self, fail, batch):
+        for _, d in batch:
+            d.errback(fail)
 
 
 class CouchDB(httpclient.ConnectionPool):
@@ -208,7 +506,8 @@ class CouchDB(httpclient.ConnectionPool):
     log_category = 'couchdb-connection'
 
     def __init__(self, host, port, username=None, password=None,
-                 https=False, maximum_connections=2, logger=None):
+                 https=False, maximum_connections=4, logger=None,
+                 minimum_connections=2):
         if username is not None and password is not None:
             a = auth.BasicHTTPCredentials(username, password)
             self._auth_header = a.header_value
@@ -222,6 +521,7 @@ class CouchDB(httpclient.ConnectionPool):
         httpclient.ConnectionPool.__init__(
             self, host, port,
             maximum_connections=maximum_connections,
+            minimum_connections=minimum_connections,
             security_policy=sp,
             logger=logger,
             enable_pipelineing=False)
@@ -231,6 +531,11 @@ class CouchDB(httpclient.ConnectionPool):
         headers.setdefault('accept', "application/json")
         return self.request(http.Methods.GET, url, headers=headers, **extra)
 
+    def head(self, url, headers=dict(), **extra):
+        self._set_auth(headers)
+        headers.setdefault('accept', "application/json")
+        return self.request(http.Methods.HEAD, url, headers=headers, **extra)
+
     def copy(self, url, headers, **extra):
         self._set_auth(headers)
         headers.setdefault('accept', "application/json")
@@ -256,6 +561,26 @@ class CouchDB(httpclient.ConnectionPool):
         return self.request(http.Methods.DELETE, url, headers=headers,
                             **extra)
 
+    def get_path_template(self, location):
+        # documents and attachments are accounted together,
+        # designs and views separately
+        parts = location.split('?', 1)[0].split('/')
+        for index in range(2, len(parts)):
+            if (parts[index] and not parts[index].startswith('_') and
+                parts[index - 1] not in NAMED_SEGMENTS):
+                parts[index] = '*'
+        return '/'.join(parts)
+
+    def get_priority(self, method, location):
+        # the changes feed delivers the notifications, the view queries
+        # should not delay the cheap document requests
+        parts = location.split('?', 1)[0].split('/')
+        if '_changes' in parts:
+            return httpclient.RequestPriority.high
+        if any(x in parts for x in SLOW_SEGMENTS):
+            return httpclient.RequestPriority.low
+        return httpclient.RequestPriority.normal
+
     def _set_auth(self, headers):
         if self._auth_header:
             headers['authorization'] = self._auth_header
@@ -302,6 +627,7 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener):
         # doc_id -> C{int} number of locks
         self._document_locks = dict()
         self._cache = Cache(desired_size=self.DESIRED_CACHE_SIZE)
+        self._writer = BulkWriter(self)
 
         self._configure(host, port, db_name, username, password,
                         https)
@@ -313,11 +639,31 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener):
     def show_connection_status(self):
         eta = self.reconnector and self.reconnector.active() and \
               time.left(self.reconnector.getTime())
-        return "CouchDB", self.is_connected(), self.host, self.port, eta
+        cache = ("hits: %(hits)d\nmisses: %(misses)d\n"
+                 "evictions: %(evictions)d\nsize: %(size)d\n"
+                 "revalidations: %(revalidations)d" %
+                 self._cache.get_stats())
+        return ("CouchDB", self.is_connected(), self.host, self.port, eta,
+                cache)
 
     def show_document_locks(self):
         return dict(self._document_locks), dict(self._pending_notifications)
 
+    def get_changes_stats(self):
+        '''Gives the number of continuous changes feeds opened and
+        the amount of changes and bytes received through them.'''
+        notifiers = self.notifiers.values()
+        return dict(
+            feeds=len([x for x in notifiers if x.connected]),
+            changes=sum(x.changes_received for x in notifiers),
+            bytes=sum(x.bytes_received for x in notifiers))
+
+    def get_pool_stats(self):
+        '''Gives the telemetry of the HTTP connection pool to CouchDB.'''
+        if self.couchdb is None:
+            return dict()
+        return self.couchdb.get_stats()
+
     ### IDbConnectionFactory
 
     def get_connection(self):
@@ -325,7 +671,7 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener):
 
     ### IDatabaseDriver
 
-    def open_doc(self, doc_id, **extra):
+    def open_doc(self, doc_id, if_none_match=None, **extra):
         url = '/%s/%s' % (self.db_name, quote(doc_id.encode('utf-8')))
         if extra:
             url += '?'
@@ -335,7 +681,17 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener):
                 if isinstance(v, types.BooleanType):
                     extra[k] = str(v).lower()
             url += urlencode(extra)
-        return self.couchdb_call(self.couchdb.get, url)
+        if if_none_match is None:
+            return self.couchdb_call(self.couchdb.get, url)
+        # the revision is the ETag of the document
+        headers = {'if-none-match': '"%s"' % (if_none_match, )}
+        return self.couchdb_call(self.couchdb.get, url, headers=headers,
+                                 parser=parse_not_modified)
+
+    def head_doc(self, doc_id):
+        url = '/%s/%s' % (self.db_name, quote(doc_id.encode('utf-8')))
+        return self.couchdb_call(self.couchdb.head, url,
+                                 parser=parse_revision)
 
     def copy_doc(self, doc_id, destination_id, rev=None):
         url = '/%s/%s' % (self.db_name, quote(doc_id.encode('utf-8')))
@@ -363,7 +719,13 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener):
         # This turns off using multipart requests for now
         force_json = True
 
-        if not following_attachments:
+        if (not following_attachments and db_name == self.db_name and
+            not (doc_id and doc_id.startswith('_local/'))):
+            # written together with the other documents saved meanwhile,
+            # the local documents are not supported by _bulk_docs
+            r = yield self._writer.write(doc)
+            defer.returnValue(r)
+        elif not following_attachments:
             r = yield self.couchdb_call(method, url, doc)
             defer.returnValue(r)
         elif version >= (1, 1, 2) and not force_json:
@@ -429,8 +791,10 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener):
     # cancel_listener from ChangeListener
 
     def query_view(self, factory, post_process=None, cache_id_suffix='',
-                   if_modified_since=None, **options):
+                   if_modified_since=None, consumer=None, **options):
         factory = IViewFactory(factory)
+        if consumer is not None and post_process is not None:
+            raise ValueError("Streamed view results cannot be post processed")
 
         url = "/%s/_design/%s/_view/%s" % (self.db_name,
                                            quote(str(factory.design_doc_id)),
@@ -452,6 +816,16 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener):
             cache_id = url
         cache_id += cache_id_suffix
 
+        if consumer is not None:
+            # streamed responses are not cached
+            row_consumer = lambda row: consumer(parse_view_row(row))
+            if body:
+                return self.couchdb_call(self.couchdb.post, url, body=body,
+                                         row_consumer=row_consumer)
+            else:
+                return self.couchdb_call(self.couchdb.get, url,
+                                         row_consumer=row_consumer)
+
         if post_process:
             parser = (parse_response, parse_view_result, post_process)
         else:
@@ -495,7 +869,7 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener):
         d.addCallback(lambda x: x['update_seq'])
         return d
 
-    def get_changes(self, filter_, limit=None, since=0):
+    def get_changes(self, filter_, limit=None, since=0, consumer=None):
         params = dict(since=since)
         if limit is not None:
             params['limit'] = limit
@@ -503,15 +877,26 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener):
             params['filter'] = str('%s/%s' % (filter_.view.design_doc_id,
                                               filter_.view.name))
         url = str('/%s/_changes?%s' % (self.db_name, urlencode(params)))
-        return self.couchdb_call(self.couchdb.get, url)
+        return self.couchdb_call(self.couchdb.get, url,
+                                 row_consumer=consumer)
 
-    def bulk_get(self, doc_ids):
+    def bulk_get(self, doc_ids, consumer=None, conflicts=False):
         url = '/%s/_all_docs?include_docs=true' % (self.db_name, )
+        if conflicts:
+            url += '&conflicts=true'
         body = dict(keys=doc_ids)
+        if consumer is not None:
+            return self.couchdb_call(self.couchdb.post, url,
+                                     json.dumps(body), row_consumer=consumer)
         cache_id = "%s#%s" % (url, hash(tuple(doc_ids)))
         return self.couchdb_call(self.couchdb.post,
                                  url, json.dumps(body), cache_id=cache_id)
 
+    def bulk_docs(self, docs):
+        url = '/%s/_bulk_docs' % (self.db_name, )
+        body = '{"docs": [%s]}' % (', '.join(docs), )
+        return self.couchdb_call(self.couchdb.post, url, body)
+
     def get_version(self):
         if self.version:
             return defer.succeed(self.version)
@@ -576,10 +961,17 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener):
         cache_id = kwargs.pop('cache_id', None)
         parser = kwargs.pop('parser', parse_response)
         if_modified_since = kwargs.pop('if_modified_since', None)
+        row_consumer = kwargs.pop('row_consumer', None)
 
         tag = "%s on %s" % (method.__name__.upper(), url)
         entry = None
 
+        if row_consumer is not None:
+            # the rows are passed to the consumer while the response is
+            # received, there is no body to be cached
+            cache_id = None
+            kwargs['decoder'] = RowsDecoder(row_consumer)
+
         if cache_id:
             entry = self._cache.get_url(cache_id)
             if entry and entry.state == EntryState.waiting:
@@ -613,7 +1005,8 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener):
         d.addCallback(defer.bridge_param, self._on_connected)
         if entry:
             d.addCallback(defer.keep_param, self._cache.freshen_entries)
-            d.addBoth(defer.keep_param, entry.got_response)
+            d.addBoth(defer.keep_param, self._cache.got_response,
+                      cache_id, entry)
             d.addErrback(self._error_handler)
             return entry.wait()
         else:
@@ -630,6 +1023,8 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener):
                                https=https)
         self.db_name = name
         self.disconnected = False
+        # tag of the database, cached by the connections
+        self.database_tag = None
 
         self._pending_notifications.clear()
         self._document_locks.clear()
@@ -782,10 +1177,19 @@ class CacheEntry(object):
 class Cache(dict):
     '''
     url -> CacheEntry
+
+    The entries are evicted by their size using segmented LRU. Entries
+    which got their response are admitted to the probation segment, the
+    ones hit again are promoted to the protected segment. When the cache
+    grows over the desired size the least recently used entries of the
+    probation segment are evicted first, which keeps the one-off
+    responses from flushing out the frequently used ones.
     '''
 
     DEFAULT_DESIRED_SIZE = 10 * 1024 * 1024
     OPERATIONS_PER_CLEANUP = 500
+    # part of the desired size which can be taken by the protected segment
+    PROTECTED_RATIO = 0.8
 
     def __init__(self, desired_size=None):
         super(Cache, self).__init__()
@@ -795,15 +1199,85 @@ class Cache(dict):
         self.last_cleanup = None
         self._operation = 0
 
+        # ident -> size of the entry at the moment it was accounted
+        self._probation = OrderedDict()
+        self._protected = OrderedDict()
+        self._probation_size = 0
+        self._protected_size = 0
+        # etag -> set([ident])
+        self._etags = dict()
+        # ident -> etag the entry is indexed with
+        self._indexed_etags = dict()
+
+        # public statistics
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.revalidations = 0
+
     def get_url(self, identifier):
         self._bump_counter()
-        if identifier in self and self[identifier].state != EntryState.invalid:
-            return self[identifier]
+        entry = self.get(identifier)
+        if entry is None:
+            self.misses += 1
+            return
+        if entry.state == EntryState.invalid:
+            del self[identifier]
+            self.misses += 1
+            return
+        self.hits += 1
+        self._touch(identifier)
+        return entry
+
+    def got_response(self, response, identifier, entry):
+        '''
+        Passes the response to the entry and accounts for its new size.
+        The entry might have been removed or replaced in the meantime,
+        in this case only the entry is updated.
+        '''
+        entry.got_response(response)
+        if self.get(identifier) is not entry:
+            return
+        if entry.state == EntryState.invalid:
+            del self[identifier]
+            return
+        self._index_etag(identifier, entry.etag)
+        if entry.size is None:
+            return
+        if identifier in self._protected:
+            # revalidated entry keeps its place in the protected segment
+            self._protected_size += entry.size - self._protected[identifier]
+            self._protected[identifier] = entry.size
+        else:
+            self._probation_size += (entry.size -
+                                     self._probation.pop(identifier, 0))
+            self._probation[identifier] = entry.size
+        self._evict()
 
     def __setitem__(self, key, value):
+        if key in self:
+            self._forget(key)
         super(Cache, self).__setitem__(key, value)
         self._bump_counter()
 
+    def __delitem__(self, key):
+        super(Cache, self).__delitem__(key)
+        self._forget(key)
+
+    def pop(self, key, *default):
+        if key in self:
+            self._forget(key)
+        return super(Cache, self).pop(key, *default)
+
+    def clear(self):
+        super(Cache, self).clear()
+        self._probation.clear()
+        self._protected.clear()
+        self._probation_size = 0
+        self._protected_size = 0
+        self._etags.clear()
+        self._indexed_etags.clear()
+
     def _bump_counter(self):
         self._operation += 1
         if self._operation % self.OPERATIONS_PER_CLEANUP == 0:
@@ -812,7 +1286,9 @@ class Cache(dict):
     def cleanup(self, ctime=None):
         '''
         This method is called iteratively by the connection owning it.
-        Its job is to control the size of cache and remove old entries.
+        It samples the size of the cache and makes sure it fits in the
+        desired size. The invalid entries are removed as soon as they
+        are discovered, so there is no need to go through all of them.
         '''
         ctime = ctime or time.time()
         if self.last_cleanup:
@@ -820,30 +1296,7 @@ class Cache(dict):
         self.last_cleanup = ctime
 
         log.debug('couchdb', "Running cache cleanup().")
-        # first remove already invalidated entries, used this iteration to
-        # build up the map of usage
-        expire = list()
-
-        # [(num_accessed / time_in_cache, size, ident)]
-        usage = list()
-
-        actual_size = 0
-
-        for ident, entry in self.iteritems():
-            if entry.state is EntryState.invalid:
-                expire.append(ident)
-                continue
-            elif entry.state is EntryState.waiting:
-                continue
-            else: # EntryState.ready
-                actual_size += entry.size
-                time_in_cache = max([ctime - entry.cached_at, 1])
-                usage.append((
-                    float(entry.num_accessed) / time_in_cache,
-                    -entry.size,
-                    ident))
-
-        self.average_size.add_point(actual_size)
+        self.average_size.add_point(self.get_size())
 
         if self.average_size.get_value() > 3 * self.desired_size:
             log.warning("couchdb", "The average size of Cache is %.2f times "
@@ -851,40 +1304,77 @@ class Cache(dict):
                         "a good idea to rethink the caching strategy.",
                         self.average_size.get_value() / self.desired_size,
                         self.desired_size)
-
-        if actual_size > self.desired_size:
-            log.debug('couchdb', "I will have to cleanup some data, "
-                      "the actual size is: %s, the desired limit is %s.",
-                      actual_size, self.desired_size)
-            # The usage list is sorted in order of things I will
-            # be removing first. The important factor is "density" of usages
-            # in time.
-            usage.sort()
-            size_to_delete = 0
-            num_to_delete = 0
-            while (len(usage) > 1 and
-                   actual_size - size_to_delete > self.desired_size):
-                _, negative_size, ident = usage.pop(0)
-                size_to_delete += -negative_size
-                num_to_delete += 1
-                expire.append(ident)
-            log.debug('couchdb', "I will remove %d entries from cache of the "
-                      "size of %s to compensate the size.",
-                      num_to_delete, size_to_delete)
-
-        for ident in expire:
-            del self[ident]
+        self._evict()
 
     def get_size(self):
-        return sum([x.size for x in self.itervalues()])
+        return self._probation_size + self._protected_size
+
+    def get_stats(self):
+        return dict(hits=self.hits, misses=self.misses,
+                    evictions=self.evictions,
+                    revalidations=self.revalidations,
+                    size=self.get_size(), entries=len(self))
 
     def freshen_entries(self, response):
         etag = response.headers.get('etag')
         if response.status == 304 and etag:
+            self.revalidations += 1
             ctime = time.time()
-            for entry in self.itervalues():
-                if entry.etag == etag:
-                    entry.fresh_at = ctime
+            for ident in self._etags.get(etag, ()):
+                self[ident].fresh_at = ctime
+
+    ### private ###
+
+    def _touch(self, ident):
+        if ident in self._protected:
+            size = self._protected.pop(ident)
+            self._protected[ident] = size
+        elif ident in self._probation:
+            # second hit, promote the entry to the protected segment
+            size = self._probation.pop(ident)
+            self._probation_size -= size
+            self._protected[ident] = size
+            self._protected_size += size
+            self._demote()
+
+    def _demote(self):
+        limit = self.desired_size * self.PROTECTED_RATIO
+        while len(self._protected) > 1 and self._protected_size > limit:
+            ident, size = self._protected.popitem(last=False)
+            self._protected_size -= size
+            self._probation[ident] = size
+            self._probation_size += size
+
+    def _evict(self):
+        # never evict the last entry, it might be the one just admitted
+        while (len(self._probation) + len(self._protected) > 1 and
+               self.get_size() > self.desired_size):
+            if self._probation:
+                ident = iter(self._probation).next()
+            else:
+                ident = iter(self._protected).next()
+            self.evictions += 1
+            del self[ident]
+
+    def _forget(self, ident):
+        size = self._probation.pop(ident, None)
+        if size is not None:
+            self._probation_size -= size
+        size = self._protected.pop(ident, None)
+        if size is not None:
+            self._protected_size -= size
+        self._index_etag(ident, None)
+
+    def _index_etag(self, ident, etag):
+        old = self._indexed_etags.pop(ident, None)
+        if old is not None:
+            idents = self._etags[old]
+            idents.discard(ident)
+            if not idents:
+                del self._etags[old]
+        if etag is not None:
+            self._indexed_etags[ident] = etag
+            self._etags.setdefault(etag, set()).add(ident)
 
 
 def apply_parsers(response, parsers, tag):
@@ -923,6 +1413,18 @@ def parse_response(response, tag):
             return failure.Failure(DatabaseError(msg))
 
 
+def parse_revision(response, tag):
+    if response.status < 300:
+        return response.headers.get('etag', '').strip('"')
+    return parse_response(response, tag)
+
+
+def parse_not_modified(response, tag):
+    if response.status == http.Status.NOT_MODIFIED:
+        return None
+    return parse_response(response, tag)
+
+
 def parse_binary(response, tag):
     if response.status < 300:
         return response.body
@@ -941,19 +1443,17 @@ def parse_view_result(resp, tag):
                (resp, ))
         return failure.Failure(DatabaseError(msg))
 
-    result = list()
+    return [parse_view_row(row) for row in resp["rows"]]
 
-    for row in resp["rows"]:
-        if "id" in row:
-            if "doc" in row:
-                # querying with include_docs=True
-                r = (row["key"], row["value"], row["id"], row["doc"])
-                result.append(r)
-            else:
-                # querying without reduce
-                result.append((row["key"], row["value"], row["id"]))
-        else:
-            # querying with reduce
-            result.append((row["key"], row["value"]))
 
-    return result
+def parse_view_row(row):
+    if "id" in row:
+        if "doc" in row:
+            # querying with include_docs=True
+            return (row["key"], row["value"], row["id"], row["doc"])
+        else:
+            # querying without reduce
+            return (row["key"], row["value"], row["id"])
+    else:
+        # querying with reduce
+        return (row["key"], row["value"])
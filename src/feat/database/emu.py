@@ -21,6 +21,7 @@
 # Headers in this file shall remain intact.
 # -*- Mode: Python -*-
 # vi:si:et:sw=4:sts=4:ts=4
+import bisect
 import copy
 import uuid
 import json
@@ -66,8 +67,8 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener,
         self._documents = {}
         # id -> name -> body
         self._attachments = {}
-        # id -> view_name -> (key, value)
-        self._view_cache = {}
+        # (design_doc_id, view_name) -> ViewIndex
+        self._view_indexes = {}
 
         self._on_connected()
 
@@ -78,6 +79,9 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener,
         # list of all old revisions
         self._changes = list()
 
+        # tag of the database, cached by the connections
+        self.database_tag = None
+
     ### IDbConnectionFactory
 
     def get_connection(self):
@@ -148,13 +152,37 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener,
 
         return d
 
+    def bulk_docs(self, docs):
+        '''Imitates the _bulk_docs request, the conflicts are reported
+        in the results of the documents causing them.'''
+        self.increase_stat('bulk_docs')
+
+        results = list()
+
+        def conflict(fail, doc):
+            fail.trap(ConflictError)
+            results.append(dict(id=json.loads(doc).get('_id'),
+                                error='conflict',
+                                reason=str(fail.value)))
+
+        defers = list()
+        for doc in docs:
+            d = self.save_doc(doc)
+            d.addCallbacks(results.append, conflict, errbackArgs=(doc, ))
+            defers.append(d)
+        d = defer.DeferredList(defers, fireOnOneErrback=True,
+                               consumeErrors=True)
+        d.addCallbacks(defer.override_result, lambda f: f.value.subFailure,
+                       callbackArgs=(results, ))
+        return d
+
     def _analize_changes(self, doc):
         for filter_i in self._filters.itervalues():
             if filter_i.match(doc):
                 deleted = doc.get('_deleted', False)
                 filter_i.notified(doc['_id'], doc['_rev'], deleted)
 
-    def open_doc(self, doc_id):
+    def open_doc(self, doc_id, if_none_match=None):
         '''Imitated fetching the document from the database.
         Doesnt implement options from paisley to get the old revision or
         get the list of revision.
@@ -163,15 +191,27 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener,
         self.increase_stat('open_doc')
         try:
             doc = self._get_doc(doc_id)
-            doc = copy.deepcopy(doc)
             if doc.get('_deleted', None):
                 raise NotFoundError('%s deleted' % doc_id)
-            d.callback(Response(doc))
+            if if_none_match is not None and doc['_rev'] == if_none_match:
+                d.callback(None)
+            else:
+                d.callback(Response(copy.deepcopy(doc)))
         except NotFoundError as e:
             d.errback(e)
 
         return d
 
+    def head_doc(self, doc_id):
+        self.increase_stat('head_doc')
+        try:
+            doc = self._get_doc(doc_id)
+            if doc.get('_deleted', None):
+                raise NotFoundError('%s deleted' % doc_id)
+            return defer.succeed(doc['_rev'])
+        except NotFoundError as e:
+            return defer.fail(e)
+
     def copy_doc(self, doc_id, destination_id, rev=None):
         d = self.open_doc(doc_id)
         d.addCallback(defer.keep_param, defer.call_param,
@@ -210,6 +250,9 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener,
 
     def query_view(self, factory, **options):
         factory = IViewFactory(factory)
+        consumer = options.pop('consumer', None)
+        if consumer is not None and 'post_process' in options:
+            raise ValueError("Streamed view results cannot be post processed")
         use_reduce = factory.use_reduce and options.get('reduce', True)
         group = options.pop('group', False)
         group_level = options.pop('group_level', None)
@@ -222,8 +265,6 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener,
             raise ValueError("Query parameter 'include_docs' is invalid for "
                              "reduce views.")
 
-        iterator = (self._perform_map(doc, factory)
-                    for doc in self._iterdocs())
         # In erlang ordering of objects is different than in python.
         # Empty dict ({}) is the "biggest" value, by convetion its used
         # to denote the end of the range. In python {} < str, so we substitute
@@ -232,11 +273,12 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener,
             if keyname in options and isinstance(options[keyname], tuple):
                 options[keyname] = tuple(x if x != {} else BIGGEST
                                          for x in options[keyname])
-        d = defer.succeed(iterator)
-        d.addCallback(self._flatten, **options)
+        d = defer.succeed(factory)
+        d.addCallback(self._get_view_index)
+        d.addCallback(self._select_rows, **options)
         if use_reduce:
-            d.addCallback(self._perform_reduce, factory, group=group,
-                          group_level=group_level)
+            d.addCallback(self._perform_cached_reduce, factory,
+                          group, group_level, options)
         if include_docs:
             d.addCallback(self._include_docs)
         d.addCallback(self._apply_slice, **options)
@@ -248,6 +290,8 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener,
             else:
                 d.addCallback(options['post_process'][0], tag,
                               *options['post_process'][1:])
+        if consumer is not None:
+            d.addCallback(self._feed_consumer, consumer, 'rows')
         return d
 
     def disconnect(self):
@@ -279,7 +323,7 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener,
     def get_update_seq(self):
         return defer.succeed(len(self._changes))
 
-    def get_changes(self, filter_, limit=None, since=0):
+    def get_changes(self, filter_, limit=None, since=0, consumer=None):
         results = list()
         for seq in range(since, len(self._changes)):
             doc = self._changes[seq]
@@ -288,22 +332,19 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener,
             results.append(
                 dict(seq=seq, id=doc['_id'], changes=[{'rev': doc['_rev']}]))
         result = dict(results=results, last_seq=len(self._changes))
-        return defer.succeed(result)
+        d = defer.succeed(result)
+        if consumer is not None:
+            d.addCallback(self._feed_consumer, consumer, 'results')
+        return d
 
-    def bulk_get(self, doc_ids):
-        result = list()
-        for doc_id in doc_ids:
-            self.increase_stat('open_doc')
-            try:
-                doc = self._get_doc(doc_id)
-                doc = copy.deepcopy(doc)
-                value = dict(rev=doc['_rev'])
-                if doc.get('_deleted', None):
-                    value['deleted'] = True
-                result.append({'_id': doc['_id'], 'value': value, 'doc': doc})
-            except NotFoundError:
-                result.append(dict(error="not_found"))
-        return defer.succeed(dict(rows=result))
+    def bulk_get(self, doc_ids, consumer=None, conflicts=False):
+        # the emulated database keeps no conflicts, the _conflicts
+        # loaded with the fixtures are always returned
+        if consumer is not None:
+            d = defer.succeed(dict(rows=self._iter_docs(doc_ids)))
+            d.addCallback(self._feed_consumer, consumer, 'rows')
+            return d
+        return defer.succeed(dict(rows=list(self._iter_docs(doc_ids))))
 
     ### public used in tests ###
 
@@ -313,6 +354,7 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener,
         attachments if necessary.'''
         doc = json.loads(body)
         self._documents[doc['_id']] = doc
+        self._expire_cache(doc['_id'])
         self._attachments[doc['_id']] = dict()
         for name in doc.get('_attachments', list()):
             attachment_body = attachment_bodies.get(name, 'stub')
@@ -320,6 +362,30 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener,
 
     ### private ###
 
+    def _iter_docs(self, doc_ids):
+        for doc_id in doc_ids:
+            self.increase_stat('open_doc')
+            try:
+                doc = self._get_doc(doc_id)
+                doc = copy.deepcopy(doc)
+                value = dict(rev=doc['_rev'])
+                if doc.get('_deleted', None):
+                    value['deleted'] = True
+                yield {'_id': doc['_id'], 'key': doc_id,
+                       'value': value, 'doc': doc}
+            except NotFoundError:
+                yield dict(key=doc_id, error="not_found")
+
+    def _feed_consumer(self, result, consumer, key):
+        # Mimics the streamed responses of the driver: the rows are
+        # passed to the consumer and the result is left without them.
+        if isinstance(result, list):
+            result = dict(rows=result)
+        for row in result[key]:
+            consumer(row)
+        result[key] = []
+        return result
+
     def _include_docs(self, rows):
         '''rows here are tuples (key, value, id), returns a list of tuples
         (key, value, id, doc)'''
@@ -349,7 +415,7 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener,
 
         if skip > 0 or limit is not None:
             if limit is None:
-                index = slice(skip, -1)
+                index = slice(skip, None)
             else:
                 index = slice(skip, skip + limit)
             rows = rows[index]
@@ -378,25 +444,41 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener,
                 return False
         return True
 
-    def _flatten(self, iterator, **filter_options):
+    def _select_rows(self, index, **filter_options):
         '''
-        iterator here gives as lists of tuples. Method flattens the structure
-        to a single list of tuples.
+        Returns the list of tuples (key, value, id) matching the options
+        sorted by the key.
         '''
-        resp = list()
-        for entry in iterator:
-            for tup in entry:
-                if self._matches_filter(tup, **filter_options):
-                    resp.append(tup)
-        return resp
+        rows = index.select(**filter_options)
+        selectors = [x for x in ('key', 'keys', 'startkey', 'endkey')
+                     if x in filter_options]
+        if len(selectors) > 1:
+            # the index only narrowed the rows using one of the selectors
+            rows = [x for x in rows
+                    if self._matches_filter(x, **filter_options)]
+        return rows
 
-    def _perform_map(self, doc, factory):
-        cached = self._get_cache(doc['_id'], factory.name)
-        if cached:
-            return cached
-        res = list(x + (doc['_id'], ) for x in factory.perform_map(doc))
-        self._set_cache(doc['_id'], factory.name, res)
-        return res
+    def _get_view_index(self, factory):
+        key = (factory.design_doc_id, factory.name)
+        index = self._view_indexes.get(key)
+        if index is None:
+            index = ViewIndex(factory)
+            for doc in self._iterdocs():
+                index.invalidate(doc['_id'])
+            self._view_indexes[key] = index
+        index.update(self._documents)
+        return index
+
+    def _perform_cached_reduce(self, map_results, factory,
+                               group, group_level, options):
+        index = self._get_view_index(factory)
+        key = _freeze((group, group_level,
+                       [(k, options.get(k)) for k in
+                        ('key', 'keys', 'startkey', 'endkey', 'descending')]))
+        if key not in index.reduce_cache:
+            index.reduce_cache[key] = self._perform_reduce(
+                map_results, factory, group=group, group_level=group_level)
+        return list(index.reduce_cache[key])
 
     def _perform_reduce(self, map_results, factory, group=False,
                         group_level=None):
@@ -449,16 +531,9 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener,
                 continue
             yield doc
 
-    def _get_cache(self, doc_id, view_name):
-        return self._view_cache.get(doc_id, {}).get(view_name, None)
-
-    def _set_cache(self, doc_id, view_name, value):
-        if doc_id not in self._view_cache:
-            self._view_cache[doc_id] = dict()
-        self._view_cache[doc_id][view_name] = value
-
     def _expire_cache(self, doc_id):
-        self._view_cache.pop(doc_id, None)
+        for index in self._view_indexes.itervalues():
+            index.invalidate(doc_id)
 
     def _set_id_and_revision(self, doc, doc_id):
         doc_id = doc_id or doc.get('_id', None)
@@ -511,3 +586,125 @@ class Database(common.ConnectionManager, log.LogProxy, ChangeListener,
 class Response(dict):
 
     pass
+
+
+class ViewIndex(object):
+    '''
+    Rows emitted by the view for all the documents, kept sorted by
+    (key, doc_id) so that the ranges of keys are found with binary search.
+    The changed documents are remapped lazily before the next query.
+    '''
+
+    # above this number of changed documents the index is rebuilt
+    # instead of being updated row by row
+    REBUILD_RATIO = 0.5
+
+    def __init__(self, factory):
+        self.factory = factory
+        # [(key, doc_id)] sorted
+        self._keys = list()
+        # [(key, value, doc_id)] in the same order as the keys
+        self._rows = list()
+        # doc_id -> [(key, doc_id)] emitted by the document
+        self._emitted = dict()
+        # ids of the documents which changed since the last update
+        self._pending = set()
+        # frozen query options -> reduced rows
+        self.reduce_cache = dict()
+
+    def invalidate(self, doc_id):
+        self._pending.add(doc_id)
+
+    def update(self, documents):
+        if not self._pending:
+            return
+        self.reduce_cache.clear()
+        # the pending set is cleared only after all the documents got
+        # mapped, if the map function fails they are retried next time
+        pending = self._pending
+        if len(pending) > len(self._emitted) * self.REBUILD_RATIO:
+            self._rebuild(documents, pending)
+        else:
+            self._update(documents, pending)
+        self._pending = set()
+
+    def _update(self, documents, pending):
+        for doc_id in pending:
+            for entry in self._emitted.get(doc_id, ()):
+                index = bisect.bisect_left(self._keys, entry)
+                del self._keys[index]
+                del self._rows[index]
+            for row in self._map(doc_id, documents.get(doc_id)):
+                entry = (row[0], row[2])
+                index = bisect.bisect_right(self._keys, entry)
+                self._keys.insert(index, entry)
+                self._rows.insert(index, row)
+
+    def select(self, descending=False, **options):
+        '''
+        Returns the list of rows matching one of the key selectors.
+        '''
+        if 'key' in options:
+            rows = self._range(options['key'], options['key'])
+        elif 'keys' in options:
+            unique = dict((_freeze(x), x) for x in options['keys'])
+            rows = list()
+            for key in sorted(unique.itervalues()):
+                rows.extend(self._range(key, key))
+        elif descending:
+            rows = self._range(options.get('endkey', NOTHING),
+                               options.get('startkey', NOTHING),
+                               high_id=options.get('startkey_docid', BIGGEST))
+        else:
+            rows = self._range(options.get('startkey', NOTHING),
+                               options.get('endkey', NOTHING),
+                               low_id=options.get('startkey_docid'))
+        if descending:
+            rows.reverse()
+        return rows
+
+    ### private ###
+
+    def _range(self, low, high, low_id=None, high_id=BIGGEST):
+        # the document ids narrow down the rows of the boundary keys
+        # the way startkey_docid does it
+        start = 0
+        if low is not NOTHING:
+            entry = (low, ) if low_id is None else (low, low_id)
+            start = bisect.bisect_left(self._keys, entry)
+        end = len(self._keys)
+        if high is not NOTHING:
+            end = bisect.bisect_right(self._keys, (high, high_id))
+        return self._rows[start:end]
+
+    def _rebuild(self, documents, pending):
+        rows = [row for row in self._rows if row[2] not in pending]
+        for doc_id in pending:
+            rows.extend(self._map(doc_id, documents.get(doc_id)))
+        rows.sort(key=lambda row: (row[0], row[2]))
+        self._rows = rows
+        self._keys = [(row[0], row[2]) for row in rows]
+
+    def _map(self, doc_id, doc):
+        self._emitted.pop(doc_id, None)
+        if doc is None or doc.get('_deleted', False):
+            return []
+        rows = list(x + (doc_id, ) for x in self.factory.perform_map(doc))
+        if rows:
+            self._emitted[doc_id] = [(x[0], doc_id) for x in rows]
+        return rows
+
+
+class Nothing(object):
+    '''Marks the missing range boundary.'''
+
+NOTHING = Nothing()
+
+
+def _freeze(value):
+    '''Turns the value into something hashable.'''
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(x) for x in value)
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.iteritems()))
+    return value
@@ -125,6 +125,19 @@ class IDatabaseClient(Interface):
                   set)
         '''
 
+    def save_documents(documents):
+        '''
+        Save multiple documents with a single request. The documents with
+        attachments to be uploaded are saved one by one.
+
+        @param documents: Documents to be saved.
+        @type documents: C{list} of L{feat.agents.document.Document}
+        @returns: Deferred called with the C{list} of the updated documents,
+                  in the same order. The documents which could not be
+                  saved are replaced by the exception explaining why
+                  (L{ConflictError} for conflicts).
+        '''
+
     def get_document(document_id):
         '''
         Download the document from the database and instantiate it.
@@ -213,6 +226,10 @@ class IDatabaseClient(Interface):
         @param factory: View factory to query.
         @type  factory: L{feat.interface.view.IViewFactory}
         @param options: Dictionary of parameters to pass to the query.
+                        The special option C{consumer} is a callable
+                        called with each result as soon as it is received
+                        from the database, in this case the Deferred
+                        fires with None when the response is consumed.
 
         @rtype: C{list} of results.
         '''
@@ -256,11 +273,29 @@ class IDatabaseDriver(Interface):
         @return: Deferred fired with the HTTP response body (keys: id, rev)
         '''
 
-    def open_doc(doc_id):
+    def bulk_docs(docs):
+        '''
+        Create or update multiple documents with a single request.
+        @param docs: C{list} of strings with json documents
+        @return: Deferred fired with the C{list} of the results for each
+                 document (keys: id, rev or id, error, reason)
+        '''
+
+    def open_doc(doc_id, if_none_match=None):
         '''
         Fetch document from database.
         @param doc_id: id of the document to fetch
-        @return: Deferred fired with json parsed document.
+        @param if_none_match: optional revision of the document known
+                              to the caller
+        @return: Deferred fired with json parsed document, or None if
+                 the document still has the if_none_match revision.
+        '''
+
+    def head_doc(doc_id):
+        '''
+        Fetch the current revision of the document without its body.
+        @param doc_id: id of the document
+        @return: Deferred fired with the revision.
         '''
 
     def copy_doc(doc_id, destination_id, revision):
@@ -325,13 +360,16 @@ class IDatabaseDriver(Interface):
         @callback: C{int} databse sequence number
         '''
 
-    def get_changes(filter, limit, since):
+    def get_changes(filter, limit, since, consumer=None):
         '''
         Returns information about the changes done to the database since
         the specified revision.
         @param filter: IViewFactory or None
         @param limit: optionally limit the data
         @param since: update_seq of database to start changes
+        @param consumer: optional callable, if given it is called with
+                         each element of "results" while the response is
+                         received and the results are left empty
         @rtype: Deferred
         @callback: C{dict} of the following form
            {"results":[
@@ -340,10 +378,13 @@ class IDatabaseDriver(Interface):
             "last_seq":1}
         '''
 
-    def bulk_get(doc_ids):
+    def bulk_get(doc_ids, consumer=None):
         '''
         Like get_document() but returns multiple documents in a single request.
         @param doc_ids: C{list} of doc_ids to fetch
+        @param consumer: optional callable, if given it is called with
+                         each row of the response while it is received and
+                         the "rows" are left empty
         @rtype: Deferred
         @callback: list of documents
         '''
@@ -1,4 +1,4 @@
-from feat.common import annotate, defer, container, error
+from feat.common import annotate, defer, container, error, first
 from feat.database import query
 from feat.models import model, action, value, utils, call, effect
 from feat.models import applicationjson
@@ -77,6 +77,7 @@ class QueryViewMeta(type(model.Collection)):
         cls._fetch_documents_set = False
         cls._fetch_documents = staticmethod(effect.identity)
         cls._item_field = None
+        cls._fetch_sources = None
 
         # this processes all the annotations
         super(QueryViewMeta, cls).__init__(name, bases, dct)
@@ -250,6 +251,32 @@ class QueryViewMeta(type(model.Collection)):
 
             cls.annotate_child_source(fetch_source)
 
+            def fetch_sources(names, context):
+                # Retrieves all the item sources with a single query,
+                # the item field index is used to map them back to names
+                c = query.Condition(
+                    cls._item_field, query.Evaluator.inside, names)
+                q = cls._factory(c)
+                d = build_query(None, context, query=q)
+                d.addCallback(context['model'].do_select, skip=0)
+                d.addCallback(map_sources, context)
+                return d
+
+            def map_sources((rows, responses), context):
+                index = first(v for k, v in responses.iteritems()
+                              if k.field == cls._item_field)
+                d = defer.succeed(rows)
+                d.addCallback(cls._fetch_documents, context)
+                d.addCallback(lambda docs: dict(
+                    (index.get_value(doc.doc_id), doc) for doc in docs))
+                return d
+
+            item_field = cls._factory.fields[cls._item_field]
+            if (cls._fetch_sources is None
+                and cls._query_target == 'source'
+                and item_field.keeps_value):
+                cls.annotate_child_sources(fetch_sources)
+
             def fetch_view(value, context):
                 if cls._query_target == 'view':
                     return fetch_matching(value, context)
@@ -1,6 +1,7 @@
 import decimal
 import inspect
 import time
+import weakref
 
 from zope.interface import implements, classProvides
 
@@ -18,6 +19,7 @@ class ParsedIndex(object):
 
     def __init__(self, entries, keep_value=False):
         self.includes_values = keep_value
+        self._ids = None
         if not keep_value:
             # here entries is just a list of ids
             self.entries = entries
@@ -32,6 +34,19 @@ class ParsedIndex(object):
     def get_value(self, id):
         return self.values.get(id)
 
+    @property
+    def ids(self):
+        '''
+        Unique ids of the index supporting fast membership tests.
+        It is built once and cached along with the parsed index.
+        '''
+        if self._ids is None:
+            if self.includes_values:
+                self._ids = self.values
+            else:
+                self._ids = frozenset(self.entries)
+        return self._ids
+
 
 class Field(object):
 
@@ -543,13 +558,14 @@ class Result(list):
 @defer.inlineCallbacks
 def select_ids(connection, query, skip=0, limit=None,
                include_responses=False):
-    temp, responses = yield _get_query_response(connection, query)
+    plan, responses = yield _get_query_response(connection, query)
 
-    total_count = len(temp)
+    total_count = plan.count()
+    # stop walking the sort index once all the rows are given
     if limit is not None:
-        stop = skip + limit
+        stop = min(skip + limit, total_count)
     else:
-        stop = None
+        stop = total_count
 
     name, direction = query.sorting
     index = first(v.entries
@@ -558,12 +574,7 @@ def select_ids(connection, query, skip=0, limit=None,
     if direction == Direction.DESC:
         index = reversed(index)
 
-    if query.aggregate:
-        # we have to copy the collection, because _get_sorted_slice()
-        # treats it as a buffer, and modifies the content
-        aggregate_index = set(temp)
-
-    r = Result(_get_sorted_slice(index, temp, skip, stop))
+    r = Result(_get_sorted_slice(index, plan, skip, stop))
     r.total_count = total_count
 
     # count reductions for aggregated fields based on the view index
@@ -573,7 +584,7 @@ def select_ids(connection, query, skip=0, limit=None,
             value_index = first(v for k, v in responses.iteritems()
                                 if k.field == field)
             r.aggregations.append(handler(
-                x for x in value_iterator(aggregate_index, value_index)))
+                x for x in value_iterator(plan, value_index)))
     if include_responses:
         defer.returnValue((r, responses))
     else:
@@ -615,8 +626,8 @@ def include_values(docs, responses, query):
 
 @defer.inlineCallbacks
 def count(connection, query):
-    temp, responses = yield _get_query_response(connection, query)
-    defer.returnValue(len(temp))
+    plan, responses = yield _get_query_response(connection, query)
+    defer.returnValue(plan.count())
 
 
 @defer.inlineCallbacks
@@ -627,7 +638,7 @@ def values(connection, query, field, unique=True):
     query.include_value.append(field)
     query.reset() # ensures the field condition gets included
 
-    temp, responses = yield _get_query_response(connection, query)
+    plan, responses = yield _get_query_response(connection, query)
     index = first(v for k, v in responses.iteritems()
                   if k.field == field)
     if not index.includes_values:
@@ -638,53 +649,297 @@ def values(connection, query, field, unique=True):
                          (field, query.name))
     if unique:
         resp = set()
-        for x in temp:
+        for x in plan:
             resp.add(index.get_value(x))
         defer.returnValue(list(resp))
     else:
         resp = list()
-        for x in temp:
+        for x in plan:
             resp.append(index.get_value(x))
         defer.returnValue(resp)
 
 
+def get_fetcher(connection):
+    '''
+    Returns the L{ViewFetcher} used to run the queries of the connection.
+    '''
+    fetcher = _fetchers.get(connection)
+    if fetcher is None:
+        fetcher = ViewFetcher()
+        _fetchers[connection] = fetcher
+    return fetcher
+
+
+class ViewFetcher(object):
+    '''
+    Fetches the view indexes needed to evaluate the queries.
+
+    The conditions selecting the exact keys of the same view are coalesced
+    into a single multi-key request. The keys which are already being
+    fetched for a concurrent query are not requested again, the result
+    of the pending request is shared instead. Requests of the same design
+    document are pipelined: the first one goes alone, so that the rest can
+    be served from the cache if it turns out the ETag hasn't changed.
+    The number of simultaneous requests can be limited by setting the
+    concurrency, by default it is not limited.
+    '''
+
+    DEFAULT_CONCURRENCY = None
+
+    def __init__(self, concurrency=None):
+        self._concurrency = concurrency or self.DEFAULT_CONCURRENCY
+        # number of requests being made and the Deferreds waiting to start
+        self._running = 0
+        self._waiting = list()
+        # (view, frozen key) of the keys being fetched at the moment
+        self._pending = set()
+        self._notifier = defer.Notifier()
+
+    def get_concurrency(self):
+        return self._concurrency
+
+    def set_concurrency(self, limit):
+        '''
+        Changes the limit of simultaneous requests, None removes it.
+        When it is lowered the requests being made are finished, the waiting
+        ones start when the number of the running ones drops below the new
+        limit.
+        '''
+        if limit is not None and limit < 1:
+            raise ValueError("Concurrency needs to be positive, %r given" %
+                             (limit, ))
+        self._concurrency = limit
+        self._start_waiting()
+
+    @defer.inlineCallbacks
+    def fetch(self, connection, query, subqueries):
+        '''
+        Fetches the indexes of the subqueries.
+        Returns a dict subquery -> ParsedIndex.
+        '''
+        responses = dict()
+        ctime = time.time()
+
+        # design_doc_id -> [callable fetching the part of subqueries]
+        requests = dict()
+        batches = dict() # view -> [(subquery, field)]
+        for subquery in subqueries:
+            field = query.fields[subquery.field]
+            if not _is_batched(field, subquery):
+                requests.setdefault(field.view.design_doc_id, list()).append(
+                    (self._fetch_subquery, subquery, field))
+            else:
+                if field.view not in batches:
+                    requests.setdefault(
+                        field.view.design_doc_id, list()).append(
+                            (self._fetch_batch, field.view, batches))
+                    batches[field.view] = list()
+                batches[field.view].append((subquery, field))
+
+        defers = [self._pipeline(connection, responses, ctime, parts)
+                  for parts in requests.itervalues()]
+        r = yield defer.DeferredList(defers, consumeErrors=True)
+        for success, res in r:
+            if not success:
+                defer.returnValue(res)
+        defer.returnValue(responses)
+
+    ### private ###
+
+    @defer.inlineCallbacks
+    def _pipeline(self, connection, responses, ctime, parts):
+        method, args = parts[0][0], parts[0][1:]
+        yield method(connection, responses, ctime, *args)
+
+        defers = [method(connection, responses, ctime, *args)
+                  for method, args in ((x[0], x[1:]) for x in parts[1:])]
+        if defers:
+            r = yield defer.DeferredList(defers, consumeErrors=True)
+            for success, res in r:
+                if not success:
+                    res.raiseException()
+
+    def _run(self, method, *args, **kwargs):
+        d = defer.Deferred()
+        d.addCallback(defer.drop_param, method, *args, **kwargs)
+        d.addBoth(self._finished)
+        self._waiting.append(d)
+        self._start_waiting()
+        return d
+
+    def _start_waiting(self):
+        while self._waiting and (self._concurrency is None or
+                                 self._running < self._concurrency):
+            self._running += 1
+            self._waiting.pop(0).callback(None)
+
+    def _finished(self, result):
+        self._running -= 1
+        self._start_waiting()
+        return result
+
+    def _fetch_subquery(self, connection, responses, ctime, subquery, field):
+        d = self._run(field.fetch, connection, subquery,
+                      if_modified_since=ctime)
+        d.addCallback(defer.inject_param, 1, responses.__setitem__,
+                      subquery)
+        d.addErrback(_fail_on_subquery, connection, subquery)
+        return d
+
+    @defer.inlineCallbacks
+    def _fetch_batch(self, connection, responses, ctime, view, batches):
+        batch = _ViewBatch(view)
+        # the fields query the batch standing for the connection,
+        # it collects the keys and post processes the rows of each field
+        defers = [field.fetch(batch, subquery, if_modified_since=ctime)
+                  for subquery, field in batches[view]]
+        keys = batch.keys
+
+        waiting = [self._notifier.wait((view, x)) for x in keys]
+        missing = [x for x in keys if (view, x) not in self._pending]
+        if missing:
+            self._pending.update((view, x) for x in missing)
+            d = self._run(
+                connection.query_view, view, parse_results=False,
+                keys=[batch.unique[x] for x in missing],
+                if_modified_since=ctime)
+            d.addCallbacks(self._batch_fetched, self._batch_failed,
+                           callbackArgs=(view, missing),
+                           errbackArgs=(view, missing))
+
+        r = yield defer.DeferredList(waiting, consumeErrors=True)
+        rows = dict()
+        for key, (success, res) in zip(keys, r):
+            if not success:
+                batch.failed(res)
+                break
+            rows[key] = res
+        else:
+            batch.fetched(rows)
+
+        r = yield defer.DeferredList(defers, consumeErrors=True)
+        for (subquery, field), (success, res) in zip(batches[view], r):
+            if not success:
+                error.handle_failure(connection, res,
+                                     "Failed querying subqueries of %s",
+                                     view.name)
+                res.raiseException()
+            responses[subquery] = res
+
+    def _batch_fetched(self, rows, view, keys):
+        grouped = dict((key, list()) for key in keys)
+        for row in rows:
+            group = grouped.get(_freeze(row[0]))
+            if group is not None:
+                group.append(row)
+        for key in keys:
+            self._pending.discard((view, key))
+            self._notifier.callback((view, key), grouped[key])
+
+    def _batch_failed(self, fail, view, keys):
+        for key in keys:
+            self._pending.discard((view, key))
+            self._notifier.errback((view, key), fail)
+
+
 ### private ###
 
 
-def _do_fetch(connection, responses, ctime, factory, subquery):
-    d = factory.fields[subquery.field].fetch(
-        connection, subquery, if_modified_since=ctime)
-    d.addCallback(defer.inject_param, 1, responses.__setitem__,
-                  subquery)
-    d.addErrback(_fail_on_subquery, connection, subquery)
-    return d
+# connection -> ViewFetcher
+_fetchers = weakref.WeakKeyDictionary()
 
 
-@defer.inlineCallbacks
-def _get_query_response(connection, query):
-    responses = dict()
-    defers = list()
+def _is_batched(field, subquery):
+    '''
+    Tells if the subquery can be fetched as a part of the multi-key request.
+    '''
+    if not isinstance(field, Field) or type(field).fetch != Field.fetch:
+        return False
+    keys = field.generate_keys(subquery.evaluator, subquery.value)
+    return _get_keys(keys) is not None
 
-    # First query should be performed separetely so that we know its ETag.
-    # This allows not making additional requests when they are not needed.
-    ctime = time.time()
-    subqueries = query.get_basic_queries()
 
-    if subqueries:
-        subquery = subqueries[0]
-        yield _do_fetch(connection, responses, ctime, query, subquery)
+def _get_keys(options):
+    '''
+    Returns the list of keys selected by the view query options if they
+    only select the exact keys, otherwise None.
+    '''
+    if options.keys() == ['key']:
+        return [options['key']]
+    if options.keys() == ['keys']:
+        return options['keys']
 
-        for subquery in subqueries[1:]:
-            defers.append(_do_fetch(
-                connection, responses, ctime, query, subquery))
 
-    if defers:
-        r = yield defer.DeferredList(defers, consumeErrors=True)
-        for success, res in r:
-            if not success:
-                defer.returnValue(res)
+class _ViewBatch(object):
+    '''
+    Stands for the connection in L{Field.fetch} of the subqueries fetched
+    with a single multi-key request. It collects the keys the fields query
+    the view for. Once the rows are fetched, each field gets the rows of
+    its keys processed by its post_process callable. The connection caches
+    the unprocessed rows of the whole request, so the cache_id_suffix
+    keeping apart the results processed by different fields is not used.
+    '''
+
+    def __init__(self, view):
+        self.view = view
+        # frozen keys in the order of the requests and frozen key -> key
+        self.keys = list()
+        self.unique = dict()
+        # [(Deferred, frozen keys, post_process, tag)]
+        self._requests = list()
+
+    def query_view(self, factory, parse_results=True, post_process=None,
+                   cache_id_suffix='', if_modified_since=None, **options):
+        keys = _get_keys(options)
+        if keys is None or parse_results or factory is not self.view:
+            raise ValueError("Only the unparsed rows of the exact keys of %s "
+                             "can be fetched in a batch, got %r" %
+                             (self.view.name, options))
+        frozen = list()
+        for key in keys:
+            frozen_key = _freeze(key)
+            frozen.append(frozen_key)
+            if frozen_key not in self.unique:
+                self.unique[frozen_key] = key
+                self.keys.append(frozen_key)
+        d = defer.Deferred()
+        tag = 'query to %s' % (factory.name, )
+        self._requests.append((d, frozen, post_process, tag))
+        return d
+
+    def fetched(self, rows):
+        '''
+        Passes the rows to the requests, rows is a dict frozen key -> rows.
+        '''
+        requests, self._requests = self._requests, list()
+        for d, keys, post_process, tag in requests:
+            result = list()
+            for key in keys:
+                result.extend(rows[key])
+            if post_process is not None:
+                d.addCallback(post_process, tag)
+            d.callback(result)
+
+    def failed(self, fail):
+        requests, self._requests = self._requests, list()
+        for d, _keys, _post_process, _tag in requests:
+            d.errback(fail)
+
+
+def _freeze(value):
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(x) for x in value)
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.iteritems()))
+    return value
 
-    defer.returnValue((_calculate_query_response(responses, query), responses))
+
+def _get_query_response(connection, query):
+    d = get_fetcher(connection).fetch(
+        connection, query, query.get_basic_queries())
+    d.addCallback(lambda responses: (
+        _calculate_query_response(responses, query), responses))
+    return d
 
 
 def _fail_on_subquery(fail, connection, subquery):
@@ -694,12 +949,17 @@ def _fail_on_subquery(fail, connection, subquery):
 
 
 def _calculate_query_response(responses, query):
+    '''
+    Builds the plan evaluating the query over the fetched indexes.
+    No intermediate sets are built, the ids are iterated and probed
+    against the indexes only when needed.
+    '''
     for_parts = []
 
     for part in query.parts:
         if isinstance(part, Condition):
             key = part.get_basic_queries()[0]
-            for_parts.append(set(responses[key].entries))
+            for_parts.append(_Leaf(responses[key]))
         elif isinstance(part, Query):
             for_parts.append(_calculate_query_response(responses, part))
     if len(for_parts) == 1:
@@ -707,37 +967,124 @@ def _calculate_query_response(responses, query):
 
     operators = list(query.operators)
     if operators[0] == Operator.AND:
-        return set.intersection(*for_parts)
+        return _And(for_parts)
     elif operators[0] == Operator.OR:
-        return set.union(*for_parts)
+        return _Or(for_parts)
     else:
         raise ValueError("Unkown operator '%r' %" (operators[0], ))
 
 
+class _Leaf(object):
+    '''Plan node of a single condition.'''
+
+    def __init__(self, index):
+        self._ids = index.ids
+
+    def size(self):
+        return len(self._ids)
+
+    def count(self):
+        return len(self._ids)
+
+    def __contains__(self, doc_id):
+        return doc_id in self._ids
+
+    def __iter__(self):
+        return iter(self._ids)
+
+
+class _And(object):
+    '''
+    Plan node of the conjunction. The smallest part drives the iteration,
+    the others are probed by id starting from the most selective one.
+    '''
+
+    def __init__(self, parts):
+        self._parts = sorted(parts, key=lambda x: x.size())
+
+    def size(self):
+        return self._parts[0].size()
+
+    def count(self):
+        return sum(1 for _ in self)
+
+    def __contains__(self, doc_id):
+        for part in self._parts:
+            if doc_id not in part:
+                return False
+        return True
+
+    def __iter__(self):
+        driver, probes = self._parts[0], self._parts[1:]
+        for doc_id in driver:
+            for part in probes:
+                if doc_id not in part:
+                    break
+            else:
+                yield doc_id
+
+
+class _Or(object):
+    '''
+    Plan node of the alternative. The parts are iterated one after another,
+    the ids already given by the previous parts are skipped by probing
+    them instead of keeping the set of visited ids.
+    '''
+
+    def __init__(self, parts):
+        self._parts = sorted(parts, key=lambda x: x.size(), reverse=True)
+
+    def size(self):
+        return sum(x.size() for x in self._parts)
+
+    def count(self):
+        return sum(1 for _ in self)
+
+    def __contains__(self, doc_id):
+        for part in self._parts:
+            if doc_id in part:
+                return True
+        return False
+
+    def __iter__(self):
+        for index, part in enumerate(self._parts):
+            previous = self._parts[:index]
+            for doc_id in part:
+                for other in previous:
+                    if doc_id in other:
+                        break
+                else:
+                    yield doc_id
+
+
 def _get_sorted_slice(index, rows, skip, stop):
-    seen = 0
-    if stop is None:
-        stop = len(rows)
+    '''
+    Walks the sort index yielding the rows of the plan between skip and stop.
+    The rows not present in the sort index come at the end in arbitrary
+    order. Only the ids up to the stop are kept in memory, so it should
+    not be greater than the number of rows.
+    '''
+    if stop is not None and stop <= skip:
+        return
+
+    seen = set()
 
     for value in index:
-        if not rows:
-            return
-        try:
-            rows.remove(value)
-        except KeyError:
+        if value in seen or value not in rows:
             continue
+        seen.add(value)
+        if len(seen) > skip:
+            yield value
+        if len(seen) == stop:
+            return
 
-        seen += 1
-        if skip < seen <= stop:
+    # if we haven't reached the sorted target,
+    # now just return the rows as they appear
+    for value in rows:
+        if value in seen:
+            continue
+        seen.add(value)
+        if len(seen) > skip:
             yield value
-        if seen > stop:
-            break
-    else:
-        # if we haven't reached the sorted target,
-        # now just return the rows as they appear
-        missing = stop - seen
-        try:
-            for x in range(missing):
-                yield rows.pop()
-        except KeyError:
-            pass
+        if len(seen) == stop:
+            return
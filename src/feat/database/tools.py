@@ -27,13 +27,21 @@ from twisted.internet import reactor, task
 
 from feat.database import view, driver, document
 from feat.agencies.net import options, config
-from feat.common import log, defer, error, serialization
+from feat.common import log, defer, error, serialization, time
 from feat.agents.application import feat
 from feat import applications
 
-from feat.database.interface import ConflictError
+from feat.database.interface import ConflictError, NotFoundError
 from feat.interface.serialization import IVersionAdapter
 
+# Number of seconds fetching a page of the view should take, the size
+# of the pages of view_aterator() is adapted to it
+PAGE_FETCH_TIME = 1.0
+# Maximum number of documents migrated concurrently
+MIGRATION_WINDOW = 100
+# Id of the local document keeping the position of the migration
+MIGRATION_CHECKPOINT = u'_local/migration_checkpoint'
+
 
 def reset_documents(snapshot):
     applications.get_initial_data_registry().reset(snapshot)
@@ -192,10 +200,16 @@ def tupletize_version(version_string):
 
 
 @defer.inlineCallbacks
-def migration_script(connection):
+def migration_script(connection, window=MIGRATION_WINDOW):
     log.info("script", "Running the migration script.")
     index = yield connection.query_view(view.DocumentByType,
-                                        group_level=2, parse_result=False)
+                                        group_level=2, parse_results=False)
+    try:
+        checkpoint = yield connection.get_document(MIGRATION_CHECKPOINT,
+                                                   raw=True)
+    except NotFoundError:
+        checkpoint = {'_id': MIGRATION_CHECKPOINT}
+
     try:
         for (type_name, version), count in index:
             restorator = serialization.lookup(type_name)
@@ -213,20 +227,21 @@ def migration_script(connection):
                           "type: %s from version %s to %d", count,
                           type_name, version, restorator.version)
 
-                migrated = 0
-                while migrated < count:
-                    fetched = yield connection.query_view(
-                        view.DocumentByType,
-                        key=(type_name, version),
-                        limit=15,
-                        reduce=False,
-                        include_docs=True)
-
-                    migrated += len(fetched)
-                    if not fetched:
-                        break
+                progress = MigrationProgress(connection, checkpoint,
+                                             type_name, version, count)
+                keys = dict(startkey=(type_name, version),
+                            endkey=(type_name, version),
+                            reduce=False, include_docs=True)
+                progress.resume(keys)
+                # the documents of a page are migrated concurrently and
+                # their saves are written together with _bulk_docs
+                yield view_aterator(connection, progress.migrated,
+                                    view.DocumentByType, keys,
+                                    max_per_page=window,
+                                    checkpoint=progress.checkpoint)
+                yield progress.finish()
                 log.info("script", "Migrated %d documents of the type %s "
-                         "from %s version to %s", migrated, type_name,
+                         "from %s version to %s", progress.done, type_name,
                          version, restorator.version)
 
     except Exception:
@@ -235,6 +250,60 @@ def migration_script(connection):
         raise
 
 
+class MigrationProgress(object):
+    '''
+    I'm keeping track of the documents of one type being migrated.
+    The position in the view is stored in a local document after each
+    page, so that an interrupted migration continues where it stopped.
+    '''
+
+    def __init__(self, connection, checkpoint, type_name, version, count):
+        self.connection = connection
+        self.type_name = type_name
+        self.version = version
+        self.count = count
+
+        # the local document of the checkpoint
+        self._doc = dict(checkpoint)
+        self._started = time.time()
+
+        self.done = 0
+        self.failed = 0
+
+    def resume(self, keys):
+        doc = self._doc
+        if (doc.get('type_name') == self.type_name and
+            doc.get('version') == self.version and doc.get('doc_id')):
+            log.info('script', "Resuming migration of the type %s from "
+                     "the document %s", self.type_name, doc['doc_id'])
+            keys['startkey_docid'] = doc['doc_id']
+
+    def migrated(self, connection, doc):
+        # the documents which failed to migrate are parsed to None
+        if doc is None:
+            self.failed += 1
+        else:
+            self.done += 1
+
+    def checkpoint(self, connection, startkey, startkey_docid):
+        elapsed = max(time.time() - self._started, 0.001)
+        log.info('script', "Migrated %d of %d documents of the type %s, "
+                 "%d failed, %.1f documents/s", self.done, self.count,
+                 self.type_name, self.failed,
+                 (self.done + self.failed) / elapsed)
+        return self._save(startkey_docid)
+
+    def finish(self):
+        return self._save(None)
+
+    ### private ###
+
+    def _save(self, doc_id):
+        self._doc.update(type_name=self.type_name, version=self.version,
+                         doc_id=doc_id)
+        return self.connection.save_document(self._doc)
+
+
 class dbscript(object):
 
     def __init__(self, dbconfig):
@@ -338,20 +407,37 @@ def standalone(script, options=[]):
 @defer.inlineCallbacks
 def view_aterator(connection, callback, view, view_keys=dict(),
                   args=tuple(), kwargs=dict(), per_page=15,
-                  consume_errors=True):
+                  consume_errors=True, max_per_page=None, checkpoint=None):
     '''
     Asynchronous iterator for the view. Downloads a view in pages
     and calls the callback for each row.
     This helps avoid transfering data in huge datachunks.
+
+    The next page starts from the key and the document id of the row
+    following the current one instead of skipping the rows already
+    seen, so fetching a page doesn't get slower the further it is.
+    The pages grow up to max_per_page rows while they are fetched faster
+    than PAGE_FETCH_TIME. After each page the checkpoint is called with
+    the startkey and startkey_docid of the next one, passing them in
+    view_keys resumes the iteration.
     '''
-    skip = 0
+    if 'keys' in view_keys:
+        raise ValueError("Iterating over multiple keys is not supported")
+    max_per_page = max(max_per_page or per_page, per_page)
+    keys = dict(view_keys)
+    if 'key' in keys:
+        keys['startkey'] = keys['endkey'] = keys.pop('key')
+
     while True:
-        keys = dict(view_keys)
-        keys.update(dict(skip=skip, limit=per_page))
-        records = yield connection.query_view(view, **keys)
+        keys['limit'] = per_page + 1
+        started = time.time()
+        rows = yield connection.query_view(view, parse_results=False,
+                                           **keys)
+        elapsed = time.time() - started
+        rows, following = rows[:per_page], rows[per_page:]
+        records = yield connection.parse_view_results(rows, view, keys)
         log.debug('view_aterator', "Fetched %d records of the view: %s",
                   len(records), view.name)
-        skip += len(records)
         for record in records:
             try:
                 yield callback(connection, record, *args, **kwargs)
@@ -363,8 +449,22 @@ def view_aterator(connection, callback, view, view_keys=dict(),
                 if not consume_errors:
                     raise e
 
-        if not records:
+        if not following:
             break
+        # continue from the following row, the reduced rows
+        # have unique keys and no document id
+        keys.pop('skip', None)
+        keys['startkey'] = following[0][0]
+        if len(following[0]) > 2:
+            keys['startkey_docid'] = following[0][2]
+        if checkpoint is not None:
+            yield checkpoint(connection, keys['startkey'],
+                             keys.get('startkey_docid'))
+
+        if elapsed < PAGE_FETCH_TIME / 2:
+            per_page = min(per_page * 2, max_per_page)
+        elif elapsed > PAGE_FETCH_TIME * 2:
+            per_page = max(per_page // 2, 1)
 
 
 def rebuild_view_index(connection, design_doc):
@@ -0,0 +1,129 @@
+# F3AT - Flumotion Asynchronous Autonomous Agent Toolkit
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# See "LICENSE.GPL" in the source distribution for more information.
+
+# Headers in this file shall remain intact.
+import time
+
+from collections import OrderedDict
+
+
+class RenderCache(object):
+    '''
+    key -> (expiration, rendered fragment, tags)
+
+    Cache of the rendered model fragments shared by all the requests
+    of a gateway. Entries are tagged with the identity of the rendered
+    model and the names of its location, so they can be invalidated
+    when the data they show changes before their time to live expires.
+    When the cache is full the oldest entries are evicted first.
+    '''
+
+    DEFAULT_MAX_SIZE = 1000
+
+    def __init__(self, max_size=None):
+        self.max_size = max_size or self.DEFAULT_MAX_SIZE
+        self._entries = OrderedDict()
+        # tag -> set([key])
+        self._tags = dict()
+
+        # public statistics
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+
+    def scope(self, scope):
+        '''Returns a view of the cache only sharing the entries
+        with the views of the same scope, like a security context.'''
+        return ScopedRenderCache(self, scope)
+
+    def get(self, key, default=None, ctime=None):
+        entry = self._entries.get(key)
+        if entry is not None:
+            expiration, value, _tags = entry
+            if expiration > (ctime or time.time()):
+                self.hits += 1
+                return value
+            self._remove(key)
+        self.misses += 1
+        return default
+
+    def set(self, key, value, ttl, tags=(), ctime=None):
+        if key in self._entries:
+            self._remove(key)
+        elif len(self._entries) >= self.max_size:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+        tags = frozenset(tags)
+        self._entries[key] = ((ctime or time.time()) + ttl, value, tags)
+        for tag in tags:
+            self._tags.setdefault(tag, set()).add(key)
+
+    def invalidate(self, *tags):
+        '''Removes all the entries having any of the specified tags.'''
+        for tag in tags:
+            keys = self._tags.get(tag)
+            if not keys:
+                continue
+            for key in list(keys):
+                self._remove(key)
+                self.invalidations += 1
+
+    def clear(self):
+        self._entries.clear()
+        self._tags.clear()
+
+    def get_stats(self):
+        total = self.hits + self.misses
+        return dict(size=len(self._entries),
+                    tags=len(self._tags),
+                    hits=self.hits,
+                    misses=self.misses,
+                    hit_rate=float(self.hits) / total if total else 0.0,
+                    invalidations=self.invalidations,
+                    evictions=self.evictions)
+
+    def __len__(self):
+        return len(self._entries)
+
+    ### private ###
+
+    def _remove(self, key):
+        _expiration, _value, tags = self._entries.pop(key)
+        for tag in tags:
+            keys = self._tags[tag]
+            keys.discard(key)
+            if not keys:
+                del self._tags[tag]
+
+
+class ScopedRenderCache(object):
+
+    __slots__ = ("cache", "scope")
+
+    def __init__(self, cache, scope):
+        self.cache = cache
+        self.scope = scope
+
+    def get(self, key, default=None):
+        return self.cache.get((self.scope, key), default)
+
+    def set(self, key, value, ttl, tags=()):
+        self.cache.set((self.scope, key), value, ttl, tags)
@@ -24,7 +24,7 @@ import socket
 from twisted.internet import error as terror
 
 from feat.common import log, defer
-from feat.gateway import resources
+from feat.gateway import cache, resources
 from feat.web import security, webserver, http
 
 # Import supported formats
@@ -44,7 +44,7 @@ class Gateway(log.LogProxy, log.Logger):
     def __init__(self, root, port_range=None, hostname=None,
                  static_path=None, security_policy=None,
                  log_keeper=None, label=None, web_statistics=None,
-                 interface='', document_registry=None):
+                 interface='', document_registry=None, render_cache=None):
         log.Logger.__init__(self, self)
         log.LogProxy.__init__(self, log_keeper or log.get_default())
 
@@ -74,6 +74,9 @@ class Gateway(log.LogProxy, log.Logger):
         self._server = None
         self._interface = interface
         self._document_registry = document_registry
+        if render_cache is None:
+            render_cache = cache.RenderCache()
+        self.render_cache = render_cache
 
         self._statistics = (web_statistics and
                             webserver.IWebStatistics(web_statistics))
@@ -138,7 +141,8 @@ class Gateway(log.LogProxy, log.Logger):
     def _build_resource(self, port):
         return resources.Root(self._host, port,
                               self._root, self._label,
-                              self._static_path)
+                              self._static_path,
+                              render_cache=self.render_cache)
 
     def _initiate_server(self, server):
         server.initiate()
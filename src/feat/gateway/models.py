@@ -430,6 +430,7 @@ class Journaler(model.Model):
     model.attribute('state', value.Enum(journaler.State),
                     getter=getter.source_attr('state'),
                     label='Connection state')
+    model.revision(call.model_call('get_revision'))
     model.collection('possible_targets',
                      child_names=getter.source_list_names('possible_targets'),
                      child_view=getter.source_list_get('possible_targets'),
@@ -446,6 +447,10 @@ class Journaler(model.Model):
     def get_pending(self):
         return len(self.source._cache)
 
+    def get_revision(self):
+        return (self.source.state, len(self.source._cache),
+                self.source.current_target_index)
+
 
 @featmodels.register_model
 class JournalTarget(model.Model):
@@ -481,6 +486,7 @@ class BaseJournalWriter(model.Model):
     model.attribute('state', value.Enum(journaler.State),
                     getter=getter.source_attr('state'),
                     label='Connection state')
+    model.revision(call.model_call('get_revision'))
 
     def get_type(self):
         return type(self.source).__name__
@@ -488,6 +494,9 @@ class BaseJournalWriter(model.Model):
     def get_pending(self):
         return len(self.source._cache)
 
+    def get_revision(self):
+        return self.source.state, len(self.source._cache)
+
 
 @featmodels.register_model
 @featmodels.register_adapter(journaler.PostgresWriter, IModel)
@@ -521,8 +530,11 @@ class AgencyAgents(model.Collection):
     model.child_model("feat.agency_agent")
     model.child_names(call.model_call("_iter_agents"))
     model.child_source(getter.source_get("get_agent"))
+    model.revision(call.model_call("_get_revision"))
 
     model.meta("html-render", "array, 1")
+    # invalidated when agents are registered
+    model.meta("json", "cache, 10")
 
     ### custom ###
 
@@ -530,6 +542,11 @@ class AgencyAgents(model.Collection):
         res = [x.get_agent_id() for x in self.source.iter_agents()]
         return res
 
+    def _get_revision(self):
+        # restarted agents get a new instance number
+        return (self.source.get_agents_generation(),
+                [x.get_status() for x in self.source.iter_agents()])
+
 
 @featmodels.register_model
 class AgencyAgent(model.Model):
@@ -603,6 +620,7 @@ class Agents(model.Collection):
 
     model.child_names(call.model_call("_iter_agents"))
     model.child_source(getter.model_get("_locate_agent"))
+    model.revision(call.model_call("_get_revision"))
 
     #FIXME: use another mean to specify the default action than name
     model.create("post",
@@ -616,6 +634,8 @@ class Agents(model.Collection):
     model.meta("html-render",
                "array-columns, Agent Id, Agent type, Status, Description, "
                "Application")
+    # invalidated when agents are registered
+    model.meta("json", "cache, 10")
 
     def init(self):
         if not self.officer.peer_info.has_role("admin"):
@@ -629,6 +649,14 @@ class Agents(model.Collection):
             res.extend(slave.agents.keys())
         return res
 
+    def _get_revision(self):
+        if first(self.source._broker.iter_slave_references()) is not None:
+            # the status of the slave agencies' agents is only known remotely
+            return None
+        return (self.source.get_agents_generation(),
+                [(x.get_status(), x.get_description())
+                 for x in self.source.iter_agents()])
+
     def _locate_agent(self, name):
 
         def agent_located(result):
@@ -718,6 +746,8 @@ class Agent(model.Model):
                     label="Description",
                     desc="Description specific to the agent's instance")
 
+    model.revision(call.model_call("get_revision"))
+
     model.child("partners",
                 model="feat.partners",
                 label="Partners", desc="Agent's partners")
@@ -792,11 +822,20 @@ class Agent(model.Model):
     def get_description(self):
         return self.source.get_description()
 
+    def get_revision(self):
+        # the partners and the instance number are stored in the descriptor
+        usage = self._has_resources() and self.source.get_resource_usage()
+        return (self.source.get_descriptor().rev,
+                self.source.get_agent_status(), self.get_description(),
+                sorted(self.get_protocols()), usage)
+
 
 @featmodels.register_model
 class Resources(model.Model):
     model.identity("feat.resources")
 
+    model.revision(call.source_call("get_resource_usage"))
+
     model.child("classes",
                 view=call.source_call("get_resource_usage"),
                 model="feat.resource_classes",
@@ -815,6 +854,8 @@ class ResourceClasses(model.Collection):
     model.child_model(getter.model_get("_child_model"))
     model.child_names(call.view_call("keys"))
     model.child_view(getter.view_get("get"))
+    # the view is the resource usage
+    model.revision(getter.model_attr("view"))
 
     ### custom ####
 
@@ -828,6 +869,7 @@ class ResourceClasses(model.Collection):
 @featmodels.register_model
 class ScalarResourceClass(model.Model):
     model.identity("feat.scalar_resource")
+    model.revision(getter.model_attr("view"))
 
     model.attribute("name", value.String(), getter.model_attr("name"))
     model.attribute("total", value.Integer(),
@@ -853,6 +895,7 @@ class RangeItems(value.Collection):
 @featmodels.register_model
 class RangeResourceClass(model.Model):
     model.identity("feat.range_resource")
+    model.revision(getter.model_attr("view"))
 
     model.attribute("name", value.String(), getter.model_attr("name"))
     model.attribute("total", RangeTotal(),
@@ -870,6 +913,8 @@ class Partners(model.Collection):
     model.identity("feat.partners")
 
     model.view(call.source_call("query_partners", "all"))
+    # partners are stored in the descriptor
+    model.revision(call.model_call("get_revision"))
 
     model.child_label("Partner")
     model.child_model("feat.partner")
@@ -877,9 +922,14 @@ class Partners(model.Collection):
     model.child_view(getter.model_get("get_partner"))
 
     model.meta("html-render", "array, 2")
+    # invalidated when the descriptor changes
+    model.meta("json", "cache, 10")
 
     ### custom ###
 
+    def get_revision(self):
+        return self.source.get_descriptor().rev
+
     def iter_partner_names(self):
         return [p.recipient.key for p in self.view]
 
@@ -955,6 +1005,10 @@ class MonitorAgent(Agent):
 
     ### custom ###
 
+    def get_revision(self):
+        # the monitoring status is not versioned
+        return None
+
     def _get_location_names(self):
         return self.view["locations"].keys()
 
@@ -1049,6 +1103,12 @@ class AlertAgent(Agent):
 
     model.action('rescan', RescanShardAction)
 
+    ### custom ###
+
+    def get_revision(self):
+        # the alerts are not versioned
+        return None
+
 
 @featmodels.register_model
 class AlertServices(model.Collection):
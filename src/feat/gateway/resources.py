@@ -20,6 +20,7 @@
 
 # Headers in this file shall remain intact.
 
+import hashlib
 import mimetypes
 import os
 import sys
@@ -35,7 +36,7 @@ from feat.models.model import DummyOfficer
 from feat.models.interface import ActionCategories, IActionPayload, IAspect,\
     ValueTypes, IEncodingInfo
 from feat.models.interface import IContext, IModel, IModelAction
-from feat.models.interface import IAttribute, IReference
+from feat.models.interface import IAttribute, IReference, IRevisioned
 from feat.models.interface import ErrorTypes, IErrorPayload, Unauthorized
 from feat.models.interface import ParameterError, InvalidParameters
 
@@ -129,18 +130,21 @@ class ErrorPayload(object):
 
 class Context(object):
 
-    __slots__ = ("scheme", "models", "names", "remaining", "arguments")
+    __slots__ = ("scheme", "models", "names", "remaining", "arguments",
+                 "render_cache")
 
     implements(IContext)
 
     default_actions = set([u"set", u"del", u"post"])
 
-    def __init__(self, scheme, models, names, remaining=None, arguments=None):
+    def __init__(self, scheme, models, names, remaining=None, arguments=None,
+                 render_cache=None):
         self.scheme = scheme
         self.names = tuple(names)
         self.models = tuple(models)
         self.remaining = tuple(remaining) if remaining else ()
         self.arguments = dict(arguments) if arguments else {}
+        self.render_cache = render_cache
 
     ### public ###
 
@@ -184,7 +188,8 @@ class Context(object):
                        models=self.models + (model, ),
                        names=self.names + (model.name, ),
                        remaining=remaining,
-                       arguments=self.arguments)
+                       arguments=self.arguments,
+                       render_cache=self.render_cache)
 
 
 class BaseResource(webserver.BaseResource):
@@ -351,9 +356,10 @@ class ActionResource(BaseResource):
 
 class ModelResource(BaseResource):
 
-    __slots__ = ("model", "_methods", "_model_history", "_name_history")
+    __slots__ = ("model", "render_cache", "_methods",
+                 "_model_history", "_name_history")
 
-    implements(webserver.IWebResource)
+    implements(webserver.IWebResource, webserver.ICachedWebResource)
 
     action_methods = {u"set": http.Methods.PUT,
                       u"del": http.Methods.DELETE,
@@ -364,8 +370,10 @@ class ModelResource(BaseResource):
 
     ActionResource = ActionResource
 
-    def __init__(self, model, name=None, models=[], names=[]):
+    def __init__(self, model, name=None, models=[], names=[],
+                 render_cache=None):
         self.model = IModel(model)
+        self.render_cache = render_cache
         self._model_history = list(models) + [self.model]
         self._name_history = list(names) + [name]
         self._methods = set([]) # set([http.Methods])
@@ -397,12 +405,13 @@ class ModelResource(BaseResource):
         d.addErrback(self.filter_errors)
         return d
 
-    def make_context(self, request, remaining=None):
+    def make_context(self, request, remaining=None, render_cache=None):
         return Context(scheme=request.scheme,
                        models=self._model_history,
                        names=self._name_history,
                        remaining=remaining,
-                       arguments=request.arguments)
+                       arguments=request.arguments,
+                       render_cache=render_cache)
 
     ### webserver.IWebResource ###
 
@@ -473,7 +482,8 @@ class ModelResource(BaseResource):
                 raise http.NotFoundError()
 
             res = ModelResource(model, model.name,
-                                self._model_history, self._name_history)
+                                self._model_history, self._name_history,
+                                self.render_cache)
             return res.initiate(), remaining[1:]
 
         def retrieve_action(model, action_name):
@@ -509,11 +519,41 @@ class ModelResource(BaseResource):
         d.addErrback(self.filter_errors)
         return d
 
+    ### webserver.ICachedWebResource ###
+
+    def get_etag(self, request, location):
+        if location[-1] == u"":
+            # actions are not covered by the model revision
+            return None
+        if not IRevisioned.providedBy(self.model):
+            return None
+
+        def got_revision(revision):
+            if revision is None:
+                return None
+            # the representation depends on the negotiated format
+            # and on the addresses rendered in it
+            key = (self.model.identity, self.model.name, revision,
+                   location, request.scheme, request.domain,
+                   sorted(request.arguments.items()),
+                   request.get_header("accept"),
+                   request.get_header("accept-charset"),
+                   request.get_header("accept-languages"))
+            return hashlib.sha1(repr(key)).hexdigest()
+
+        d = IRevisioned(self.model).fetch_revision()
+        d.addCallback(got_revision)
+        d.addErrback(self.filter_errors)
+        return d
+
     def action_GET(self, request, response, location):
         response.set_header("Cache-Control", "no-cache")
-        context = self.make_context(request)
         if location[-1] == u"":
+            context = self.make_context(request)
             return self.render_action("get", request, response, context)
+        # only plain model renderings are cached, not the actions results
+        cache = self._get_render_cache(request)
+        context = self.make_context(request, render_cache=cache)
         return self.render_model(self.model, request, response, context)
 
     def render_action(self, action_name, request, response, context):
@@ -587,9 +627,20 @@ class ModelResource(BaseResource):
         else:
             response.set_length(0)
 
+    ### private ###
+
+    def _get_render_cache(self, request):
+        if self.render_cache is None:
+            return None
+        # rendered models depend on what the peer is allowed to see
+        peer_info = request.peer_info
+        return self.render_cache.scope(peer_info and peer_info.context)
+
 
 class StaticResource(BaseResource):
 
+    implements(webserver.ICachedWebResource)
+
     BUFFER_SIZE = 1024*1024*4
 
     def __init__(self, hostname, port, root_path):
@@ -614,21 +665,18 @@ class StaticResource(BaseResource):
         request.context["rel_loc"] = remaining
         return self
 
-    def action_GET(self, request, response, location):
-        rel_loc = request.context.get("rel_loc")
-        if rel_loc is None:
-            raise http.NotFoundError()
+    ### webserver.ICachedWebResource ###
 
-        rel_path = http.tuple2path(rel_loc)
-        full_path = os.path.join(self._root_path, rel_path)
-        res_path = os.path.realpath(full_path)
-        if not res_path.startswith(self._root_path):
-            raise http.ForbiddenError()
-        if os.path.isdir(res_path):
-            raise http.ForbiddenError()
-        if not os.path.isfile(res_path):
-            raise http.NotFoundError()
+    def get_etag(self, request, location):
+        try:
+            res_path = self._get_resource_path(request)
+        except http.HTTPError:
+            return None
+        rst = os.stat(res_path)
+        return "%x-%x" % (int(rst.st_mtime * 1000), rst.st_size)
 
+    def action_GET(self, request, response, location):
+        res_path = self._get_resource_path(request)
         rst = os.stat(res_path)
 
         # FIXME: Caching Policy, should be extracted to a ICachingPolicy
@@ -665,6 +713,22 @@ class StaticResource(BaseResource):
 
     ### private ###
 
+    def _get_resource_path(self, request):
+        rel_loc = request.context.get("rel_loc")
+        if rel_loc is None:
+            raise http.NotFoundError()
+
+        rel_path = http.tuple2path(rel_loc)
+        full_path = os.path.join(self._root_path, rel_path)
+        res_path = os.path.realpath(full_path)
+        if not res_path.startswith(self._root_path):
+            raise http.ForbiddenError()
+        if os.path.isdir(res_path):
+            raise http.ForbiddenError()
+        if not os.path.isfile(res_path):
+            raise http.NotFoundError()
+        return res_path
+
     def _write_resource(self, response, res):
 
         try:
@@ -696,10 +760,12 @@ class Root(BaseResource):
     label = "FEAT Gateway"
     desc = None
 
-    def __init__(self, hostname, port, source, label=None, static_path=None):
+    def __init__(self, hostname, port, source, label=None, static_path=None,
+                 render_cache=None):
         self.source = source
         self.hostname = hostname
         self.port = port
+        self.render_cache = render_cache
         if label:
             self.label = label
         self._static = (static_path and
@@ -734,7 +800,7 @@ class Root(BaseResource):
         d = defer.succeed(None)
         d.addCallback(defer.drop_param, model.initiate,
                       aspect=self, officer=officer)
-        d.addCallback(ModelResource, root)
+        d.addCallback(ModelResource, root, render_cache=self.render_cache)
         d.addCallback(ModelResource.initiate)
         d.addErrback(self.filter_errors)
         return d
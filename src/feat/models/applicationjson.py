@@ -260,6 +260,15 @@ def prevent_inline(meta):
     return ['prevent-inline'] in parsed
 
 
+def cache_ttl(meta):
+    """Returns for how many seconds the rendered model can be cached
+    as specified by a json meta like "cache, 10", or None."""
+    for parsed in get_parsed_meta(meta):
+        if parsed[0] == 'cache' and len(parsed) == 2:
+            return float(parsed[1])
+    return None
+
+
 def render_compact_attribute(submodel, item, context):
     attr = IAttribute(submodel)
     if attr.value_info.value_type is ValueTypes.binary:
@@ -290,14 +299,36 @@ def write_model(doc, obj, *args, **kwargs):
     context = kwargs["context"]
 
     verbose = "format" in kwargs and "verbose" in kwargs["format"]
+
+    # contexts can provide a cache for the models annotated with a ttl
+    cache = getattr(context, "render_cache", None)
+    ttl = cache_ttl(obj) if cache is not None else None
+    if ttl:
+        key = (obj.identity, obj.name, context.names, verbose,
+               repr(sorted(context.arguments.items())))
+        data = cache.get(key)
+        if data is not None:
+            render_json(data, doc)
+            return defer.succeed(None)
+
     if verbose:
         d = render_verbose(obj, context)
     else:
         d = render_compact_model(obj, context)
 
+    if ttl:
+        # invalidated by model identity or by any name of its location
+        tags = (obj.identity, obj.name) + context.names[1:]
+        d.addCallback(_cache_rendered, cache, key, ttl, tags)
+
     return d.addCallback(render_json, doc)
 
 
+def _cache_rendered(data, cache, key, ttl, tags):
+    cache.set(key, data, ttl, tags)
+    return data
+
+
 class NestedJson(document.BaseDocument):
     '''
     This is an implementation used to represent nested documents which
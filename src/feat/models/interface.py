@@ -39,7 +39,8 @@ __all__ = ["ResponseTypes", "ActionCategories",
            "IModelItem", "IModelAction", "IActionParam",
            "IValueInfo", "IValueCollection", "IValueList", "IValueRange",
            "IEncodingInfo", "IValueOptions", "IValueOption",
-           "IActionPayload", "IErrorPayload", "IQueryModel"]
+           "IActionPayload", "IErrorPayload", "IQueryModel",
+           "IRevisioned"]
 
 
 class ResponseTypes(enum.Enum):
@@ -785,6 +786,18 @@ class IQueryModel(IModel):
         """
 
 
+class IRevisioned(Interface):
+    """Model able to tell cheaply if its content changed."""
+
+    def fetch_revision():
+        """
+        Retrieves an opaque value changing every time the model
+        content changes, or None if the model is not revisioned.
+        @return: a deferred fired with the revision or None.
+        @rtype: defer.Deferred
+        """
+
+
 class IAttribute(IModel, IValueInfo):
     """
     Helper interface to make it simpler to use attribute models.
@@ -35,10 +35,15 @@ from feat.models.interface import IOfficer, Unauthorized, ActionFailed
 from feat.models.interface import IModel, IModelItem, IQueryModel
 from feat.models.interface import IActionFactory, IModelFactory
 from feat.models.interface import IAspect, IReference, IContextMaker
+from feat.models.interface import IRevisioned
 
 from feat.interface.security import IPeerInfo
 
 
+# Maximum number of collection items initiated at the same time
+DEFAULT_ITEM_CONCURRENCY = 20
+
+
 ### Annotations ###
 
 
@@ -88,6 +93,17 @@ def view(effect_or_value):
     _annotate("view", effect_or_value)
 
 
+def revision(effect):
+    """
+    Annotates the model revision, a value changing every time
+    the model content changes; it lets clients skip retrieving
+    a model they already know.
+    @param effect: an effect to retrieve the revision.
+    @type effect: callable
+    """
+    _annotate("revision", effect)
+
+
 def attribute(name, value, getter=None, setter=None, deleter=None,
               label=None, desc=None, meta=None):
     """
@@ -269,7 +285,8 @@ def action(name, factory, label=None, desc=None):
 def collection(name, child_names=None, child_source=None,
                child_view=None, child_model=None, child_label=None,
                child_desc=None, child_meta=None,
-               label=None, desc=None, meta=None, model_meta=None):
+               label=None, desc=None, meta=None, model_meta=None,
+               child_sources=None):
     """
     Annotate a dynamic collection of sub-models.
 
@@ -299,12 +316,16 @@ def collection(name, child_names=None, child_source=None,
     @type  meta:         list of tuple
     @param model_meta:   collection model metadata.
     @type  model_meta:   list of tuple
+    @param child_sources: an effect that retrieve the sources of a list
+                          of sub-models in one call.
+    @type  child_sources: callable
     """
     _annotate("collection", name, child_names=child_names,
               child_source=child_source, child_view=child_view,
               child_model=child_model, child_label=child_label,
               child_desc=child_desc, child_meta=child_meta,
-              label=label, desc=desc, meta=meta, model_meta=model_meta)
+              label=label, desc=desc, meta=meta, model_meta=model_meta,
+              child_sources=child_sources)
 
 
 def child_model(model_factory):
@@ -367,6 +388,20 @@ def child_source(effect):
     _annotate("child_source", effect)
 
 
+def child_sources(effect):
+    """
+    Annotate the effect used to retrieve the sources of several sub-models
+    at once. The effect is called with the list of names as value and
+    should return either a list of sources in the same order or a
+    dictionary indexed by name; missing sub-models are given as None.
+    When fetching all the items of a collection it is used instead of
+    calling the child_source effect for each of them.
+    @param effect: an effect to retrieve the sources from a list of names.
+    @type effect: callable
+    """
+    _annotate("child_sources", effect)
+
+
 def child_view(effect):
     """
     Annotate the effect used to retrieve a sub-model's view.
@@ -438,6 +473,14 @@ def _validate_effect(effect):
     return effect
 
 
+def _preloaded(source):
+
+    def preloaded(_value, _context, **_params):
+        return defer.succeed(source)
+
+    return preloaded
+
+
 ### Registry ###
 
 
@@ -562,11 +605,12 @@ class AbstractModel(models_meta.Metadata, mro.DeferredMroMixin):
     __metaclass__ = MetaModel
     __slots__ = ("source", "aspect", "view", "reference", "officer")
 
-    implements(IModel, IContextMaker)
+    implements(IModel, IContextMaker, IRevisioned)
 
     _model_identity = None
     _model_view = None
     _model_reference = None
+    _model_revision = None
     _model_is_detached = False
 
     ### class methods ###
@@ -612,6 +656,14 @@ class AbstractModel(models_meta.Metadata, mro.DeferredMroMixin):
                 "key": unicode(key) if key is not None else self.name,
                 "action": action}
 
+    ### IRevisioned ###
+
+    def fetch_revision(self):
+        if self._model_revision is None:
+            return defer.succeed(None)
+        context = self.make_context()
+        return defer.maybeDeferred(self._model_revision, None, context)
+
     ### IModel ###
 
     @property
@@ -718,6 +770,11 @@ class AbstractModel(models_meta.Metadata, mro.DeferredMroMixin):
         """@see: feat.models.model.view"""
         cls._model_view = _validate_effect(effect_or_value)
 
+    @classmethod
+    def annotate_revision(cls, effect):
+        """@see: feat.models.model.revision"""
+        cls._model_revision = _validate_effect(effect)
+
 
 class NoChildrenMixin(object):
     """Mix with BaseModel for models without sub-model."""
@@ -888,12 +945,13 @@ class StaticChildrenMixin(object):
                             child_model=None, child_label=None,
                             child_desc=None, child_meta=None,
                             label=None, desc=None, meta=None,
-                            model_meta=None):
+                            model_meta=None, child_sources=None):
         """@see: feat.models.model.collection"""
         name = _validate_str(name)
         coll_cls = MetaCollection.new(cls._model_identity + "." + name,
                                       child_names=child_names,
                                       child_source=child_source,
+                                      child_sources=child_sources,
                                       child_view=child_view,
                                       child_model=child_model,
                                       child_label=child_label,
@@ -1341,11 +1399,13 @@ class DynamicItemsMixin(object):
 
     _fetch_names = None
     _fetch_source = None
+    _fetch_sources = None
     _fetch_view = None
     _item_label = None
     _item_desc = None
     _item_model = None
     _item_meta = container.MroList("_mro_item_meta")
+    _item_concurrency = DEFAULT_ITEM_CONCURRENCY
 
     ### IModel ###
 
@@ -1376,12 +1436,6 @@ class DynamicItemsMixin(object):
                                  "items", self.identity, self.name)
             return None
 
-        def create_items(names):
-            Item = DynamicModelItem
-            items = [Item(self, n).initiate().addErrback(log_error)
-                     for n in names]
-            return defer.join(*items)
-
         def cleanup(items):
             # Only counting the item whose initiate method
             # returns a non None value
@@ -1389,7 +1443,7 @@ class DynamicItemsMixin(object):
 
         context = self.make_context(key=self.name)
         d = self._fetch_names(None, context)
-        d.addCallback(create_items)
+        d.addCallback(self._create_items, log_error)
         d.addCallback(cleanup)
         return d
 
@@ -1415,14 +1469,6 @@ class DynamicItemsMixin(object):
                                  "items", self.identity, self.name)
             return None
 
-        def create_items(names):
-            if not names:
-                return []
-            Item = DynamicModelItem
-            items = [Item(self, n).initiate().addErrback(log_error)
-                     for n in names]
-            return defer.join(*items)
-
         def cleanup(items):
             # Only returns the item whose initiate method
             # returns a non None value
@@ -1430,12 +1476,53 @@ class DynamicItemsMixin(object):
 
         context = self.make_context()
         d = self._fetch_names(None, context)
-        d.addCallback(create_items)
+        d.addCallback(self._create_items, log_error)
         d.addCallback(cleanup)
         return d
 
     ### private ###
 
+    def _create_items(self, names, log_error):
+        if not names:
+            return []
+        names = list(names)
+        if self._fetch_sources is None:
+            items = [DynamicModelItem(self, n) for n in names]
+            return self._initiate_items(items, log_error)
+
+        context = self.make_context()
+        d = defer.maybeDeferred(self._fetch_sources, names, context)
+        d.addCallback(self._got_sources, names)
+        # the sources failing to be fetched or not matching the names
+        # fall back to the default getter of each item
+        d.addErrback(self._fetch_sources_failed, names)
+        d.addCallback(self._initiate_items, log_error)
+        return d
+
+    def _got_sources(self, sources, names):
+        if isinstance(sources, dict):
+            sources = [sources.get(n) for n in names]
+        elif sources is None or len(sources) != len(names):
+            raise ModelError("%s model %s fetched sources for %d items "
+                             "instead of %d" % (self.identity, self.name,
+                                                len(sources or []),
+                                                len(names)))
+        return [DynamicModelItem(self, n, source_getter=_preloaded(s))
+                for n, s in zip(names, sources)]
+
+    def _fetch_sources_failed(self, failure, names):
+        # Fallback to retrieve the sources one by one
+        error.handle_failure(None, failure, "Error fetching %s model %s "
+                             "item sources", self.identity, self.name)
+        return [DynamicModelItem(self, n) for n in names]
+
+    def _initiate_items(self, items, log_error):
+        # Bounds the number of items initiated at the same time,
+        # each of them may perform a request to retrieve its source
+        semaphore = defer.DeferredSemaphore(self._item_concurrency)
+        return defer.join(*[semaphore.run(i.initiate).addErrback(log_error)
+                            for i in items])
+
     def _notsup(self, feature_desc):
         msg = ("%s model %s does not support %s"
                % (self.identity, self.name, feature_desc, ))
@@ -1473,6 +1560,11 @@ class DynamicItemsMixin(object):
         """@see: feat.models.collection.child_source"""
         cls._fetch_source = _validate_effect(effect)
 
+    @classmethod
+    def annotate_child_sources(cls, effect):
+        """@see: feat.models.collection.child_sources"""
+        cls._fetch_sources = _validate_effect(effect)
+
     @classmethod
     def annotate_child_view(cls, effect):
         """@see: feat.models.collection.child_view"""
@@ -1485,7 +1577,8 @@ class MetaCollection(type(AbstractModel)):
     def new(identity, child_names=None,
             child_source=None, child_view=None,
             child_model=None, child_label=None,
-            child_desc=None, child_meta=None, meta=None):
+            child_desc=None, child_meta=None, meta=None,
+            child_sources=None):
         cls_name = utils.mk_class_name(identity)
         cls = MetaCollection(cls_name, (DynCollection, ), {"__slots__": ()})
         cls.annotate_identity(identity)
@@ -1497,6 +1590,7 @@ class MetaCollection(type(AbstractModel)):
                 cls.annotate_child_meta(*meta_item)
         cls.annotate_child_names(child_names)
         cls.annotate_child_source(child_source)
+        cls.annotate_child_sources(child_sources)
         cls.annotate_child_view(child_view)
         cls.apply_class_meta(meta)
         return cls
@@ -1534,15 +1628,16 @@ class DynCollection(Collection):
 
 class DynamicModelItem(BaseModelItem):
 
-    __slots__ = ("_name", "_reference", "_child")
+    __slots__ = ("_name", "_reference", "_child", "_source")
 
     implements(IModelItem, IAspect)
 
-    def __init__(self, model, name):
+    def __init__(self, model, name, source_getter=None):
         BaseModelItem.__init__(self, model)
         self._name = name
         self._reference = models_reference.Relative(name)
         self._child = None
+        self._source = source_getter or model._fetch_source
         metadata = list(model._item_meta)
         if metadata:
             for meta in metadata:
@@ -1561,7 +1656,7 @@ class DynamicModelItem(BaseModelItem):
         officer = self.model.officer.get_fetch_officer(self.model, self)
         # We need to do it right away to be sure the source exists
         d = self._create_model(view_getter=self.model._fetch_view,
-                               source_getters=[self.model._fetch_source],
+                               source_getters=[self._source],
                                model_factory=self.model._item_model,
                                officer=officer)
         d.addCallback(self._got_model)
@@ -217,7 +217,7 @@ class Driver(log.Logger, log.LogProxy, Commands):
         jouropts = dict()
         if jourfile:
             jouropts['filename'] = jourfile
-            jouropts['encoding'] = 'zip'
+            jouropts['compression'] = 'zlib'
         self._jourwriter = journaler.SqliteWriter(self, **jouropts)
         self._journaler = journaler.Journaler()
 
@@ -21,6 +21,7 @@
 # Headers in this file shall remain intact.
 import collections
 import functools
+import os
 import sys
 import uuid
 
@@ -101,6 +102,17 @@ def attr(*args, **kwargs):
     return wrap
 
 
+def benchmark(func):
+    """Decorator marking the tests measuring the performance.
+
+    They are skipped unless the FEAT_TEST_BENCHMARK environment variable
+    is set, the results are logged at the INFO level.
+    """
+    if not os.environ.get('FEAT_TEST_BENCHMARK'):
+        return attr('slow', skip="benchmark, set FEAT_TEST_BENCHMARK")(func)
+    return attr('slow')(func)
+
+
 class TestCase(unittest.TestCase, log.LogProxy, log.Logger):
 
     implements(ITimeProvider)
@@ -24,6 +24,7 @@
 # Headers in this file shall remain intact.
 
 import itertools
+import time
 import types
 
 from zope.interface import Interface, implements
@@ -33,7 +34,7 @@ from twisted.python.reflect import qual
 from twisted.spread import jelly
 from twisted.trial.unittest import SkipTest
 
-from feat.common import serialization, enum
+from feat.common import serialization, enum, reflect
 from feat.common.serialization import base, adapters
 from feat.interface.serialization import Capabilities, ISnapshotable
 from feat.interface.serialization import ISerializable
@@ -145,6 +146,11 @@ jelly.setUnjellyableForClass(qual(NotReferenceableDummy),
                              NotReferenceableDummy)
 
 
+class BenchmarkDummy(serialization.Serializable):
+
+    type_name = "benchmark-dummy"
+
+
 class TestTypeSerializationDummy(object):
     pass
 
@@ -252,6 +258,72 @@ class ConverterTest(common.TestCase):
                            self.unserializer.convert,
                            capabilities=capabilities)
 
+    def testSinglePassPacking(self):
+        if self.serializer is None:
+            raise SkipTest("No serializer, cannot test packing")
+
+        for freezing in (False, True):
+            if freezing:
+                capabilities = self.serializer.freezer_capabilities
+                convert = self.serializer.freeze
+            else:
+                capabilities = self.serializer.converter_capabilities
+                convert = self.serializer.convert
+
+            values = [v for _, vs, _ in self.symmetry_table(capabilities)
+                      for v in vs]
+            try:
+                table = self.convertion_table(capabilities, freezing) or ()
+                values.extend(v for record in table for v in record[1])
+            except SkipTest:
+                pass
+
+            for value in values:
+                try:
+                    expected = self.convert_in_two_passes(
+                        value, capabilities, freezing)
+                except Exception, e:
+                    # not all the symmetry values can be frozen
+                    self.assertRaises(type(e), convert, value)
+                else:
+                    self.assertEqual(repr(expected), repr(convert(value)))
+
+    @common.benchmark
+    def testPackingBenchmark(self):
+        if self.serializer is None:
+            raise SkipTest("No serializer, cannot benchmark packing")
+
+        caps = self.serializer.converter_capabilities
+        message = BenchmarkDummy()
+        message.payload = [dict(number=x, str="spam", tuple=(x, x + 1))
+                           for x in range(20)]
+        tree = type(self.serializer)(tree=True)
+
+        def measure(convert):
+            start = time.time()
+            for _ in xrange(200):
+                convert(message)
+            return (time.time() - start) / 200 * 1000000
+
+        two_passes = measure(lambda value: self.convert_in_two_passes(
+            value, caps, False))
+        single_pass = measure(self.serializer.convert)
+        single_pass_tree = measure(tree.convert)
+        self.info("%s: two passes %.1f us, single pass %.1f us, "
+                  "single pass of a tree %.1f us",
+                  reflect.canonical_name(self.serializer),
+                  two_passes, single_pass, single_pass_tree)
+
+    def convert_in_two_passes(self, value, capabilities, freezing):
+        serializer = self.serializer
+        try:
+            flattened = serializer.flatten_value(value, capabilities,
+                                                 freezing)
+            return serializer.post_convertion(
+                serializer.pack_value(flattened))
+        finally:
+            serializer.reset()
+
     def serialize(self, data):
         return self.serializer.convert(data)
 
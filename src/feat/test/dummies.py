@@ -31,10 +31,13 @@ from feat.agencies.interface import IAgencyInterestInternalFactory
 from feat.interface.protocols import IInterest, InterestType
 from feat.interface.agent import IAgencyAgent, AgencyAgentState
 from feat.interface.agency import ExecMode
+from feat.interface.generic import ITimeProvider
 
 
 class DummyBase(journal.DummyRecorderNode, log.LogProxy, log.Logger):
 
+    implements(ITimeProvider)
+
     def __init__(self, logger, now=None):
         journal.DummyRecorderNode.__init__(self)
         log.LogProxy.__init__(self, logger)
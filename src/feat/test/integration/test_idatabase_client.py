@@ -382,6 +382,34 @@ class TestCase(object):
         self.assertEquals(1, len(res))
         self.assertEquals(doc, res[0])
 
+    @defer.inlineCallbacks
+    def testStreamingViewResults(self):
+        views = (IncludeDocsView, )
+        design_doc = view.DesignDocument.generate_from_views(views)[0]
+        yield self.connection.save_document(design_doc)
+
+        docs = list()
+        for x in range(3):
+            doc = yield self.connection.save_document(
+                DummyDocument(field=u'doc %d' % (x, )))
+            docs.append(doc)
+
+        received = list()
+        res = yield self.connection.query_view(IncludeDocsView,
+                                               include_docs=True,
+                                               consumer=received.append)
+        self.assertIs(None, res)
+        self.assertEquals(sorted(docs, key=lambda x: x.doc_id),
+                          sorted(received, key=lambda x: x.doc_id))
+
+        received = list()
+        yield self.connection.query_view(IncludeDocsView,
+                                         parse_results=False,
+                                         consumer=received.append)
+        self.assertEquals(3, len(received))
+        self.assertEquals(set(x.doc_id for x in docs),
+                          set(x[2] for x in received))
+
     @defer.inlineCallbacks
     def testBinaryAttachments(self):
         gifdata = ("%c" * 35) % (
@@ -860,6 +888,15 @@ class TestCase(object):
         self.assertEquals(1, len(changes['results']))
         self.assertEqual(changes['results'][0]['id'], doc.doc_id)
 
+        # stream the results
+        received = list()
+        changes = yield self.connection.get_changes(since=start_seq,
+                                                    consumer=received.append)
+        self.assertEqual([], changes['results'])
+        self.assertEqual(seq + 1, changes['last_seq'])
+        self.assertEqual([doc.doc_id, doc2.doc_id],
+                         [x['id'] for x in received])
+
     @defer.inlineCallbacks
     def testBulkGet(self):
         docs = []
@@ -888,6 +925,32 @@ class TestCase(object):
         gets = yield self.connection.bulk_get(doc_ids)
         self.assertEquals(docs[1:], gets)
 
+    @defer.inlineCallbacks
+    def testStreamingBulkGet(self):
+        docs = []
+        for x in range(3):
+            doc = yield self.connection.save_document(DummyDocument())
+            docs.append(doc)
+        doc_ids = [x.doc_id for x in docs]
+
+        received = list()
+        res = yield self.connection.bulk_get(doc_ids,
+                                             consumer=received.append)
+        self.assertIs(None, res)
+        self.assertEqual(docs, received)
+
+        received = list()
+        yield self.connection.bulk_get(['notexistant'] + doc_ids,
+                                       consume_errors=False,
+                                       consumer=received.append)
+        self.assertEqual(docs, received[1:])
+        self.assertIsInstance(received[0], NotFoundError)
+
+        yield self.connection.delete_document(docs[0])
+        received = list()
+        yield self.connection.bulk_get(doc_ids, consumer=received.append)
+        self.assertEqual(docs[1:], received)
+
         gets = yield self.connection.bulk_get(doc_ids, consume_errors=False)
         self.assertEquals(docs[1:], gets[1:])
         self.assertIsInstance(gets[0], NotFoundError)
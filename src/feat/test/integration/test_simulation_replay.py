@@ -96,3 +96,21 @@ class ReplayTest(common.SimulationTest):
         agent = self.get_local('agent')
         result = yield agent.test_side_effect(42)
         self.assertEqual(result, 42 + 1 + 2 +3)
+
+    @defer.inlineCallbacks
+    def testReplayingDeltaSnapshots(self):
+        agency = self.get_local('agency')
+        medium = self.get_local('medium')
+        agent = self.get_local('agent')
+
+        medium.journal_snapshot()
+        for value in range(3):
+            yield agent.test_side_effect(value)
+            medium.journal_snapshot()
+
+        stats = agency.get_snapshot_stats()
+        self.assertEqual(1, stats['full_snapshots'])
+        self.assertEqual(3, stats['delta_snapshots'])
+        self.assertTrue(stats['saved_bytes'] > 0)
+        # the replayability check at the end of the test applies the
+        # deltas and compares the result with the state of the agent
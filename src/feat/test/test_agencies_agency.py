@@ -25,6 +25,7 @@ from feat.common import defer, serialization
 from feat.interface.agent import AgencyAgentState
 from feat.agents.base import descriptor, agent
 from feat.database import document
+from feat.gateway import models
 from feat.test import common
 from feat.agents.application import feat
 
@@ -137,6 +138,25 @@ class TestAgentCallbacks(common.TestCase, common.AgencyTestHelper):
         yield medium.wait_for_state(AgencyAgentState.ready)
         self.assertCalled(medium.get_agent(), 'startup', times=1)
 
+    @defer.inlineCallbacks
+    def testAgentsModelRevision(self):
+        model = models.AgencyAgents(self.agency)
+        yield model.initiate()
+        rev = yield model.fetch_revision()
+
+        medium = yield self.agency.start_agent(self.desc)
+        self.assertNotEqual(rev, (yield model.fetch_revision()))
+        rev = yield model.fetch_revision()
+        self.assertEqual(rev, (yield model.fetch_revision()))
+
+        medium.get_agent().set_started()
+        yield medium.wait_for_state(AgencyAgentState.ready)
+        self.assertNotEqual(rev, (yield model.fetch_revision()))
+        rev = yield model.fetch_revision()
+
+        yield medium.terminate_hard()
+        self.assertNotEqual(rev, (yield model.fetch_revision()))
+
     @defer.inlineCallbacks
     def testAgentNoStartup(self):
         medium = yield self.agency.start_agent(self.desc, run_startup=False)
@@ -1,3 +1,4 @@
+import timeit
 import uuid
 
 from zope.interface import implements
@@ -426,3 +427,135 @@ class TestRouting(common.TestCase):
         m_id = msg.message_id
         m_ids = [msg.message_id for msg in sink.messages]
         self.assertFalse(m_id in m_ids, "Messages are: %r" % (sink.messages, ))
+
+
+class TestTable(common.TestCase):
+
+    implements(ITimeProvider)
+
+    def get_time(self):
+        return self._time
+
+    def setUp(self):
+        self._time = time.time()
+        self.table = routing.Table(self, self)
+
+    def testPriorityOrder(self):
+        order = list()
+        key = ('agent', 'shard')
+        sinks = [OrderedSink(self, order, name) for name in 'abcd']
+        self.table.append_route(routing.Route(sinks[0], key, 5, False))
+        self.table.append_route(routing.Route(sinks[1], key, 1, False))
+        self.table.append_route(routing.Route(sinks[2], key, 5, False))
+        self.table.append_route(routing.Route(sinks[3], key, 3, False))
+
+        self.table.dispatch(direct(key), outgoing=False)
+        self.assertEqual(['b', 'd', 'a', 'c'], order)
+
+    def testFinalStopsProcessing(self):
+        order = list()
+        key = ('agent', 'shard')
+        sinks = [OrderedSink(self, order, name) for name in 'abc']
+        self.table.append_route(routing.Route(sinks[0], key, 1, False))
+        self.table.append_route(routing.Route(sinks[1], key, 2, True))
+        self.table.append_route(routing.Route(sinks[2], key, 3, False))
+
+        self.table.dispatch(direct(key), outgoing=False)
+        self.assertEqual(['a', 'b'], order)
+
+    def testOtherKeysDontMatch(self):
+        order = list()
+        sink = OrderedSink(self, order, 'a')
+        self.table.append_route(routing.Route(sink, ('agent', 'shard')))
+        self.table.dispatch(direct(('other', 'shard')), outgoing=False)
+        self.table.dispatch(direct(('agent', 'other')), outgoing=False)
+        self.assertEqual([], order)
+
+    def testRemoveRouteAndSink(self):
+        order = list()
+        key = ('agent', 'shard')
+        a = OrderedSink(self, order, 'a')
+        b = OrderedSink(self, order, 'b')
+        route = routing.Route(a, key, 1, False)
+        self.table.append_route(route)
+        self.table.append_route(routing.Route(a, ('other', 'shard')))
+        self.table.append_route(routing.Route(b, key, 2, False))
+
+        self.table.remove_route(route)
+        self.table.dispatch(direct(key), outgoing=False)
+        self.assertEqual(['b'], order)
+
+        # removing nonexisting route only logs a warning
+        self.table.remove_route(route)
+        self.table.remove_route(routing.Route(a, ('unknown', 'shard')))
+
+        self.table.remove_sink(b)
+        self.table.dispatch(direct(key), outgoing=False)
+        self.assertEqual(['b'], order)
+
+        self.table.dispatch(direct(('other', 'shard')), outgoing=False)
+        self.assertEqual(['b', 'a'], order)
+
+    def testMessageStore(self):
+        store = routing.MessageStore(self)
+        key = ('agent', 'shard')
+        m1 = direct(key, expiration_time=self._time + 1)
+        m2 = direct(key, expiration_time=self._time + 3)
+        m3 = direct(('other', 'shard'), expiration_time=self._time + 1)
+        m4 = direct(key, expiration_time=self._time - 1)
+        for m in (m1, m2, m3, m4):
+            store.insert(m)
+
+        sink = OrderedSink(self, list(), 'a')
+        route = routing.Route(sink, key, final=False)
+        matching = store.match_to_route(route)
+        self.assertEqual(set([m1.message_id, m2.message_id]),
+                         set([m.message_id for m in matching]))
+
+        self._time += 2
+        matching = store.match_to_route(route)
+        self.assertEqual([m2.message_id], [m.message_id for m in matching])
+        self.assertEqual({key: set([m2.message_id])}, store._index)
+
+        matching = store.match_to_route(route.copy(final=True))
+        self.assertEqual([m2.message_id], [m.message_id for m in matching])
+        self.assertEqual([], store.match_to_route(route))
+        self.assertEqual({}, store._index)
+
+    @common.benchmark
+    def testDispatchBenchmark(self):
+        results = dict()
+        for bindings in (10, 100, 1000, 10000):
+            table = routing.Table(self, self)
+            sink = OrderedSink(self, list(), 'sink')
+            for index in range(bindings):
+                key = ('agent%d' % (index, ), 'shard')
+                table.append_route(routing.Route(sink, key, index % 3))
+            # the route with the lowest priority, checked last by
+            # the linear scan
+            key = ('target', 'shard')
+            table.append_route(routing.Route(sink, key, 3))
+            message = direct(key)
+            timer = timeit.Timer(lambda: table.dispatch(message, False))
+            results[bindings] = min(timer.repeat(repeat=3, number=200))
+            self.info("Dispatch with %d bindings: %.2f us per message",
+                      bindings, results[bindings] / 200 * 1e6)
+
+        # the cost should not grow with the number of bindings,
+        # leave a lot of room for the noise
+        self.assertTrue(results[10000] < results[10] * 5, results)
+
+
+class OrderedSink(log.Logger):
+
+    implements(routing.ISink)
+
+    def __init__(self, logger, order, name):
+        log.Logger.__init__(self, logger)
+        self.order = order
+        self.name = name
+
+    ### ISink ###
+
+    def on_message(self, message):
+        self.order.append(self.name)
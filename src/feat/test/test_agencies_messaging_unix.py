@@ -132,6 +132,69 @@ class UnixSocketMessagingTest(common.TestCase):
         yield self.wait_for(connections[1].has_messages(3), 1, 0.02)
         yield self.wait_for(connections[2].has_messages(3), 1, 0.02)
 
+    @defer.inlineCallbacks
+    def testBatchingMessages(self):
+        connections = yield self._connect()
+
+        recp = recipient.Agent('agent_id', 'shard')
+        connections[1].create_binding(recp)
+        yield self._wait_for_bindings()
+
+        for _ in range(50):
+            connections[2].post(recp, msg())
+        yield self.wait_for(connections[1].has_messages(50), 1, 0.02)
+
+        for agency in self.agencies:
+            stats = agency.broker.get_dispatch_stats()
+            self.assertEqual(0, stats['queue_depth'])
+
+        stats = self.agencies[2].broker.get_dispatch_stats()
+        self.assertEqual(50, stats['flushed_messages'])
+        self.assertEqual(1, stats['flushes'])
+        self.assertEqual(50, stats['max_flush_size'])
+
+        stats = self.agencies[0].broker.get_dispatch_stats()
+        self.assertEqual(50, stats['flushed_messages'])
+        self.assertTrue(stats['flushes'] < 50)
+
+    @defer.inlineCallbacks
+    def testDispatchingToSlavesWithoutBatches(self):
+        # slaves running the version from before the batches
+        self.patch(unix.Slave, 'remote_dispatch_batch', None)
+        connections = yield self._connect()
+
+        recp = recipient.Agent('agent_id', 'shard')
+        connections[1].create_binding(recp)
+        yield self._wait_for_bindings()
+
+        for _ in range(50):
+            connections[2].post(recp, msg())
+        yield self.wait_for(connections[1].has_messages(50), 1, 0.02)
+        dispatchers = self.agencies[0].get_broker_backend()._dispatchers
+        self.assertFalse(any(d._batching for d in dispatchers.values()))
+
+        for _ in range(50):
+            connections[2].post(recp, msg())
+        yield self.wait_for(connections[1].has_messages(100), 1, 0.02)
+        stats = self.agencies[0].broker.get_dispatch_stats()
+        self.assertEqual(0, stats['queue_depth'])
+        self.assertEqual(100, stats['flushed_messages'])
+        # pb logs the calls to the unknown method on the slave side
+        self.assertTrue(self.flushLoggedErrors(pb.NoSuchMethod))
+
+    @defer.inlineCallbacks
+    def _connect(self):
+        connections = list()
+        for agency in self.agencies:
+            yield agency.initiate()
+            con = yield agency.get_connection()
+            connections.append(con)
+        defer.returnValue(connections)
+
+    def _wait_for_bindings(self):
+        # bindings are announced to the master asynchronously
+        return common.delay(None, 0.1)
+
     def _delete_socket_file(self):
         try:
             os.unlink(self.agencies[0].broker.socket_path)
@@ -23,6 +23,7 @@
 # vi:si:et:sw=4:sts=4:ts=4
 import uuid
 import os
+import time
 
 from twisted.internet import defer
 
@@ -170,6 +171,41 @@ class TestMixin(object):
         self.assertEqual(1, len(channel1.messages))
         self.assertEqual(channel1.messages[0].payload, {"value": "66"})
 
+    @defer.inlineCallbacks
+    def testPostingManyMessages(self):
+        count = 200
+        channel = StubChannel(self.backend2)
+        self.backend1.add_route(channel.recipient, self.backend2.route)
+
+        for i in xrange(count):
+            msg = message.BaseMessage(payload=i, recipient=channel.recipient)
+            self.backend1.post(msg)
+
+        yield self.wait_for(lambda: len(channel.messages) == count, 4)
+        self.assertEqual(range(count),
+                         sorted(m.payload for m in channel.messages))
+
+    @common.benchmark
+    @common.attr(timeout=120)
+    @defer.inlineCallbacks
+    def testPostingBenchmark(self):
+        count = 2000
+        channel = StubChannel(self.backend2)
+        self.backend1.add_route(channel.recipient, self.backend2.route)
+
+        start = time.time()
+        for i in xrange(count):
+            msg = message.BaseMessage(payload=i, recipient=channel.recipient)
+            self.backend1.post(msg)
+
+        yield self.wait_for(lambda: len(channel.messages) == count, 60)
+        elapsed = time.time() - start
+
+        self.info("%s: posted %d messages in %.2fs (%.0f messages/s)",
+                  type(self).__name__, count, elapsed, count / elapsed)
+        self.assertEqual(range(count),
+                         sorted(m.payload for m in channel.messages))
+
     ### private ###
 
     def wait_for_idle(self):
@@ -231,6 +267,34 @@ class TestNetTCPTunneling(common.TestCase, TestMixin):
         return common.TestCase.tearDown(self)
 
 
+class TestNetTCPBatchedTunneling(common.TestCase, TestMixin):
+
+    timeout = 5
+
+    def setUp(self):
+        port_range = range(4000, 4100)
+        registry1 = serialization.get_registry().clone()
+        registry1.register(Notification1)
+        self.backend1 = tunneling.Backend("localhost",
+                                          port_range=port_range,
+                                          version=1, registry=registry1,
+                                          batch_delay=0.01)
+
+        registry2 = serialization.get_registry().clone()
+        registry2.register(Notification2)
+        self.backend2 = tunneling.Backend("localhost",
+                                          port_range=port_range,
+                                          version=2, registry=registry2,
+                                          batch_delay=0.01)
+
+        return common.TestCase.setUp(self)
+
+    def tearDown(self):
+        self.backend1.disconnect()
+        self.backend2.disconnect()
+        return common.TestCase.tearDown(self)
+
+
 class TestNetSSLTunneling(common.TestCase, TestMixin):
 
     timeout = 5
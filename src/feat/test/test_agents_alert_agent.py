@@ -7,6 +7,7 @@ from feat.agents.base import alert
 from feat.gateway import models
 from feat.models import response
 
+from feat.interface.agent import AgencyAgentState
 from feat.interface.protocols import ProtocolFailed
 from feat.interface.alert import Severity
 
@@ -79,6 +80,27 @@ class TestAgent(common.TestCase, ModelTestMixin):
         yield model.initiate()
         yield self.validate_model_tree(model)
 
+    @defer.inlineCallbacks
+    def testModelRevision(self):
+        # the alerts are not versioned
+        model = models.AlertAgent(self.agent)
+        yield model.initiate()
+        rev = yield model.fetch_revision()
+        self.assertIs(None, rev)
+
+        model = models.Agent(self.agent)
+        yield model.initiate()
+        rev = yield model.fetch_revision()
+        self.assertEqual(rev, (yield model.fetch_revision()))
+
+        self.medium.state = AgencyAgentState.terminating
+        self.addCleanup(delattr, self.medium, 'state')
+        self.assertNotEqual(rev, (yield model.fetch_revision()))
+        rev = yield model.fetch_revision()
+
+        yield self.medium.save_document(self.medium.descriptor)
+        self.assertNotEqual(rev, (yield model.fetch_revision()))
+
     @defer.inlineCallbacks
     def testScanningShard(self):
         self.medium.reset()
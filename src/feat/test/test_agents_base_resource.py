@@ -92,8 +92,7 @@ class DummyAgent(serialization.Serializable, common.DummyRecorderNode,
     @common.Mock.record
     def update_descriptor(self, method, allocation):
         assert callable(method)
-        method(self.descriptor, allocation)
-        return defer.succeed(allocation)
+        return defer.succeed(method(self.descriptor, allocation))
 
 
 @common.attr(timescale=0.05)
@@ -172,6 +171,93 @@ class PortResourceTest(common.TestCase, Common):
         self.agent.time += 15
         self._assert_allocated([[], [1001, 1002, 1003]])
 
+    @defer.inlineCallbacks
+    def testAllocatingFromLargeRange(self):
+        self.resources.define('ports', resource.Range, 2000, 61999)
+        allocs = list()
+        for _ in range(200):
+            alloc = yield self.resources.allocate(ports=100)
+            allocs.append(alloc)
+        pre = yield self.resources.preallocate(ports=50)
+        self.assertEqual(range(22000, 22050),
+                         sorted(pre.alloc['ports'].values))
+
+        yield self.resources.release(allocs[10].id)
+        alloc = yield self.resources.allocate(ports=150)
+        self.assertEqual(range(3000, 3100) + range(22050, 22100),
+                         sorted(alloc.alloc['ports'].values))
+
+        usage = self.resources.get_usage()['ports']
+        self.assertEqual(('range_def', (2000, 61999)), usage[:2])
+        self.assertEqual(20100, len(usage[2]))
+        self.assertEqual(range(22000, 22050), usage[3])
+
+    @defer.inlineCallbacks
+    def testIndexesAreKeptUpToDate(self):
+        self.resources.define('ports', resource.Range, 1, 65535)
+        for _ in range(5):
+            yield self.resources.allocate(ports=100)
+        indexes = self.resources._get_indexes('ports')
+
+        def check():
+            # the kept indexes give the same as the ones built from scratch
+            usage = self.resources.get_usage()
+            self.assertIs(indexes, self.resources._get_indexes('ports'))
+            self.resources.restored()
+            self.assertEqual(usage, self.resources.get_usage())
+            return self.resources._get_indexes('ports')
+
+        pre = yield self.resources.preallocate(ports=10)
+        alloc = yield self.resources.allocate(ports=10)
+        value = min(alloc.alloc['ports'].values)
+        mod = yield self.resources.premodify(alloc.id,
+                                             ports=('release', value))
+        indexes = check()
+        yield self.resources.confirm(pre.id)
+        indexes = check()
+        yield self.resources.confirm(mod.id)
+        indexes = check()
+        self.assertNotIn(value, self.resources.allocated()['ports'])
+
+        yield self.resources.premodify(alloc.id, ports=('add', 5))
+        self.assertEqual(524, len(self.resources.allocated()['ports']))
+        self.agent.time += 15
+        indexes = check()
+        self.assertEqual(519, len(self.resources.allocated()['ports']))
+        yield self.resources.release(alloc.id)
+        check()
+        self.assertEqual(range(1, 511), self.resources.allocated()['ports'])
+
+
+class RangeIndexTest(common.TestCase):
+
+    def testIteratingFreeValues(self):
+        allocs = [AllocatedRange([3, 4, 7]), RangeModification([5, -4])]
+        index = resource.RangeIndex(allocs)
+        self.assertEqual([1, 2, 6, 8, 9],
+                         list(index.iter_free(1, 9)))
+        self.assertEqual([6], list(index.iter_free(4, 6)))
+        self.assertEqual([], list(index.iter_free(3, 5)))
+        self.assertEqual([3, 4, 5, 7], index.used_between(1, 9))
+        self.assertEqual([4, 5], index.used_between(4, 6))
+
+        index = resource.RangeIndex([])
+        self.assertEqual([0, 1, 2], list(index.iter_free(0, 2)))
+        self.assertEqual([], index.used_between(0, 2))
+
+    def testUpdatingEntries(self):
+        index = resource.RangeIndex()
+        index.set('a', AllocatedRange([1, 2, 3]))
+        index.set('b', RangeModification([3, 4]))
+        self.assertEqual([1, 2, 3, 4], index.used_between(0, 9))
+        index.set('a', AllocatedRange([2]))
+        self.assertEqual([2, 3, 4], index.used_between(0, 9))
+        index.discard('b')
+        index.discard('unknown')
+        self.assertEqual([2], index.used_between(0, 9))
+        self.assertTrue(index.is_used(2))
+        self.assertFalse(index.is_used(3))
+
 
 @common.attr(timescale=0.05)
 class ResourcesTest(common.TestCase, Common):
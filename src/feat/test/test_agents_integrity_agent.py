@@ -1,3 +1,5 @@
+import json
+
 
 from feat.agents.base import alert
 from feat.agents.integrity import integrity_agent, api
@@ -78,6 +80,36 @@ class IntegrationAgentTest(_Base):
         self.assertIn('couchdb-conflicts', self.state.alert_statuses)
         self.assertEqual(0, self.state.alert_statuses['couchdb-conflicts'][0])
 
+    @defer.inlineCallbacks
+    def testSolvingConflictsInBulk(self):
+        db = self.connection.database
+        for doc_id in ('doc1', 'doc2'):
+            db.load_fixture(json.dumps(
+                {'_id': doc_id, '_rev': '2-a', '_conflicts': ['2-b']}))
+        bulk_get = db.bulk_get
+        bulk_gets = []
+
+        def counting_bulk_get(doc_ids, *args, **kwargs):
+            bulk_gets.append(kwargs)
+            return bulk_get(doc_ids, *args, **kwargs)
+
+        self.patch(db, 'bulk_get', counting_bulk_get)
+
+        solved = dict()
+
+        def solve(connection, doc_id, plain_doc=None):
+            solved[doc_id] = plain_doc
+            return defer.succeed(None)
+
+        self.patch(conflicts, 'solve', solve)
+
+        yield self.agent.handle_conflicts(set(['doc1', 'doc2', 'doc3']))
+        self.assertEqual([dict(conflicts=True)], bulk_gets)
+        self.assertEqual(['2-b'], solved['doc1']['_conflicts'])
+        self.assertEqual(['2-b'], solved['doc2']['_conflicts'])
+        self.assertEqual({'_id': 'doc3', '_deleted': True}, solved['doc3'])
+        self.assertEqual(0, self.state.alert_statuses['couchdb-conflicts'][0])
+
     @defer.inlineCallbacks
     def testCheckingReplicationStatus(self):
         self.patch(self.connection, 'get_update_seq',
@@ -205,15 +205,16 @@ class TestExpDict(common.TestCase):
                                             ("eggs", 77)])
 
         t.time += 15
+        # expired entries are still there until the dictionary is accessed
+        self.assertEqual(d.size(), 3)
         self.assertEqual(len(d), 2)
+        self.assertEqual(d.size(), 2)
 
         self.check_iterator(iter(d), ["bacon", "eggs"])
         self.check_iterator(d.iterkeys(), ["bacon", "eggs"])
         self.check_iterator(d.itervalues(), [18, 77])
         self.check_iterator(d.iteritems(), [("bacon", 18), ("eggs", 77)])
 
-        self.assertEqual(d.size(), 3)
-
         t.time += 10
         self.assertEqual(len(d), 1)
 
@@ -222,7 +223,7 @@ class TestExpDict(common.TestCase):
         self.check_iterator(d.itervalues(), [77])
         self.check_iterator(d.iteritems(), [("eggs", 77)])
 
-        self.assertEqual(d.size(), 3)
+        self.assertEqual(d.size(), 1)
 
         d.set("beans", 88, t.time + 5)
         d.set("tomatoes", 44, t.time + 5)
@@ -230,9 +231,12 @@ class TestExpDict(common.TestCase):
         d["foo"] = "bar"
 
         self.assertEqual(len(d), 5)
-        self.assertEqual(d.size(), 7)
+        self.assertEqual(d.size(), 5)
 
         t.time += 10
+        self.assertEqual(d.size(), 5)
+        self.assertRaises(KeyError, d.__getitem__, "spam")
+        self.assertEqual(d.size(), 1)
         self.assertEqual(len(d), 1)
 
         self.check_iterator(iter(d), ["foo"])
@@ -240,42 +244,14 @@ class TestExpDict(common.TestCase):
         self.check_iterator(d.itervalues(), ["bar"])
         self.check_iterator(d.iteritems(), [("foo", "bar")])
 
-        self.assertEqual(len(d), 1)
-        self.assertEqual(d.size(), 7)
-        self.assertRaises(KeyError, d.__getitem__, "spam")
-        self.assertEqual(len(d), 1)
-        self.assertEqual(d.size(), 6)
-        self.assertRaises(KeyError, d.__getitem__, "spam")
-        self.assertEqual(len(d), 1)
-        self.assertEqual(d.size(), 6)
-        self.assertEqual("ohohoh", d.get("bacon", "ohohoh"))
-        self.assertEqual(len(d), 1)
-        self.assertEqual(d.size(), 5)
         self.assertEqual("ohohoh", d.get("bacon", "ohohoh"))
-        self.assertEqual(len(d), 1)
-        self.assertEqual(d.size(), 5)
         self.assertRaises(KeyError, d.remove, "eggs")
-        self.assertEqual(len(d), 1)
-        self.assertEqual(d.size(), 4)
-        self.assertRaises(KeyError, d.remove, "eggs")
-        self.assertEqual(len(d), 1)
-        self.assertEqual(d.size(), 4)
 
         def del_beans(d):
             del d["beans"]
 
         self.assertRaises(KeyError, del_beans, d)
-        self.assertEqual(len(d), 1)
-        self.assertEqual(d.size(), 3)
-        self.assertRaises(KeyError, del_beans, d)
-        self.assertEqual(len(d), 1)
-        self.assertEqual(d.size(), 3)
-        self.assertFalse("tomatoes" in d)
-        self.assertEqual(len(d), 1)
-        self.assertEqual(d.size(), 2)
         self.assertFalse("tomatoes" in d)
-        self.assertEqual(len(d), 1)
-        self.assertEqual(d.size(), 2)
         d.pack()
         self.assertEqual(len(d), 1)
         self.assertEqual(d.size(), 1)
@@ -296,62 +272,60 @@ class TestExpDict(common.TestCase):
         t.time += 10
         self.check_iterator(iter(d), [])
 
-    def testForcedExpiration(self):
+    def testExpirationIndex(self):
         t = DummyTimeProvider(0)
-        d = ExpDict(t, 3)
-        self.assertEqual(len(d), 0)
-        d.set("spam", 42, 10, relative=True)
-        d.set("bacon", 18, 40, relative=True)
-        d.set("eggs", 77, 40, relative=True)
-        self.assertEqual(len(d), 3)
-        self.assertEqual(d.size(), 3)
-        t.time += 15
+        expired = []
+        d = ExpDict(t, 3, on_expire=expired.append)
+        d.set("spam", 42, 10)
+        d.set("bacon", 18, 20)
+        d.set("eggs", 77, 30)
+        # replacing or removing entries leaves the old index entries stale
+        d.set("spam", 43, 25)
+        d["bacon"] = 19
+        del d["eggs"]
         self.assertEqual(len(d), 2)
-        d.set("beans", 88, 5, relative=True)
-        self.assertEqual(len(d), 3)
-        self.assertEqual(d.size(), 4)
-        self.assertEqual(77, d["eggs"]) # Forced packing
-        self.assertEqual(d.size(), 3)
-        t.time += 10
+
+        t.time = 15
         self.assertEqual(len(d), 2)
-        d.set("1", 1, 5, relative=True)
-        self.assertEqual(len(d), 3)
-        self.assertEqual(d.size(), 4)
-        d.set("2", 2, 5, relative=True) # Forced packing
-        self.assertEqual(len(d), 4)
-        self.assertEqual(d.size(), 4)
-        d.set("3", 3, 5, relative=True) # nothing to pack
-        self.assertEqual(len(d), 5)
-        self.assertEqual(d.size(), 5)
-        t.time += 10
+        self.assertEqual([], expired)
+
+        t.time = 26
+        self.assertEqual(len(d), 1)
+        self.assertEqual([43], expired)
+        self.assertEqual(d["bacon"], 19)
+
+        t.time = 40
+        self.assertEqual(len(d), 1)
+        self.assertEqual([43], expired)
+
+        # stale index entries don't accumulate
+        for i in range(100):
+            d.set("beans", i, 100 + i)
+        self.assertTrue(len(d._heap) <= 2 * (len(d) + 3))
+        self.assertEqual(d["beans"], 99)
+
+        t.time = 150
         self.assertEqual(len(d), 2)
-        self.assertEqual(d.remove("eggs"), 77) # forced pack
+        t.time = 200
         self.assertEqual(len(d), 1)
-        self.assertEqual(d.size(), 1)
-        t.time += 10
-        self.assertEqual(len(d), 0)
-        d.set("1", 1, 0.1, relative=True)
-        d.set("2", 2, 0.1, relative=True)
-        d.set("3", 3, 0.1, relative=True)
-        self.assertEqual(len(d), 3)
-        self.assertEqual(d.size(), 4)
-        self.assertTrue("2" in d) # forced pack
-        self.assertEqual(len(d), 3)
-        self.assertEqual(d.size(), 3)
-        t.time += 0.2
+        self.assertEqual([43, 99], expired)
+
+        d.pack()
+        self.assertEqual([], d._heap)
+
+    def testSetWithSameExpiration(self):
+        t = DummyTimeProvider(0)
+        d = ExpDict(t)
+        d.set("spam", 1, 10)
+        d.remove("spam")
+        d.set("spam", 2, 10)
+        d.set("bacon", 3, 10)
+        self.assertEqual(len(d), 2)
+        t.time = 10
         self.assertEqual(len(d), 0)
-        self.assertFalse("foo" in d) # Only one lazy packing per second
-        self.assertEqual(d.size(), 3)
-        d.set("4", 1, 0.8, relative=True)
-        d.set("5", 2, 0.9, relative=True)
-        d.set("6", 3, 0.9, relative=True)
-        self.assertEqual(d.size(), 6)
-        t.time += 0.8
-        self.assertFalse("foo" in d) # Now it should lazy pack
-        self.assertEqual(d.size(), 2)
-        t.time += 0.2
-        d.pack() # calling pack() always pack
         self.assertEqual(d.size(), 0)
+        self.assertEqual(None, d.pop("spam", None))
+        self.assertRaises(KeyError, d.pop, "spam")
 
     def testSerialization(self):
         t = DummyTimeProvider(0)
@@ -492,6 +492,29 @@ class GenericSerializationTest(common.TestCase):
 
         self.assertEqual(data, [{"value": 42}, {"value": 42}])
 
+    def testTreeSerialization(self):
+        Ref = pytree.Reference
+        Deref = pytree.Dereference
+        Inst = pytree.Instance
+        tree = pytree.Serializer(tree=True)
+
+        shared = [1, 2]
+        value = DummySerializable(dict(a=shared, b=(shared, [3])))
+        name = reflect.canonical_name(DummySerializable)
+        expected = Inst(name, {"value": {"a": [1, 2], "b": ([1, 2], [3])}})
+
+        # shared values are detected and serialized using references
+        self.assertEqual(
+            Inst(name, {"value": {"a": Ref(1, [1, 2]),
+                                  "b": (Deref(1), [3])}}),
+            self.serializer.convert(value))
+        # the tree serializer doesn't look for them
+        self.assertEqual(expected, tree.convert(value))
+
+        value.value["b"] = ([1, 2], [3])
+        self.assertEqual(expected, self.serializer.convert(value))
+        self.assertEqual(expected, tree.convert(value))
+
 
 class PyTreeConvertersTest(common_serialization.ConverterTest):
 
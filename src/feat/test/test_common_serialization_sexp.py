@@ -23,6 +23,7 @@
 # See "LICENSE.GPL" in the source distribution for more information.
 # Headers in this file shall remain intact.
 
+import copy
 import itertools
 import types
 
@@ -661,3 +662,77 @@ class TestInstanceCreation(common.TestCase):
         self.assertEqual(C.restored_count, 1)
         self.assertEqual(D.recover_count, 2)
         self.assertEqual(D.restored_count, 2)
+
+
+class TestTreeDelta(common.TestCase):
+
+    def assertPatches(self, old, new):
+        before = copy.deepcopy(old)
+        operations = sexp.diff_tree(old, new)
+        self.assertEqual(new, sexp.patch_tree(old, operations))
+        self.assertEqual(before, old)
+        return operations
+
+    def testDiffingEqualTrees(self):
+        tree = ['dictionary', ['a', 1], ['b', ['list', 'x', 2.5]]]
+        self.assertEqual([], self.assertPatches(tree, copy.deepcopy(tree)))
+
+    def testReplacingValues(self):
+        old = ['dictionary', ['a', 1], ['b', ['list', 'x', 2.5]]]
+        new = ['dictionary', ['a', 2], ['b', ['list', 'x', 2.5]]]
+        self.assertEqual([((1, 1), None, None, 2)],
+                         self.assertPatches(old, new))
+
+        new = ['dictionary', ['a', 1], ['b', None]]
+        self.assertEqual([((2, 1), None, None, None)],
+                         self.assertPatches(old, new))
+
+        self.assertPatches(old, 'spam')
+        self.assertPatches('spam', old)
+
+    def testSplicingLists(self):
+        old = ['list', 1, 2, 3, 4]
+        self.assertEqual([((), 3, 3, [5])],
+                         self.assertPatches(old, ['list', 1, 2, 5, 3, 4]))
+        self.assertEqual([((), 2, 4, [])],
+                         self.assertPatches(old, ['list', 1, 4]))
+        self.assertPatches(old, ['list'])
+        self.assertPatches(['list'], old)
+
+    def testChangingNumericTypes(self):
+
+        def check(old, new):
+            old, new = sexp.serialize(old), sexp.serialize(new)
+            self.assertNotEqual([], self.assertPatches(old, new))
+            patched = sexp.unserialize(sexp.patch_tree(
+                old, sexp.diff_tree(old, new)))
+            self.assertEqual(_types(sexp.unserialize(new)), _types(patched))
+
+        check([1, [2, 3]], [1, [2.0, 3]])
+        check(['x', [1]], ['x', [1L]])
+        check({'a': [1, 2], 'b': 3}, {'a': [1, 2.0], 'b': 3})
+        check({'a': {'b': [1]}}, {'a': {'b': [1L]}})
+        check([{'a': 1}, 2], [{'a': 1.0}, 2, 3])
+        check([[1], 2, 3], [[1L], 2])
+
+    def testPatchingSharedNodes(self):
+        shared = ['list', 1, 2]
+        old = ['tuple', shared, ['list', shared]]
+        new = ['tuple', ['list', 1, 3], ['list', ['list', 1, 2, 3]]]
+        self.assertPatches(old, new)
+        self.assertEqual(['list', 1, 2], shared)
+
+    def testEstimatingSize(self):
+        self.assertEqual(3, sexp.tree_size(42))
+        self.assertEqual(6, sexp.tree_size('spam'))
+        self.assertEqual(11, sexp.tree_size(['list', 1]))
+        delta = sexp.diff_tree(['list', 1, 'a' * 100], ['list', 1, 'b'])
+        self.assertTrue(sexp.tree_size(delta) < 20)
+
+
+def _types(value):
+    if isinstance(value, (list, tuple)):
+        return type(value), [_types(x) for x in value]
+    if isinstance(value, dict):
+        return type(value), sorted((k, _types(v)) for k, v in value.items())
+    return type(value), value
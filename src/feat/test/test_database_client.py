@@ -79,3 +79,261 @@ class UnserializingAndMigrationgTest(common.TestCase):
         fetched = yield self.client.get_document("test-doc")
         self.assertEqual(3, fetched.version)
         self.assertIsInstance(fetched, MigratableDoc)
+
+
+class SavedDoc(document.Document):
+
+    type_name = 'saved-document-test'
+
+    document.field('field', None)
+
+
+class SavingDocumentsTest(common.TestCase):
+
+    def setUp(self):
+        self.registry = base.Registry()
+        self.registry.register(SavedDoc)
+
+        self.db = emu.Database()
+        self.unserializer = dcommon.CouchdbUnserializer(registry=self.registry)
+        self.client = client.Connection(self.db, self.unserializer)
+
+    @defer.inlineCallbacks
+    def testSaveDocuments(self):
+        bulk_docs = self.db.bulk_docs
+        calls = []
+
+        def counting_bulk_docs(docs):
+            calls.append(len(docs))
+            return bulk_docs(docs)
+
+        self.patch(self.db, 'bulk_docs', counting_bulk_docs)
+
+        docs = [SavedDoc(field=x) for x in range(3)]
+        docs.append({'_id': 'raw', 'field': 3})
+        results = yield self.client.save_documents(docs)
+        self.assertEqual([4], calls)
+        self.assertEqual(docs, results)
+        for doc in docs[:3]:
+            self.assertTrue(doc.doc_id)
+            self.assertTrue(doc.rev)
+            fetched = yield self.client.get_document(doc.doc_id)
+            self.assertEqual(doc.field, fetched.field)
+        self.assertTrue(docs[3]['_rev'])
+
+        # the stale document fails, the rest is saved
+        stale = SavedDoc(doc_id=docs[0].doc_id, field='stale')
+        docs[1].field = 'updated'
+        results = yield self.client.save_documents([stale, docs[1]])
+        self.assertIsInstance(results[0], client.ConflictError)
+        self.assertIs(docs[1], results[1])
+        fetched = yield self.client.get_document(docs[1].doc_id)
+        self.assertEqual('updated', fetched.field)
+
+    @defer.inlineCallbacks
+    def testDatabaseTagIsCached(self):
+        tag = yield self.client.get_database_tag()
+        self.assertEqual(tag, self.db.database_tag)
+
+        other = client.Connection(self.db, self.unserializer)
+        self.patch(other, 'get_document', None)
+        tag2 = yield other.get_database_tag()
+        self.assertEqual(tag, tag2)
+
+
+class CachingDocumentsTest(common.TestCase):
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        self.registry = base.Registry()
+        self.registry.register(SavedDoc)
+
+        self.db = emu.Database()
+        self.unserializer = dcommon.CouchdbUnserializer(registry=self.registry)
+        self.client = client.Connection(self.db, self.unserializer,
+                                        cache_documents=True)
+        self.cache = self.client.document_cache
+
+        # the other connection modifies the documents behind our back
+        self.other = client.Connection(self.db, self.unserializer)
+        self.doc = yield self.other.save_document(SavedDoc(field=1))
+
+    @defer.inlineCallbacks
+    def testRevalidatingDocuments(self):
+        fetched = yield self.client.get_document(self.doc.doc_id)
+        self.assertEqual(1, fetched.field)
+        self.assertEqual(1, self.cache.misses)
+
+        fetched.field = 'modified locally'
+        fetched = yield self.client.get_document(self.doc.doc_id)
+        self.assertEqual(1, fetched.field)
+        self.assertEqual(1, self.cache.revalidations)
+
+        self.doc.field = 2
+        yield self.other.save_document(self.doc)
+        fetched = yield self.client.get_document(self.doc.doc_id)
+        self.assertEqual(2, fetched.field)
+        self.assertEqual(2, self.cache.misses)
+        self.assertEqual(0, self.cache.hits)
+
+        yield self.other.delete_document(self.doc)
+        d = self.client.get_document(self.doc.doc_id)
+        self.assertFailure(d, client.NotFoundError)
+        yield d
+        self.assertEqual(0, self.cache.get_stats()['entries'])
+
+    @defer.inlineCallbacks
+    def testTrustingListenedDocuments(self):
+        yield self.client.changes_listener((self.doc.doc_id, ), self._changed)
+        yield self.client.get_document(self.doc.doc_id)
+
+        self.patch(self.db, 'open_doc', None)
+        self.patch(self.db, 'head_doc', None)
+        fetched = yield self.client.get_document(self.doc.doc_id)
+        self.assertEqual(1, fetched.field)
+        rev = yield self.client.get_revision(self.doc.doc_id)
+        self.assertEqual(self.doc.rev, rev)
+        self.assertEqual(2, self.cache.hits)
+
+        self.doc.field = 2
+        yield self.other.save_document(self.doc)
+        yield common.delay(None, 0.01)
+        self.assertEqual(1, self.cache.invalidations)
+        self.assertEqual(0, self.cache.get_stats()['entries'])
+
+    @defer.inlineCallbacks
+    def testSavingForgetsTheDocument(self):
+        fetched = yield self.client.get_document(self.doc.doc_id)
+        fetched.field = 2
+        yield self.client.save_document(fetched)
+        self.assertEqual(0, self.cache.get_stats()['entries'])
+        fetched = yield self.client.get_document(self.doc.doc_id)
+        self.assertEqual(2, fetched.field)
+
+    @defer.inlineCallbacks
+    def testGettingRevisionWithHead(self):
+        open_doc = self.db.open_doc
+        self.patch(self.db, 'open_doc', None)
+        rev = yield self.other.get_revision(self.doc.doc_id)
+        self.assertEqual(self.doc.rev, rev)
+        self.patch(self.db, 'open_doc', open_doc)
+
+        d = self.other.get_revision('unknown')
+        self.assertFailure(d, client.NotFoundError)
+        yield d
+
+    @defer.inlineCallbacks
+    def testDistrustingDocumentsChangedDuringFetch(self):
+        doc_id = self.doc.doc_id
+        yield self.client.changes_listener((doc_id, ), self._changed)
+        raw = yield self.db.open_doc(doc_id)
+
+        open_doc = self.db.open_doc
+        fetch = defer.Deferred()
+        self.patch(self.db, 'open_doc', lambda *_, **__: fetch)
+        d = self.client.get_document(doc_id)
+        self.doc.field = 2
+        yield self.other.save_document(self.doc)
+        yield common.delay(None, 0.01)
+        # the response was sent before the change was done
+        fetch.callback(raw)
+        fetched = yield d
+        self.assertEqual(1, fetched.field)
+        self.assertFalse(self.cache.get(doc_id)[1])
+
+        self.patch(self.db, 'open_doc', open_doc)
+        fetched = yield self.client.get_document(doc_id)
+        self.assertEqual(2, fetched.field)
+        self.assertTrue(self.cache.get(doc_id)[1])
+
+    @defer.inlineCallbacks
+    def testDistrustingWhenNotificationsAreMissed(self):
+        doc_id = self.doc.doc_id
+        yield self.client.changes_listener((doc_id, ), self._changed)
+        yield self.client.get_document(doc_id)
+        self.client.cancel_listener(doc_id)
+        self.assertFalse(self.cache.get(doc_id)[1])
+
+        self.doc.field = 2
+        yield self.other.save_document(self.doc)
+        yield self.client.changes_listener((doc_id, ), self._changed)
+        fetched = yield self.client.get_document(doc_id)
+        self.assertEqual(2, fetched.field)
+        self.assertTrue(self.cache.get(doc_id)[1])
+
+        self.db._on_disconnected()
+        self.assertFalse(self.cache.get(doc_id)[1])
+
+    def testEvictingLeastRecentlyUsed(self):
+        cache = client.DocumentCache(desired_size=2)
+        for x in range(3):
+            cache.store({'_id': str(x), '_rev': '1-a'})
+        cache.get('1')
+        cache.store({'_id': '3', '_rev': '1-a'})
+        self.assertEqual((None, False), cache.get('0'))
+        self.assertEqual((None, False), cache.get('2'))
+        self.assertEqual('1', cache.get('1')[0]['_id'])
+        self.assertEqual(2, cache.get_stats()['evictions'])
+
+    def _changed(self, doc_id, rev, deleted, own_change):
+        pass
+
+
+class RowsConsumerTest(common.TestCase):
+
+    def setUp(self):
+        self.received = list()
+        self.parsed = dict()
+
+    def parse(self, row):
+        return self.parsed.get(row, [row])
+
+    @defer.inlineCallbacks
+    def testRowsAreConsumedInOrder(self):
+        consumer = client.RowsConsumer(self.received.append, self.parse)
+        consumer(1)
+        self.assertIs(None, consumer.wait())
+
+        self.parsed[2] = defer.Deferred()
+        for row in (2, 3):
+            consumer(row)
+        self.assertEqual([1], self.received)
+        self.parsed[2].callback([2])
+        yield consumer.wait()
+        self.assertEqual([1, 2, 3], self.received)
+
+    @defer.inlineCallbacks
+    def testFailingRow(self):
+        consumer = client.RowsConsumer(self.received.append, self.parse)
+        self.parsed[1] = defer.Deferred()
+        self.parsed[3] = defer.Deferred()
+        for row in (1, 2, 3, 4):
+            consumer(row)
+        self.parsed[1].errback(ValueError('unserializing failed'))
+        self.parsed[3].errback(ValueError('dropped'))
+        d = consumer.wait()
+        self.assertFailure(d, ValueError)
+        error = yield d
+        self.assertEqual('unserializing failed', str(error))
+        self.assertEqual([], self.received)
+
+    @defer.inlineCallbacks
+    def testBulkGetWithFailingRow(self):
+        db = emu.Database()
+        connection = client.Connection(db)
+        doc = yield connection.save_document({'_id': 'doc1'})
+        yield connection.save_document({'_id': 'doc2'})
+
+        unserialize = connection.unserialize_document
+
+        def failing_unserialize(raw):
+            if raw['_id'] == 'doc2':
+                return defer.fail(ValueError('upgrade failed'))
+            return defer.succeed(unserialize(raw))
+
+        self.patch(connection, 'unserialize_document', failing_unserialize)
+        d = connection.bulk_get(['doc1', 'doc2'],
+                                consumer=self.received.append)
+        self.assertFailure(d, ValueError)
+        yield d
+        self.assertEqual([doc], self.received)
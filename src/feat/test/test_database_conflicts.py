@@ -0,0 +1,59 @@
+import json
+
+from feat.common import defer
+from feat.database import conflicts, emu
+from feat.test import common
+
+
+class TestConflicts(common.TestCase):
+
+    def setUp(self):
+        common.TestCase.setUp(self)
+        self.db = emu.Database()
+        self.connection = self.db.get_connection()
+        self.patch(conflicts, 'BATCH_SIZE', 2)
+
+    def load(self, **doc):
+        self.db.load_fixture(json.dumps(doc))
+
+    @defer.inlineCallbacks
+    def testCheckConflicts(self):
+        self.load(_id='doc1', _rev='2-a', _conflicts=['2-b'])
+        self.load(_id='doc2', _rev='1-a')
+        self.load(_id='doc3', _rev='2-a', _deleted=True)
+
+        result = yield conflicts.check_conflicts(
+            self.connection, ['doc1', 'doc2', 'doc3', 'doc4'])
+        self.assertEqual(4, len(result))
+        in_conflict, raw_doc = result['doc1']
+        self.assertTrue(in_conflict)
+        self.assertEqual(['2-b'], raw_doc['_conflicts'])
+        in_conflict, raw_doc = result['doc2']
+        self.assertFalse(in_conflict)
+        self.assertEqual('1-a', raw_doc['_rev'])
+        for doc_id in ('doc3', 'doc4'):
+            self.assertEqual((False, {'_id': doc_id, '_deleted': True}),
+                             result[doc_id])
+
+    @defer.inlineCallbacks
+    def testCleanupUpdateLogs(self):
+        for x in range(5):
+            yield self.connection.save_document({'_id': u'log%d' % (x, )})
+
+        bulk_get = self.connection.bulk_get
+        chunks = []
+
+        def counting_bulk_get(doc_ids, *args, **kwargs):
+            chunks.append(len(doc_ids))
+            return bulk_get(doc_ids, *args, **kwargs)
+
+        self.patch(self.connection, 'bulk_get', counting_bulk_get)
+
+        # the missing log has already been cleaned up
+        doc_ids = [u'log%d' % (x, ) for x in range(6)]
+        yield conflicts._cleanup_update_logs(self.connection, doc_ids)
+        self.assertEqual([2, 2, 2], chunks)
+        for doc_id in doc_ids:
+            d = self.connection.get_document(doc_id)
+            self.assertFailure(d, conflicts.NotFoundError)
+            yield d
@@ -0,0 +1,604 @@
+# F3AT - Flumotion Asynchronous Autonomous Agent Toolkit
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# See "LICENSE.GPL" in the source distribution for more information.
+
+# Headers in this file shall remain intact.
+import json
+import time
+import urlparse
+
+from twisted.test.proto_helpers import StringTransport
+
+from feat.database import driver, view
+from feat.web import http, httpclient
+from feat.test import common
+
+
+def response(body, etag, status=200):
+    res = httpclient.Response()
+    res.status = status
+    res.body = body
+    res.headers = {'etag': etag} if etag else {}
+    return res
+
+
+def parser(response, tag):
+    return response.body
+
+
+class TestCache(common.TestCase):
+
+    def setUp(self):
+        self.cache = driver.Cache(desired_size=100)
+
+    def fill(self, ident, size, etag=None):
+        entry = driver.CacheEntry(ident, parser)
+        self.cache[ident] = entry
+        self.cache.got_response(
+            response('x' * size, etag or '"%s"' % (ident, )), ident, entry)
+        return entry
+
+    def testAccountingSize(self):
+        self.fill('a', 30)
+        self.fill('b', 20)
+        self.assertEqual(50, self.cache.get_size())
+        del self.cache['a']
+        self.assertEqual(20, self.cache.get_size())
+        self.cache.pop('b')
+        self.assertEqual(0, self.cache.get_size())
+        self.fill('c', 10)
+        self.cache.clear()
+        self.assertEqual(0, self.cache.get_size())
+        self.assertEqual(0, len(self.cache))
+
+    def testEvictsLeastRecentlyUsed(self):
+        self.fill('a', 40)
+        self.fill('b', 40)
+        self.assertIsNot(None, self.cache.get_url('a'))
+        self.fill('c', 40)
+        self.assertEqual(set(['a', 'c']), set(self.cache.keys()))
+        self.assertEqual(1, self.cache.evictions)
+        self.assertEqual(80, self.cache.get_size())
+
+    def testProtectedSurvivesScan(self):
+        self.fill('hot', 30)
+        self.cache.get_url('hot')
+        for x in range(10):
+            self.fill('scan%d' % (x, ), 30)
+        self.assertIn('hot', self.cache)
+        self.assertIn('scan9', self.cache)
+        self.assertEqual(90, self.cache.get_size())
+
+    def testBiggerThanDesiredSize(self):
+        self.fill('a', 10)
+        self.fill('big', 200)
+        self.assertEqual(['big'], self.cache.keys())
+
+    def testInvalidEntriesAreRemoved(self):
+        entry = driver.CacheEntry('a', parser)
+        self.cache['a'] = entry
+        self.cache.got_response(response('body', None), 'a', entry)
+        self.assertNotIn('a', self.cache)
+        self.assertEqual(0, self.cache.get_size())
+
+        self.fill('b', 10)
+        self.cache['b'].state = driver.EntryState.invalid
+        self.assertIs(None, self.cache.get_url('b'))
+        self.assertNotIn('b', self.cache)
+
+    def testHitsAndMisses(self):
+        self.assertIs(None, self.cache.get_url('a'))
+        entry = self.fill('a', 10)
+        self.assertIs(entry, self.cache.get_url('a'))
+        self.assertEqual(dict(hits=1, misses=1, evictions=0,
+                              revalidations=0, size=10, entries=1),
+                         self.cache.get_stats())
+
+    def testFreshenEntries(self):
+        a = self.fill('a', 10, etag='"rev"')
+        b = self.fill('b', 10, etag='"rev"')
+        c = self.fill('c', 10, etag='"other"')
+        a.fresh_at = b.fresh_at = c.fresh_at = 0
+        self.cache.freshen_entries(response('', '"rev"', status=304))
+        self.assertEqual(1, self.cache.revalidations)
+        self.assertTrue(a.fresh_at > 0)
+        self.assertTrue(b.fresh_at > 0)
+        self.assertEqual(0, c.fresh_at)
+
+        # removed entries are not freshened anymore
+        del self.cache['a']
+        self.assertEqual(set(['b']), self.cache._etags['"rev"'])
+        del self.cache['b']
+        self.assertNotIn('"rev"', self.cache._etags)
+
+    def testRevalidationKeepsProtectedEntry(self):
+        entry = self.fill('a', 30)
+        self.cache.get_url('a')
+        entry.state = driver.EntryState.waiting
+        self.cache.got_response(response('', '"a"', status=304), 'a', entry)
+        self.assertEqual(driver.EntryState.ready, entry.state)
+        self.assertIn('a', self.cache._protected)
+        self.assertEqual(30, self.cache.get_size())
+
+    def testReplacedEntryIsNotAccounted(self):
+        entry = driver.CacheEntry('a', parser)
+        self.cache['a'] = entry
+        self.cache.clear()
+        self.cache.got_response(response('body', '"a"'), 'a', entry)
+        self.assertEqual(driver.EntryState.ready, entry.state)
+        self.assertEqual(0, self.cache.get_size())
+        self.assertNotIn('a', self.cache)
+
+
+VIEW_RESPONSE = ('{"total_rows":3,"offset":0,"rows":[\r\n'
+                 '{"id":"a","key":"a","value":{"rev":"1-x"},'
+                 '"doc":{"_id":"a","text":"} ] \\" {["}},\r\n'
+                 '{"id":"b","key":["b",[1,2]],"value":{"rev":"1-y"},'
+                 '"doc":{"_id":"b","nested":{"list":[{}]}}},\r\n'
+                 '{"key":"c","error":"not_found"}\r\n'
+                 ']}\n')
+
+
+class TestRowsParser(common.TestCase):
+
+    def parse(self, body, chunk_size):
+        rows = list()
+        parser = driver.RowsParser(rows.append)
+        for index in range(0, len(body), chunk_size):
+            parser.feed(body[index:index + chunk_size])
+        return rows, parser.finish()
+
+    def testParsingInChunks(self):
+        expected = driver.json.loads(VIEW_RESPONSE)
+        expected_rows = expected.pop('rows')
+        expected['rows'] = []
+        for chunk_size in (1, 2, 3, 7, 16, len(VIEW_RESPONSE)):
+            rows, rest = self.parse(VIEW_RESPONSE, chunk_size)
+            self.assertEqual(expected_rows, rows)
+            self.assertEqual(expected, rest)
+
+    def testBufferKeepsSingleRow(self):
+        parser = driver.RowsParser(lambda row: None)
+        parser.feed('{"results":[')
+        for x in range(1000):
+            parser.feed('{"seq":%d,"id":"doc_%d"},\n' % (x, x))
+        parser.feed('{"seq":1000,')
+        self.assertEqual('{"seq":1000,', parser._buffer)
+        parser.feed('"id":"last"}\n],\n"last_seq":1001}\n')
+        self.assertEqual(dict(results=[], last_seq=1001), parser.finish())
+
+    def testResponsesWithoutRows(self):
+        rows, rest = self.parse('{"error":"not_found","reason":"missing"}', 5)
+        self.assertEqual([], rows)
+        self.assertEqual(dict(error='not_found', reason='missing'), rest)
+
+        rows, rest = self.parse('{"doc":{"rows":[{"a":1}]}}', 5)
+        self.assertEqual([], rows)
+        self.assertEqual({'doc': {'rows': [{'a': 1}]}}, rest)
+
+    def testTruncatedResponse(self):
+        parser = driver.RowsParser(lambda row: None)
+        parser.feed(VIEW_RESPONSE[:100])
+        self.assertRaises(ValueError, parser.finish)
+
+
+class TestRowsDecoder(common.TestCase):
+
+    def decode(self, status, body, callback):
+        decoder = driver.RowsDecoder(callback)
+        decoder.status = status
+        decoder.headers = {'content-type': 'application/json'}
+        decoder.makeConnection(None)
+        for index in range(0, len(body), 10):
+            decoder.dataReceived(body[index:index + 10])
+        decoder.connectionLost()
+        return decoder.get_result()
+
+    @common.defer.inlineCallbacks
+    def testStreamingRows(self):
+        rows = list()
+        response = yield self.decode(200, VIEW_RESPONSE, rows.append)
+        self.assertEqual(3, len(rows))
+        rest = driver.parse_response(response, 'test')
+        self.assertEqual(dict(total_rows=3, offset=0, rows=[]), rest)
+
+    @common.defer.inlineCallbacks
+    def testErrorResponse(self):
+        rows = list()
+        response = yield self.decode(404, '{"rows":[{"a":1}]}', rows.append)
+        self.assertEqual([], rows)
+        self.assertEqual('{"rows":[{"a":1}]}', response.body)
+
+    @common.defer.inlineCallbacks
+    def testFailingConsumer(self):
+
+        def callback(row):
+            raise AttributeError(row)
+
+        d = self.decode(200, VIEW_RESPONSE, callback)
+        yield self.assertFailure(d, AttributeError)
+
+
+class TestCouchDB(common.TestCase):
+
+    def testPathTemplates(self):
+        couchdb = driver.CouchDB('localhost', 5984)
+        templates = [
+            ('/feat/doc1?rev=1-abc', '/feat/*'),
+            ('/feat/doc1/attachment', '/feat/*/*'),
+            ('/feat/_local/doc1', '/feat/_local/*'),
+            ('/feat/_design/featjs/_view/by_type?key=%22a%22',
+             '/feat/_design/featjs/_view/by_type'),
+            ('/feat/_changes?feed=continuous', '/feat/_changes'),
+            ('/feat/', '/feat/'),
+            ('/_all_dbs', '/_all_dbs')]
+        for location, expected in templates:
+            self.assertEqual(expected, couchdb.get_path_template(location))
+
+    def testPriorities(self):
+        couchdb = driver.CouchDB('localhost', 5984)
+        priorities = [
+            ('/feat/doc1', 'normal'),
+            ('/feat/_changes?feed=continuous', 'high'),
+            ('/feat/_design/featjs/_view/by_type?key=1', 'low'),
+            ('/feat/_all_docs?include_docs=true', 'low'),
+            ('/feat/_bulk_docs', 'normal')]
+        for location, expected in priorities:
+            priority = couchdb.get_priority(http.Methods.GET, location)
+            self.assertEqual(expected, priority.name)
+
+
+class EvenView(view.BaseView):
+
+    name = 'even'
+
+    def filter(doc, request):
+        return doc.get('value', 1) % 2 == 0
+
+
+class StandInCouchDB(object):
+    '''
+    Stand-in for the CouchDB connection pool serving the database
+    information, the continuous changes feeds, which are filtered
+    the way CouchDB would do it, the _bulk_docs writes and the documents
+    written by them.
+    '''
+
+    def __init__(self):
+        self.update_seq = 0
+        # [(query, doc_ids, ChangeReceiver)]
+        self.feeds = list()
+        # [(seq, doc_id, value)] of the emitted changes
+        self.changes = list()
+        # filter name -> view evaluating it
+        self.filters = dict()
+        # doc_id -> revision
+        self.revisions = dict()
+        # [number of documents written by each _bulk_docs request]
+        self.bulk_requests = list()
+        # [(method, url)] of the requests made
+        self.requests = list()
+
+    def get(self, url, headers=dict(), **extra):
+        return self.request('GET', url, None, headers=headers, **extra)
+
+    def head(self, url, headers=dict(), **extra):
+        return self.request('HEAD', url, None, headers=headers, **extra)
+
+    def post(self, url, body=None, headers=dict(), **extra):
+        return self.request('POST', url, body, **extra)
+
+    def put(self, url, body=None, headers=dict(), **extra):
+        return self.request('PUT', url, body, **extra)
+
+    def request(self, method, url, body, decoder=None, headers=dict(),
+                **extra):
+        self.requests.append((method, url))
+        path, query = urlparse.urlparse(url)[2:5:2]
+        if path.endswith('/_bulk_docs'):
+            return self.bulk_docs(json.loads(body)['docs'])
+        doc_id = path.split('/', 2)[-1]
+        if method in ('GET', 'HEAD') and doc_id in self.revisions:
+            return self.open_doc(method, doc_id, headers)
+        if not path.endswith('/_changes'):
+            res = response(json.dumps(dict(update_seq=self.update_seq)), None)
+            res.headers['content-type'] = 'application/json'
+            return common.defer.succeed(res)
+
+        query = dict(urlparse.parse_qsl(query))
+        doc_ids = None
+        if query.get('filter') == '_doc_ids':
+            doc_ids = set(json.loads(body)['doc_ids'])
+        decoder.status = 200
+        decoder.makeConnection(StringTransport())
+        feed = (query, doc_ids, decoder)
+        self.feeds.append(feed)
+        d = decoder.get_result()
+        for change in self.changes:
+            if change[0] > int(query['since']):
+                self.send(feed, *change)
+        return d
+
+    def bulk_docs(self, docs):
+        self.bulk_requests.append(len(docs))
+        results = list()
+        for doc in docs:
+            doc_id = doc['_id']
+            if doc.get('_rev') != self.revisions.get(doc_id):
+                results.append(dict(id=doc_id, error='conflict',
+                                    reason='Document update conflict.'))
+                continue
+            self.update_seq += 1
+            rev = '%d-abc' % (self.update_seq, )
+            self.revisions[doc_id] = rev
+            results.append(dict(id=doc_id, rev=rev))
+        res = response(json.dumps(results), None, status=201)
+        res.headers['content-type'] = 'application/json'
+        return common.defer.succeed(res)
+
+    def open_doc(self, method, doc_id, headers):
+        rev = self.revisions[doc_id]
+        etag = '"%s"' % (rev, )
+        if headers.get('if-none-match') == etag:
+            return common.defer.succeed(
+                response('', etag, status=http.Status.NOT_MODIFIED))
+        body = json.dumps(dict(_id=doc_id, _rev=rev))
+        res = response(body if method == 'GET' else '', etag)
+        res.headers['content-type'] = 'application/json'
+        return common.defer.succeed(res)
+
+    def get_open_feeds(self):
+        return [x for x in self.feeds if not x[2].transport.disconnecting]
+
+    def emit(self, doc_id, value):
+        self.update_seq += 1
+        change = (self.update_seq, doc_id, value)
+        self.changes.append(change)
+        for feed in self.get_open_feeds():
+            self.send(feed, *change)
+
+    def send(self, feed, seq, doc_id, value):
+        query, doc_ids, receiver = feed
+        if doc_ids is not None and doc_id not in doc_ids:
+            return
+        rev = '%d-abc' % (seq, )
+        doc = dict(_id=doc_id, _rev=rev, value=value)
+        view = self.filters.get(query.get('filter'))
+        if (view is not None and
+            not view.perform_filter(doc, dict(query=query))):
+            return
+        change = dict(seq=seq, id=doc_id, changes=[dict(rev=rev)])
+        if query.get('include_docs') == 'true':
+            change['doc'] = doc
+        receiver.dataReceived(json.dumps(change) + '\n')
+
+
+class TestChangesFeed(common.TestCase):
+
+    def setUp(self):
+        common.TestCase.setUp(self)
+        self.db = driver.Database('localhost', 5984, 'feat')
+        self.db.couchdb = StandInCouchDB()
+        self.db._on_connected()
+        self.addCleanup(self.db._cancel_reconnector)
+        self.notified = list()
+
+    def callback(self, doc_id, rev, deleted):
+        self.notified.append(doc_id)
+
+    @common.defer.inlineCallbacks
+    def testDocumentListeners(self):
+        couchdb = self.db.couchdb
+        l1 = yield self.db.listen_changes(['doc1', 'doc2'], self.callback)
+        l2 = yield self.db.listen_changes(['doc2', 'doc3'], self.callback)
+        self.assertEqual(1, len(couchdb.get_open_feeds()))
+        query, doc_ids, _ = couchdb.get_open_feeds()[0]
+        self.assertEqual('_doc_ids', query['filter'])
+        self.assertEqual(set(['doc1', 'doc2', 'doc3']), doc_ids)
+
+        for doc_id in ['doc1', 'doc2', 'doc3', 'doc4']:
+            couchdb.emit(doc_id, 1)
+        yield common.delay(None, 0.01)
+        self.assertEqual(['doc1', 'doc2', 'doc2', 'doc3'], self.notified)
+        self.assertEqual(3, self.db.get_changes_stats()['changes'])
+
+        yield self.db.cancel_listener(l1)
+        query, doc_ids, _ = couchdb.get_open_feeds()[0]
+        self.assertEqual(set(['doc2', 'doc3']), doc_ids)
+
+        yield self.db.cancel_listener(l2)
+        self.assertEqual([], couchdb.get_open_feeds())
+        self.assertEqual(0, self.db.get_changes_stats()['feeds'])
+
+    @common.defer.inlineCallbacks
+    def testRestartingResumesFromLastSequence(self):
+        couchdb = self.db.couchdb
+        yield self.db.listen_changes(['doc1'], self.callback)
+        query, _, _ = couchdb.get_open_feeds()[0]
+        self.assertEqual('0', query['since'])
+        couchdb.emit('doc1', 1)
+
+        d1 = self.db.listen_changes(['doc2'], self.callback)
+        d2 = self.db.listen_changes(['doc3'], self.callback)
+        # changed while the restart of the feed is delayed
+        couchdb.emit('doc2', 1)
+        couchdb.emit('doc3', 1)
+        yield d1
+        yield d2
+
+        # the feed is restarted once for both listeners
+        self.assertEqual(2, len(couchdb.feeds))
+        query, doc_ids, _ = couchdb.get_open_feeds()[0]
+        self.assertEqual('1', query['since'])
+        self.assertEqual(set(['doc1', 'doc2', 'doc3']), doc_ids)
+        yield common.delay(None, 0.01)
+        self.assertEqual(['doc1', 'doc2', 'doc3'], self.notified)
+
+    @common.defer.inlineCallbacks
+    def testViewFiltersHaveTheirOwnFeed(self):
+        couchdb = self.db.couchdb
+        name = '%s/%s' % (EvenView.design_doc_id, EvenView.name)
+        couchdb.filters[name] = EvenView
+        yield self.db.listen_changes(['doc1'], self.callback)
+        yield self.db.listen_changes(EvenView, self.callback)
+        self.assertEqual(2, len(couchdb.get_open_feeds()))
+        query, doc_ids, _ = couchdb.get_open_feeds()[1]
+        # the view is evaluated by CouchDB
+        self.assertEqual(name, query['filter'])
+        self.assertNotIn('include_docs', query)
+        self.assertEqual(None, doc_ids)
+
+        couchdb.emit('doc1', 1)
+        couchdb.emit('doc2', 2)
+        couchdb.emit('doc3', 3)
+        yield common.delay(None, 0.01)
+        self.assertEqual(['doc1', 'doc2'], self.notified)
+        stats = self.db.get_changes_stats()
+        self.assertEqual(2, stats['feeds'])
+        self.assertEqual(2, stats['changes'])
+        self.assertTrue(stats['bytes'] > 0)
+
+    @common.defer.inlineCallbacks
+    def testFilteringReducesTraffic(self):
+        couchdb = self.db.couchdb
+        for index in range(10):
+            yield self.db.listen_changes(['doc%d' % (index, )],
+                                         self.callback)
+        yield self.db.listen_changes(EvenView, self.callback)
+        view_feed = [x for x in self.db.notifiers.itervalues()
+                     if x.name != 'doc_ids'][0]
+
+        for index in range(500):
+            couchdb.emit('doc%d' % (index, ), index)
+        # only the changes of the listened documents are sent,
+        # the view feed receives half of them
+        filtered = self.db.notifiers['doc_ids'].bytes_received
+        halved = view_feed.bytes_received
+        self.assertTrue(filtered * 20 < halved, (filtered, halved))
+
+    @common.benchmark
+    @common.attr(timeout=120)
+    @common.defer.inlineCallbacks
+    def testChangesBenchmark(self):
+        couchdb = self.db.couchdb
+        for index in range(100):
+            yield self.db.listen_changes(['doc%d' % (index, )],
+                                         self.callback)
+
+        def measure(count):
+            start = time.time()
+            bytes = self.db.get_changes_stats()['bytes']
+            for index in range(count):
+                couchdb.emit('doc%d' % (index % 10000, ), index)
+            elapsed = time.time() - start
+            received = self.db.get_changes_stats()['bytes'] - bytes
+            return count / elapsed, received
+
+        rate, filtered = measure(20000)
+        self.info("Filtered feed: %d changes/s, %d bytes received",
+                  rate, filtered)
+
+        yield self.db.listen_changes(EvenView, self.callback)
+        rate, unfiltered = measure(20000)
+        self.info("Filtered and view feeds: %d changes/s, %d bytes received",
+                  rate, unfiltered)
+        self.assertTrue(filtered * 50 < unfiltered, (filtered, unfiltered))
+
+
+class TestBulkDocs(common.TestCase):
+
+    def setUp(self):
+        common.TestCase.setUp(self)
+        self.db = driver.Database('localhost', 5984, 'feat')
+        self.db.couchdb = StandInCouchDB()
+        self.db.version = (1, 2, 0)
+        self.db._on_connected()
+        self.addCleanup(self.db._cancel_reconnector)
+
+    def save(self, doc_id, rev=None):
+        doc = dict(_id=doc_id)
+        if rev:
+            doc['_rev'] = rev
+        return self.db.save_doc(json.dumps(doc), doc_id)
+
+    @common.defer.inlineCallbacks
+    def testCoalescingWrites(self):
+        couchdb = self.db.couchdb
+        defers = [self.save('doc%d' % (x, )) for x in range(3)]
+        results = yield common.defer.DeferredList(defers)
+        self.assertEqual([3], couchdb.bulk_requests)
+        for (success, result), x in zip(results, range(3)):
+            self.assertTrue(success)
+            self.assertEqual('doc%d' % (x, ), result['id'])
+            self.assertEqual(couchdb.revisions[result['id']], result['rev'])
+
+        # the documents saved in the next iteration are written separately
+        yield self.save('doc3')
+        self.assertEqual([3, 1], couchdb.bulk_requests)
+
+    @common.defer.inlineCallbacks
+    def testConflicts(self):
+        couchdb = self.db.couchdb
+        r = yield self.save('doc1')
+        d1 = self.save('doc1')
+        d2 = self.save('doc1', r['rev'])
+        self.assertFailure(d1, driver.ConflictError)
+        yield d1
+        r2 = yield d2
+        self.assertEqual(couchdb.revisions['doc1'], r2['rev'])
+        self.assertEqual([1, 2], couchdb.bulk_requests)
+
+    @common.defer.inlineCallbacks
+    def testWritesAreNotDelayed(self):
+        couchdb = self.db.couchdb
+        yield self.save('doc1')
+        method, url = couchdb.requests[-1]
+        self.assertTrue(url.startswith('/feat/_bulk_docs'))
+        priority = driver.CouchDB('localhost', 5984).get_priority(method, url)
+        self.assertEqual(httpclient.RequestPriority.normal, priority)
+
+    @common.defer.inlineCallbacks
+    def testSizeLimit(self):
+        couchdb = self.db.couchdb
+        self.db._writer.max_size = 2
+        defers = [self.save('doc%d' % (x, )) for x in range(5)]
+        yield common.defer.DeferredList(defers)
+        self.assertEqual([2, 2, 1], couchdb.bulk_requests)
+        self.assertEqual(3, self.db._writer.requests)
+        self.assertEqual(5, self.db._writer.documents)
+
+    @common.defer.inlineCallbacks
+    def testLocalDocumentsBypass(self):
+        couchdb = self.db.couchdb
+        yield self.db.save_doc(json.dumps(dict(_id='_local/doc')),
+                               '_local/doc')
+        self.assertEqual([], couchdb.bulk_requests)
+
+    @common.defer.inlineCallbacks
+    def testOpeningUnchangedDocuments(self):
+        r = yield self.save('doc1')
+        rev = yield self.db.head_doc('doc1')
+        self.assertEqual(r['rev'], rev)
+
+        doc = yield self.db.open_doc('doc1')
+        self.assertEqual(r['rev'], doc['_rev'])
+        doc = yield self.db.open_doc('doc1', if_none_match=r['rev'])
+        self.assertIs(None, doc)
+        doc = yield self.db.open_doc('doc1', if_none_match='0-old')
+        self.assertEqual(r['rev'], doc['_rev'])
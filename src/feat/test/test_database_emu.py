@@ -23,7 +23,7 @@ import json
 
 from twisted.internet import defer
 
-from feat.database import emu
+from feat.database import emu, view
 from feat.database.interface import ConflictError, NotFoundError
 
 from . import common
@@ -203,3 +203,81 @@ class TestDatabaseIntegration(common.TestCase):
 
     def _gen_doc(self, doc_id):
         return json.dumps({'_id': doc_id})
+
+
+class ValueView(view.BaseView):
+
+    name = 'values'
+    use_reduce = True
+    reduce = '_count'
+
+    def map(doc):
+        if 'value' in doc:
+            yield ('value', doc['value']), None
+            if doc['value'] % 2 == 0:
+                yield ('even', doc['value']), doc['value']
+
+
+class TestViewIndex(common.TestCase):
+
+    def setUp(self):
+        self.database = emu.Database()
+
+    @defer.inlineCallbacks
+    def testIncrementalUpdates(self):
+        revs = dict()
+        for x in range(10):
+            doc_id = u'doc%d' % (x, )
+            resp = yield self.database.save_doc(
+                json.dumps({'_id': doc_id, 'value': x}))
+            revs[doc_id] = resp['rev']
+
+        yield self.assertRows(range(10))
+        yield self.assertRows([3, 4, 5], startkey=('value', 3),
+                              endkey=('value', 5))
+        yield self.assertRows([5, 4, 3], startkey=('value', 5),
+                              endkey=('value', 3), descending=True)
+        yield self.assertRows([7, 8, 9], startkey=('value', 7),
+                              endkey=('value', {}))
+        yield self.assertRows([4], key=('value', 4))
+        yield self.assertRows([1, 4], keys=[('value', 4), ('value', 1),
+                                            ('value', 4)])
+        yield self.assertRows([2, 3], startkey=('value', 2), limit=2)
+        yield self.assertRows([8, 9], startkey=('value', 2), skip=6)
+        res = yield self.database.query_view(ValueView)
+        self.assertEqual([(None, 15)], res)
+
+        # update, remove and add documents
+        resp = yield self.database.save_doc(json.dumps(
+            {'_id': u'doc4', '_rev': revs[u'doc4'], 'value': 14}))
+        revs[u'doc4'] = resp['rev']
+        yield self.database.delete_doc(u'doc5', revs[u'doc5'])
+        yield self.database.save_doc(json.dumps({'_id': u'doc10'}))
+        yield self.database.save_doc(json.dumps({'_id': u'doc11',
+                                                 'value': -1}))
+
+        yield self.assertRows([-1, 0, 1, 2, 3, 6, 7, 8, 9, 14])
+        yield self.assertRows([3, 6], startkey=('value', 3),
+                              endkey=('value', 6))
+        yield self.assertRows([], key=('value', 5))
+        res = yield self.database.query_view(ValueView)
+        self.assertEqual([(None, 15)], res)
+        res = yield self.database.query_view(ValueView, group_level=1)
+        self.assertEqual([(('even', ), 5), (('value', ), 10)], res)
+
+        # deleting and changing the docs removes the rows
+        yield self.database.delete_doc(u'doc4', revs[u'doc4'])
+        res = yield self.database.query_view(
+            ValueView, reduce=False, key=('even', 14))
+        self.assertEqual([], res)
+        res = yield self.database.query_view(ValueView, startkey=('even', ),
+                                             endkey=('even', {}))
+        self.assertEqual([(None, 4)], res)
+
+    def assertRows(self, expected, **options):
+        options.setdefault('startkey', ('value', ))
+        options.setdefault('endkey', ('value', {}))
+        d = self.database.query_view(ValueView, reduce=False, **options)
+        d.addCallback(lambda rows: [x[0][1] for x in rows])
+        d.addCallback(self.assertEqual, expected)
+        return d
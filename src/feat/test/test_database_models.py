@@ -104,6 +104,29 @@ class TestDoingSelectsViaApi(common.TestCase, ModelTestMixin):
         v = yield self.modelattr(submodel, 'field4')
         self.assertEqual('value', v)
 
+    @defer.inlineCallbacks
+    def testFetchItemsInBulk(self):
+        bulk_get = self.connection.bulk_get
+        calls = []
+
+        def counting_bulk_get(doc_ids, *args, **kwargs):
+            calls.append(doc_ids)
+            return bulk_get(doc_ids, *args, **kwargs)
+
+        self.patch(self.connection, 'bulk_get', counting_bulk_get)
+
+        items = yield self.model.fetch_items()
+        self.assertEqual(10, len(items))
+        self.assertEqual(1, len(calls))
+        field1s = []
+        for item in items:
+            submodel = yield item.fetch()
+            self.assertIsInstance(submodel, DocumentExtended)
+            self.assertEqual(item.name, submodel.source.doc_id)
+            field1 = yield self.modelattr(submodel, 'field1')
+            field1s.append(field1)
+        self.assertEqual(range(0, 20, 2), sorted(field1s))
+
     @defer.inlineCallbacks
     def testFetchItemAsJson(self):
         js = yield self.model_as_json(self.model)
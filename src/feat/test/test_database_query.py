@@ -1,6 +1,10 @@
+import json
+import time
+
 from zope.interface import classProvides
 
-from feat.database import query
+from feat.common import defer
+from feat.database import query, view, emu, client
 from feat.database.interface import IViewFactory
 from feat.test import common
 
@@ -71,3 +75,384 @@ class TestQueryObject(common.TestCase):
                                           query.Evaluator.equals, 1))
         self.assertRaises(ValueError, DummyQuery,
                           aggregation=[['unknown handler', 'field1']])
+
+
+class TestQueryPlan(common.TestCase):
+
+    def setUp(self):
+        C = query.Condition
+        E = query.Evaluator
+        self.c1 = C('field1', E.le, 10)
+        self.c2 = C('field2', E.equals, 'A')
+        self.c3 = C('field3', E.ge, 5)
+        self.responses = {
+            self.c1: query.ParsedIndex(
+                [(x, x) for x in range(11)], keep_value=True),
+            self.c2: query.ParsedIndex([0, 2, 2, 4, 6, 8, 10, 12, 14]),
+            self.c3: query.ParsedIndex(range(5, 20))}
+
+    def calculate(self, *parts):
+        q = DummyQuery(*parts)
+        return query._calculate_query_response(self.responses, q)
+
+    def testSingleCondition(self):
+        plan = self.calculate(self.c2)
+        self.assertEqual(8, plan.count())
+        self.assertEqual(set([0, 2, 4, 6, 8, 10, 12, 14]), set(plan))
+        self.assertTrue(4 in plan)
+        self.assertFalse(5 in plan)
+
+    def testOperators(self):
+        O = query.Operator
+        plan = self.calculate(self.c1, O.AND, self.c2, O.AND, self.c3)
+        self.assertEqual(3, plan.count())
+        self.assertEqual([6, 8, 10], sorted(plan))
+        self.assertTrue(8 in plan)
+        self.assertFalse(12 in plan)
+
+        plan = self.calculate(self.c1, O.OR, self.c2)
+        self.assertEqual(13, plan.count())
+        result = list(plan)
+        self.assertEqual(len(result), len(set(result)))
+        self.assertEqual(range(11) + [12, 14], sorted(result))
+        self.assertTrue(12 in plan)
+        self.assertFalse(13 in plan)
+
+        nested = DummyQuery(self.c1, O.OR, self.c2)
+        plan = self.calculate(nested, O.AND, self.c3)
+        self.assertEqual([5, 6, 7, 8, 9, 10, 12, 14], sorted(plan))
+        self.assertEqual(8, plan.count())
+
+    def testSortedSlice(self):
+        O = query.Operator
+        plan = self.calculate(self.c1, O.AND, self.c2)
+        index = self.responses[self.c2].entries
+
+        def get_slice(skip, stop, index=index):
+            return list(query._get_sorted_slice(index, plan, skip, stop))
+
+        self.assertEqual([0, 2, 4, 6, 8, 10], get_slice(0, None))
+        self.assertEqual([4, 6], get_slice(2, 4))
+        self.assertEqual([10], get_slice(5, 10))
+        self.assertEqual([], get_slice(6, 10))
+        self.assertEqual([10, 8, 6], get_slice(0, 3, reversed(index)))
+
+        # the index is walked only until the last row is given
+        walked = list()
+
+        def walk():
+            for value in index:
+                walked.append(value)
+                yield value
+
+        self.assertEqual([8, 10], get_slice(4, plan.count(), walk()))
+        self.assertEqual(10, walked[-1])
+        self.assertTrue(len(walked) < len(index))
+
+        # rows missing in the sort index come at the end
+        index = [8, 4]
+        self.assertEqual([8, 4], get_slice(0, 2, index))
+        result = get_slice(1, None, index)
+        self.assertEqual(4, result[0])
+        self.assertEqual(set([0, 2, 6, 10]), set(result[1:]))
+        self.assertEqual(2, len(get_slice(4, None, index)))
+
+
+class IndexView(view.BaseView):
+
+    name = 'index_view'
+
+    def map(doc):
+        for field in ('field1', 'field2', 'field3', 'field4', 'field5'):
+            yield (field, doc.get(field)), None
+
+
+class IndexQuery(query.Query):
+
+    name = 'index_query'
+    query.field(query.Field('field1', IndexView))
+    query.field(query.Field('field2', IndexView))
+    query.field(query.Field('field3', IndexView))
+    query.field(query.Field('field4', IndexView))
+    query.field(query.Field('field5', IndexView))
+
+
+class UnbatchedField(query.Field):
+
+    def fetch(self, connection, condition, if_modified_since=None):
+        return query.Field.fetch(self, connection, condition,
+                                 if_modified_since)
+
+
+class UnbatchedQuery(query.Query):
+
+    name = 'unbatched_query'
+    query.field(UnbatchedField('field1', IndexView))
+    query.field(UnbatchedField('field2', IndexView))
+    query.field(UnbatchedField('field3', IndexView))
+    query.field(UnbatchedField('field4', IndexView))
+    query.field(UnbatchedField('field5', IndexView))
+
+
+class RecordingField(query.ListValueField):
+
+    def __init__(self, *args, **kwargs):
+        query.ListValueField.__init__(self, *args, **kwargs)
+        self.parsed = list()
+
+    def parse_view_result(self, rows, tag):
+        self.parsed.append([x[0] for x in rows])
+        return query.ListValueField.parse_view_result(self, rows, tag)
+
+
+class ValuesQuery(query.Query):
+
+    name = 'values_query'
+    query.field(RecordingField('field2', IndexView))
+    query.field(query.Field('field3', IndexView))
+
+
+class StandInConnection(object):
+    '''
+    Records the view requests and delays their results until released.
+    '''
+
+    def __init__(self, connection, hold=True):
+        self.connection = connection
+        self.hold = hold
+        self.requests = list()
+        self.held = list()
+
+    def query_view(self, factory, **options):
+        self.requests.append(options)
+        d = self.connection.query_view(factory, **options)
+        if not self.hold:
+            return d
+        result = defer.Deferred()
+        d.addBoth(lambda r: self.held.append((result, r)))
+        return result
+
+    def release(self):
+        held, self.held = self.held, list()
+        for d, r in held:
+            d.callback(r)
+
+
+class TestViewFetcher(common.TestCase):
+
+    def setUp(self):
+        self.db = emu.Database()
+        for x in range(20):
+            doc = dict(('field%d' % (i, ), x % i) for i in range(1, 6))
+            doc['_id'] = u'doc%02d' % (x, )
+            self.db.load_fixture(json.dumps(doc))
+        self.connection = StandInConnection(client.Connection(self.db))
+
+    def condition(self, field, evaluator, value):
+        return query.Condition(field, getattr(query.Evaluator, evaluator),
+                               value)
+
+    def expected(self, predicate):
+        return set(u'doc%02d' % (x, ) for x in range(20) if predicate(x))
+
+    @defer.inlineCallbacks
+    def testCoalescesKeyedConditions(self):
+        C, O = self.condition, query.Operator
+        q = IndexQuery(C('field2', 'equals', 0), O.AND,
+                       C('field3', 'inside', (0, 1)), O.AND,
+                       C('field4', 'equals', 1), O.AND,
+                       C('field5', 'ge', 3),
+                       sorting=('field2', query.Direction.ASC))
+        d = query.select_ids(self.connection, q)
+        # the keyed conditions are fetched with a single request
+        self.assertEqual(1, len(self.connection.requests))
+        self.assertEqual(
+            set([('field2', 0), ('field3', 0), ('field3', 1),
+                 ('field4', 1)]),
+            set(self.connection.requests[0]['keys']))
+        self.connection.release()
+        # the range is pipelined after the first request to the design doc
+        self.assertEqual(2, len(self.connection.requests))
+        self.assertEqual(('field5', 3),
+                         self.connection.requests[1]['startkey'])
+        self.connection.release()
+        res = yield d
+        self.assertEqual(
+            self.expected(lambda x: (x % 2 == 0 and x % 3 in (0, 1) and
+                                     x % 4 == 1 and x % 5 >= 3)),
+            set(res))
+
+        self.connection.hold = False
+        q = IndexQuery(C('field2', 'equals', 1), O.OR,
+                       C('field3', 'inside', (2, 0)))
+        res = yield query.select_ids(self.connection, q)
+        self.assertEqual(self.expected(lambda x: x % 2 == 1 or x % 3 != 1),
+                         set(res))
+
+    @defer.inlineCallbacks
+    def testSharesPendingKeys(self):
+        C, O = self.condition, query.Operator
+        q1 = IndexQuery(C('field2', 'equals', 0), O.AND,
+                        C('field3', 'equals', 1))
+        q2 = IndexQuery(C('field3', 'equals', 1), O.OR,
+                        C('field4', 'equals', 2))
+        d1 = query.count(self.connection, q1)
+        d2 = query.count(self.connection, q2)
+        self.assertEqual(2, len(self.connection.requests))
+        # the key being fetched for the first query is not requested again
+        self.assertEqual([('field4', 2)], self.connection.requests[1]['keys'])
+        self.connection.release()
+        c1 = yield d1
+        c2 = yield d2
+        self.assertEqual(len(self.expected(
+            lambda x: x % 2 == 0 and x % 3 == 1)), c1)
+        self.assertEqual(len(self.expected(
+            lambda x: x % 3 == 1 or x % 4 == 2)), c2)
+
+    @defer.inlineCallbacks
+    def testConcurrencyLimit(self):
+        C = self.condition
+        fetcher = query.get_fetcher(self.connection)
+        self.assertIs(fetcher, query.get_fetcher(self.connection))
+        self.assertEqual(fetcher.DEFAULT_CONCURRENCY,
+                         fetcher.get_concurrency())
+        # not limited by default
+        defers = [query.count(self.connection,
+                              IndexQuery(C('field5', 'equals', x)))
+                  for x in range(3)]
+        self.assertEqual(3, len(self.connection.requests))
+        self.connection.release()
+        yield defer.DeferredList(defers)
+        del self.connection.requests[:]
+
+        fetcher.set_concurrency(1)
+
+        defers = [query.count(self.connection,
+                              IndexQuery(C('field5', 'equals', x)))
+                  for x in range(3)]
+        self.assertEqual(1, len(self.connection.requests))
+        fetcher.set_concurrency(2)
+        self.assertEqual(2, len(self.connection.requests))
+        self.connection.release()
+        self.assertEqual(3, len(self.connection.requests))
+        self.connection.release()
+        res = yield defer.DeferredList(defers)
+        self.assertEqual([4, 4, 4], [x[1] for x in res])
+        self.assertRaises(ValueError, fetcher.set_concurrency, 0)
+
+        fetcher.set_concurrency(None)
+        self.assertIs(None, fetcher.get_concurrency())
+
+    @defer.inlineCallbacks
+    def testLoweringConcurrencyLimit(self):
+        C = self.condition
+        fetcher = query.get_fetcher(self.connection)
+        fetcher.set_concurrency(2)
+
+        defers = [query.count(self.connection,
+                              IndexQuery(C('field5', 'equals', x)))
+                  for x in range(4)]
+        self.assertEqual(2, len(self.connection.requests))
+        fetcher.set_concurrency(1)
+        # the waiting requests start one by one
+        self.connection.release()
+        self.assertEqual(3, len(self.connection.requests))
+        self.connection.release()
+        self.assertEqual(4, len(self.connection.requests))
+        self.connection.release()
+        res = yield defer.DeferredList(defers)
+        self.assertEqual([4, 4, 4, 4], [x[1] for x in res])
+
+    @defer.inlineCallbacks
+    def testFailedBatch(self):
+        C, O = self.condition, query.Operator
+        self.connection.hold = False
+        self.connection.query_view = lambda *_, **__: defer.fail(
+            ValueError('boom'))
+        q = IndexQuery(C('field2', 'equals', 0), O.AND,
+                       C('field3', 'equals', 1))
+        d = query.count(self.connection, q)
+        self.assertFailure(d, ValueError)
+        yield d
+        self.assertFalse(query.get_fetcher(self.connection)._pending)
+
+    @defer.inlineCallbacks
+    def testCoalescedRequests(self):
+        C, O = self.condition, query.Operator
+        conditions = [C('field1', 'equals', 1)]
+        for i in range(2, 6):
+            conditions.extend([O.AND, C('field%d' % (i, ), 'equals', 1)])
+        self.connection.hold = False
+
+        # the fields overriding fetch() are requested one by one
+        res = yield query.count(self.connection, UnbatchedQuery(*conditions))
+        self.assertEqual(5, len(self.connection.requests))
+        del self.connection.requests[:]
+        res2 = yield query.count(self.connection, IndexQuery(*conditions))
+        self.assertEqual(1, len(self.connection.requests))
+        self.assertEqual(res, res2)
+
+    @common.benchmark
+    @defer.inlineCallbacks
+    def testBenchmark(self):
+        from twisted.internet import reactor
+
+        # the stand-in of the HTTP server answers with a latency
+        latency = 0.002
+        calls = [0]
+
+        class LatentConnection(object):
+
+            def __init__(self, connection):
+                self.connection = connection
+
+            def query_view(self, factory, **options):
+                calls[0] += 1
+                d = defer.Deferred()
+                reactor.callLater(latency, d.callback, None)
+                d.addCallback(lambda _: self.connection.query_view(
+                    factory, **options))
+                return d
+
+        C, O = self.condition, query.Operator
+        conditions = [C('field1', 'equals', 1)]
+        for i in range(2, 6):
+            conditions.extend([O.AND, C('field%d' % (i, ), 'equals', 1)])
+
+        requests = dict()
+        for factory in (UnbatchedQuery, IndexQuery):
+            for name, connection in (
+                ('emu', client.Connection(self.db)),
+                ('http stand-in', LatentConnection(
+                    client.Connection(self.db)))):
+                q = factory(*conditions)
+                calls[0] = 0
+                start = time.time()
+                for x in range(100):
+                    yield query.count(connection, q)
+                took = time.time() - start
+                self.info("%s against %s: %.1f queries/s, %s requests",
+                          factory.name, name, 100 / took, calls[0])
+            requests[factory] = calls[0]
+
+        self.assertEqual(500, requests[UnbatchedQuery])
+        self.assertEqual(100, requests[IndexQuery])
+
+    @defer.inlineCallbacks
+    def testBatchedFieldsArePostProcessed(self):
+        C, O = self.condition, query.Operator
+        self.connection.hold = False
+        q = ValuesQuery(C('field2', 'inside', (1, 0)), O.AND,
+                        C('field3', 'equals', 0))
+        field = q.fields['field2']
+        res = yield query.values(self.connection, q, 'field2', unique=False)
+        self.assertEqual(1, len(self.connection.requests))
+        self.assertEqual(
+            set([('field2', 1), ('field2', 0), ('field3', 0)]),
+            set(self.connection.requests[0]['keys']))
+        # the field parses only the rows of its keys, in the order of keys
+        self.assertEqual(1, len(field.parsed))
+        self.assertEqual([('field2', 1)] * 10 + [('field2', 0)] * 10,
+                         field.parsed[0])
+        self.assertEqual(sorted([x % 2] for x in range(20) if x % 3 == 0),
+                         sorted(res))
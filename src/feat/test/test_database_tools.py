@@ -24,6 +24,7 @@ import mock
 from twisted.internet import defer, task
 
 from feat.database import tools, document, migration, view, driver, client
+from feat.database import emu
 from feat.test import common
 from feat.test.integration.common import SimulationTest
 from feat.common import serialization
@@ -117,6 +118,36 @@ class TestCase(common.TestCase, common.AgencyTestHelper):
         doc = yield self.connection.get_document('testdoc')
         self.assertEqual('default upgraded', doc.field1)
 
+    @defer.inlineCallbacks
+    def testResumingMigration(self):
+        serialization.register(VersionedTest1)
+        for x in range(10):
+            yield self.connection.save_document(
+                VersionedTest1(doc_id=u'doc%d' % (x, )))
+        # the previous run stopped before the document doc6
+        yield self.connection.save_document(
+            {'_id': tools.MIGRATION_CHECKPOINT,
+             'type_name': VersionedTest1.type_name,
+             'version': 1, 'doc_id': u'doc6'})
+
+        serialization.register(VersionedTest2)
+        migration.register(SimpleMigration(type_name=VersionedTest2.type_name,
+                                           source_ver=1,
+                                           target_ver=2))
+        yield tools.migration_script(self.connection, window=2)
+
+        for x in range(10):
+            doc = yield self.connection.get_document(u'doc%d' % (x, ),
+                                                     raw=True)
+            if x < 6:
+                self.assertEqual('default', doc['field1'])
+            else:
+                self.assertEqual('default upgraded', doc['field1'])
+
+        checkpoint = yield self.connection.get_document(
+            tools.MIGRATION_CHECKPOINT, raw=True)
+        self.assertEqual(None, checkpoint['doc_id'])
+
     @defer.inlineCallbacks
     def testDefiningDocument(self):
         feat.initial_data(SomeDocument)
@@ -160,6 +191,75 @@ class IntegrationWithSimulation(SimulationTest):
         self.assertFalse(isinstance(current[-1], SomeDocument))
 
 
+class ModuloView(view.BaseView):
+
+    name = "modulo"
+
+    def map(doc):
+        if 'value' in doc:
+            yield doc['value'] % 3, doc['_id']
+
+
+class TestViewIterator(common.TestCase):
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        common.TestCase.setUp(self)
+        self.db = emu.Database()
+        self.connection = self.db.get_connection()
+        for x in range(50):
+            yield self.connection.save_document(
+                {'_id': u'doc%02d' % (x, ), 'value': x})
+
+        query_view = self.connection.query_view
+        self.queries = list()
+
+        def recording_query_view(factory, **options):
+            self.queries.append(options)
+            return query_view(factory, **options)
+
+        self.patch(self.connection, 'query_view', recording_query_view)
+        self.visited = list()
+
+    def callback(self, connection, record):
+        self.visited.append(record)
+
+    @defer.inlineCallbacks
+    def testKeysetPagination(self):
+        yield tools.view_aterator(self.connection, self.callback, ModuloView,
+                                  per_page=7, max_per_page=20)
+        expected = sorted(u'doc%02d' % (x, ) for x in range(50))
+        self.assertEqual(expected, sorted(self.visited))
+        self.assertEqual(50, len(self.visited))
+
+        self.assertEqual([8, 15, 21, 21], [x['limit'] for x in self.queries])
+        self.assertFalse([x for x in self.queries if 'skip' in x])
+        self.assertEqual((0, u'doc21'), (self.queries[1]['startkey'],
+                                          self.queries[1]['startkey_docid']))
+
+    @defer.inlineCallbacks
+    def testCheckpoint(self):
+        positions = list()
+
+        def checkpoint(connection, startkey, startkey_docid):
+            positions.append((startkey, startkey_docid))
+
+        yield tools.view_aterator(self.connection, self.callback, ModuloView,
+                                  dict(key=2), per_page=5,
+                                  checkpoint=checkpoint)
+        self.assertEqual(16, len(self.visited))
+        self.assertEqual([(2, u'doc17'), (2, u'doc32'), (2, u'doc47')],
+                         positions)
+
+        # resuming the iteration from the position
+        del self.visited[:]
+        keys = dict(key=2, startkey_docid=positions[1][1])
+        yield tools.view_aterator(self.connection, self.callback, ModuloView,
+                                  keys, per_page=5)
+        self.assertEqual([u'doc32', u'doc35', u'doc38', u'doc41',
+                          u'doc44', u'doc47'], self.visited)
+
+
 class SomeView(view.BaseView):
 
     name = "some_view"
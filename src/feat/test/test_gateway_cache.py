@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# F3AT - Flumotion Asynchronous Autonomous Agent Toolkit
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# See "LICENSE.GPL" in the source distribution for more information.
+# Headers in this file shall remain intact.
+
+from feat.gateway import cache
+
+from feat.test import common
+
+
+class TestRenderCache(common.TestCase):
+
+    def testGettingAndExpiring(self):
+        c = cache.RenderCache()
+        self.assertEqual(c.get("a", ctime=1), None)
+        c.set("a", "A", 10, ctime=1)
+        self.assertEqual(c.get("a", ctime=2), "A")
+        self.assertEqual(c.get("a", "default", ctime=11), "default")
+        self.assertEqual(len(c), 0)
+        self.assertEqual(c.get_stats(),
+                         dict(size=0, tags=0, hits=1, misses=2,
+                              hit_rate=1.0 / 3, invalidations=0,
+                              evictions=0))
+
+    def testInvalidating(self):
+        c = cache.RenderCache()
+        c.set("agents", "AGENTS", 10, ("feat.agents", "agents"))
+        c.set("agent", "AGENT", 10, ("feat.agent", "agents", "a1"))
+        c.set("partners", "PARTNERS", 10,
+              ("feat.partners", "agents", "a1", "partners"))
+        c.set("other", "OTHER", 10, ("feat.agent", "agents", "a2"))
+
+        c.invalidate("a1")
+        self.assertEqual(c.get("agent"), None)
+        self.assertEqual(c.get("partners"), None)
+        self.assertEqual(c.get("agents"), "AGENTS")
+        self.assertEqual(c.get("other"), "OTHER")
+
+        c.invalidate("unknown", "feat.agents")
+        self.assertEqual(c.get("agents"), None)
+        self.assertEqual(c.get("other"), "OTHER")
+        self.assertEqual(c.get_stats()["invalidations"], 3)
+        self.assertEqual(c.get_stats()["tags"], 3)
+
+        # replacing an entry replaces its tags
+        c.set("other", "OTHER", 10, ("feat.agent", ))
+        c.invalidate("a2")
+        self.assertEqual(c.get("other"), "OTHER")
+        c.clear()
+        self.assertEqual(c.get("other"), None)
+        self.assertEqual(c.get_stats()["tags"], 0)
+
+    def testEvicting(self):
+        c = cache.RenderCache(max_size=3)
+        for i in range(5):
+            c.set(i, i, 10, ("tag", ))
+        self.assertEqual(len(c), 3)
+        self.assertEqual(c.get(0), None)
+        self.assertEqual(c.get(1), None)
+        self.assertEqual(c.get(4), 4)
+        self.assertEqual(c.get_stats()["evictions"], 2)
+        c.invalidate("tag")
+        self.assertEqual(len(c), 0)
+
+    def testScoping(self):
+        c = cache.RenderCache()
+        admin = c.scope("admin")
+        guest = c.scope("guest")
+        admin.set("key", "ADMIN", 10)
+        self.assertEqual(admin.get("key"), "ADMIN")
+        self.assertEqual(guest.get("key"), None)
+        guest.set("key", "GUEST", 10, ("tag", ))
+        self.assertEqual(guest.get("key"), "GUEST")
+        c.invalidate("tag")
+        self.assertEqual(guest.get("key"), None)
+        self.assertEqual(admin.get("key"), "ADMIN")
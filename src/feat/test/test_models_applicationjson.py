@@ -241,6 +241,59 @@ class DummyModel(model.Model):
                     effect.context_value('view'))
 
 
+@register
+class CachedModel(model.Model):
+    model.identity('test.cached')
+    model.attribute("value", value.Integer(),
+                    call.model_call("get_value"))
+    model.meta("json", "cache, 10")
+
+    def get_value(self):
+        self.source.fetched += 1
+        return self.source.value
+
+
+class DummyAspect(object):
+
+    implements(interface.IAspect)
+
+    def __init__(self, name):
+        self.name = unicode(name)
+        self.label = None
+        self.desc = None
+
+
+class DummyCacheSource(object):
+
+    def __init__(self, value):
+        self.value = value
+        self.fetched = 0
+
+
+class DummyRenderCache(dict):
+
+    def set(self, key, value, ttl, tags=()):
+        self[key] = (value, ttl, tags)
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key][0]
+        return default
+
+
+class CachingContext(DummyContext):
+
+    def __init__(self, models=None, names=None, render_cache=None):
+        DummyContext.__init__(self, models, names)
+        self.arguments = {}
+        self.render_cache = render_cache
+
+    def descend(self, model):
+        return CachingContext(models=self.models + (model, ),
+                              names=self.names + (model.name, ),
+                              render_cache=self.render_cache)
+
+
 class TestApplicationJSON(common.TestCase):
 
     @defer.inlineCallbacks
@@ -715,6 +768,54 @@ class TestApplicationJSON(common.TestCase):
         structs = yield item.fetch()
         yield self.check(structs, {u"href": u"root/some/place"})
 
+    @defer.inlineCallbacks
+    def testCachingModels(self):
+
+        @defer.inlineCallbacks
+        def write(obj, ctx, fmt="compact"):
+            doc = document.WritableDocument("application/json")
+            yield document.write(doc, obj, context=ctx, format=fmt)
+            defer.returnValue(json.loads(doc.get_data()))
+
+        cache = DummyRenderCache()
+        ctx = CachingContext(("ROOT", ), ("root", ), render_cache=cache)
+        src = DummyCacheSource(42)
+        mdl = yield CachedModel.create(src, DummyAspect("cached"))
+
+        data = yield write(mdl, ctx)
+        self.assertEqual(data, {u"value": 42})
+        self.assertEqual(src.fetched, 1)
+        self.assertEqual(len(cache), 1)
+        _value, ttl, tags = cache.values()[0]
+        self.assertEqual(ttl, 10)
+        self.assertEqual(set(tags), set(["test.cached", "cached"]))
+
+        src.value = 66
+        data = yield write(mdl, ctx)
+        self.assertEqual(data, {u"value": 42})
+        self.assertEqual(src.fetched, 1)
+
+        # the format and the location are part of the key
+        data = yield write(mdl, ctx, "verbose")
+        self.assertEqual(data[u"items"][u"value"][u"value"], 66)
+        self.assertEqual(src.fetched, 2)
+        data = yield write(mdl, ctx.descend(mdl))
+        self.assertEqual(data, {u"value": 66})
+        self.assertEqual(src.fetched, 3)
+        self.assertEqual(len(cache), 3)
+
+        cache.clear()
+        data = yield write(mdl, ctx)
+        self.assertEqual(data, {u"value": 66})
+        self.assertEqual(src.fetched, 4)
+
+        # models without ttl and contexts without cache are not cached
+        cache.clear()
+        yield write(mdl, DummyContext(("ROOT", ), ("root", )))
+        inline = yield InlineModel.create(object())
+        yield write(inline, ctx)
+        self.assertEqual(len(cache), 0)
+
     @defer.inlineCallbacks
     def testActionPayloadReader(self):
 
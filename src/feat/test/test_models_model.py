@@ -230,6 +230,12 @@ class TestReference(model.Model):
     model.action("action", DummyAction)
 
 
+@register
+class TestRevision(model.Model):
+    model.identity("test-revision")
+    model.revision(getter.source_attr("revision"))
+
+
 @register
 class TestModelEffects(model.Model):
     model.identity("test-model-calls")
@@ -278,6 +284,63 @@ class TestModelEffects(model.Model):
         return self.childs[name]
 
 
+class BulkSource(object):
+
+    def __init__(self, size):
+        self.items = dict((u"item%d" % i, DummySource())
+                          for i in range(size))
+        self.fetched = []
+        self.bulk_fetched = []
+        self.pending = 0
+        self.max_pending = 0
+        self.broken = False
+        self.short = False
+
+    def iter_names(self):
+        return self.items.keys() + [u"spam"]
+
+    def get_value(self, name):
+
+        def retrieve(key):
+            self.pending -= 1
+            return self.items.get(key)
+
+        self.fetched.append(name)
+        self.pending += 1
+        self.max_pending = max(self.max_pending, self.pending)
+        d = defer.succeed(name)
+        d.addCallback(common.delay, 0.01)
+        d.addCallback(retrieve)
+        return d
+
+    def get_values(self, names):
+        if self.broken:
+            raise ValueError("Broken")
+        self.bulk_fetched.append(names)
+        if self.short:
+            return [self.items.get(n) for n in names[1:]]
+        return dict((n, self.items.get(n)) for n in names)
+
+
+@register
+class TestBulkCollection(model.Collection):
+    __slots__ = ()
+    model.identity("test-bulk-collection")
+    model.child_model(DummyModel2)
+    model.child_names(call.source_call("iter_names"))
+    model.child_source(getter.source_get("get_value"))
+    model.child_sources(call.source_filter("get_values"))
+
+
+@register
+class TestUnbatchedCollection(model.Collection):
+    __slots__ = ()
+    model.identity("test-unbatched-collection")
+    model.child_model(DummyModel2)
+    model.child_names(call.source_call("iter_names"))
+    model.child_source(getter.source_get("get_value"))
+
+
 class TestModelsModel(common.TestCase):
 
     def setUp(self):
@@ -357,6 +420,22 @@ class TestModelsModel(common.TestCase):
         self.assertEqual(a2.reference.resolve(ctx2),
                          "http://dummy.net/child/action")
 
+    @defer.inlineCallbacks
+    def testRevision(self):
+        src = DummySource()
+        src.revision = "1-abc"
+        mdl = TestRevision(src)
+        self.assertTrue(interface.IRevisioned.providedBy(mdl))
+        rev = yield mdl.fetch_revision()
+        self.assertEqual(rev, "1-abc")
+        src.revision = "2-def"
+        rev = yield mdl.fetch_revision()
+        self.assertEqual(rev, "2-def")
+
+        mdl = TestReference(src)
+        rev = yield mdl.fetch_revision()
+        self.assertEqual(rev, None)
+
     @defer.inlineCallbacks
     def testModelMeta(self):
 
@@ -875,3 +954,56 @@ class TestModelsModel(common.TestCase):
         self.assertTrue(value2.source is src.items[u"value2"])
 
         yield self.asyncEqual(None, mdl.fetch_item("spam"))
+
+    @defer.inlineCallbacks
+    def testBulkCollection(self):
+        src = BulkSource(50)
+        mdl = yield TestBulkCollection.create(src)
+
+        items = yield mdl.fetch_items()
+        self.assertEqual(50, len(items))
+        self.assertEqual([], src.fetched)
+        self.assertEqual(1, len(src.bulk_fetched))
+        self.assertEqual(set(src.iter_names()), set(src.bulk_fetched[0]))
+        for item in items:
+            child = yield item.fetch()
+            self.assertTrue(isinstance(child, DummyModel2))
+            self.assertTrue(child.source is src.items[item.name])
+
+        yield self.asyncEqual(50, mdl.count_items())
+        self.assertEqual(2, len(src.bulk_fetched))
+
+        # single items are still retrieved by name
+        item = yield mdl.fetch_item(u"item3")
+        child = yield item.fetch()
+        self.assertTrue(child.source is src.items[u"item3"])
+        self.assertEqual([u"item3"], src.fetched)
+
+        # failing to fetch in bulk fallbacks to one by one
+        src.broken = True
+        items = yield mdl.fetch_items()
+        self.assertEqual(50, len(items))
+        self.assertEqual(52, len(src.fetched))
+        self.assertEqual(2, len(src.bulk_fetched))
+
+        # so does fetching the sources of too few items
+        src.broken = False
+        src.short = True
+        items = yield mdl.fetch_items()
+        self.assertEqual(50, len(items))
+        self.assertEqual(103, len(src.fetched))
+        self.assertEqual(3, len(src.bulk_fetched))
+        for item in items:
+            child = yield item.fetch()
+            self.assertTrue(child.source is src.items[item.name])
+
+    @defer.inlineCallbacks
+    def testUnbatchedCollection(self):
+        src = BulkSource(50)
+        mdl = yield TestUnbatchedCollection.create(src)
+
+        items = yield mdl.fetch_items()
+        self.assertEqual(50, len(items))
+        self.assertEqual(51, len(src.fetched))
+        self.assertTrue(src.max_pending > 1)
+        self.assertTrue(src.max_pending <= model.DEFAULT_ITEM_CONCURRENCY)
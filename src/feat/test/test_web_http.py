@@ -212,6 +212,27 @@ class TestHTTP(common.TestCase):
                "utf8": 0.78,
                "iso-8859-1": http.DEFAULT_PRIORITY})
 
+    def testParseAcceptEncoding(self):
+
+        def check(val, expected):
+            result = http.parse_accepted_codings(val)
+            self.assertEqual(result, expected)
+
+        check(None, {})
+        check("gzip, Deflate",
+              {"gzip": http.DEFAULT_PRIORITY,
+               "deflate": http.DEFAULT_PRIORITY})
+        check("gzip;q=0, identity; q=0.5, *;q=0",
+              {"gzip": 0.0,
+               "identity": 0.5,
+               "*": 0.0})
+
+    def testParseEntityTags(self):
+        self.assertEqual(http.parse_entity_tags(None), [])
+        self.assertEqual(http.parse_entity_tags('"abc"'), ["abc"])
+        self.assertEqual(http.parse_entity_tags('W/"abc", "d", *'),
+                         ["abc", "d", "*"])
+
     def testTuple2Path(self):
 
         def check(tup, expected):
@@ -192,6 +192,222 @@ class TestConnection(common.TestCase):
         return transport
 
 
+class TestConnectionPool(common.TestCase):
+
+    def setUp(self):
+        self.reactor = ReactorMock()
+        self.pool = httpclient.ConnectionPool(
+            'testsite.com', 80, maximum_connections=1,
+            enable_pipelineing=False)
+        self.pool.reactor = self.reactor
+
+    @defer.inlineCallbacks
+    def testCollectingStatistics(self):
+        d1 = self.pool.request(http.Methods.GET, '/db/doc1?rev=1')
+        d2 = self.pool.request(http.Methods.GET, '/db/doc1')
+        d3 = self.pool.request(http.Methods.PUT, '/db/doc1')
+        self.assertEqual(1, len(self.reactor.tcpClients))
+        stats = self.pool.get_stats()
+        self.assertEqual(3, stats['awaiting'])
+        self.assertEqual(1, stats['connecting'])
+
+        factory = self.reactor.tcpClients[0][2]
+        addr = self.reactor.connectors[0]._address
+        transport = self._make_connection(factory, addr)
+        for index, (status, d) in enumerate([(200, d1), (404, d2),
+                                             (201, d3)]):
+            yield self._wait_for_requests(transport, index + 1)
+            self._respond(transport, status)
+            response = yield d
+            self.assertEqual(status, response.status)
+        self.addCleanup(self.pool.disconnect)
+
+        stats = self.pool.get_stats()
+        self.assertEqual(3, stats['requests'])
+        self.assertEqual(0, stats['failures'])
+        self.assertEqual(1, stats['connections_made'])
+        self.assertEqual(1, stats['connected'])
+        self.assertEqual(1, stats['idle'])
+        self.assertEqual(0, stats['awaiting'])
+        self.assertEqual(1, stats['connect']['count'])
+        self.assertEqual(set(['GET /db/doc1', 'PUT /db/doc1']),
+                         set(stats['endpoints']))
+        get = stats['endpoints']['GET /db/doc1']
+        self.assertEqual(2, get['response']['count'])
+        self.assertEqual(2, get['wait']['count'])
+        # only the first request waited for the connection to be made
+        self.assertEqual(1, get['connect']['count'])
+        for name, value in stats.iteritems():
+            self.assertEqual(value, self.pool.get_stat(name))
+        self.assertRaises(KeyError, self.pool.get_stat, 'unknown')
+        self.assertEqual([('PUT /db/doc1', 201), ('GET /db/doc1', 404),
+                          ('GET /db/doc1', 200)],
+                         [(x[0], x[4])
+                          for x in self.pool.statistics.iter_recent()])
+
+    def testLimitingEndpoints(self):
+        statistics = httpclient.PoolStatistics()
+        statistics.max_endpoints = 2
+        statistics.recent_size = 2
+        a = statistics.get_endpoint(http.Methods.GET, '/a')
+        b = statistics.get_endpoint(http.Methods.GET, '/b')
+        c = statistics.get_endpoint(http.Methods.GET, '/c')
+        self.assertIs(a, statistics.get_endpoint(http.Methods.GET, '/a'))
+        self.assertIs(c, statistics.get_endpoint(http.Methods.GET, '/d'))
+        self.assertEqual('GET (other)', c.name)
+        self.assertEqual(3, len(list(statistics.iter_endpoints())))
+
+    def testRecordingRecentRequests(self):
+        statistics = httpclient.PoolStatistics()
+        statistics.recent_size = 2
+        statistics.__init__()
+        endpoint = statistics.get_endpoint(http.Methods.GET, '/a')
+        self.assertEqual([], list(statistics.iter_recent()))
+        statistics.request_done(endpoint, 0.1, 0, 0.2, 200)
+        statistics.request_done(endpoint, 0.1, 0, 0.3, None)
+        statistics.request_done(endpoint, 0.1, 0.5, 0.4, 500)
+        self.assertEqual([('GET /a', 0.1, 0.5, 0.4, 500),
+                          ('GET /a', 0.1, 0, 0.3, None)],
+                         list(statistics.iter_recent()))
+        self.assertEqual(1, statistics.failures)
+        self.assertEqual(1, endpoint.failures)
+        self.assertEqual(1, endpoint.connect.count)
+
+    def testPipeliningOnLeastLoadedConnection(self):
+        protocols = [DummyPoolProtocol(depth) for depth in (3, 1, 2, 0)]
+        protocols[3].can_pipeline = False
+        self.pool._connected.update(protocols)
+        self.assertIs(protocols[1], self.pool._get_pipeline_protocol(
+            httpclient.RequestPriority.normal))
+        # nothing is pipelined behind long requests
+        protocols[1].slow_requests = 1
+        self.assertIs(protocols[2], self.pool._get_pipeline_protocol(
+            httpclient.RequestPriority.normal))
+        self.assertIs(protocols[1], self.pool._get_pipeline_protocol(
+            httpclient.RequestPriority.low))
+        self.pool.max_pipeline_depth = 2
+        self.assertIs(None, self.pool._get_pipeline_protocol(
+            httpclient.RequestPriority.normal))
+
+    def testAdjustingPoolSize(self):
+        pool = httpclient.ConnectionPool('testsite.com', 80,
+                                         maximum_connections=3,
+                                         minimum_connections=1)
+        self.assertEqual(1, pool._limit)
+        for _ in range(pool.adjust_window * 3):
+            pool._adjust_limit(0.2, 0.1)
+        self.assertEqual(3, pool._limit)
+        for _ in range(pool.adjust_window - 1):
+            pool._adjust_limit(0, 0.1)
+        self.assertEqual(3, pool._limit)
+        pool._adjust_limit(0, 0.1)
+        self.assertEqual(2, pool._limit)
+        for _ in range(pool.adjust_window * 3):
+            pool._adjust_limit(0.001, 0.1)
+        self.assertEqual(1, pool._limit)
+        self.assertEqual(1, pool.get_stats()['limit'])
+
+    def _make_connection(self, factory, addr):
+        protocol = factory.buildProtocol(addr)
+        transport = Transport()
+        transport.protocol = protocol
+        protocol.makeConnection(transport)
+        return transport
+
+    def _wait_for_requests(self, transport, num):
+
+        def check():
+            return transport.value().count(' HTTP/1.1\r\n') >= num
+
+        return self.wait_for(check, 5, 0.01)
+
+    def _respond(self, transport, status):
+        transport.protocol.dataReceived(
+            transport.protocol.delimiter.join([
+                "HTTP/1.1 %d Whatever" % (status, ),
+                "Content-Length: 4",
+                "",
+                "body",
+                ]))
+
+
+class DummyPoolProtocol(object):
+
+    def __init__(self, depth):
+        self.depth = depth
+        self.can_pipeline = True
+        self.in_pool = True
+        self.slow_requests = 0
+
+    def get_depth(self):
+        return self.depth
+
+
+class TestRequestQueue(common.TestCase):
+
+    def testServingPrioritiesFairly(self):
+        queue = httpclient.RequestQueue()
+        for priority in httpclient.RequestPriority:
+            for index in range(6):
+                d = defer.Deferred()
+                d.request = (priority.name, index)
+                queue.append(d, priority)
+        self.assertEqual(18, len(queue))
+        order = [queue.pop().request for _ in range(10)]
+        self.assertEqual([('high', 0), ('high', 1), ('high', 2), ('high', 3),
+                          ('normal', 0), ('normal', 1), ('low', 0),
+                          ('high', 4), ('high', 5), ('normal', 2)], order)
+        self.assertEqual(8, len(queue))
+        queue.clear()
+        self.assertEqual(0, len(queue))
+        self.assertRaises(IndexError, queue.pop)
+
+    def testSkippingCancelledRequests(self):
+        queue = httpclient.RequestQueue()
+        d1, d2 = defer.Deferred(), defer.Deferred()
+        queue.append(d1)
+        queue.append(d2, httpclient.RequestPriority.low)
+        self.assertEqual([d1, d2], list(queue))
+        d1.addErrback(lambda f: f.trap(defer.CancelledError))
+        d1.cancel()
+        self.assertIs(d2, queue.pop())
+        self.assertRaises(IndexError, queue.pop)
+
+
+class TestLatencyHistogram(common.TestCase):
+
+    def testEmptyHistogram(self):
+        histogram = httpclient.LatencyHistogram()
+        self.assertEqual(dict(count=0, mean=0.0, p50=0.0, p90=0.0, p99=0.0,
+                              max=0.0), histogram.get_stats())
+
+    def testPercentiles(self):
+        histogram = httpclient.LatencyHistogram()
+        for millis in range(1, 1001):
+            histogram.add(millis / 1000.0)
+        self.assertEqual(1000, histogram.count)
+        self.assertAlmostEqual(0.5005, histogram.get_mean())
+        for fraction in (0.01, 0.5, 0.9, 0.99):
+            value = histogram.get_percentile(fraction)
+            self.assertTrue(fraction <= value <= fraction * 1.125,
+                            (fraction, value))
+        self.assertEqual(1.0, histogram.get_percentile(1.0))
+        self.assertEqual(1.0, histogram.max)
+
+    def testBucketBounds(self):
+        histogram = httpclient.LatencyHistogram()
+        previous = 0
+        for index in range(histogram.buckets - 1):
+            bound = histogram._upper_bound(index)
+            self.assertTrue(bound > previous)
+            # the bound is the first value of the next bucket
+            self.assertEqual(index, histogram._index(bound * 0.999999))
+            self.assertEqual(index + 1, histogram._index(bound * 1.000001))
+            previous = bound
+        self.assertEqual(histogram.buckets - 1, histogram._index(1e9))
+        self.assertEqual(0, histogram._index(-1))
+
+
 class Transport(StringTransportWithDisconnection, object):
 
     pass
@@ -238,6 +454,33 @@ class TestProtocol(common.TestCase):
 
         self.assertTrue(self.protocol.factory.onConnectionReset_called)
 
+    @defer.inlineCallbacks
+    def testResponsesWithoutBody(self):
+        d = self.protocol.request(http.Methods.HEAD, '/doc')
+        self.protocol.dataReceived(
+            self.protocol.delimiter.join([
+                "HTTP/1.1 200 OK",
+                "ETag: \"1-abc\"",
+                "Content-Length: 12",
+                "", ""]))
+        response = yield d
+        self.assertEqual(200, response.status)
+        self.assertEqual('"1-abc"', response.headers['etag'])
+        self.assertEqual('', response.body)
+        self.assertTrue(self.protocol.is_idle())
+
+        d = self.protocol.request(http.Methods.GET, '/doc',
+                                  headers={'if-none-match': '"1-abc"'})
+        self.protocol.dataReceived(
+            self.protocol.delimiter.join([
+                "HTTP/1.1 304 Not Modified",
+                "ETag: \"1-abc\"",
+                "", ""]))
+        response = yield d
+        self.assertEqual(304, response.status)
+        self.assertEqual('', response.body)
+        self.assertTrue(self.protocol.is_idle())
+
     @defer.inlineCallbacks
     def testCancelledRequest(self):
         d = self.protocol.request(http.Methods.GET, '/',
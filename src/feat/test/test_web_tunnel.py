@@ -322,3 +322,112 @@ class TestHTTPTunnel(common.TestCase):
             return self.t1.is_idle() and self.t2.is_idle()
 
         return self.wait_for(check, timeout)
+
+
+@common.attr(timescale=0.1)
+class TestBatchedHTTPTunnel(TestHTTPTunnel):
+
+    def setUp(self):
+        port_range = range(4000, 4100)
+        r1 = serialization.get_registry().clone()
+        r1.register(Av1)
+        self.d1 = DummyDispatcher()
+        self.t1 = tunnel.Tunnel(self, port_range, self.d1, "localhost",
+                                version=1, registry=r1, max_delay=10,
+                                batch_delay=0.1)
+        r2 = serialization.get_registry().clone()
+        r2.register(Av2)
+        self.d2 = DummyDispatcher()
+        self.t2 = tunnel.Tunnel(self, port_range, self.d2, "localhost",
+                                version=2, registry=r2, max_delay=10,
+                                batch_delay=0.1)
+        return common.TestCase.setUp(self)
+
+    @defer.inlineCallbacks
+    def testMessagesShareRequests(self):
+        yield self.t1.start_listening()
+        yield self.t2.start_listening()
+
+        url2a = http.append_location(self.t2.uri, "beans")
+        url2b = http.append_location(self.t2.uri, "egg")
+
+        # the first message goes through the handshake
+        yield self.t1.post(url2a, 0)
+        peer = self.t1._peers.values()[0]
+        self.assertTrue(peer.batching)
+
+        batches = []
+        post_frames = peer.post_frames
+
+        def count_batches(frames):
+            batches.append(len(frames))
+            return post_frames(frames)
+
+        peer.post_frames = count_batches
+
+        results = [self.t1.post(url2a if x % 2 else url2b, x)
+                   for x in range(1, 11)]
+        results = yield defer.DeferredList(results)
+        self.assertEqual([True] * 10, [x[1] for x in results])
+        self.assertEqual([10], batches)
+        self.assertEqual([(url2a, 0)] +
+                         [(url2a if x % 2 else url2b, x)
+                          for x in range(1, 11)],
+                         self.d2.messages)
+
+        # exceeding the byte budget sends the batch right away
+        self.t1._batch_size = 1
+        del batches[:]
+        yield self.t1.post(url2a, 11)
+        self.assertEqual([1], batches)
+        self.assertFalse(self.t1._batches)
+
+    @defer.inlineCallbacks
+    def testExpirationInBatch(self):
+        self.t1._batch_delay = 5
+        yield self.t1.start_listening()
+        yield self.t2.start_listening()
+
+        url = http.append_location(self.t2.uri, "spam")
+        yield self.t1.post(url, 1)
+
+        d1 = self.t1.post(url, 2, 2)
+        d2 = self.t1.post(url, 3, 20)
+        results = yield defer.DeferredList([d1, d2])
+        self.assertEqual([False, True], [x[1] for x in results])
+        self.assertEqual([(url, 1), (url, 3)], self.d2.messages)
+
+
+class TestFrames(common.TestCase):
+
+    def testParsingFrames(self):
+        body = "5 /spam\n\"abc\"0 /empty\n2 /beans\n{}"
+        self.assertEqual([("/spam", '"abc"'), ("/empty", ""),
+                          ("/beans", "{}")],
+                         tunnel.parse_frames(body))
+        self.assertEqual([], tunnel.parse_frames(""))
+        self.assertRaises(ValueError, tunnel.parse_frames, "5 /spam\n\"a")
+        self.assertRaises(ValueError, tunnel.parse_frames, "5 /spam")
+        self.assertRaises(ValueError, tunnel.parse_frames, "x /spam\n")
+
+    def testNegotiatingBatching(self):
+
+        class Response(object):
+
+            def __init__(self, **headers):
+                self.headers = headers
+
+        t = tunnel.Tunnel(self, range(4000, 4100), DummyDispatcher(),
+                          version=2)
+        peer = tunnel.Peer(t, ("http", "localhost", 4000))
+        server = http.compose_user_agent(tunnel.FEAT_IDENT, 1)
+
+        # servers of the previous versions don't announce it
+        peer._update_peer_version(Response(server=server))
+        self.assertFalse(peer.batching)
+
+        headers = {"server": server,
+                   tunnel.BATCHING_HEADER: tunnel.FRAMES_CONTENT_TYPE}
+        peer._update_peer_version(Response(**headers))
+        self.assertTrue(peer.batching)
+        self.assertEqual(1, peer._target_version)
@@ -24,7 +24,9 @@
 # Headers in this file shall remain intact.
 import os
 import tempfile
+import time
 import types
+import zlib
 
 from feat.test import common
 
@@ -1088,6 +1090,146 @@ class TestWebServer(common.TestCase):
         self.assertIn('Fields: %s' % (format, ), content)
 
 
+class CachedResource(DummyResource):
+
+    implements(webserver.ICachedWebResource)
+
+    def __init__(self, etag, **kwargs):
+        DummyResource.__init__(self, **kwargs)
+        self.etag = etag
+        self.rendered = 0
+
+    def get_etag(self, request, location):
+        return self.etag
+
+    def do_render_resource(self, request, response, location):
+        self.rendered += 1
+        return DummyResource.do_render_resource(self, request,
+                                                response, location)
+
+
+class TestCompression(common.TestCase):
+
+    def setUp(self):
+        common.TestCase.setUp(self)
+        self.big = "compressible " * 200
+        root = DummyResource(render_content="ROOT", error_content="ERROR")
+        root["big"] = DummyResource(render_content=self.big)
+        root["small"] = DummyResource(render_content="SMALL")
+        self.cached = CachedResource("1234", render_content=self.big)
+        root["cached"] = self.cached
+        self.unknown = CachedResource(None, render_content="UNKNOWN")
+        root["unknown"] = self.unknown
+
+        self.server = webserver.Server(0, root)
+        self.server._scheme = http.Schemes.HTTP
+        self.server.enable_mime_type(TEXT_PLAIN)
+
+    def request(self, uri, method="GET", **headers):
+        request = DummyPrivateRequest(uri)
+        request.method = method
+        request.request_headers.update(headers)
+        result = self.server._process_request(request)
+        self.assertEqual(result, NOT_DONE_YET)
+        return request.notifyFinish()
+
+    @defer.inlineCallbacks
+    def testCompression(self):
+        request = yield self.request("/big")
+        self.assertEqual(request.content.getvalue(), self.big)
+        self.assertFalse("content-encoding" in request.response_headers)
+        self.assertEqual(request.response_headers["vary"], "accept-encoding")
+
+        request = yield self.request("/big", **{"accept-encoding": "gzip"})
+        self.assertEqual(request.response_headers["content-encoding"], "gzip")
+        data = request.content.getvalue()
+        self.assertTrue(len(data) < len(self.big) / 10)
+        self.assertEqual(zlib.decompress(data, 16 + zlib.MAX_WBITS), self.big)
+
+        request = yield self.request("/big", **{"accept-encoding":
+                                                "gzip;q=0, deflate"})
+        self.assertEqual(request.response_headers["content-encoding"],
+                         "deflate")
+        self.assertEqual(zlib.decompress(request.content.getvalue()),
+                         self.big)
+
+        request = yield self.request("/big", **{"accept-encoding":
+                                                "*;q=0, identity"})
+        self.assertFalse("content-encoding" in request.response_headers)
+        self.assertEqual(request.content.getvalue(), self.big)
+
+        # not worth it
+        request = yield self.request("/small", **{"accept-encoding": "gzip"})
+        self.assertFalse("content-encoding" in request.response_headers)
+        self.assertEqual(request.content.getvalue(), "SMALL")
+
+        self.server.enable_compression = False
+        request = yield self.request("/big", **{"accept-encoding": "gzip"})
+        self.assertFalse("content-encoding" in request.response_headers)
+        self.assertEqual(request.content.getvalue(), self.big)
+
+    @defer.inlineCallbacks
+    def testConditionalGet(self):
+        request = yield self.request("/cached")
+        self.assertEqual(request.code, http.Status.OK)
+        self.assertEqual(request.content.getvalue(), self.big)
+        self.assertEqual(request.response_headers["etag"], 'W/"1234"')
+        self.assertEqual(self.cached.rendered, 1)
+
+        request = yield self.request("/cached",
+                                     **{"if-none-match": 'W/"1234"'})
+        self.assertEqual(request.code, http.Status.NOT_MODIFIED)
+        self.assertEqual(request.content.getvalue(), "")
+        self.assertEqual(request.response_headers["etag"], 'W/"1234"')
+        self.assertEqual(self.cached.rendered, 1)
+
+        request = yield self.request("/cached", method="HEAD",
+                                     **{"if-none-match": '"1", "1234"'})
+        self.assertEqual(request.code, http.Status.NOT_MODIFIED)
+        self.assertEqual(self.cached.rendered, 1)
+
+        self.cached.etag = "5678"
+        request = yield self.request("/cached",
+                                     **{"if-none-match": 'W/"1234"'})
+        self.assertEqual(request.code, http.Status.OK)
+        self.assertEqual(request.content.getvalue(), self.big)
+        self.assertEqual(request.response_headers["etag"], 'W/"5678"')
+        self.assertEqual(self.cached.rendered, 2)
+
+        request = yield self.request("/unknown", **{"if-none-match": '*'})
+        self.assertEqual(request.code, http.Status.OK)
+        self.assertEqual(request.content.getvalue(), "UNKNOWN")
+        self.assertFalse("etag" in request.response_headers)
+        self.assertEqual(self.unknown.rendered, 1)
+
+    @common.benchmark
+    @defer.inlineCallbacks
+    def testCompressionBenchmark(self):
+
+        @defer.inlineCallbacks
+        def run(label, **headers):
+            size = 0
+            rendered = self.cached.rendered
+            start = time.clock()
+            for _ in range(1000):
+                request = yield self.request("/cached", **headers)
+                size += len(request.content.getvalue())
+            cpu = (time.clock() - start) / 1000 * 1000000
+            rendered = self.cached.rendered - rendered
+            self.info("%s: %d bytes, %.1f us of CPU per request, %d renders",
+                      label, size / 1000, cpu, rendered)
+            defer.returnValue((size, rendered))
+
+        identity, _ = yield run("Identity")
+        gzipped, _ = yield run("Gzip", **{"accept-encoding": "gzip"})
+        self.assertTrue(gzipped < identity)
+        not_modified, rendered = yield run(
+            "Not modified",
+            **{"accept-encoding": "gzip", "if-none-match": '"1234"'})
+        self.assertTrue(not_modified < gzipped)
+        self.assertEqual(0, rendered)
+
+
 def _write_upper(doc, obj):
     doc.write(obj.value.upper())
 
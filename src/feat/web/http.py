@@ -801,6 +801,14 @@ def parse_accepted_language(value):
     return type, priority
 
 
+def parse_accepted_coding(value):
+    type, params = _split_http_definition(value)
+    if type:
+        type = type.lower()
+    priority = float(params.get("q", DEFAULT_PRIORITY))
+    return type, priority
+
+
 def parse_accepted_types(value):
     if not value:
         return {}
@@ -819,6 +827,26 @@ def parse_accepted_languages(value):
     return dict([parse_accepted_language(p) for p in value.split(',')])
 
 
+def parse_accepted_codings(value):
+    if not value:
+        return {}
+    return dict([parse_accepted_coding(p) for p in value.split(',')])
+
+
+def parse_entity_tags(value):
+    """Parses If-Match or If-None-Match header value to a list of
+    entity tags without the weakness indicator, "*" is kept as is."""
+    if not value:
+        return []
+    tags = []
+    for tag in value.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        tags.append(tag.strip('"'))
+    return tags
+
+
 def compose_user_agent(name, version=None):
     if version is None:
         return name
@@ -1,3 +1,6 @@
+import math
+from collections import deque
+
 from zope.interface import Interface, Attribute, implements
 
 from twisted.internet import reactor as treactor, error as terror
@@ -5,7 +8,7 @@ from twisted.internet.protocol import ClientFactory, Protocol
 from twisted.internet.interfaces import ISSLTransport
 from twisted.python import failure
 
-from feat.common import defer, error, log, time, first
+from feat.common import defer, error, log, time, enum
 from feat.web import http, security
 
 
@@ -260,6 +263,14 @@ class Protocol(http.BaseProtocol):
         assert self._response is not None, "No response information"
         self._response.headers[name] = value
 
+    def process_body_start(self):
+        # the responses to HEAD requests and the 204 and 304 responses
+        # have no body whatever their headers say
+        if (self._response.request_params['method'] == 'HEAD' or
+            self._response.status in (http.Status.NO_CONTENT,
+                                      http.Status.NOT_MODIFIED)):
+            self._no_content_follows = True
+
     def process_body_data(self, data):
         assert self._response is not None, "No response information"
         self._response.dataReceived(data)
@@ -568,39 +579,324 @@ def cancel_connector(d):
         d.errback(defer.CancelledError(msg))
 
 
+class LatencyHistogram(object):
+    '''
+    I count durations in buckets growing exponentially, every power of two
+    is split in eight linear sub-buckets so the percentiles I give are
+    precise up to 12.5%. Recording a duration doesn't allocate anything.
+    '''
+
+    # Durations are counted in microseconds, the last bucket takes
+    # everything longer than 2^31 microseconds (~36 minutes).
+    resolution = 1e-6
+    buckets = 240
+
+    def __init__(self):
+        self._counts = [0] * self.buckets
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, duration):
+        self.count += 1
+        self.total += duration
+        if duration > self.max:
+            self.max = duration
+        self._counts[self._index(duration)] += 1
+
+    def get_mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def get_percentile(self, fraction):
+        '''
+        Gives the upper bound of the bucket holding the duration
+        below which the given fraction (0.0 - 1.0) of durations are.
+        '''
+        if not self.count:
+            return 0.0
+        rank = max(1, int(math.ceil(self.count * fraction)))
+        seen = 0
+        for index, count in enumerate(self._counts):
+            seen += count
+            if seen >= rank:
+                return min(self._upper_bound(index), self.max)
+        return self.max
+
+    def get_stats(self):
+        return dict(count=self.count, mean=self.get_mean(),
+                    p50=self.get_percentile(0.5),
+                    p90=self.get_percentile(0.9),
+                    p99=self.get_percentile(0.99),
+                    max=self.max)
+
+    ### private ###
+
+    def _index(self, duration):
+        value = int(duration / self.resolution)
+        if value < 16:
+            return max(value, 0)
+        shift = value.bit_length() - 4
+        return min(8 * shift + (value >> shift), self.buckets - 1)
+
+    def _upper_bound(self, index):
+        if index < 16:
+            return (index + 1) * self.resolution
+        shift, sub = divmod(index, 8)
+        return ((sub + 9) << (shift - 1)) * self.resolution
+
+
+class EndpointStatistics(object):
+    '''
+    Latencies of the requests done with one method on one path template.
+    The wait time is spent waiting for a connection from the pool,
+    the connect time is spent establishing the connection if the request
+    had to wait for a new one, the response time is the rest.
+    '''
+
+    def __init__(self, method, template):
+        self.method = method
+        self.template = template
+        self.name = "%s %s" % (method.name, template)
+        self.wait = LatencyHistogram()
+        self.connect = LatencyHistogram()
+        self.response = LatencyHistogram()
+        self.failures = 0
+
+    def get_stats(self):
+        return dict(failures=self.failures,
+                    wait=self.wait.get_stats(),
+                    connect=self.connect.get_stats(),
+                    response=self.response.get_stats())
+
+
+class PoolStatistics(object):
+    '''
+    Counters and latency histograms of a L{ConnectionPool}. The last
+    requests are kept in a ring of preallocated slots, so the memory
+    used doesn't grow with the number of requests.
+    '''
+
+    counters = ('requests', 'pipelined', 'retries', 'failures',
+                'connections_made', 'connections_lost', 'connections_failed')
+
+    # Requests on more endpoints than that are counted together
+    max_endpoints = 100
+    other_template = "(other)"
+    recent_size = 64
+
+    def __init__(self):
+        self.requests = 0
+        self.pipelined = 0
+        self.retries = 0
+        self.failures = 0
+        self.connections_made = 0
+        self.connections_lost = 0
+        self.connections_failed = 0
+        self.connect = LatencyHistogram()
+
+        # (method, template) -> EndpointStatistics
+        self._endpoints = dict()
+        # slots of [name, wait, connect, response, status]
+        self._recent = [[None, 0.0, 0.0, 0.0, None]
+                        for _ in xrange(self.recent_size)]
+        self._recent_index = 0
+
+    def get_endpoint(self, method, template):
+        endpoint = self._endpoints.get((method, template))
+        if endpoint is not None:
+            return endpoint
+        if len(self._endpoints) >= self.max_endpoints:
+            template = self.other_template
+            endpoint = self._endpoints.get((method, template))
+            if endpoint is not None:
+                return endpoint
+        endpoint = EndpointStatistics(method, template)
+        self._endpoints[(method, template)] = endpoint
+        return endpoint
+
+    def iter_endpoints(self):
+        return self._endpoints.itervalues()
+
+    def request_done(self, endpoint, wait, connect, response, status):
+        '''Records a finished request, status is None if it failed.'''
+        endpoint.wait.add(wait)
+        if connect:
+            endpoint.connect.add(connect)
+        endpoint.response.add(response)
+        if status is None:
+            endpoint.failures += 1
+            self.failures += 1
+
+        slot = self._recent[self._recent_index]
+        slot[0] = endpoint.name
+        slot[1] = wait
+        slot[2] = connect
+        slot[3] = response
+        slot[4] = status
+        self._recent_index = (self._recent_index + 1) % self.recent_size
+
+    def iter_recent(self):
+        '''Iterates over the last requests, the most recent first.'''
+        for offset in xrange(1, self.recent_size + 1):
+            slot = self._recent[(self._recent_index - offset) %
+                                self.recent_size]
+            if slot[0] is None:
+                break
+            yield tuple(slot)
+
+    def get_stats(self):
+        stats = dict((name, getattr(self, name)) for name in self.counters)
+        stats.update(connect=self.connect.get_stats(),
+                     endpoints=dict((x.name, x.get_stats())
+                                    for x in self.iter_endpoints()))
+        return stats
+
+    def get_stat(self, name):
+        '''
+        Gives one value of L{get_stats}. The statistics of the histograms
+        are computed only if they are asked for.
+        '''
+        if name in self.counters:
+            return getattr(self, name)
+        if name == 'connect':
+            return self.connect.get_stats()
+        if name == 'endpoints':
+            return dict((x.name, x.get_stats())
+                        for x in self.iter_endpoints())
+        raise KeyError(name)
+
+
+class RequestPriority(enum.Enum):
+    '''
+    high - requests which should be sent as soon as possible
+    normal - the default
+    low - long running requests, nothing gets pipelined behind them
+    '''
+
+    high, normal, low = range(3)
+
+
+class RequestQueue(object):
+    '''
+    I keep the requests waiting for a connection, each priority in its
+    own deque. The priorities are served in weighted round robin, so
+    the requests of low priority are delayed but not starved.
+    '''
+
+    weights = {RequestPriority.high: 4,
+               RequestPriority.normal: 2,
+               RequestPriority.low: 1}
+
+    def __init__(self):
+        self._priorities = sorted(RequestPriority)
+        self._queues = dict((x, deque()) for x in self._priorities)
+        self._credits = dict(self.weights)
+
+    def __len__(self):
+        return sum(len(x) for x in self._queues.itervalues())
+
+    def __iter__(self):
+        for priority in self._priorities:
+            for d in self._queues[priority]:
+                yield d
+
+    def append(self, d, priority=RequestPriority.normal):
+        self._queues[priority].append(d)
+
+    def pop(self):
+        '''
+        Gives the next waiting Deferred skipping the cancelled ones,
+        raises IndexError if the queue is empty.
+        '''
+        while True:
+            d = self._pop()
+            if not d.called:
+                return d
+
+    def clear(self):
+        for queue in self._queues.itervalues():
+            queue.clear()
+
+    ### private ###
+
+    def _pop(self):
+        for refill in (False, True):
+            if refill:
+                self._credits.update(self.weights)
+            for priority in self._priorities:
+                queue = self._queues[priority]
+                if queue and self._credits[priority] > 0:
+                    self._credits[priority] -= 1
+                    return queue.popleft()
+        raise IndexError("pop from an empty queue")
+
+
 class PoolProtocol(Protocol):
 
     def __init__(self, *args, **kwargs):
         super(PoolProtocol, self).__init__(*args, **kwargs)
         self.in_pool = False
         self.can_pipeline = None
+        # time it took to establish the connection and
+        # whether a request has been already sent through it
+        self.connect_time = 0.0
+        self.used = False
+        # number of requests of low priority being handled
+        self.slow_requests = 0
+
+    def get_depth(self):
+        '''Gives the number of requests waiting for the response.'''
+        return len(self._requests or ())
 
 
 class PoolFactory(Factory):
 
     protocol = PoolProtocol
 
+    def __init__(self, log_keeper, owner, deferred):
+        Factory.__init__(self, log_keeper, owner, deferred)
+        self.started_epoch = time.time()
+
 
 class ConnectionPool(Connection):
     '''
     I establish and keep a number of persitent connections to a web service
     speaking HTTT 1.1 protocol.
+
+    The number of connections is kept between the minimum and the maximum
+    given. It grows when the requests spend too much time waiting for
+    a connection, compared to the time they take to be handled, and it
+    shrinks when they don't wait at all.
     '''
 
     factory = PoolFactory
 
+    # Requests pipelined on the same connection
+    max_pipeline_depth = 4
+    # Number of requests after which the size of the pool is adjusted
+    adjust_window = 20
+    # Part of the time of requests spent waiting to grow or shrink the pool
+    grow_wait_ratio = 0.5
+    shrink_wait_ratio = 0.05
+
     def __init__(self, host, port=None, protocol=None,
                  security_policy=None, logger=None,
                  maximum_connections=10, enable_pipelineing=True,
-                 response_timeout=None):
+                 response_timeout=None, minimum_connections=None):
 
         Connection.__init__(self, host, port, protocol,
                             security_policy, logger)
         self._connected = set()
         self._idle = set()
-        # [Deferred] to be triggered when the protocol connection becomes free
-        self._awaiting_client = list()
+        # Deferreds to be triggered when the protocol connection becomes free
+        self._awaiting_client = RequestQueue()
         self._max = maximum_connections
+        self._min = min(minimum_connections or maximum_connections,
+                        maximum_connections)
+        # current number of connections the pool can open
+        self._limit = self._min
+        # [requests, time waiting, time handling] since the last adjustment
+        self._window = [0, 0.0, 0.0]
         self._connecting = 0
         self._enable_pipelineing = enable_pipelineing
 
@@ -611,6 +907,8 @@ class ConnectionPool(Connection):
         # expecting all the requests to be cancelled
         self._disconnecting = False
 
+        self.statistics = PoolStatistics()
+
     ### public ###
 
     def is_idle(self):
@@ -619,15 +917,47 @@ class ConnectionPool(Connection):
     def disconnect(self):
         self._disconnecting = True
         [x.cancel() for x in self._awaiting_client]
-        [x.transport.loseConnection() for x in self._connected]
+        [x.transport.loseConnection() for x in list(self._connected)]
 
     def enable_pipelineing(self, value):
         self._enable_pipelineing = value
 
+    def get_stats(self):
+        stats = self.statistics.get_stats()
+        stats.update(self._get_gauges())
+        return stats
+
+    def get_stat(self, name):
+        '''
+        Gives one value of L{get_stats}, without computing the statistics
+        of the latency histograms unless they are asked for.
+        '''
+        gauges = self._get_gauges()
+        if name in gauges:
+            return gauges[name]
+        return self.statistics.get_stat(name)
+
+    def get_path_template(self, location):
+        '''
+        Gives the path the latency of requests to the location is
+        accounted under. Override it to group paths containing
+        identifiers, by default only the query string is dropped.
+        '''
+        return location.split('?', 1)[0]
+
+    def get_priority(self, method, location):
+        '''
+        Gives the priority of the request which didn't specify it.
+        Override it to schedule the requests by location.
+        '''
+        return RequestPriority.normal
+
     def request(self, method, location, headers=None, body=None, decoder=None,
                 outside_of_the_pool=False, dont_pipeline=False,
-                reset_retry=1):
+                reset_retry=1, priority=None):
         started = time.time()
+        if priority is None:
+            priority = self.get_priority(method, location)
         self.debug('%s-ing on %s', method.name, location)
         self.log('Headers: %r', headers)
         self.log('Body: %r', body)
@@ -639,6 +969,7 @@ class ConnectionPool(Connection):
         # post requests are not idempotent and should not be pipelined
         can_pipeline = (not dont_pipeline and method != http.Methods.POST and
                         reset_retry == 1)
+        self.statistics.requests += 1
         if self._idle and reset_retry == 1:
             self.log("Reusing existing idle connection.")
             protocol = self._idle.pop()
@@ -646,36 +977,36 @@ class ConnectionPool(Connection):
         else:
             protocol = None
             if can_pipeline:
-                protocol = first(x for x in self._connected
-                                 if x.can_pipeline and x.in_pool)
+                protocol = self._get_pipeline_protocol(priority)
             if protocol:
                 self.log("The request will be pipelined.")
+                self.statistics.pipelined += 1
                 d = defer.succeed(protocol)
             else:
                 self.log("The request will be handled when a connection"
                          " returns to a pool.")
                 d = defer.Deferred()
-                self._awaiting_client.append(d)
+                self._awaiting_client.append(d, priority)
 
             # Regardless if we have pipeline this request or not, check if
             # we can have more connections, so that the next request can be
             # handeled by it.
-            if self._pool_len() < self._max:
+            if self._pool_len() < self._limit:
                 self.log("Initializing new connection.")
                 self._connecting += 1
                 self._connect()
         d.addCallback(self._request, method, location, headers, body, decoder,
-                      outside_of_the_pool, can_pipeline)
+                      outside_of_the_pool, can_pipeline, started, priority)
         d.addErrback(self._handle_connection_reset, method, location,
                      headers, body, decoder, outside_of_the_pool,
-                     dont_pipeline, reset_retry)
+                     dont_pipeline, reset_retry, priority)
         d.addBoth(defer.keep_param, self._log_request_result,
                   method, location, started)
         return d
 
     def _handle_connection_reset(self, fail, method, location,
                      headers, body, decoder, outside_of_the_pool,
-                     dont_pipeline, reset_retry):
+                     dont_pipeline, reset_retry, priority):
         fail.trap(ConnectionReset)
         # don't retry more than 3 times or if we are disconnecting
         if reset_retry > 3 or self._disconnecting:
@@ -683,22 +1014,28 @@ class ConnectionPool(Connection):
         self.warning("The request will be retrying, because the underlying"
                      " connection was closed before the response was received."
                      " This is retry no %s.", reset_retry)
+        self.statistics.retries += 1
         return self.request(method, location,
                             headers, body, decoder, outside_of_the_pool,
-                            dont_pipeline, reset_retry + 1)
+                            dont_pipeline, reset_retry + 1, priority)
 
     def onClientConnectionFailed(self, reason):
         if self._disconnecting:
             return
         self._connecting -= 1
+        self.statistics.connections_failed += 1
         self.info("Failed connecting to %s:%s. Reason: %s",
                   self._host, self._port, reason)
         for d in self._awaiting_client:
-            d.errback(reason)
-        del self._awaiting_client[:]
+            if not d.called:
+                d.errback(reason)
+        self._awaiting_client.clear()
 
     def onClientConnectionMade(self, protocol):
         self._connecting -= 1
+        protocol.connect_time = time.time() - protocol.factory.started_epoch
+        self.statistics.connections_made += 1
+        self.statistics.connect.add(protocol.connect_time)
         self._connected.add(protocol)
         self._return_to_the_pool(protocol)
         self.debug("Connection made to %s:%s, pool has now %d connections "
@@ -708,6 +1045,7 @@ class ConnectionPool(Connection):
     def onClientConnectionLost(self, protocol, reason):
         if protocol in self._connected:
             self._connected.remove(protocol)
+            self.statistics.connections_lost += 1
         if protocol in self._idle:
             self._idle.remove(protocol)
         pool_len = self._pool_len()
@@ -717,7 +1055,7 @@ class ConnectionPool(Connection):
                    len(self._idle),
                    len(self._connected) - pool_len + self._connecting)
 
-        possible_to_run = self._max - self._pool_len()
+        possible_to_run = self._limit - self._pool_len()
         if (self._awaiting_client and possible_to_run > 0):
             to_spawn = min([len(self._awaiting_client), possible_to_run])
             self.debug("Establishing %d extra connections to handle pending"
@@ -733,6 +1071,13 @@ class ConnectionPool(Connection):
         return (len([x for x in self._connected if x.in_pool]) +
                 self._connecting)
 
+    def _get_gauges(self):
+        return dict(idle=len(self._idle), connected=len(self._connected),
+                    awaiting=len(self._awaiting_client),
+                    connecting=self._connecting, pending=self._pending,
+                    maximum_connections=self._max,
+                    minimum_connections=self._min, limit=self._limit)
+
     def _connect(self):
         d = Connection._connect(self)
         # supress errors returned by _connect() method. They are handled by
@@ -740,16 +1085,92 @@ class ConnectionPool(Connection):
         d.addErrback(defer.override_result, None)
         return d
 
+    def _get_pipeline_protocol(self, priority):
+        # the least loaded connection not handling a long request
+        best = None
+        for protocol in self._connected:
+            if not (protocol.can_pipeline and protocol.in_pool):
+                continue
+            if protocol.slow_requests and priority != RequestPriority.low:
+                continue
+            depth = protocol.get_depth()
+            if depth >= self.max_pipeline_depth:
+                continue
+            if best is None or depth < best.get_depth():
+                best = protocol
+        return best
+
+    def _adjust_limit(self, wait, handling):
+        window = self._window
+        window[0] += 1
+        window[1] += wait
+        window[2] += handling
+        if window[0] < self.adjust_window:
+            return
+        requests, wait, handling = window
+        window[:] = [0, 0.0, 0.0]
+        if wait > handling * self.grow_wait_ratio and self._limit < self._max:
+            self._limit += 1
+            self.debug("Requests spent %.3fs waiting for a connection, "
+                       "the pool can now have %d connections",
+                       wait / requests, self._limit)
+        elif (wait <= handling * self.shrink_wait_ratio and
+              self._limit > self._min):
+            self._limit -= 1
+            self.debug("Requests don't wait for connections, the pool "
+                       "can now have %d connections", self._limit)
+            if self._idle and len(self._connected) > self._limit:
+                protocol = self._idle.pop()
+                protocol.transport.loseConnection()
+
     def _request(self, protocol, method, location, headers, body, decoder,
-                 outside_of_the_pool, can_pipeline):
+                 outside_of_the_pool, can_pipeline, started, priority):
+        acquired = time.time()
+        wait = acquired - started
+        connect = 0.0
+        if not protocol.used:
+            # the request was waiting for this connection to be made
+            protocol.used = True
+            connect = min(protocol.connect_time, wait)
+            wait -= connect
+        endpoint = self.statistics.get_endpoint(
+            method, self.get_path_template(location))
+
         protocol.in_pool = not outside_of_the_pool
         protocol.can_pipeline = can_pipeline
-        return Connection._request(self, protocol, method, location, headers,
-                                   body, decoder)
+        slow = priority == RequestPriority.low
+        if slow:
+            protocol.slow_requests += 1
+        d = Connection._request(self, protocol, method, location, headers,
+                                body, decoder)
+        d.addBoth(defer.keep_param, self._request_finished, protocol, slow,
+                  endpoint, wait, connect, acquired)
+        return d
+
+    def _request_finished(self, result, protocol, slow,
+                          endpoint, wait, connect, acquired):
+        if slow:
+            protocol.slow_requests -= 1
+        if isinstance(result, failure.Failure):
+            status = None
+        else:
+            status = getattr(result, 'status', None)
+            status = int(status) if status is not None else 0
+        handling = time.time() - acquired
+        self.statistics.request_done(endpoint, wait, connect,
+                                     handling, status)
+        if not protocol.in_pool:
+            # requests outside of the pool (like long polls) don't
+            # tell anything about the number of connections needed
+            return
+        self._adjust_limit(wait + connect, handling)
 
     def _return_to_the_pool(self, protocol):
         try:
-            d = self._awaiting_client.pop(0)
+            d = self._awaiting_client.pop()
             d.callback(protocol)
         except IndexError:
+            # nobody waited for the connection, the next
+            # request doesn't get its connect time accounted
+            protocol.used = True
             self._idle.add(protocol)
@@ -34,6 +34,14 @@ DEFAULT_RESPONSE_TIMEOUT = 5*60+1
 
 FEAT_IDENT = "FeatTunnel"
 
+# Messages posted in a single request are framed in a body of this type.
+# Each frame is a "LENGTH LOCATION\n" line followed by LENGTH bytes of
+# the serialized message. Servers supporting it announce it with the
+# batching header in the response to the HEAD request.
+FRAMES_CONTENT_TYPE = "application/x-feat-frames"
+BATCHING_HEADER = "x-feat-batching"
+DEFAULT_BATCH_SIZE = 64 * 1024
+
 
 class TunnelError(error.FeatError):
     pass
@@ -64,7 +72,15 @@ class Tunnel(base.RangeServer):
     def __init__(self, log_keeper, port_range, dispatcher,
                  public_host=None, version=None, registry=None,
                  server_security_policy=None,
-                 client_security_policy=None, max_delay=None):
+                 client_security_policy=None, max_delay=None,
+                 batch_delay=None, batch_size=DEFAULT_BATCH_SIZE):
+        """
+        @param batch_delay: enables batching of the messages to the peers
+                            supporting it, messages posted to a peer in this
+                            number of seconds are sent in a single request.
+        @param batch_size: number of bytes of serialized messages after
+                           which the batch is sent without waiting.
+        """
         base.RangeServer.__init__(self, port_range,
                                   hostname=public_host,
                                   security_policy=server_security_policy,
@@ -86,8 +102,14 @@ class Tunnel(base.RangeServer):
         self._quarantined = set([]) # set([PEER_KEY])
         self._pendings = {} # {PEER_KEY: [(DEFERRED, PATH, DATA, EXPIRATION)]}
         self._peers = {} # {KEY: Peer}
+        # {PEER_KEY: [(DEFERRED, PATH, DATA, EXPIRATION, FRAME)]}
+        self._batches = {}
+        self._batch_sizes = {} # {PEER_KEY: SIZE}
+        self._batch_calls = {} # {PEER_KEY: IDelayedCall}
 
         self._max_delay = max_delay or type(self).max_delay
+        self._batch_delay = batch_delay
+        self._batch_size = batch_size
 
     @property
     def version(self):
@@ -102,6 +124,8 @@ class Tunnel(base.RangeServer):
             return False
         if self._pendings:
             return False
+        if self._batches:
+            return False
         if self.factory is not None and not self.factory.is_idle():
             return False
         for peer in self._peers.itervalues():
@@ -135,6 +159,7 @@ class Tunnel(base.RangeServer):
 
     def disconnect(self):
         self._cancel_retries()
+        self._cancel_batches()
         for peer in self._peers.values():
             peer.disconnect()
         base.RangeServer.disconnect(self)
@@ -164,6 +189,7 @@ class Tunnel(base.RangeServer):
 
     def _remove_peer(self, key):
         del self._peers[key]
+        self._requeue_batch(key)
         if key in self._pendings:
             self._schedule_retry(key)
 
@@ -210,7 +236,13 @@ class Tunnel(base.RangeServer):
             deferred.callback(False)
             return
 
-        d = self._peers[key].post(location, data)
+        peer = self._peers[key]
+        if self._batch_delay is not None and peer.batching:
+            self._add_to_batch(key, peer, location, data, expiration,
+                               deferred)
+            return
+
+        d = peer.post(location, data)
         args = (key, location, data, expiration, deferred)
         d.addCallbacks(self._post_succeed, self._post_failed,
                        callbackArgs=args, errbackArgs=args)
@@ -226,6 +258,72 @@ class Tunnel(base.RangeServer):
         self._quarantined.add(key)
         self._schedule_retry(key)
 
+    def _add_to_batch(self, key, peer, location, data, expiration, d):
+        frame = peer.serialize_frame(location, data)
+        if key not in self._batches:
+            self._batches[key] = []
+            self._batch_sizes[key] = 0
+            self._batch_calls[key] = time.call_later(self._batch_delay,
+                                                     self._post_batch, key)
+        self._batches[key].append((d, location, data, expiration, frame))
+        self._batch_sizes[key] += len(frame)
+        if self._batch_sizes[key] >= self._batch_size:
+            self._post_batch(key)
+
+    def _pop_batch(self, key):
+        callid = self._batch_calls.pop(key, None)
+        if callid is not None and callid.active():
+            callid.cancel()
+        self._batch_sizes.pop(key, None)
+        return self._batches.pop(key, [])
+
+    def _post_batch(self, key):
+        now = time.time()
+        batch = []
+        for record in self._pop_batch(key):
+            d, _loc, _data, exp, _frame = record
+            if exp and exp <= now:
+                d.callback(False)
+            else:
+                batch.append(record)
+        if not batch:
+            return
+
+        if key not in self._peers:
+            self._batch_failed(None, key, batch)
+            return
+
+        self.log("Posting %d messages to %s in one request",
+                 len(batch), self._key2url(key))
+        d = self._peers[key].post_frames([r[4] for r in batch])
+        args = (key, batch)
+        d.addCallbacks(self._batch_succeed, self._batch_failed,
+                       callbackArgs=args, errbackArgs=args)
+        return d
+
+    def _batch_succeed(self, response, key, batch):
+        for d, _loc, _data, _exp, _frame in batch:
+            d.callback(True)
+
+    def _batch_failed(self, failure, key, batch):
+        self.debug("failed to post %d messages to %s, putting them "
+                   "in quarantine", len(batch), self._key2url(key))
+        for d, loc, data, exp, _frame in batch:
+            self._add_pending(key, loc, data, exp, d)
+        self._quarantined.add(key)
+        self._schedule_retry(key)
+
+    def _requeue_batch(self, key):
+        # The messages waiting for the batch are posted again, when
+        # the connection to the peer is established.
+        for d, loc, data, exp, _frame in self._pop_batch(key):
+            self._add_pending(key, loc, data, exp, d)
+
+    def _cancel_batches(self):
+        for key in self._batches.keys():
+            for d, _loc, _data, _exp, _frame in self._pop_batch(key):
+                d.callback(False)
+
     def _cleanup_expired(self, key, now=None):
         now = now if now is not None else time.time()
         not_expired = []
@@ -326,6 +424,7 @@ class Peer(httpclient.Connection):
         self._key = key
         self._peer_version = None
         self._target_version = None
+        self._batching = False
         self._headers = {}
 
         self._headers["host"] = "%s:%d" % (host, port)
@@ -335,6 +434,10 @@ class Peer(httpclient.Connection):
 
     ### public ###
 
+    @property
+    def batching(self):
+        return self._batching
+
     def head(self, location):
         d = self.request(http.Methods.HEAD, location, headers=self._headers)
         d.addCallback(self._update_peer_version)
@@ -344,6 +447,15 @@ class Peer(httpclient.Connection):
         body = self._serialize(data)
         return self.request(http.Methods.POST, location, self._headers, body)
 
+    def serialize_frame(self, location, data):
+        payload = self._serialize(data)
+        return "%d %s\n%s" % (len(payload), location, payload)
+
+    def post_frames(self, frames):
+        headers = dict(self._headers)
+        headers["content-type"] = FRAMES_CONTENT_TYPE
+        return self.request(http.Methods.POST, "/", headers, "".join(frames))
+
     ### overridden ###
 
     def onClientConnectionFailed(self, reason):
@@ -374,6 +486,8 @@ class Peer(httpclient.Connection):
         vout = vser if vser is not None and vser < vin else vin
         self._peer_version = vser
         self._target_version = vout
+        self._batching = (response.headers.get(BATCHING_HEADER) ==
+                          FRAMES_CONTENT_TYPE)
 
         self._headers["user-agent"] = http.compose_user_agent(FEAT_IDENT, vout)
 
@@ -403,7 +517,7 @@ class Request(httpserver.Request):
         vout = self.channel.owner._version
 
         ctype = self.get_received_header("content-type")
-        if ctype != "application/json":
+        if ctype not in ("application/json", FRAMES_CONTENT_TYPE):
             self._error(http.Status.UNSUPPORTED_MEDIA_TYPE,
                         "Message content type not supported, "
                         "only application/json is.")
@@ -427,6 +541,7 @@ class Request(httpserver.Request):
             vin = vcli if vcli is not None and vcli < vout else vout
             server_header = http.compose_user_agent(FEAT_IDENT, vin)
             self.set_header("server", server_header)
+            self.set_header(BATCHING_HEADER, FRAMES_CONTENT_TYPE)
             self.set_length(0)
             self.finish()
             return
@@ -452,16 +567,27 @@ class Request(httpserver.Request):
             unserializer = json.Unserializer(registry=self._registry,
                                              source_ver=vin, target_ver=vout)
             body = "".join(self._buffer)
-            try:
-                data = unserializer.convert(body)
-            except Exception as e:
-                msg = "Error while unserializing tunnel message"
-                error.handle_exception(self, e, msg)
-                self._error(http.Status.BAD_REQUEST,
-                            "Invalid message, unserialization failed.")
-                return
 
-            self.channel.owner._dispatch(uri, data)
+            if ctype == FRAMES_CONTENT_TYPE:
+                try:
+                    frames = parse_frames(body)
+                except ValueError as e:
+                    self._error(http.Status.BAD_REQUEST,
+                                "Invalid message frames: %s" % (e, ))
+                    return
+                self._dispatch_frames(unserializer, frames,
+                                      host, port, scheme)
+            else:
+                try:
+                    data = unserializer.convert(body)
+                except Exception as e:
+                    msg = "Error while unserializing tunnel message"
+                    error.handle_exception(self, e, msg)
+                    self._error(http.Status.BAD_REQUEST,
+                                "Invalid message, unserialization failed.")
+                    return
+
+                self.channel.owner._dispatch(uri, data)
 
             self.set_response_code(http.Status.OK)
             server_header = http.compose_user_agent(FEAT_IDENT, vin)
@@ -475,6 +601,20 @@ class Request(httpserver.Request):
         self.write("Method not allowed, only POST and HEAD.")
         self.finish()
 
+    def _dispatch_frames(self, unserializer, frames, host, port, scheme):
+        # Frames are independent, the failure to unserialize one of them
+        # doesn't prevent delivering the others.
+        for location, payload in frames:
+            uri = http.compose(location, host=host, port=port, scheme=scheme)
+            try:
+                data = unserializer.convert(payload)
+            except Exception as e:
+                msg = ("Error while unserializing tunnel message for %s"
+                       % (uri, ))
+                error.handle_exception(self, e, msg)
+                continue
+            self.channel.owner._dispatch(uri, data)
+
     def _error(self, status, message=None):
         if not self.writing:
             self.clear_headers()
@@ -489,3 +629,23 @@ class Request(httpserver.Request):
 
 class RequestFactory(httpserver.RequestFactory):
     request_class = Request
+
+
+def parse_frames(body):
+    """Splits the body of a batch into a list of (LOCATION, PAYLOAD)."""
+    frames = []
+    pos = 0
+    while pos < len(body):
+        end = body.find("\n", pos)
+        if end < 0:
+            raise ValueError("frame header not terminated")
+        try:
+            length, location = body[pos:end].split(" ", 1)
+            length = int(length)
+        except ValueError:
+            raise ValueError("invalid frame header %r" % (body[pos:end], ))
+        pos = end + 1 + length
+        if pos > len(body):
+            raise ValueError("frame truncated")
+        frames.append((location, body[end + 1:pos]))
+    return frames
@@ -27,6 +27,7 @@ import sys
 import time
 import tempfile
 import types
+import zlib
 
 from zope.interface import Interface, Attribute, implements
 
@@ -132,6 +133,21 @@ class IWebResource(Interface):
         """
 
 
+class ICachedWebResource(Interface):
+    """
+    Resource able to tell if its representation changed without
+    rendering it, GET requests with a matching If-None-Match header
+    are answered with a 304 status and the resource is not rendered.
+    """
+
+    def get_etag(request, location):
+        """
+        Returns an entity tag changing every time the representation
+        the request would get changes, or None if it is not known.
+        Can return a Deferred.
+        """
+
+
 class IWebRequest(Interface):
 
     peer = Attribute("")
@@ -150,6 +166,7 @@ class IWebRequest(Interface):
     accepted_mime_types = Attribute("")
     accepted_encodings = Attribute("")
     accepted_languages = Attribute("")
+    accepted_codings = Attribute("Content codings from Accept-Encoding")
     length = Attribute("")
     context = Attribute("")
     cancelled = Attribute("C{bool} set if the underlying connection was "
@@ -171,6 +188,10 @@ class IWebRequest(Interface):
     def does_accept_language(language):
         """Returns if the request is accepting the specified language."""
 
+    def does_accept_coding(coding):
+        """Returns if the request is accepting the specified
+        content coding, like gzip or deflate."""
+
     def reset():
         """
         Returns to the start of the input data stream.
@@ -691,11 +712,20 @@ class Server(log.LogProxy, log.Logger):
 
     log_category = 'webserver'
 
+    # Content codings in order of preference
+    content_codings = ("gzip", "deflate")
+    compression_level = 6
+    # Smaller responses are not worth compressing
+    compression_min_size = 1024
+    compressible_mime_types = ("text/", "application/json",
+                               "application/xml", "application/javascript",
+                               "application/x-javascript")
+
     def __init__(self, port, root_resource, registry=None,
                  security_policy=None, server_identity=None,
                  default_authenticator=None, default_authorizer=None,
                  log_keeper=None, web_statistics=None,
-                 interface=''):
+                 interface='', enable_compression=True):
         self.log_name = ":%s" % (port, )
         log.Logger.__init__(self, self)
         log_keeper = log_keeper or log.get_default() or log.FluLogKeeper()
@@ -710,6 +740,7 @@ class Server(log.LogProxy, log.Logger):
         self._authorizer = default_authorizer
         self.statistics = web_statistics and IWebStatistics(web_statistics)
         self._interface = interface
+        self.enable_compression = enable_compression
 
         self._scheme = None
         self._mime_types = {}
@@ -1117,6 +1148,32 @@ class Server(log.LogProxy, log.Logger):
         return self._render_resource(request, response, resource, location)
 
     def _render_resource(self, request, response, resource, location):
+        if (request.method in (http.Methods.GET, http.Methods.HEAD)
+            and ICachedWebResource.providedBy(resource)):
+            d = resource.get_etag(request, location)
+            if isinstance(d, defer.Deferred):
+                return d.addCallback(self._got_etag, request, response,
+                                     resource, location)
+            return self._got_etag(d, request, response, resource, location)
+        return self._do_render_resource(request, response,
+                                        resource, location)
+
+    def _got_etag(self, etag, request, response, resource, location):
+        if etag is None:
+            return self._do_render_resource(request, response,
+                                            resource, location)
+        # weak because compressed and identity representations share it
+        response.set_header("etag", 'W/"%s"' % (etag, ))
+        tags = http.parse_entity_tags(request.get_header("if-none-match"))
+        if etag in tags or "*" in tags:
+            self.log("Resource %s not modified for request %s, "
+                     "skipping rendering", resource, request)
+            response.set_status(http.Status.NOT_MODIFIED)
+            return self._terminate(request, response)
+        return self._do_render_resource(request, response,
+                                        resource, location)
+
+    def _do_render_resource(self, request, response, resource, location):
         self.log("Rendering path '%s' for request %s",
                  http.tuple2path(location), request)
         d = resource.render_resource(request, response, location)
@@ -1326,6 +1383,8 @@ class Request(log.Logger, log.LogProxy):
         accepted_encodings = http.parse_accepted_charsets(accept_charset)
         accept_languages = self.get_header("accept-languages")
         accepted_languages = http.parse_accepted_languages(accept_languages)
+        accept_encoding = self.get_header("accept-encoding")
+        accepted_codings = http.parse_accepted_codings(accept_encoding)
 
         try:
             method = http.Methods[self._ref.method]
@@ -1349,6 +1408,7 @@ class Request(log.Logger, log.LogProxy):
         self._accept_tree = accept_tree
         self._accepted_encodings = accepted_encodings
         self._accepted_languages = accepted_languages
+        self._accepted_codings = accepted_codings
         self._method = method
         self._protocol = protocol
         self._credentials = None
@@ -1455,6 +1515,10 @@ class Request(log.Logger, log.LogProxy):
     def accepted_languages(self):
         return self._accepted_languages
 
+    @property
+    def accepted_codings(self):
+        return self._accepted_codings
+
     @property
     def length(self):
         return self._length
@@ -1503,6 +1567,15 @@ class Request(log.Logger, log.LogProxy):
             return True
         return False
 
+    def does_accept_coding(self, coding):
+        priority = self._accepted_codings.get(coding)
+        if priority is None:
+            priority = self._accepted_codings.get("*")
+        if priority is None:
+            # identity is acceptable unless explicitly refused
+            return coding == "identity"
+        return priority > 0
+
     def reset(self):
         self._ref.content.seek(0)
 
@@ -1620,6 +1693,9 @@ class Response(log.Logger):
         self._finished = None
         self._bytes = 0
         self._cancelled = False
+        # None until the first data is sent, then a compressor
+        # object or False if the response is not compressed
+        self._compressor = None
 
     ### IWebResponse ###
 
@@ -1858,7 +1934,7 @@ class Response(log.Logger):
         if self._cache:
             self._cache.write(data)
         else:
-            self._request._ref.write(data)
+            self._send(data)
 
     def writelines(self, sequence):
         self.prepare()
@@ -1867,7 +1943,7 @@ class Response(log.Logger):
         if self._cache is not None:
             self._cache.writelines(lines)
         else:
-            self._request._ref.writelines(lines)
+            self._send("".join(lines))
 
     ### protected ###
 
@@ -1888,6 +1964,7 @@ class Response(log.Logger):
             self._prepared = False
             self._cache = StringIO()
             self._objects = []
+            self._compressor = None
 
     def _finish(self):
         if self._request.cancelled:
@@ -1903,7 +1980,9 @@ class Response(log.Logger):
             if self._cache is not None:
                 data = self._cache.getvalue()
                 self.prepare()
-                self._request._ref.write(self._encode(data))
+                self._send(self._encode(data), last=True)
+            elif self._compressor:
+                self._request._ref.write(self._compressor.flush())
         except http.HTTPError:
             pass
         except Exception, e:
@@ -1991,6 +2070,51 @@ class Response(log.Logger):
         if self._server.identity:
             self._set_header("server", self._server.identity)
 
+    def _send(self, data, last=False):
+        if self._compressor is None:
+            # the size is only known if everything is sent at once
+            size = len(data) if last else None
+            self._compressor = self._create_compressor(size)
+        if self._compressor:
+            data = self._compressor.compress(data)
+            if last:
+                data += self._compressor.flush()
+        self._request._ref.write(data)
+
+    def _create_compressor(self, size):
+        server = self._server
+        if not server.enable_compression:
+            return False
+        mime_type = (self._mime_type or "").lower()
+        if not mime_type.startswith(server.compressible_mime_types):
+            return False
+        headers = self._request._ref.responseHeaders
+        if (headers.hasHeader("content-encoding")
+            or headers.hasHeader("content-length")):
+            return False
+        code = self._request._ref.code
+        if code < 200 or code in (http.Status.NO_CONTENT,
+                                  http.Status.NOT_MODIFIED):
+            return False
+        # caches should not mix the representations
+        self._set_header("vary", "accept-encoding")
+        if size is not None and size < server.compression_min_size:
+            return False
+
+        for coding in server.content_codings:
+            if self._request.does_accept_coding(coding):
+                break
+        else:
+            return False
+
+        self._set_header("content-encoding", coding)
+        if coding == "gzip":
+            wbits = 16 + zlib.MAX_WBITS
+        else:
+            wbits = zlib.MAX_WBITS
+        return zlib.compressobj(server.compression_level,
+                                zlib.DEFLATED, wbits)
+
     def _write_object_succeed(self, result, obj):
         self._objects.append(obj)
         self._writing = False